@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the database layer (bot/db.py).
+
+Runs against a throw-away database in a temp directory, never against bot.db.
+
+    python bench_db.py pool [updates]   # connect-per-query vs pooled connections
+    python bench_db.py latency          # event-loop stalls during a long query, sync vs async API
+    python bench_db.py expiry [orders]  # near-expiry scan: computed expiry vs indexed orders.expires_at
+    python bench_db.py rows [users]     # dict rows vs query_rows / query_column / query_map / query_scalar
+"""
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_tmpdir = tempfile.mkdtemp()
+os.environ["DB_NAME"] = os.path.join(_tmpdir, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bot import db  # noqa: E402
+from bot.config import DB_NAME  # noqa: E402
+
+
+def _legacy_query_db(query, args=(), one=False):
+    # The pre-pool implementation: a fresh connection per call
+    with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(query, args).fetchall()
+        if one:
+            return dict(rows[0]) if rows else None
+        return [dict(r) for r in rows]
+
+
+def _seed(users: int = 5000):
+    db.db_setup()
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, first_name, join_date) VALUES (?, ?, '2025-01-01 00:00:00')",
+            [(i, f"u{i}") for i in range(1, users + 1)],
+        )
+
+
+async def _update(query_fn, user_id: int):
+    # Roughly what a /start or my_services click issues today
+    query_fn("SELECT value FROM settings WHERE key='bot_active'", one=True)
+    query_fn("SELECT user_id FROM admins WHERE user_id = ?", (user_id,), one=True)
+    query_fn("SELECT banned FROM users WHERE user_id = ?", (user_id,), one=True)
+    query_fn("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,), one=True)
+    query_fn("SELECT key, value FROM settings")
+    query_fn("SELECT text FROM messages WHERE message_name = ?", ('start_main',), one=True)
+    query_fn("SELECT * FROM buttons WHERE menu_name = 'start_main' ORDER BY row, col")
+    query_fn("SELECT value FROM settings WHERE key='free_trial_status'", one=True)
+    await asyncio.sleep(0)
+    query_fn("SELECT * FROM orders WHERE user_id = ? AND status = 'approved'", (user_id,))
+    query_fn("SELECT balance FROM user_wallets WHERE user_id = ?", (user_id,), one=True)
+
+
+async def _run(query_fn, updates: int) -> float:
+    t0 = time.perf_counter()
+    await asyncio.gather(*(_update(query_fn, (i % 5000) + 1) for i in range(updates)))
+    return time.perf_counter() - t0
+
+
+_SLOW_SQL = (
+    "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+    "SELECT COUNT(*) AS c FROM n"
+)
+
+
+async def _ticker(stop: asyncio.Event, lags: list):
+    # Stands in for other users' updates: each tick should run every ~10ms
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - t0 - 0.01)
+
+
+async def _latency_run(use_async: bool, rows: int):
+    stop = asyncio.Event()
+    lags = []
+    ticker = asyncio.create_task(_ticker(stop, lags))
+    await asyncio.sleep(0.05)
+    t0 = time.perf_counter()
+    if use_async:
+        await db.aquery_db(_SLOW_SQL, (rows,), one=True)
+    else:
+        db.query_db(_SLOW_SQL, (rows,), one=True)
+    took = time.perf_counter() - t0
+    await asyncio.sleep(0.05)
+    stop.set()
+    await ticker
+    return took, max(lags) if lags else 0.0, len(lags)
+
+
+def bench_pool(updates: int):
+    print(f"{updates} concurrent updates x 10 queries\n")
+    legacy = asyncio.run(_run(_legacy_query_db, updates))
+    pooled = asyncio.run(_run(db.query_db, updates))
+    print(f"  connect-per-query : {legacy * 1000:8.1f} ms  ({legacy / updates * 1e6:7.1f} us/update)")
+    print(f"  pooled connection : {pooled * 1000:8.1f} ms  ({pooled / updates * 1e6:7.1f} us/update)")
+    print(f"  speedup           : {legacy / pooled:8.2f}x")
+
+
+def bench_latency(rows: int = 3_000_000):
+    print("long query while other updates tick every 10ms\n")
+    ok = True
+    for label, use_async in (("query_db  (sync) ", False), ("aquery_db (async)", True)):
+        took, worst, ticks = asyncio.run(_latency_run(use_async, rows))
+        print(f"  {label}: query {took * 1000:7.1f} ms, worst tick delay {worst * 1000:7.1f} ms, ticks {ticks}")
+        if use_async and worst > took / 2:
+            ok = False
+    db.shutdown_db_executor()
+    print("\n  " + ("OK: updates kept flowing during the async query" if ok else "FAIL: event loop stalled"))
+    return ok
+
+
+_EXPIRY_LEGACY_SQL = """
+    SELECT o.id, o.user_id, o.timestamp, p.duration_days
+    FROM orders o
+    LEFT JOIN plans p ON o.plan_id = p.id
+    WHERE o.status = 'approved'
+    AND datetime(o.timestamp, '+' || p.duration_days || ' days') <= ?
+    AND datetime(o.timestamp, '+' || p.duration_days || ' days') > ?
+    AND o.notified_expiry_3d != 1
+"""
+
+_EXPIRY_SQL = """
+    SELECT o.id, o.user_id, o.expires_at
+    FROM orders o
+    LEFT JOIN plans p ON o.plan_id = p.id
+    WHERE o.status = 'approved'
+    AND o.expires_at <= ?
+    AND o.expires_at > ?
+    AND o.notified_expiry_3d != 1
+"""
+
+
+def _seed_orders(orders: int):
+    rnd = random.Random(42)
+    now = time.time()
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO plans (id, name, price, duration_days, traffic_gb) VALUES (?, ?, 0, ?, 10)",
+            [(i, f"p{d}", d) for i, d in enumerate((7, 30, 60, 90, 180, 365), start=1)],
+        )
+        conn.executemany(
+            "INSERT INTO orders (user_id, plan_id, status, timestamp) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    rnd.randint(1, 5000),
+                    rnd.randint(1, 6),
+                    rnd.choice(("approved", "approved", "approved", "pending", "rejected", "deleted")),
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - rnd.randint(0, 2 * 365 * 86400))),
+                )
+                for _ in range(orders)
+            ],
+        )
+    # Same statement as the backfill in migration 3
+    t0 = time.perf_counter()
+    with conn:
+        conn.execute(
+            "UPDATE orders SET expires_at = datetime(timestamp, '+' || "
+            "(SELECT duration_days FROM plans WHERE plans.id = orders.plan_id) || ' days') "
+            "WHERE expires_at IS NULL"
+        )
+    return time.perf_counter() - t0
+
+
+def _best_of(sql: str, args, runs: int = 5):
+    best, rows = None, 0
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        rows = len(db.query_db(sql, args))
+        took = time.perf_counter() - t0
+        best = took if best is None else min(best, took)
+    return best, rows
+
+
+def bench_expiry(orders: int):
+    print(f"near-expiry scan over {orders} orders\n")
+    backfill = _seed_orders(orders)
+    print(f"  backfill expires_at : {backfill * 1000:8.1f} ms")
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    horizon = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() + 3 * 86400))
+    ok = True
+    results = []
+    for label, sql in (("computed expiry    ", _EXPIRY_LEGACY_SQL), ("orders.expires_at  ", _EXPIRY_SQL)):
+        took, rows = _best_of(sql, (horizon, now))
+        plan = " / ".join(r["detail"] for r in db.query_db("EXPLAIN QUERY PLAN " + sql, (horizon, now)))
+        print(f"  {label}: {took * 1000:8.2f} ms, {rows} rows  [{plan}]")
+        results.append((took, rows))
+    if results[0][1] != results[1][1]:
+        print("\n  FAIL: queries disagree")
+        ok = False
+    print(f"  speedup             : {results[0][0] / results[1][0]:8.1f}x")
+    return ok
+
+
+def _measure(fn, runs: int):
+    # (best wall time per call, peak traced allocation of one call)
+    best = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        took = time.perf_counter() - t0
+        best = took if best is None else min(best, took)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def bench_rows(users: int):
+    print(f"result modes, {users} users\n")
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, first_name, join_date) VALUES (?, ?, '2025-01-01 00:00:00')",
+            [(i, f"u{i}") for i in range(1, users + 1)],
+        )
+    settings_sql = "SELECT key, value FROM settings"
+    scalar_sql = "SELECT value FROM settings WHERE key = 'free_trial_status'"
+    cases = [
+        (
+            "user ids (broadcast)",
+            lambda: [r['user_id'] for r in db.query_db("SELECT user_id FROM users")],
+            lambda: db.query_column("SELECT user_id FROM users"),
+            5,
+        ),
+        (
+            "user rows, 3 columns",
+            lambda: db.query_db("SELECT user_id, first_name, join_date FROM users"),
+            lambda: db.query_rows("SELECT user_id, first_name, join_date FROM users"),
+            5,
+        ),
+        (
+            "settings map",
+            lambda: {s['key']: s['value'] for s in db.query_db(settings_sql)},
+            lambda: db.query_map(settings_sql),
+            2000,
+        ),
+        (
+            "one setting",
+            lambda: (db.query_db(scalar_sql, one=True) or {}).get('value'),
+            lambda: db.query_scalar(scalar_sql),
+            20000,
+        ),
+    ]
+    ok = True
+    for label, as_dicts, compact, runs in cases:
+        expected = as_dicts()
+        if isinstance(expected, list) and expected and isinstance(expected[0], dict):
+            expected = [tuple(r.values()) for r in expected]
+        if expected != compact():
+            print(f"  FAIL: {label}: results disagree")
+            ok = False
+        (t_dict, m_dict), (t_compact, m_compact) = _measure(as_dicts, runs), _measure(compact, runs)
+        print(
+            f"  {label:22}: dicts {t_dict * 1e6:10.1f} us {m_dict / 1024:9.1f} KiB"
+            f" | compact {t_compact * 1e6:10.1f} us {m_compact / 1024:9.1f} KiB"
+            f" | speedup {t_dict / t_compact:5.2f}x, peak memory ratio {m_dict / max(m_compact, 1):5.2f}x"
+        )
+    return ok
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "pool"
+    _seed()
+    print(f"DB: {DB_NAME}")
+    ok = True
+    if mode == "latency":
+        ok = bench_latency()
+    elif mode == "rows":
+        ok = bench_rows(int(sys.argv[2]) if len(sys.argv) > 2 else 200_000)
+    elif mode == "expiry":
+        ok = bench_expiry(int(sys.argv[2]) if len(sys.argv) > 2 else 200_000)
+    else:
+        bench_pool(int(sys.argv[2]) if len(sys.argv) > 2 else 300)
+    db.close_all_connections()
+    shutil.rmtree(_tmpdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,7 @@ from .handlers.admin_users import (
     admin_users_show_tickets,
     admin_users_show_wallet,
     admin_users_show_refs,
+    admin_users_show_archive,
 )
 from .handlers.admin_service_actions import (
     admin_service_renew_confirm,
@@ -57,11 +58,14 @@ from .handlers.admin_cron import (
     admin_cron_set_hour_save,
 )
 
-from .config import BOT_TOKEN, DAILY_JOB_HOUR
-from .db import query_db
-from .db import db_setup
+from .config import BOT_TOKEN, DAILY_JOB_HOUR, PANEL_SNAPSHOT_SECONDS
+from .cache import get_setting
+from .db import db_setup, close_all_connections, shutdown_db_executor, order_flag_writer
 from .jobs import check_expirations
 from .jobs.notifications import check_low_traffic_and_expiry
+from .archive import archive_job
+from .ledger import ledger_job
+from .panel_cache import refresh_panel_snapshots
 from .handlers.common import force_join_checker, dynamic_button_handler, start_command
 from .handlers.cancel import cancel_flow, cancel_admin_flow
 from .handlers.admin import (
@@ -83,6 +87,7 @@ from .handlers.admin import (
     admin_generate_backup,
     backup_restore_start,
     backup_restore_receive_file,
+    backup_restore_apply,
     cancel_admin_conversation,
     exit_admin_panel,
     # admin_run_reminder_check,
@@ -185,6 +190,7 @@ from .handlers.admin_settings import (
     admin_toggle_time_alert as admin_toggle_time_alert,
     admin_toggle_auto_backup as admin_toggle_auto_backup,
     admin_set_auto_backup_hours_start as admin_set_auto_backup_hours_start,
+    admin_cycle_auto_backup_mode as admin_cycle_auto_backup_mode,
     admin_set_talert_value_save as admin_set_talert_value_save,
     admin_run_alerts_now as admin_run_alerts_now,
     admin_settings_send_test_join_log as admin_settings_send_test_join_log,
@@ -263,7 +269,8 @@ from .handlers.admin_stats_broadcast import (
     admin_broadcast_ask_message as admin_broadcast_ask_message,
     admin_broadcast_execute as admin_broadcast_execute,
 )
-from .handlers.admin_system import admin_system_health, admin_clear_notifications
+from .handlers.admin_search import admin_search_start, admin_search_receive, admin_search_page
+from .handlers.admin_system import admin_system_health, admin_clear_notifications, admin_db_stats, admin_stats_check, admin_ledger_check
 
 async def debug_text_logger(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
@@ -281,11 +288,18 @@ async def debug_text_logger(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pass
 
 
+async def _on_shutdown(application: Application) -> None:
+    order_flag_writer.flush()
+    shutdown_db_executor()
+    close_all_connections()
+
+
 def build_application() -> Application:
     db_setup()
     application = (
         Application.builder()
         .token(BOT_TOKEN)
+        .post_shutdown(_on_shutdown)
         .concurrent_updates(True)
         .pool_timeout(30.0)  # Timeout for connection pool
         .connection_pool_size(8)  # Limit concurrent connections
@@ -298,18 +312,23 @@ def build_application() -> Application:
 
     if application.job_queue:
         try:
-            st = query_db("SELECT value FROM settings WHERE key='daily_job_hour'", one=True)
-            hour = int((st or {}).get('value') or DAILY_JOB_HOUR)
+            hour = int(get_setting('daily_job_hour') or DAILY_JOB_HOUR)
         except Exception:
             hour = DAILY_JOB_HOUR
         application.job_queue.run_daily(check_expirations, time=time(hour=hour, minute=0, second=0), name="daily_expiration_check")
         # Traffic and expiry notifications - run every 24 hours (reduced from 12h to minimize panel logins)
         application.job_queue.run_repeating(check_low_traffic_and_expiry, interval=24*3600, first=600, name="notification_check")
+        # Move deleted orders, settled transactions and closed ticket threads to the archive tables
+        application.job_queue.run_repeating(archive_job, interval=24*3600, first=1800, name="archive_cold_rows")
+        # Keep the per-panel user snapshots (services list, service details, jobs) current
+        application.job_queue.run_repeating(refresh_panel_snapshots, interval=PANEL_SNAPSHOT_SECONDS, first=30, name="panel_user_snapshots")
+        # Audit the day's wallet ledger entries and checkpoint the balances
+        application.job_queue.run_repeating(ledger_job, interval=24*3600, first=2400, name="wallet_ledger_checkpoint")
         # Auto-backup scheduling
         from .config import logger
         try:
-            ab_enabled = (query_db("SELECT value FROM settings WHERE key='auto_backup_enabled'", one=True) or {}).get('value') == '1'
-            ab_hours = int((query_db("SELECT value FROM settings WHERE key='auto_backup_hours'", one=True) or {}).get('value') or '3')
+            ab_enabled = get_setting('auto_backup_enabled') == '1'
+            ab_hours = int(get_setting('auto_backup_hours') or '3')
         except Exception as e:
             logger.warning(f"Auto-backup config error: {e}, using defaults")
             ab_enabled = False; ab_hours = 3
@@ -347,15 +366,21 @@ def build_application() -> Application:
                 CallbackQueryHandler(backup_start, pattern='^backup_start$'),
                 CallbackQueryHandler(backup_restore_start, pattern='^backup_restore_start$'),
                 CallbackQueryHandler(premium_admin_run_reminder_check, pattern=r'^admin_test_reminder$'),
-                CallbackQueryHandler(admin_tickets_menu, pattern='^admin_tickets_menu$'),
+                CallbackQueryHandler(admin_tickets_menu, pattern=r'^admin_tickets_(menu|page_[np][0-9a-z]+)$'),
                 CallbackQueryHandler(admin_tutorials_menu, pattern='^admin_tutorials_menu$'),
                 CallbackQueryHandler(admin_system_health, pattern='^admin_system_health$'),
                 CallbackQueryHandler(admin_clear_notifications, pattern='^admin_clear_notifications$'),
-                CallbackQueryHandler(admin_wallet_tx_menu, pattern='^admin_wallet_tx_menu$'),
+                CallbackQueryHandler(admin_db_stats, pattern='^admin_db_stats(_reset)?$'),
+                CallbackQueryHandler(admin_stats_check, pattern='^admin_stats_(check|rebuild)$'),
+                CallbackQueryHandler(admin_ledger_check, pattern='^admin_ledger_(check|full|rebuild)$'),
+                CallbackQueryHandler(admin_wallet_tx_menu, pattern=r'^admin_wallet_tx_(menu|page_[np][0-9a-z]+)$'),
                 CallbackQueryHandler(admin_orders_menu, pattern='^admin_orders_menu$'),
+                CallbackQueryHandler(admin_search_start, pattern='^admin_search$'),
             ],
             ADMIN_USERS_MENU: [
-                CallbackQueryHandler(admin_users_page, pattern=r'^admin_users_page_\d+$'),
+                CallbackQueryHandler(admin_search_start, pattern='^admin_search$'),
+                CallbackQueryHandler(admin_search_page, pattern=r'^admin_search_page_\d+$'),
+                CallbackQueryHandler(admin_users_page, pattern=r'^admin_users_page_[np][0-9a-z]+$'),
                 CallbackQueryHandler(admin_users_toggle_ban, pattern=r'^admin_user_toggle_\d+$'),
                 CallbackQueryHandler(admin_users_export_csv, pattern=r'^admin_users_export$'),
                 CallbackQueryHandler(admin_users_search_start, pattern=r'^admin_users_search$'),
@@ -363,10 +388,11 @@ def build_application() -> Application:
                 CallbackQueryHandler(admin_users_view_by_id_callback, pattern=r'^admin_user_view_\d+$'),
                 CallbackQueryHandler(admin_users_toggle_ban_inline, pattern=r'^admin_user_ban_(yes|no)_\d+$'),
                 CallbackQueryHandler(admin_users_toggle_ban_inline, pattern=r'^admin_user_ban_\d+$'),
-                CallbackQueryHandler(admin_users_show_services, pattern=r'^admin_user_services_\d+(_page_\d+)?$'),
-                CallbackQueryHandler(admin_users_show_tickets, pattern=r'^admin_user_tickets_\d+(_page_\d+)?$'),
-                CallbackQueryHandler(admin_users_show_wallet, pattern=r'^admin_user_wallet_\d+(_page_\d+)?$'),
-                CallbackQueryHandler(admin_users_show_refs, pattern=r'^admin_user_refs_\d+(_page_\d+)?$'),
+                CallbackQueryHandler(admin_users_show_services, pattern=r'^admin_user_services_\d+(_page_[np][0-9a-z]+)?$'),
+                CallbackQueryHandler(admin_users_show_tickets, pattern=r'^admin_user_tickets_\d+(_page_[np][0-9a-z]+)?$'),
+                CallbackQueryHandler(admin_users_show_wallet, pattern=r'^admin_user_wallet_\d+(_page_[np][0-9a-z]+)?$'),
+                CallbackQueryHandler(admin_users_show_refs, pattern=r'^admin_user_refs_\d+(_page_[np][0-9a-z]+)?$'),
+                CallbackQueryHandler(admin_users_show_archive, pattern=r'^admin_user_archive_\d+$'),
                 # Admin service actions
                 CallbackQueryHandler(admin_service_renew_confirm, pattern=r'^admin_service_renew_\d+_\d+$'),
                 CallbackQueryHandler(admin_service_renew_execute, pattern=r'^admin_service_renew_yes_\d+_\d+$'),
@@ -375,6 +401,10 @@ def build_application() -> Application:
                 CallbackQueryHandler(admin_command, pattern='^admin_main$'),
             ],
             ADMIN_USERS_AWAIT_SEARCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_users_search_apply)],
+            ADMIN_SEARCH_AWAIT_QUERY: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_search_receive),
+                CallbackQueryHandler(admin_command, pattern='^admin_main$'),
+            ],
             ADMIN_CRON_MENU: [
                 CallbackQueryHandler(admin_cron_toggle_reminders, pattern=r'^cron_toggle_reminders_(0|1)$'),
                 CallbackQueryHandler(admin_cron_set_hour_start, pattern=r'^cron_set_hour_start$'),
@@ -386,6 +416,7 @@ def build_application() -> Application:
             ],
             BACKUP_RESTORE_AWAIT_FILE: [
                 MessageHandler(filters.Document.ALL, backup_restore_receive_file),
+                CallbackQueryHandler(backup_restore_apply, pattern='^backup_restore_apply$'),
             ],
             ADMIN_MESSAGES_MENU: [
                 CallbackQueryHandler(admin_messages_select, pattern=r'^msg_select_.+'),
@@ -503,7 +534,7 @@ def build_application() -> Application:
                 CallbackQueryHandler(admin_toggle_trial_status, pattern=r'^set_trial_status_(0|1)$'),
                 CallbackQueryHandler(admin_cards_menu, pattern='^admin_cards_menu$'),
                 CallbackQueryHandler(admin_wallets_menu, pattern='^admin_wallets_menu$'),
-                CallbackQueryHandler(admin_wallet_tx_menu, pattern='^admin_wallet_tx_menu$'),
+                CallbackQueryHandler(admin_wallet_tx_menu, pattern=r'^admin_wallet_tx_(menu|page_[np][0-9a-z]+)$'),
                 CallbackQueryHandler(admin_set_usd_rate_start, pattern='^set_usd_rate_start$'),
                 CallbackQueryHandler(admin_set_trial_panel_start, pattern='^set_trial_panel_start$'),
                 CallbackQueryHandler(admin_set_trial_panel_choose, pattern=r'^set_trial_panel_\d+$'),
@@ -527,6 +558,7 @@ def build_application() -> Application:
                 # Auto-backup controls
                 CallbackQueryHandler(admin_toggle_auto_backup, pattern=r'^toggle_auto_backup_(0|1)$'),
                 CallbackQueryHandler(admin_set_auto_backup_hours_start, pattern='^set_auto_backup_hours_start$'),
+                CallbackQueryHandler(admin_cycle_auto_backup_mode, pattern='^cycle_auto_backup_mode$'),
                 CallbackQueryHandler(admin_run_alerts_now, pattern='^run_alerts_now$'),
                 # Test log buttons
                 CallbackQueryHandler(admin_settings_send_test_join_log, pattern='^test_join_log$'),
@@ -541,7 +573,7 @@ def build_application() -> Application:
                 CallbackQueryHandler(admin_wallet_adjust_menu, pattern='^admin_wallet_adjust_menu$'),
             ],
             ADMIN_WALLET_MENU: [
-                CallbackQueryHandler(admin_wallet_tx_menu, pattern='^admin_wallet_tx_menu$'),
+                CallbackQueryHandler(admin_wallet_tx_menu, pattern=r'^admin_wallet_tx_(menu|page_[np][0-9a-z]+)$'),
                 CallbackQueryHandler(admin_wallet_tx_view, pattern=r'^wallet_tx_view_\d+$'),
                 CallbackQueryHandler(admin_wallet_tx_approve, pattern=r'^wallet_tx_approve_\d+$'),
                 CallbackQueryHandler(admin_wallet_tx_reject, pattern=r'^wallet_tx_reject_\d+$'),
@@ -713,15 +745,18 @@ def build_application() -> Application:
     application.add_handler(CallbackQueryHandler(admin_orders_manage, pattern='^admin_orders_manage$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_orders_manage, pattern='^admin_orders_menu$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_orders_pending, pattern='^admin_orders_pending$'), group=3)
-    application.add_handler(CallbackQueryHandler(lambda u, c: admin_orders_menu(u, c, int(u.callback_query.data.split('_')[-1])), pattern=r'^admin_orders_page_\d+$'), group=3)
+    application.add_handler(CallbackQueryHandler(lambda u, c: admin_orders_menu(u, c, u.callback_query.data.split('_')[-1]), pattern=r'^admin_orders_page_[np][0-9a-z]+$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_user_management, pattern='^admin_user_management$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_payments_menu, pattern='^admin_payments_menu$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_system_health, pattern='^admin_system_health$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_clear_notifications, pattern='^admin_clear_notifications$'), group=3)
+    application.add_handler(CallbackQueryHandler(admin_db_stats, pattern='^admin_db_stats(_reset)?$'), group=3)
+    application.add_handler(CallbackQueryHandler(admin_stats_check, pattern='^admin_stats_(check|rebuild)$'), group=3)
+    application.add_handler(CallbackQueryHandler(admin_ledger_check, pattern='^admin_ledger_(check|full|rebuild)$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_quick_backup, pattern='^admin_quick_backup$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_discount_menu, pattern='^admin_discount_menu$'), group=3)
     # admin_messages_menu is handled by ConversationHandler, no need for global handler
-    application.add_handler(CallbackQueryHandler(admin_tickets_menu, pattern='^admin_tickets_menu$'), group=3)
+    application.add_handler(CallbackQueryHandler(admin_tickets_menu, pattern=r'^admin_tickets_(menu|page_[np][0-9a-z]+)$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_run_alerts_now, pattern='^run_alerts_now$'), group=3)
     # Reseller approvals (global)
     application.add_handler(CallbackQueryHandler(admin_reseller_approve, pattern=r'^reseller_approve_\d+$'), group=3)
@@ -769,6 +804,7 @@ def build_application() -> Application:
     application.add_handler(CallbackQueryHandler(admin_set_time_alert_days_start, pattern='^set_time_alert_days_start$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_toggle_auto_backup, pattern=r'^toggle_auto_backup_(0|1)$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_set_auto_backup_hours_start, pattern='^set_auto_backup_hours_start$'), group=3)
+    application.add_handler(CallbackQueryHandler(admin_cycle_auto_backup_mode, pattern='^cycle_auto_backup_mode$'), group=3)
 
     # Wallet manual adjust (global)
     application.add_handler(CallbackQueryHandler(admin_wallet_adjust_start, pattern=r'^wallet_adjust_start_(credit|debit)$'), group=3)
@@ -908,7 +944,7 @@ def build_application() -> Application:
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, admin_ticket_receive_reply), group=-3)
 
     # Admin wallet tx (global)
-    application.add_handler(CallbackQueryHandler(admin_wallet_tx_menu, pattern=r'^admin_wallet_tx_menu$'), group=3)
+    application.add_handler(CallbackQueryHandler(admin_wallet_tx_menu, pattern=r'^admin_wallet_tx_(menu|page_[np][0-9a-z]+)$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_wallet_tx_view, pattern=r'^wallet_tx_view_\d+$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_wallet_tx_approve, pattern=r'^wallet_tx_approve_\d+$'), group=3)
     application.add_handler(CallbackQueryHandler(admin_wallet_tx_reject, pattern=r'^wallet_tx_reject_\d+$'), group=3)
@@ -0,0 +1,130 @@
+"""
+Hot/cold archiving.
+
+Deleted orders, settled wallet transactions and old ticket threads are kept
+for the record but are never needed by user-facing flows, while every scan
+of orders/wallet_transactions/ticket_messages pays for them. The archive job
+moves such rows into <table>_archive (same columns plus archived_at, created
+by migration 5), a small batch per transaction so the write lock is only held
+for a few milliseconds at a time. Admin screens read the archive on demand.
+"""
+
+from datetime import datetime, timedelta
+
+from .config import DB_ARCHIVE_ORDER_DAYS, DB_ARCHIVE_TX_MONTHS, DB_ARCHIVE_TICKET_DAYS, logger
+from .db import transaction, report_query, run_db
+
+ARCHIVE_BATCH = 500
+
+# table -> (key column, next batch of cold keys; params: cutoff, limit). Moved rows
+# leave the live table, so each batch query simply returns the next ones.
+_COLD_ROWS = {
+    'orders': ('id', (
+        "SELECT id FROM orders WHERE status IN ('deleted', 'canceled') "
+        "AND COALESCE(deleted_at, expires_at, timestamp) < ? LIMIT ?"
+    )),
+    'wallet_transactions': ('id', (
+        "SELECT id FROM wallet_transactions WHERE status IN ('approved', 'rejected') "
+        "AND created_at < ? LIMIT ?"
+    )),
+    # Whole threads only: tickets no longer pending whose last message is older than the cutoff
+    'ticket_messages': ('ticket_id', (
+        "SELECT m.ticket_id FROM (SELECT ticket_id, MAX(created_at) AS last_at FROM ticket_messages GROUP BY ticket_id) m "
+        "JOIN tickets t ON t.id = m.ticket_id WHERE t.status != 'pending' AND m.last_at < ? LIMIT ?"
+    )),
+}
+
+
+def _cutoffs(now: datetime) -> dict:
+    cutoffs = {}
+    if DB_ARCHIVE_ORDER_DAYS > 0:
+        cutoffs['orders'] = now - timedelta(days=DB_ARCHIVE_ORDER_DAYS)
+    if DB_ARCHIVE_TX_MONTHS > 0:
+        cutoffs['wallet_transactions'] = now - timedelta(days=30 * DB_ARCHIVE_TX_MONTHS)
+    if DB_ARCHIVE_TICKET_DAYS > 0:
+        cutoffs['ticket_messages'] = now - timedelta(days=DB_ARCHIVE_TICKET_DAYS)
+    return {table: ts.strftime("%Y-%m-%d %H:%M:%S") for table, ts in cutoffs.items()}
+
+
+def _shared_columns(tx, table: str) -> list:
+    """Columns of `table`, adding any the archive table lacks (the live table gained a column)."""
+    cols = [r['name'] for r in tx.query(f"PRAGMA table_info({table})")]
+    archived = {r['name'] for r in tx.query(f"PRAGMA table_info({table}_archive)")}
+    for col in cols:
+        if col not in archived:
+            tx.execute(f"ALTER TABLE {table}_archive ADD COLUMN {col}")
+    return cols
+
+
+def archive_table(table: str, cutoff: str, batch: int = ARCHIVE_BATCH) -> int:
+    """Move the cold rows of `table` older than `cutoff` into its archive; returns the number moved."""
+    moved = 0
+    cols = None
+    archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    while True:
+        with transaction() as tx:
+            if cols is None:
+                cols = ', '.join(_shared_columns(tx, table))
+            key, cold_sql = _COLD_ROWS[table]
+            keys = [r[key] for r in tx.query(cold_sql, (cutoff, batch))]
+            if not keys:
+                break
+            marks = ', '.join('?' * len(keys))
+            tx.execute(
+                f"INSERT OR REPLACE INTO {table}_archive ({cols}, archived_at) "
+                f"SELECT {cols}, ? FROM {table} WHERE {key} IN ({marks})",
+                (archived_at, *keys),
+            )
+            tx.execute(f"DELETE FROM {table} WHERE {key} IN ({marks})", keys)
+            moved += tx.rowcount
+    return moved
+
+
+def archive_cold_rows() -> dict:
+    """Run every enabled archiving rule; returns {table: rows moved}."""
+    moved = {}
+    for table, cutoff in _cutoffs(datetime.now()).items():
+        try:
+            moved[table] = archive_table(table, cutoff)
+        except Exception as e:
+            logger.error(f"Archiving {table} failed: {e}")
+    if any(moved.values()):
+        logger.info(f"Archived cold rows: {moved}")
+    return moved
+
+
+async def archive_job(context):
+    """Scheduled job: move cold rows to the archive tables."""
+    await run_db(archive_cold_rows)
+
+
+def archive_counts() -> dict:
+    """{table: (live rows, archived rows)} for the admin screens."""
+    row = report_query(
+        """
+        SELECT
+            (SELECT COUNT(*) FROM orders) AS orders,
+            (SELECT COUNT(*) FROM orders_archive) AS orders_archive,
+            (SELECT COUNT(*) FROM wallet_transactions) AS wallet_transactions,
+            (SELECT COUNT(*) FROM wallet_transactions_archive) AS wallet_transactions_archive,
+            (SELECT COUNT(*) FROM ticket_messages) AS ticket_messages,
+            (SELECT COUNT(*) FROM ticket_messages_archive) AS ticket_messages_archive
+        """,
+        one=True,
+    ) or {}
+    return {t: (row.get(t) or 0, row.get(f"{t}_archive") or 0) for t in _COLD_ROWS}
+
+
+def user_archive(user_id: int, limit: int = 50) -> dict:
+    """Archived orders and wallet transactions of one user, newest first."""
+    orders = report_query(
+        "SELECT o.id, o.status, o.marzban_username, o.timestamp, o.deleted_at, o.final_price, o.archived_at, p.name AS plan_name "
+        "FROM orders_archive o LEFT JOIN plans p ON p.id = o.plan_id WHERE o.user_id = ? ORDER BY o.id DESC LIMIT ?",
+        (user_id, limit),
+    )
+    txs = report_query(
+        "SELECT id, amount, direction, status, created_at FROM wallet_transactions_archive "
+        "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (user_id, limit),
+    )
+    return {'orders': orders, 'wallet_transactions': txs}
@@ -0,0 +1,337 @@
+"""
+Online database backups.
+
+The backup is taken with SQLite's backup API (sqlite3.Connection.backup)
+instead of reading the database file: copying bot.db byte-for-byte while the
+bot writes to it (and while recent commits still sit in bot.db-wal) can
+produce a torn or stale copy, and reading it into memory doubles RSS for a
+large database.
+
+The source is a read-only connection holding one read transaction for the
+whole copy, so the result is a consistent snapshot of the moment the backup
+started. Under WAL that transaction never blocks writers; the copy proceeds in
+steps of DB_BACKUP_PAGES pages and lands in a temp file that callers stream
+into their ZIP archive.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+from .config import DB_NAME, DB_BACKUP_DIR, DB_BACKUP_PAGES, logger
+from .db import open_readonly_connection, run_report
+
+
+def backup_database(dest_path: str, progress=None) -> dict:
+    """Copy the live database to `dest_path` (overwritten) and return what was copied.
+
+    `progress(done_pages, total_pages)` is called after every step, on the calling thread.
+    Returns {'path', 'pages', 'bytes', 'seconds'}.
+    """
+    started = time.perf_counter()
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    src = open_readonly_connection()
+    dst = sqlite3.connect(dest_path)
+    pages = 0
+    try:
+        # Pin one snapshot; otherwise every commit by the bot restarts the copy
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+
+        def _on_step(status, remaining, total):
+            nonlocal pages
+            pages = total
+            if progress is not None:
+                progress(total - remaining, total)
+
+        src.backup(dst, pages=max(1, DB_BACKUP_PAGES), progress=_on_step)
+    finally:
+        src.close()
+        dst.close()
+    result = {
+        'path': dest_path,
+        'pages': pages,
+        'bytes': os.path.getsize(dest_path),
+        'seconds': time.perf_counter() - started,
+    }
+    logger.info(
+        f"DB backup: {result['pages']} pages ({result['bytes'] / 1048576:.1f} MB) "
+        f"in {result['seconds']:.2f} s -> {dest_path}"
+    )
+    return result
+
+
+def backup_to_tempfile(progress=None) -> dict:
+    """backup_database into a new temp file; the caller removes result['path']."""
+    fd, path = tempfile.mkstemp(prefix='bot_db_', suffix='.sqlite')
+    os.close(fd)
+    try:
+        return backup_database(path, progress)
+    except Exception:
+        os.remove(path)
+        raise
+
+
+async def abackup_to_tempfile(progress=None) -> dict:
+    """backup_to_tempfile on a reporting thread.
+
+    `progress` is an async callable (done_pages, total_pages), run on the event
+    loop at most once a second and once more when the copy completes.
+    """
+    loop = asyncio.get_running_loop()
+    last = 0.0
+
+    def _on_step(done, total):
+        nonlocal last
+        now = time.monotonic()
+        if progress is None or (now - last < 1.0 and done < total):
+            return
+        last = now
+        asyncio.run_coroutine_threadsafe(progress(done, total), loop)
+
+    return await run_report(backup_to_tempfile, _on_step)
+
+
+# --- Base + delta backups ---
+# The periodic auto-backup sends a full base archive every few runs and, in
+# between, only the pages that changed: against the base ("differential",
+# each delta restores on its own with the base) or against the previous run
+# ("incremental", smallest deltas, but every delta of the chain is needed).
+# Pages are compared by hash; the only state kept on the server is the chain
+# position and two page-hash lists in DB_BACKUP_DIR.
+BACKUP_MODES = ('full', 'differential', 'incremental')
+BASE_MANIFEST = 'base.json'
+DELTA_MANIFEST = 'delta.json'
+DELTA_PAGES = 'pages.bin'
+BASE_DB_NAME = 'bot_db.sqlite'
+_HASH_SIZE = 16
+_FORMAT = 'wingsbot-backup'
+
+
+def _backup_dir() -> str:
+    path = DB_BACKUP_DIR or os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), 'backups')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _page_size(path: str) -> int:
+    with open(path, 'rb') as f:
+        header = f.read(100)
+    size = int.from_bytes(header[16:18], 'big')
+    return 65536 if size == 1 else size
+
+
+def _scan_pages(path: str, page_size: int):
+    """(per-page hashes, sha256 of the whole file), reading one page at a time."""
+    hashes = bytearray()
+    whole = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                break
+            whole.update(page)
+            hashes += hashlib.blake2b(page, digest_size=_HASH_SIZE).digest()
+    return bytes(hashes), whole.hexdigest()
+
+
+def _load_chain():
+    root = _backup_dir()
+    try:
+        with open(os.path.join(root, 'chain.json'), encoding='utf-8') as f:
+            chain = json.load(f)
+        with open(os.path.join(root, 'base.hashes'), 'rb') as f:
+            chain['base_hashes'] = f.read()
+        with open(os.path.join(root, 'last.hashes'), 'rb') as f:
+            chain['last_hashes'] = f.read()
+        return chain
+    except (OSError, ValueError):
+        return None
+
+
+def save_chain_state(result: dict):
+    """Record a backup from make_chain_backup as delivered; the next delta builds on it."""
+    state = result.get('state')
+    if not state:
+        return
+    root = _backup_dir()
+    files = [('base.hashes', state.get('base_hashes')), ('last.hashes', state['last_hashes'])]
+    for name, data in files:
+        if data is None:
+            continue
+        with open(os.path.join(root, name + '.tmp'), 'wb') as f:
+            f.write(data)
+        os.replace(os.path.join(root, name + '.tmp'), os.path.join(root, name))
+    meta = {k: state[k] for k in ('base_id', 'seq', 'mode', 'page_size', 'sha256')}
+    with open(os.path.join(root, 'chain.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(root, 'chain.json.tmp'), os.path.join(root, 'chain.json'))
+
+
+def make_chain_backup(out_dir: str, mode: str = 'differential', full_every: int = 8, extra_files=()) -> dict:
+    """Snapshot the database and write the next archive of the chain into `out_dir`.
+
+    A base archive (bot_db.sqlite + base.json) is written when there is no chain
+    yet, after `full_every` deltas, when the mode or page size changed, or when
+    `mode` is 'full'; otherwise a delta archive (delta.json + pages.bin). The
+    chain only advances once the caller passes the result to save_chain_state.
+    `extra_files` are (path, arcname) pairs added to base archives.
+
+    Returns {'kind', 'path', 'base_id', 'seq', 'pages', 'bytes', 'db_bytes', 'state'}.
+    """
+    if mode not in BACKUP_MODES:
+        mode = 'differential'
+    snap = backup_to_tempfile()
+    try:
+        page_size = _page_size(snap['path'])
+        hashes, sha256 = _scan_pages(snap['path'], page_size)
+        page_count = len(hashes) // _HASH_SIZE
+        chain = _load_chain()
+        now = datetime.now()
+        need_base = (
+            mode == 'full'
+            or chain is None
+            or chain.get('mode') != mode
+            or chain.get('page_size') != page_size
+            or int(chain.get('seq') or 0) >= max(0, full_every)
+        )
+        if need_base:
+            base_id = now.strftime('%Y%m%d%H%M%S')
+            manifest = {
+                'format': _FORMAT, 'kind': 'base', 'base_id': base_id, 'seq': 0, 'mode': mode,
+                'page_size': page_size, 'page_count': page_count, 'sha256': sha256,
+                'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            path = os.path.join(out_dir, f"wingsbot_{base_id}_base.zip")
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.writestr(BASE_MANIFEST, json.dumps(manifest, indent=2))
+                z.write(snap['path'], arcname=BASE_DB_NAME)
+                for extra_path, arcname in extra_files:
+                    if os.path.exists(extra_path):
+                        z.write(extra_path, arcname=arcname)
+            changed = page_count
+            state = dict(manifest, base_hashes=hashes, last_hashes=hashes)
+        else:
+            base_id = chain['base_id']
+            seq = int(chain['seq']) + 1
+            ref = chain['base_hashes'] if mode == 'differential' else chain['last_hashes']
+            changed_pages = [
+                pgno for pgno in range(page_count)
+                if hashes[pgno * _HASH_SIZE:(pgno + 1) * _HASH_SIZE] != ref[pgno * _HASH_SIZE:(pgno + 1) * _HASH_SIZE]
+            ]
+            changed = len(changed_pages)
+            manifest = {
+                'format': _FORMAT, 'kind': 'delta', 'base_id': base_id, 'seq': seq, 'mode': mode,
+                'page_size': page_size, 'page_count': page_count, 'pages': changed, 'sha256': sha256,
+                'parent_sha256': chain.get('sha256'), 'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            path = os.path.join(out_dir, f"wingsbot_{base_id}_{mode[:4]}{seq:03d}.zip")
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.writestr(DELTA_MANIFEST, json.dumps(manifest, indent=2))
+                with open(snap['path'], 'rb') as src, z.open(DELTA_PAGES, 'w', force_zip64=True) as out:
+                    for pgno in changed_pages:
+                        src.seek(pgno * page_size)
+                        out.write(pgno.to_bytes(4, 'big'))
+                        out.write(src.read(page_size))
+            state = dict(manifest, base_hashes=None, last_hashes=hashes)
+        result = {
+            'kind': manifest['kind'], 'path': path, 'base_id': base_id, 'seq': manifest['seq'],
+            'pages': changed, 'bytes': os.path.getsize(path), 'db_bytes': snap['bytes'], 'state': state,
+        }
+        logger.info(
+            f"DB {result['kind']} backup {base_id}#{result['seq']} ({mode}): {changed}/{page_count} pages, "
+            f"{result['bytes'] / 1048576:.2f} MB archive"
+        )
+        return result
+    finally:
+        os.remove(snap['path'])
+
+
+async def amake_chain_backup(out_dir: str, mode: str = 'differential', full_every: int = 8, extra_files=()) -> dict:
+    return await run_report(make_chain_backup, out_dir, mode, full_every, extra_files)
+
+
+def read_manifest(zip_path: str):
+    """The base.json / delta.json of a chain archive, or None for any other file."""
+    try:
+        with zipfile.ZipFile(zip_path) as z:
+            names = set(z.namelist())
+            for name in (BASE_MANIFEST, DELTA_MANIFEST):
+                if name in names:
+                    manifest = json.loads(z.read(name))
+                    if manifest.get('format') == _FORMAT:
+                        return manifest
+    except (OSError, ValueError, zipfile.BadZipFile):
+        pass
+    return None
+
+
+def plan_restore(archives):
+    """Pick the archives needed to rebuild the newest state: (base, [deltas in order]).
+
+    `archives` is a list of (path, manifest). Raises ValueError if no base is
+    given, or if an incremental chain has a gap.
+    """
+    bases = [a for a in archives if a[1]['kind'] == 'base']
+    if not bases:
+        raise ValueError("no base archive (wingsbot_*_base.zip) was given")
+    base = max(bases, key=lambda a: a[1]['base_id'])
+    base_id = base[1]['base_id']
+    deltas = sorted(
+        (a for a in archives if a[1]['kind'] == 'delta' and a[1]['base_id'] == base_id),
+        key=lambda a: a[1]['seq'],
+    )
+    if not deltas:
+        return base, []
+    newest = deltas[-1]
+    if newest[1]['mode'] == 'differential':
+        return base, [newest]
+    seqs = [d[1]['seq'] for d in deltas]
+    missing = sorted(set(range(1, seqs[-1] + 1)) - set(seqs))
+    if missing:
+        raise ValueError(f"incremental chain {base_id} is missing deltas: {', '.join(map(str, missing))}")
+    unique = {d[1]['seq']: d for d in deltas}
+    return base, [unique[s] for s in sorted(unique)]
+
+
+def restore_chain(archives, dest_path: str) -> dict:
+    """Rebuild the database into `dest_path` from a base archive and its deltas.
+
+    `archives` is a list of (path, manifest) as returned by read_manifest; the
+    result is checked against the sha256 recorded at backup time and with
+    PRAGMA integrity_check. Returns the manifest of the state restored.
+    """
+    base, deltas = plan_restore(archives)
+    with zipfile.ZipFile(base[0]) as z, z.open(BASE_DB_NAME) as src, open(dest_path, 'wb') as out:
+        shutil.copyfileobj(src, out, 1024 * 1024)
+    target = base[1]
+    for path, manifest in deltas:
+        page_size = manifest['page_size']
+        with zipfile.ZipFile(path) as z, z.open(DELTA_PAGES) as src, open(dest_path, 'r+b') as out:
+            out.truncate(manifest['page_count'] * page_size)
+            while True:
+                head = src.read(4)
+                if not head:
+                    break
+                out.seek(int.from_bytes(head, 'big') * page_size)
+                out.write(src.read(page_size))
+        target = manifest
+    _hashes, sha256 = _scan_pages(dest_path, target['page_size'])
+    if sha256 != target['sha256']:
+        raise ValueError(f"restored database does not match backup {target['base_id']}#{target['seq']}")
+    conn = sqlite3.connect(dest_path)
+    try:
+        check = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if check != 'ok':
+        raise ValueError(f"restored database failed integrity_check: {check}")
+    return target
@@ -1,9 +1,10 @@
 """
 Simple in-memory cache to reduce database queries
 """
+import threading
 import time
-from typing import Any, Optional
-from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Mapping, Optional
 
 # Simple dict-based cache with TTL
 _cache = {}
@@ -38,14 +39,167 @@ def clear_cache():
     _cache.clear()
     _cache_ttl.clear()
 
-# Cache for frequently accessed settings
-@lru_cache(maxsize=128)
-def get_bot_active_status() -> str:
-    """Cached bot active status - invalidate on change"""
-    from .db import query_db
-    cur = query_db("SELECT value FROM settings WHERE key='bot_active'", one=True)
-    return (cur or {}).get('value') or '1'
-
-def invalidate_bot_active_cache():
-    """Call this when bot_active setting changes"""
-    get_bot_active_status.cache_clear()
+
+class Settings:
+    """In-memory copy of the `settings` table.
+
+    Loaded once on first use, then kept in sync by writing through set()/set_many();
+    readers never touch SQLite. Each write swaps in a new dict, so a snapshot taken
+    with all() stays consistent, and bumps `version` so derived caches can tell
+    that something changed.
+    """
+
+    _TRUE = ('1', 'true', 'on', 'yes')
+
+    def __init__(self):
+        self._values = None
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def reload(self):
+        """(Re)load the whole table, e.g. after the database file was replaced."""
+        from .db import query_map
+        values = query_map("SELECT key, value FROM settings")
+        with self._lock:
+            self._values = values
+            self.version += 1
+
+    def all(self) -> Mapping[str, Optional[str]]:
+        """Read-only snapshot of every setting."""
+        if self._values is None:
+            self.reload()
+        return MappingProxyType(self._values)
+
+    def rows(self) -> list:
+        """The table as [{'key': ..., 'value': ...}] rows, sorted by key (settings.json dumps)."""
+        return [{'key': k, 'value': v} for k, v in sorted(self.all().items())]
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Raw value of `key`; `default` when the key is missing or NULL."""
+        if self._values is None:
+            self.reload()
+        value = self._values.get(key)
+        return default if value is None else value
+
+    def get_int(self, key: str, default: int = 0) -> int:
+        try:
+            return int(float(self.get(key)))
+        except (TypeError, ValueError):
+            return default
+
+    def get_float(self, key: str, default: float = 0.0) -> float:
+        try:
+            return float(self.get(key))
+        except (TypeError, ValueError):
+            return default
+
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        value = self.get(key)
+        if value is None or value == '':
+            return default
+        return str(value).strip().lower() in self._TRUE
+
+    def set_many(self, values: dict) -> bool:
+        """Upsert several settings in one transaction; memory is updated only after commit."""
+        from .db import transaction
+        from .config import logger
+        values = {k: (None if v is None else str(v)) for k, v in values.items()}
+        try:
+            with transaction() as tx:
+                for key, value in values.items():
+                    tx.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        except Exception as e:
+            logger.error(f"Saving settings {list(values)} failed: {e}")
+            return False
+        with self._lock:
+            if self._values is not None:
+                self._values = {**self._values, **values}
+            self.version += 1
+        return True
+
+    def set(self, key: str, value) -> bool:
+        return self.set_many({key: value})
+
+
+settings_cache = Settings()
+
+
+def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    return settings_cache.get(key, default)
+
+
+def get_settings() -> Mapping[str, Optional[str]]:
+    return settings_cache.all()
+
+
+def set_setting(key: str, value) -> bool:
+    """Write one setting through to the database and the in-memory copy."""
+    return settings_cache.set(key, value)
+
+
+class RenderCache:
+    """Message templates and button layouts, plus keyboards built from them.
+
+    Both tables are loaded together on first use and change only through the admin
+    message/button editors, which call invalidate(). Built keyboards are shared by
+    all users and keyed on the settings version as well, since the start menu hides
+    buttons depending on settings.
+    """
+
+    def __init__(self):
+        self._messages = None
+        self._buttons = None
+        self._keyboards = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        from .db import query_rows
+        messages = {
+            name: {'text': text, 'file_id': file_id, 'file_type': file_type}
+            for name, text, file_id, file_type in query_rows("SELECT message_name, text, file_id, file_type FROM messages")
+        }
+        buttons = {}
+        for menu, text, target, is_url, row, col in query_rows(
+            "SELECT menu_name, text, target, is_url, row, col FROM buttons ORDER BY menu_name, row, col"
+        ):
+            buttons.setdefault(menu, []).append({'text': text, 'target': target, 'is_url': is_url, 'row': row, 'col': col})
+        with self._lock:
+            self._messages, self._buttons = messages, buttons
+
+    def message(self, name: str) -> Optional[dict]:
+        """{'text', 'file_id', 'file_type'} of a message template, or None."""
+        if self._messages is None:
+            self._load()
+        return self._messages.get(name)
+
+    def buttons(self, menu: str) -> list:
+        """Buttons of `menu` ordered by row, col (callers must not modify them)."""
+        if self._buttons is None:
+            self._load()
+        return self._buttons.get(menu, [])
+
+    def keyboard(self, key, build):
+        """The keyboard built by build() for `key`, reused until messages, buttons or settings change."""
+        full_key = (key, settings_cache.version)
+        markup = self._keyboards.get(full_key)
+        if markup is None:
+            markup = build()
+            with self._lock:
+                if len(self._keyboards) > 256:
+                    self._keyboards.clear()
+                self._keyboards[full_key] = markup
+        return markup
+
+    def invalidate(self):
+        with self._lock:
+            self._messages = None
+            self._buttons = None
+            self._keyboards = {}
+
+
+render_cache = RenderCache()
+
+
+def invalidate_render_cache():
+    """Call after editing messages or buttons."""
+    render_cache.invalidate()
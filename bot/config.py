@@ -70,6 +70,35 @@ def _unify_chat_identifier(raw_id: str, username: str):
 # Prefer CHANNEL_ID if provided, otherwise CHANNEL_USERNAME
 CHANNEL_CHAT = _unify_chat_identifier(RAW_CHANNEL_ID, CHANNEL_USERNAME)
 DB_NAME = os.getenv("DB_NAME", "bot.db")
+# SQLite tuning for the pooled connections (page cache per connection, memory-mapped I/O)
+DB_CACHE_KB = _safe_int(os.getenv("DB_CACHE_KB", "8192"), 8192)
+DB_MMAP_MB = _safe_int(os.getenv("DB_MMAP_MB", "64"), 64)
+# Threads serving aquery_db/aexecute_db and the max number of queued async DB calls
+DB_WORKERS = _safe_int(os.getenv("DB_WORKERS", "4"), 4)
+DB_MAX_PENDING = _safe_int(os.getenv("DB_MAX_PENDING", "256"), 256)
+# Threads (each with a read-only connection) for admin reports, exports and backups
+DB_REPORT_WORKERS = _safe_int(os.getenv("DB_REPORT_WORKERS", "2"), 2)
+# Per-statement latency stats (0 disables) and the threshold for the slow-query log
+DB_STATS = _safe_int(os.getenv("DB_STATS", "1"), 1)
+DB_SLOW_MS = _safe_int(os.getenv("DB_SLOW_MS", "250"), 250)
+# Pages copied per step of an online backup (4 KiB each)
+DB_BACKUP_PAGES = _safe_int(os.getenv("DB_BACKUP_PAGES", "1024"), 1024)
+# Where the auto-backup keeps its chain state (page hashes); default: backups/ next to the DB
+DB_BACKUP_DIR = os.getenv("DB_BACKUP_DIR", "")
+# Archiving of cold rows into *_archive tables (0 disables a rule): deleted/canceled
+# orders after N days, settled wallet transactions after N months, messages of
+# non-pending tickets quiet for N days
+DB_ARCHIVE_ORDER_DAYS = _safe_int(os.getenv("DB_ARCHIVE_ORDER_DAYS", "30"), 30)
+DB_ARCHIVE_TX_MONTHS = _safe_int(os.getenv("DB_ARCHIVE_TX_MONTHS", "6"), 6)
+DB_ARCHIVE_TICKET_DAYS = _safe_int(os.getenv("DB_ARCHIVE_TICKET_DAYS", "90"), 90)
+# Write-behind batching for job flag updates: flush every N rows or after T milliseconds
+DB_FLUSH_ROWS = _safe_int(os.getenv("DB_FLUSH_ROWS", "500"), 500)
+DB_FLUSH_MS = _safe_int(os.getenv("DB_FLUSH_MS", "2000"), 2000)
+# Panel clients: worker threads and keep-alive connections per panel, so one slow
+# panel cannot hold up calls to the others or the bot itself
+PANEL_MAX_CONNECTIONS = _safe_int(os.getenv("PANEL_MAX_CONNECTIONS", "4"), 4)
+# How old a panel user snapshot may get before it is refreshed in the background (bot/panel_cache.py)
+PANEL_SNAPSHOT_SECONDS = _safe_int(os.getenv("PANEL_SNAPSHOT_SECONDS", "300"), 300)
 NOBITEX_TOKEN = os.getenv("NOBITEX_TOKEN", "")
 
 # Job schedule hour for daily tasks
@@ -1,547 +1,775 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import os
+import re
+import shutil
 import sqlite3
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from .config import DB_NAME, logger
+from urllib.request import pathname2url
+from .config import (
+    DB_NAME, DB_CACHE_KB, DB_MMAP_MB, DB_WORKERS, DB_MAX_PENDING,
+    DB_FLUSH_ROWS, DB_FLUSH_MS, DB_REPORT_WORKERS, DB_STATS, DB_SLOW_MS, logger,
+)
+
+
+# --- Connection pool ---
+# One long-lived connection per thread. PTB runs every handler on the event
+# loop thread, so in practice the bot reuses a single connection for all
+# updates instead of opening a new one per query.
+_local = threading.local()
+_pool_lock = threading.Lock()
+_all_connections = []
+# Bumped by close_all_connections so other threads drop their (now closed) connection
+_pool_generation = 0
+# Every connection is opened under this lock; replace_database_file holds it
+# while it swaps the file, so nothing can open DB_NAME half-way through
+_file_lock = threading.RLock()
+# Unpooled connections (streams, backups) still open, closed too by a file swap
+_unpooled = weakref.WeakSet()
+
+
+class _Connection(sqlite3.Connection):
+    """sqlite3.Connection that can be weakly referenced (for _unpooled)."""
+
+
+def _configure_connection(conn: sqlite3.Connection, readonly: bool = False):
+    pragmas = [
+        f"PRAGMA cache_size=-{int(DB_CACHE_KB)}",
+        f"PRAGMA mmap_size={int(DB_MMAP_MB) * 1024 * 1024}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    if not readonly:
+        pragmas[:0] = ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL"]
+    cursor = conn.cursor()
+    for pragma in pragmas:
+        try:
+            cursor.execute(pragma)
+        except sqlite3.Error as e:
+            logger.warning(f"DB pragma failed ({pragma}): {e}")
+    cursor.close()
+
+
+def _open_connection(readonly: bool) -> sqlite3.Connection:
+    if readonly:
+        uri = f"file:{pathname2url(os.path.abspath(DB_NAME))}?mode=ro"
+        target, options = uri, {'uri': True}
+    else:
+        target, options = DB_NAME, {}
+    with _file_lock:
+        conn = sqlite3.connect(
+            target, check_same_thread=False, timeout=30, cached_statements=256, factory=_Connection, **options
+        )
+    _configure_connection(conn, readonly)
+    return conn
+
+
+class _PooledConnection:
+    """A thread's pooled connection, kept in a threading.local.
+
+    When the thread exits (panel worker threads come and go with their
+    executors) the holder is dropped and its finalizer closes the connection
+    and takes it out of _all_connections.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, generation: int):
+        self.conn = conn
+        self.pid = os.getpid()
+        self.generation = generation
+        weakref.finalize(self, _release_connection, conn)
+
+
+def _release_connection(conn: sqlite3.Connection):
+    with _pool_lock:
+        with contextlib.suppress(ValueError):
+            _all_connections.remove(conn)
+    with contextlib.suppress(sqlite3.Error):
+        conn.close()
+
+
+def _thread_connection(local: threading.local, readonly: bool) -> sqlite3.Connection:
+    holder = getattr(local, 'holder', None)
+    if holder is not None and holder.pid == os.getpid() and holder.generation == _pool_generation:
+        return holder.conn
+    with _file_lock:
+        conn = _open_connection(readonly)
+        with _pool_lock:
+            _all_connections.append(conn)
+            generation = _pool_generation
+        # Outside _pool_lock: dropping a stale holder runs its finalizer, which takes the lock
+        local.holder = _PooledConnection(conn, generation)
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return the pooled connection of the current thread (opened on first use)."""
+    return _thread_connection(_local, readonly=False)
+
+
+def open_readonly_connection() -> sqlite3.Connection:
+    """A new, unpooled read-only connection; the caller closes it."""
+    with _file_lock:
+        conn = _open_connection(readonly=True)
+        _unpooled.add(conn)
+    return conn
+
+
+def close_all_connections():
+    """Close every pooled connection (used on shutdown and before restoring a DB file)."""
+    global _pool_generation
+    with _pool_lock:
+        conns = list(_all_connections)
+        _all_connections.clear()
+        _pool_generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+    _ro_local.__dict__.clear()
+
+
+def replace_database_file(path: str, backup_path: str | None = None):
+    """Install the database file at `path` as DB_NAME and bring it up to the current schema.
+
+    No connection can be opened meanwhile: the open ones (pooled and unpooled)
+    are closed, the live database is checkpointed so DB_NAME holds all of it,
+    optionally copied to `backup_path`, replaced, and migrated. Blocking; run it
+    on a DB thread.
+    """
+    with _file_lock:
+        close_all_connections()
+        for conn in list(_unpooled):
+            with contextlib.suppress(sqlite3.Error):
+                conn.close()
+        if os.path.exists(DB_NAME):
+            conn = sqlite3.connect(DB_NAME, timeout=30)
+            try:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.warning(f"Checkpoint before replacing the database failed: {e}")
+            finally:
+                conn.close()
+            if backup_path:
+                shutil.copy2(DB_NAME, backup_path)
+        for suffix in ('-wal', '-shm'):
+            with contextlib.suppress(OSError):
+                os.remove(DB_NAME + suffix)
+        shutil.copy2(path, DB_NAME)
+        from .migrations import migrate
+        migrate()
+
+
+# --- Statement statistics ---
+# Every statement is timed and folded into a per-fingerprint histogram, which
+# costs a couple of microseconds per call. Statements slower than DB_SLOW_MS
+# are logged with the bot code location that issued them.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+# Histogram bucket upper bounds in ms: 0.05 ms .. ~75 s, x1.5 per bucket
+_BUCKETS_MS = tuple(0.05 * 1.5 ** i for i in range(36))
+_INTERNAL_FILES = {os.path.abspath(__file__), os.path.abspath(contextlib.__file__)}
+# Call site of an a*() call, carried into the DB thread for the slow-query log
+_call_site = threading.local()
+
+
+@functools.lru_cache(maxsize=2048)
+def fingerprint(query: str) -> str:
+    """Normalized SQL used to group statements: literals and IN lists become ?, whitespace collapsed."""
+    text = _LITERALS.sub('?', query)
+    text = _IN_LISTS.sub('(?+)', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def _caller_location() -> str:
+    site = getattr(_call_site, 'value', None)
+    if site is not None:
+        return f"{os.path.relpath(site[0])}:{site[1]} in {site[2]}"
+    frame = sys._getframe(1)
+    while frame is not None and os.path.abspath(frame.f_code.co_filename) in _INTERNAL_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return f"{os.path.relpath(frame.f_code.co_filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+
+class StatementStats:
+    """Call count, total/max time, rows and a latency histogram per statement fingerprint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.since = time.time()
+
+    def record(self, query: str, seconds: float, rows: int = 0):
+        fp = fingerprint(query)
+        ms = seconds * 1000.0
+        bucket = bisect.bisect_left(_BUCKETS_MS, ms)
+        with self._lock:
+            st = self._stats.get(fp)
+            if st is None:
+                st = self._stats[fp] = [0, 0.0, 0.0, 0, [0] * (len(_BUCKETS_MS) + 1)]
+            st[0] += 1
+            st[1] += ms
+            if ms > st[2]:
+                st[2] = ms
+            st[3] += rows
+            st[4][bucket] += 1
+        if ms >= DB_SLOW_MS:
+            logger.warning(f"Slow query {ms:.0f} ms ({rows} rows) at {_caller_location()}: {fp[:300]}")
+
+    @staticmethod
+    def _percentile(hist, count: int, max_ms: float, p: float) -> float:
+        target = p * count
+        seen = 0
+        for i, n in enumerate(hist):
+            seen += n
+            if seen >= target:
+                return min(_BUCKETS_MS[i], max_ms) if i < len(_BUCKETS_MS) else max_ms
+        return max_ms
+
+    def top(self, n: int = 10, key: str = 'total_ms') -> list:
+        """The n statements with the highest `key` (total_ms, calls, avg_ms, p99_ms, max_ms, rows)."""
+        with self._lock:
+            items = [(fp, st[0], st[1], st[2], st[3], list(st[4])) for fp, st in self._stats.items()]
+        result = []
+        for fp, calls, total, max_ms, rows, hist in items:
+            result.append({
+                'sql': fp,
+                'calls': calls,
+                'total_ms': total,
+                'avg_ms': total / calls,
+                'p50_ms': self._percentile(hist, calls, max_ms, 0.50),
+                'p95_ms': self._percentile(hist, calls, max_ms, 0.95),
+                'p99_ms': self._percentile(hist, calls, max_ms, 0.99),
+                'max_ms': max_ms,
+                'rows': rows,
+            })
+        result.sort(key=lambda r: r[key], reverse=True)
+        return result[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.since = time.time()
+
+
+db_stats = StatementStats()
+
+
+def _rollback_quietly(conn: sqlite3.Connection):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        pass
+
+
+def _fetch(conn: sqlite3.Connection, query: str, args=(), one: bool = False):
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute(query, args)
+    rows = cursor.fetchall()
+    cursor.close()
+    if DB_STATS:
+        db_stats.record(query, time.perf_counter() - started, len(rows))
+    if one:
+        return dict(rows[0]) if rows else None
+    return [dict(row) for row in rows]
 
 
 def query_db(query: str, args=(), one: bool = False):
+    conn = None
     try:
-        with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(query, args)
-            rows = cursor.fetchall()
-            if one:
-                return dict(rows[0]) if rows else None
-            return [dict(row) for row in rows]
+        conn = get_connection()
+        result = _fetch(conn, query, args, one)
+        if conn.in_transaction:
+            conn.commit()
+        return result
     except sqlite3.Error as e:
         logger.error(f"DB query error: {e}")
+        if conn is not None:
+            _rollback_quietly(conn)
         return None if one else []
 
 
-def execute_db(query: str, args=()):
+# Compact result modes: plain tuples instead of a dict per row. For the many
+# call sites that read one or two columns this skips building a dict (and its
+# key strings' hash table) per row, which is most of query_db's cost.
+def _fetch_tuples(conn: sqlite3.Connection, query: str, args=(), one: bool = False):
+    started = time.perf_counter()
+    cursor = conn.execute(query, args)
+    if one:
+        row = cursor.fetchone()
+        rows = [] if row is None else [row]
+    else:
+        rows = cursor.fetchall()
+    cursor.close()
+    if DB_STATS:
+        db_stats.record(query, time.perf_counter() - started, len(rows))
+    return rows
+
+
+def _query_tuples(query: str, args=(), one: bool = False):
+    conn = None
     try:
-        with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, args)
+        conn = get_connection()
+        rows = _fetch_tuples(conn, query, args, one)
+        if conn.in_transaction:
             conn.commit()
-            return cursor.lastrowid
+        return rows
     except sqlite3.Error as e:
-        logger.error(f"DB execute error: {e}")
-        return None
+        logger.error(f"DB query error: {e}")
+        if conn is not None:
+            _rollback_quietly(conn)
+        return []
 
 
-def get_message_text(message_name: str, default: str = '') -> str:
-    """دریافت متن پیام از دیتابیس با fallback به متن پیش‌فرض"""
-    try:
-        row = query_db("SELECT text FROM messages WHERE message_name = ?", (message_name,), one=True)
-        if row and row.get('text'):
-            return row['text']
-        return default
-    except Exception:
-        return default
+def query_rows(query: str, args=()) -> list:
+    """Rows as plain tuples, in SELECT column order."""
+    return _query_tuples(query, args)
 
 
-def initialize_default_content(cursor: sqlite3.Cursor, conn: sqlite3.Connection):
-    default_messages = {
-        'start_main': ('\U0001F44B سلام! به ربات فروش کانفیگ ما خوش آمدید.\nبرای شروع از دکمه‌های زیر استفاده کنید.', None, None),
-        'admin_panel_main': ('\U0001F5A5\uFE0F پنل مدیریت ربات. لطفا یک گزینه را انتخاب کنید.', None, None),
-        'buy_config_main': ('\U0001F4E1 **خرید کانفیگ**\n\nلطفا یکی از پلن‌های زیر را انتخاب کنید:', None, None),
-        'payment_info_text': ('\U0001F4B3 **اطلاعات پرداخت** \U0001F4B3\n\nمبلغ پلن انتخابی را به یکی از کارت‌های زیر واریز کرده و سپس اسکرین‌شات رسید را در همین صفحه ارسال نمایید.', None, None),
-        'renewal_reminder_text': ('\u26A0\uFE0F **یادآوری تمدید سرویس**\n\nکاربر گرامی، اعتبار سرویس شما رو به اتمام است.\n\n{details}\n\nبرای جلوگیری از قطع شدن سرویس، لطفاً از طریق دکمه "سرویس من" در منوی اصلی ربات اقدام به تمدید نمایید.', None, None),
-        'admin_messages_menu': ('مدیریت پیام‌ها و صفحات:', None, None),
-        'admin_users_menu': ('👥 مدیریت کاربران', None, None),
-        'admin_stats_title': ('\U0001F4C8 **آمار ربات**', None, None),
-        'admin_panels_menu': ('\U0001F5A5\uFE0F مدیریت پنل‌ها', None, None),
-        'admin_plans_menu': ('\U0001F4CB مدیریت پلن‌ها', None, None),
-        'admin_cards_menu': ('\U0001F4B3 مدیریت کارت‌های بانکی', None, None),
-        'admin_settings_menu': ('\u2699\uFE0F **تنظیمات کلی ربات**', None, None),
-        'trial_panel_select': ('پنل ساخت تست را انتخاب کنید:', None, None),
-        'trial_inbound_select': ('اینباند کانفیگ تست را انتخاب کنید:', None, None)
-    }
-
-    for name, (text, f_id, f_type) in default_messages.items():
-        cursor.execute(
-            "INSERT OR IGNORE INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
-            (name, text, f_id, f_type),
-        )
-        # Admin audit log
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS admin_audit (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER NOT NULL,
-                action TEXT NOT NULL,
-                target TEXT,
-                created_at TEXT NOT NULL,
-                meta TEXT
-            )
-            """
-        )
+def query_column(query: str, args=()) -> list:
+    """Values of the first column, e.g. query_column("SELECT user_id FROM admins")."""
+    return [row[0] for row in _query_tuples(query, args)]
 
-    conn.commit()
 
-    from .db import query_db as _query_db, execute_db as _execute_db
+def query_scalar(query: str, args=(), default=None):
+    """First column of the first row, or `default` when there is no row or it is NULL."""
+    rows = _query_tuples(query, args, one=True)
+    if not rows or rows[0][0] is None:
+        return default
+    return rows[0][0]
 
-    if not _query_db("SELECT 1 FROM panels", one=True):
-        url_row = _query_db("SELECT value FROM settings WHERE key = 'panel_url'", one=True)
-        user_row = _query_db("SELECT value FROM settings WHERE key = 'panel_user'", one=True)
-        password_row = _query_db("SELECT value FROM settings WHERE key = 'panel_pass'", one=True)
 
-        url = url_row.get('value') if url_row else 'https://your-panel.com'
-        user = user_row.get('value') if user_row else 'admin'
-        password = password_row.get('value') if password_row else 'password'
+def query_map(query: str, args=(), key_col: int = 0, val_col: int = 1) -> dict:
+    """{row[key_col]: row[val_col]}, e.g. query_map("SELECT key, value FROM settings")."""
+    return {row[key_col]: row[val_col] for row in _query_tuples(query, args)}
 
-        _execute_db(
-            "INSERT INTO panels (name, panel_type, url, username, password, sub_base) VALUES (?, ?, ?, ?, ?, ?)",
-            ('پنل اصلی (پیش‌فرض)', 'marzban', url, user, password, None),
-        )
-        _execute_db("DELETE FROM settings WHERE key IN ('panel_url', 'panel_user', 'panel_pass')")
 
-    default_settings = {'free_trial_days': '1', 'free_trial_gb': '0.2', 'free_trial_status': '1'}
-    for key, value in default_settings.items():
-        _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
+def execute_db(query: str, args=()):
+    conn = None
+    try:
+        conn = get_connection()
+        started = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.execute(query, args)
+        conn.commit()
+        lastrowid = cursor.lastrowid
+        cursor.close()
+        if DB_STATS:
+            db_stats.record(query, time.perf_counter() - started)
+        return lastrowid
+    except sqlite3.Error as e:
+        logger.error(f"DB execute error: {e}")
+        if conn is not None:
+            _rollback_quietly(conn)
+        return None
 
-    # Insert default cards
-    if not _query_db("SELECT 1 FROM cards", one=True):
-        _execute_db(
-            "INSERT INTO cards (card_number, holder_name) VALUES (?, ?)",
-            ("6037-0000-0000-0000", "نام دارنده کارت"),
-        )
 
-    # Ensure USD rate related settings exist
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_manual', ''))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_cached', ''))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_cached_ts', ''))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_mode', 'manual'))
-
-    # Payment method toggles and gateway config
-    defaults = [
-        ('pay_card_enabled', '1'),
-        ('pay_crypto_enabled', '1'),
-        ('pay_gateway_enabled', '0'),
-        ('gateway_type', 'zarinpal'),
-        ('zarinpal_merchant_id', ''),
-        ('aghapay_pin', ''),
-        ('aghapay_api_key', ''),
-        ('gateway_callback_url', ''),
-        # Signup bonus defaults
-        ('signup_bonus_enabled', '0'),
-        ('signup_bonus_amount', '0'),
-        # Free trial: selected panel (optional)
-        ('free_trial_panel_id', ''),
-        # Referral commission percent (default 10)
-        ('referral_commission_percent', '10'),
-        # Config footer text (shown under config link)
-        ('config_footer_text', 'آموزش اتصال :\nhttps://t.me/madeingod_tm'),
-        # Reseller defaults
-        ('reseller_enabled', '1'),
-        ('reseller_fee_toman', '200000'),
-        ('reseller_discount_percent', '50'),
-        ('reseller_duration_days', '30'),
-        ('reseller_max_purchases', '10'),
-        # User visibility & traffic alerts
-        ('user_show_quota_enabled', '1'),
-        # traffic_alert_mode: percent|remaining_gb
-        ('traffic_alert_enabled', '0'),
-        # GB-only threshold for remaining traffic
-        ('traffic_alert_value_gb', '5'),
-        # Time-based alerts
-        ('time_alert_enabled', '1'),
-        ('time_alert_days', '3'),
-        # Auto-backup
-        ('auto_backup_enabled', '0'),
-        ('auto_backup_hours', '12'),
-    ]
-    for k, v in defaults:
-        _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (k, v))
-    # Cron/job defaults
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('daily_job_hour', '9'))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('reminder_job_enabled', '1'))
-    # Maintenance message default
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('maintenance_message', '⚠️ ربات موقتا در حال نگهداری است. لطفا بعدا مراجعه کنید.'))
+# --- Transactions ---
+class Transaction:
+    """Statements of one unit of work, run on a single connection and committed once."""
 
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.rowcount = 0
 
-def db_setup():
-    with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
-        cursor = conn.cursor()
-        # Performance pragmas
-        try:
-            cursor.execute("PRAGMA journal_mode=WAL")
-            cursor.execute("PRAGMA synchronous=NORMAL")
-        except sqlite3.Error:
-            pass
+    def query(self, query: str, args=(), one: bool = False):
+        return _fetch(self.conn, query, args, one)
 
-        # --- Create Tables ---
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, join_date TEXT)"
-        )
-        cursor.execute("PRAGMA table_info(users)")
-        ucols_init = [col[1] for col in cursor.fetchall()]
-        if 'banned' not in ucols_init:
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN banned INTEGER NOT NULL DEFAULT 0")
-            except sqlite3.Error:
-                pass
-        # Referrals
-        cursor.execute("PRAGMA table_info(users)")
-        ucols = [col[1] for col in cursor.fetchall()]
-        if 'referrer_id' not in ucols:
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN referrer_id INTEGER")
-            except sqlite3.Error:
-                pass
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS referrals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER NOT NULL,
-                referee_id INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
-                UNIQUE(referrer_id, referee_id)
-            )
-            """
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS messages (message_name TEXT PRIMARY KEY, text TEXT, file_id TEXT, file_type TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS buttons (id INTEGER PRIMARY KEY AUTOINCREMENT, menu_name TEXT, text TEXT, target TEXT, is_url BOOLEAN DEFAULT 0, row INTEGER, col INTEGER)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT, price INTEGER NOT NULL, duration_days INTEGER NOT NULL, traffic_gb REAL NOT NULL)"
-        )
-        # Migrations for plans: add optional per-plan binding to panel/inbound
-        cursor.execute("PRAGMA table_info(plans)")
-        pcols = [col[1] for col in cursor.fetchall()]
-        if 'panel_id' not in pcols:
-            try:
-                cursor.execute("ALTER TABLE plans ADD COLUMN panel_id INTEGER")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding panel_id to plans: {e}")
-        cursor.execute("PRAGMA table_info(plans)")
-        pcols = [col[1] for col in cursor.fetchall()]
-        if 'xui_inbound_id' not in pcols:
-            try:
-                cursor.execute("ALTER TABLE plans ADD COLUMN xui_inbound_id INTEGER")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding xui_inbound_id to plans: {e}")
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS cards (id INTEGER PRIMARY KEY AUTOINCREMENT, card_number TEXT NOT NULL, holder_name TEXT NOT NULL)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS free_trials (user_id INTEGER PRIMARY KEY, timestamp TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS discount_codes (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE NOT NULL, percentage INTEGER NOT NULL, usage_limit INTEGER NOT NULL, times_used INTEGER DEFAULT 0, expiry_date TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS panels (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, panel_type TEXT NOT NULL DEFAULT 'marzban', url TEXT NOT NULL, username TEXT NOT NULL, password TEXT NOT NULL, sub_base TEXT, token TEXT)"
-        )
-        # Migrations for existing tables
-        cursor.execute("PRAGMA table_info(panels)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'enabled' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN enabled INTEGER NOT NULL DEFAULT 1")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding enabled to panels: {e}")
-        if 'panel_type' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN panel_type TEXT NOT NULL DEFAULT 'marzban'")
-                cursor.execute("UPDATE panels SET panel_type = 'marzban' WHERE panel_type IS NULL")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding panel_type to panels: {e}")
-        cursor.execute("PRAGMA table_info(panels)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'sub_base' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN sub_base TEXT")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding sub_base to panels: {e}")
-        cursor.execute("PRAGMA table_info(panels)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'token' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN token TEXT")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding token to panels: {e}")
-        # Ensure panel_inbounds exists BEFORE running its migrations
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS panel_inbounds (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                panel_id INTEGER NOT NULL,
-                protocol TEXT NOT NULL,
-                tag TEXT NOT NULL,
-                inbound_id INTEGER,
-                UNIQUE(panel_id, tag),
-                FOREIGN KEY (panel_id) REFERENCES panels(id) ON DELETE CASCADE
-            )
-            """
-        )
+    def execute(self, query: str, args=()):
+        started = time.perf_counter()
+        cursor = self.conn.cursor()
+        cursor.execute(query, args)
+        self.rowcount = cursor.rowcount
+        lastrowid = cursor.lastrowid
+        cursor.close()
+        if DB_STATS:
+            db_stats.record(query, time.perf_counter() - started)
+        return lastrowid
 
-        # Migrations for panel_inbounds
-        cursor.execute("PRAGMA table_info(panel_inbounds)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'inbound_id' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panel_inbounds ADD COLUMN inbound_id INTEGER")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding inbound_id to panel_inbounds: {e}")
-
-        # Table for manually setting inbounds for each panel (already ensured above)
-
-        # Orders table with conditional add columns
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='orders'")
-        if cursor.fetchone():
-            cursor.execute("PRAGMA table_info(orders)")
-            columns = [col[1] for col in cursor.fetchall()]
-
-            if 'panel_id' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN panel_id INTEGER")
-            if 'discount_code' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN discount_code TEXT")
-            if 'final_price' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN final_price INTEGER")
-            if 'last_reminder_date' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN last_reminder_date TEXT")
-            if 'panel_type' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN panel_type TEXT")
-            if 'last_link' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN last_link TEXT")
-                except sqlite3.Error:
-                    pass
-            if 'last_traffic_alert_date' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN last_traffic_alert_date TEXT")
-                except sqlite3.Error:
-                    pass
-            if 'desired_username' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN desired_username TEXT")
-                except sqlite3.Error:
-                    pass
-
-            if 'xui_inbound_id' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN xui_inbound_id INTEGER")
-                except sqlite3.Error:
-                    pass
-            if 'xui_client_id' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN xui_client_id TEXT")
-                except sqlite3.Error:
-                    pass
-            if 'is_trial' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN is_trial INTEGER DEFAULT 0")
-                except sqlite3.Error:
-                    pass
-            # Notification tracking columns
-            if 'notified_traffic_80' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN notified_traffic_80 INTEGER DEFAULT 0")
-                except sqlite3.Error:
-                    pass
-            if 'notified_traffic_95' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN notified_traffic_95 INTEGER DEFAULT 0")
-                except sqlite3.Error:
-                    pass
-            if 'notified_expiry_3d' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN notified_expiry_3d INTEGER DEFAULT 0")
-                except sqlite3.Error:
-                    pass
-            if 'notified_expiry_1d' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN notified_expiry_1d INTEGER DEFAULT 0")
-                except sqlite3.Error:
-                    pass
-        else:
-            cursor.execute(
-                """
-                CREATE TABLE orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, plan_id INTEGER NOT NULL,
-                    status TEXT DEFAULT 'pending', marzban_username TEXT, screenshot_file_id TEXT, timestamp TEXT,
-                    panel_id INTEGER, discount_code TEXT, final_price INTEGER, last_reminder_date TEXT, panel_type TEXT,
-                    last_link TEXT, xui_inbound_id INTEGER, xui_client_id TEXT, reseller_applied INTEGER DEFAULT 0,
-                    is_trial INTEGER DEFAULT 0,
-                    notified_traffic_80 INTEGER DEFAULT 0,
-                    notified_traffic_95 INTEGER DEFAULT 0,
-                    notified_expiry_3d INTEGER DEFAULT 0,
-                    notified_expiry_1d INTEGER DEFAULT 0
-                )
-                """
-            )
-        # NEW: wallets and wallet_transactions
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS wallets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                asset TEXT NOT NULL,
-                chain TEXT NOT NULL,
-                address TEXT NOT NULL,
-                memo TEXT
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_wallets (
-                user_id INTEGER PRIMARY KEY,
-                balance INTEGER NOT NULL DEFAULT 0
-            )
-            """
+    def rollback(self):
+        """Discard the statements run so far; use it as the last step of the block."""
+        self.conn.rollback()
+
+    def apply_wallet_entry(self, user_id: int, amount: int, kind: str, reference: str = None, allow_negative: bool = False):
+        """Append a signed entry to wallet_ledger and move the cached balance with it.
+
+        This is the only way balances change (see bot/ledger.py). The new balance
+        continues the user's last ledger entry, not user_wallets, so a hand-edited
+        cache never leaks into the ledger. Returns the new balance, or None without
+        writing anything when a debit would take the balance below zero and
+        allow_negative is off.
+        """
+        amount = int(amount)
+        last = self.query(
+            "SELECT balance_after FROM wallet_ledger WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,), one=True
         )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS wallet_transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                direction TEXT NOT NULL, -- credit/debit
-                method TEXT NOT NULL,    -- gateway/crypto/card/manual
-                status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
-                created_at TEXT NOT NULL,
-                screenshot_file_id TEXT,
-                reference TEXT,
-                meta TEXT
-            )
-            """
+        balance_after = int((last or {}).get('balance_after') or 0) + amount
+        if amount < 0 and balance_after < 0 and not allow_negative:
+            return None
+        entry_id = self.execute(
+            "INSERT INTO wallet_ledger (user_id, amount, balance_after, kind, reference, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, amount, balance_after, kind, reference, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
         )
-        # Reseller tables
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS resellers (
-                user_id INTEGER PRIMARY KEY,
-                status TEXT NOT NULL DEFAULT 'active',
-                activated_at TEXT NOT NULL,
-                expires_at TEXT NOT NULL,
-                discount_percent INTEGER NOT NULL,
-                max_purchases INTEGER NOT NULL,
-                used_purchases INTEGER NOT NULL DEFAULT 0
-            )
-            """
+        self.execute(
+            "INSERT INTO user_wallets (user_id, balance, ledger_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance, ledger_id = excluded.ledger_id",
+            (user_id, balance_after, entry_id),
         )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS reseller_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                method TEXT NOT NULL, -- card/crypto/gateway
-                status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
-                created_at TEXT NOT NULL,
-                screenshot_file_id TEXT,
-                reference TEXT,
-                meta TEXT
+        return balance_after
+
+    def credit_wallet(self, user_id: int, amount: int, kind: str = 'credit', reference: str = None):
+        self.apply_wallet_entry(user_id, amount, kind, reference)
+
+    def debit_wallet(self, user_id: int, amount: int, kind: str = 'debit', reference: str = None) -> bool:
+        """Conditional debit: returns False (and changes nothing) if the balance is short."""
+        return self.apply_wallet_entry(user_id, -int(amount), kind, reference) is not None
+
+
+@contextmanager
+def transaction():
+    """Run several statements atomically with a single commit.
+
+    BEGIN IMMEDIATE takes the write lock up front, so two concurrent money
+    flows for the same user serialize instead of both reading a stale
+    balance. Errors roll everything back and are re-raised to the caller.
+    Not re-entrant; do not await inside the block.
+
+        with transaction() as tx:
+            if tx.debit_wallet(user_id, price, 'purchase'):
+                tx.execute("INSERT INTO wallet_transactions ...", (...))
+    """
+    conn = get_connection()
+    _rollback_quietly(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield Transaction(conn)
+    except BaseException as e:
+        _rollback_quietly(conn)
+        if isinstance(e, sqlite3.Error):
+            logger.error(f"DB transaction error: {e}")
+        raise
+    else:
+        conn.commit()
+
+
+# --- Write-behind queue ---
+class WriteBehindQueue:
+    """Buffers small idempotent UPDATEs (notification/reminder flags) and writes
+    them with executemany in one transaction, instead of a commit per row.
+
+    Rows are flushed when max_rows are pending, when the oldest pending row is
+    older than max_delay_ms (checked on add), and explicitly by the jobs when
+    they finish and by the application on shutdown. A flush that add() finds
+    due runs on the DB threads when add() is called on the event loop.
+    """
+
+    def __init__(self, max_rows: int = 500, max_delay_ms: int = 2000):
+        self.max_rows = max_rows
+        self.max_delay_ms = max_delay_ms
+        self._pending = {}
+        self._count = 0
+        self._oldest = None
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def add(self, query: str, args=()):
+        with self._lock:
+            self._pending.setdefault(query, []).append(tuple(args))
+            self._count += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = not self._scheduled and (
+                self._count >= self.max_rows
+                or (time.monotonic() - self._oldest) * 1000 >= self.max_delay_ms
             )
-            """
-        )
-        # Migration: add reseller_applied if missing
-        cursor.execute("PRAGMA table_info(orders)")
-        ocols = [col[1] for col in cursor.fetchall()]
-        if 'reseller_applied' not in ocols:
+            if due:
+                self._scheduled = True
+        if due:
             try:
-                cursor.execute("ALTER TABLE orders ADD COLUMN reseller_applied INTEGER DEFAULT 0")
-            except sqlite3.Error:
-                pass
-        # Tickets table
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tickets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                content_type TEXT,
-                text TEXT,
-                file_id TEXT,
-                created_at TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'pending'
-            )
-            """
-        )
-        # Threaded ticket messages (new)
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS ticket_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ticket_id INTEGER NOT NULL,
-                sender TEXT NOT NULL, -- 'user' | 'admin'
-                content_type TEXT,
-                text TEXT,
-                file_id TEXT,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
-            )
-            """
-        )
-        # Tutorials
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tutorials (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tutorial_media (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tutorial_id INTEGER NOT NULL,
-                content_type TEXT NOT NULL,
-                file_id TEXT NOT NULL,
-                caption TEXT,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (tutorial_id) REFERENCES tutorials(id) ON DELETE CASCADE
-            )
-            """
-        )
-        # Admins table (additional admins besides primary ADMIN_ID)
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY
-            )
-            """
-        )
-        conn.commit()
-        initialize_default_content(cursor, conn)
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Already off the event loop
+                self.flush()
+            else:
+                loop.run_in_executor(_get_executor(), self.flush)
 
-        # Create indexes for hot queries (idempotent)
+    def flush(self) -> int:
+        with self._lock:
+            self._scheduled = False
+            pending, self._pending = self._pending, {}
+            count, self._count = self._count, 0
+            self._oldest = None
+        if not pending:
+            return 0
         try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_date ON orders(status, timestamp)")
-        except sqlite3.Error:
-            pass
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)")
-        except sqlite3.Error:
-            pass
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_plan ON orders(plan_id)")
-        except sqlite3.Error:
-            pass
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_user_status ON wallet_transactions(user_id, status, created_at)")
-        except sqlite3.Error:
-            pass
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_panels_enabled ON panels(enabled)")
-        except sqlite3.Error:
-            pass
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_panel_inbounds_panel ON panel_inbounds(panel_id)")
-        except sqlite3.Error:
-            pass
-        try:
-            conn.commit()
-        except sqlite3.Error:
-            pass
\ No newline at end of file
+            with transaction() as tx:
+                for query, rows in pending.items():
+                    started = time.perf_counter()
+                    tx.conn.executemany(query, rows)
+                    if DB_STATS:
+                        db_stats.record(query, time.perf_counter() - started)
+        except sqlite3.Error as e:
+            logger.error(f"Write-behind flush of {count} rows failed: {e}")
+            # Keep the rows so the next flush retries them
+            with self._lock:
+                for query, rows in pending.items():
+                    self._pending.setdefault(query, [])[:0] = rows
+                self._count += count
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            return 0
+        return count
+
+    async def aflush(self) -> int:
+        return await run_db(self.flush)
+
+
+# Shared queue for per-order flag updates from the notification/reminder jobs
+order_flag_writer = WriteBehindQueue(max_rows=DB_FLUSH_ROWS, max_delay_ms=DB_FLUSH_MS)
+
+
+# --- Async API ---
+# Handlers run on PTB's event loop; a slow query or a write-lock wait there
+# would stall every other update. The a* variants run the same functions on
+# dedicated DB threads (each with its own pooled connection) and bound the
+# number of queued calls so a burst cannot pile up unbounded work.
+_executor = None
+_executor_lock = threading.Lock()
+_pending = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=max(1, DB_WORKERS), thread_name_prefix='db')
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking DB callable on the DB executor and await its result."""
+    global _pending
+    loop = asyncio.get_running_loop()
+    if _pending is None or _pending[0] is not loop:
+        _pending = (loop, asyncio.Semaphore(max(1, DB_MAX_PENDING)))
+    async with _pending[1]:
+        return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _at_call_site(site: tuple, func, *args):
+    _call_site.value = site
+    try:
+        return func(*args)
+    finally:
+        _call_site.value = None
+
+
+def _site_of(frame) -> tuple:
+    # Formatted only if the statement turns out to be slow
+    return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+async def aquery_db(query: str, args=(), one: bool = False):
+    return await run_db(_at_call_site, _site_of(sys._getframe(1)), query_db, query, args, one)
+
+
+async def aexecute_db(query: str, args=()):
+    return await run_db(_at_call_site, _site_of(sys._getframe(1)), execute_db, query, args)
+
+
+def shutdown_db_executor():
+    """Wait for queued DB work to finish and stop the DB threads."""
+    global _executor, _pending, _report_executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+        report_executor, _report_executor = _report_executor, None
+    _pending = None
+    for ex in (executor, report_executor):
+        if ex is not None:
+            ex.shutdown(wait=True)
+
+
+# --- Read-only reporting ---
+# Admin statistics, exports and backups read whole tables. They run on their
+# own few threads, each with a read-only (mode=ro) connection, so they never
+# take the write lock or occupy the DB workers that serve user updates. Under
+# WAL a reader does not block writers and is not blocked by them.
+_ro_local = threading.local()
+_report_executor = None
+
+
+def get_readonly_connection() -> sqlite3.Connection:
+    """Return the read-only connection of the current thread (opened on first use)."""
+    return _thread_connection(_ro_local, readonly=True)
+
+
+class Snapshot:
+    """Reads that all see the database as it was at the first one."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def query(self, query: str, args=(), one: bool = False):
+        return _fetch(self.conn, query, args, one)
+
+
+@contextmanager
+def read_snapshot():
+    """Read-only unit of work: every query in the block reads the same WAL snapshot.
+
+        with read_snapshot() as snap:
+            users = snap.query("SELECT COUNT(*) AS c FROM users", one=True)
+            orders = snap.query("SELECT COUNT(*) AS c FROM orders", one=True)
+    """
+    conn = get_readonly_connection()
+    _rollback_quietly(conn)
+    conn.execute("BEGIN")
+    try:
+        yield Snapshot(conn)
+    finally:
+        _rollback_quietly(conn)
+
+
+def report_query(query: str, args=(), one: bool = False):
+    """query_db on the read-only connection; for reports, exports and statistics."""
+    try:
+        with read_snapshot() as snap:
+            return snap.query(query, args, one)
+    except sqlite3.Error as e:
+        logger.error(f"DB report query error: {e}")
+        return None if one else []
+
+
+def _get_report_executor() -> ThreadPoolExecutor:
+    global _report_executor
+    if _report_executor is None:
+        with _executor_lock:
+            if _report_executor is None:
+                _report_executor = ThreadPoolExecutor(max_workers=max(1, DB_REPORT_WORKERS), thread_name_prefix='db-report')
+    return _report_executor
+
+
+async def run_report(func, *args, **kwargs):
+    """Run a blocking report callable (typically using read_snapshot) on the reporting threads."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_report_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def areport_query(query: str, args=(), one: bool = False):
+    return await run_report(_at_call_site, _site_of(sys._getframe(1)), report_query, query, args, one)
+
+
+# --- Streaming ---
+# query_db materializes the whole result. For results that grow with the
+# user base (broadcast recipients, exports, per-order jobs) iter_db streams
+# rows in batches of `batch_size`, so memory stays bounded by the batch, not
+# by the table. Each stream gets its own short-lived read-only connection:
+# the open cursor pins one WAL snapshot for the duration of the iteration
+# without holding a transaction on the pooled (write) connections.
+ITER_BATCH_SIZE = 500
+
+
+def _iter_batches(query: str, args=(), batch_size: int = ITER_BATCH_SIZE):
+    conn = None
+    rows = 0
+    elapsed = 0.0
+    try:
+        started = time.perf_counter()
+        conn = open_readonly_connection()
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(query, args)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            elapsed += time.perf_counter() - started
+            if not batch:
+                break
+            rows += len(batch)
+            yield [dict(row) for row in batch]
+            started = time.perf_counter()
+    except sqlite3.Error as e:
+        logger.error(f"DB iter error: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+        if DB_STATS:
+            db_stats.record(query, elapsed, rows)
+
+
+def iter_db(query: str, args=(), batch_size: int = ITER_BATCH_SIZE):
+    """Yield the rows of `query` as dicts, fetching `batch_size` rows at a time.
+
+        for row in iter_db("SELECT user_id FROM users"):
+            ...
+    """
+    for batch in _iter_batches(query, args, batch_size):
+        yield from batch
+
+
+async def aiter_db(query: str, args=(), batch_size: int = ITER_BATCH_SIZE):
+    """Async iter_db: each batch is fetched on the reporting threads, rows are yielded on the loop.
+
+    The statement and its WAL snapshot stay open until the loop ends; loops that
+    await network calls per row should page by key instead.
+
+        async for row in aiter_db("SELECT user_id FROM users"):
+            ...
+    """
+    batches = _iter_batches(query, args, batch_size)
+    try:
+        while True:
+            batch = await run_report(next, batches, None)
+            if batch is None:
+                return
+            for row in batch:
+                yield row
+    finally:
+        # Still running on a report thread if we were cancelled mid-fetch; it
+        # then closes its connection when it is garbage collected.
+        with contextlib.suppress(ValueError):
+            batches.close()
+
+
+def get_message_text(message_name: str, default: str = '') -> str:
+    """دریافت متن پیام (از کش قالب‌ها) با fallback به متن پیش‌فرض"""
+    from .cache import render_cache
+    try:
+        return (render_cache.message(message_name) or {}).get('text') or default
+    except Exception:
+        return default
+
+
+def extend_order_expiry(order_id: int, days: int):
+    """Push orders.expires_at forward by `days`, counted from now if the service already expired.
+
+    Also re-arms the near-expiry notifications for the new period. The jobs
+    queue their notified_expiry_* flags conditional on the expires_at they
+    warned about, so a flag still pending in order_flag_writer does not undo this.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    execute_db(
+        "UPDATE orders SET expires_at = datetime(MAX(COALESCE(expires_at, ?), ?), ?), "
+        "notified_expiry_3d = 0, notified_expiry_1d = 0 WHERE id = ?",
+        (now, now, f"+{int(days)} days", order_id),
+    )
+
+
+def db_setup():
+    """Bring the schema up to date; a single version check when it already is."""
+    from .migrations import migrate
+    migrate()
@@ -16,7 +16,8 @@ from .admin import (
     admin_set_trial_inbound_start,
     admin_set_trial_inbound_choose,
     backup_restore_start,
-    backup_restore_receive_file
+    backup_restore_receive_file,
+    backup_restore_apply,
 )
 
 from .admin_users import (
@@ -32,7 +33,8 @@ from .admin_users import (
     admin_users_show_services,
     admin_users_show_tickets,
     admin_users_show_wallet,
-    admin_users_show_refs
+    admin_users_show_refs,
+    admin_users_show_archive
 )
 
 from .admin_system import (
@@ -58,6 +60,7 @@ __all__ = [
     'admin_set_trial_inbound_choose',
     'backup_restore_start',
     'backup_restore_receive_file',
+    'backup_restore_apply',
     'admin_users_menu',
     'admin_users_page',
     'admin_users_search_start',
@@ -71,6 +74,7 @@ __all__ = [
     'admin_users_show_tickets',
     'admin_users_show_wallet',
     'admin_users_show_refs',
+    'admin_users_show_archive',
     'admin_system_health',
     'admin_clear_notifications'
 ]
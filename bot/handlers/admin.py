@@ -19,8 +19,15 @@ import time
 from uuid import uuid4
 
 from ..config import ADMIN_ID, logger
-from ..db import query_db, execute_db, get_message_text
-from ..panel import VpnPanelAPI
+from ..db import (
+    query_db, query_column, execute_db, get_message_text, transaction, read_snapshot, run_db, run_report, areport_query,
+    replace_database_file,
+)
+from ..cache import get_setting, get_settings, set_setting, settings_cache, invalidate_render_cache
+from ..backup import abackup_to_tempfile, read_manifest, plan_restore, restore_chain
+from ..stats import counters, revenue as stats_revenue, today as stats_today, month_start
+from ..pagination import Keyset
+from ..panel import VpnPanelAPI, forget_panel_state
 from ..utils import register_new_user
 from ..states import *
 from .renewal import process_renewal_for_order
@@ -68,8 +75,8 @@ async def admin_set_trial_inbound_start(update: Update, context: ContextTypes.DE
         "اینباندی را انتخاب کنید تا کانفیگ‌های تست روی همان اینباند ساخته شوند."
     )
     # Choose panel first: use selected free_trial_panel_id or ask user to pick if not set
-    sel = query_db("SELECT value FROM settings WHERE key='free_trial_panel_id'", one=True)
-    panel_id = int((sel.get('value') or 0)) if sel and str(sel.get('value') or '').isdigit() else None
+    sel = get_setting('free_trial_panel_id') or ''
+    panel_id = int(sel) if str(sel).isdigit() else None
     if not panel_id:
         await _safe_edit_text(query.message, "ابتدا از گزینه 'انتخاب پنل ساخت تست' یک پنل انتخاب کنید.")
         return SETTINGS_MENU
@@ -103,7 +110,7 @@ async def admin_set_trial_inbound_choose(update: Update, context: ContextTypes.D
         await query.answer("شناسه نامعتبر", show_alert=True)
         return SETTINGS_MENU
     # Persist setting
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('free_trial_inbound_id', ?)", (inbound_id,))
+    set_setting('free_trial_inbound_id', inbound_id)
     await query.answer("اینباند تست ذخیره شد", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -316,7 +323,8 @@ async def backup_restore_start(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await answer_safely(query)
     context.user_data['awaiting_admin'] = 'backup_restore'
-    await _safe_edit_text(query.message, "فایل بکاپ (.db یا .zip) را ارسال کنید. توجه: قبل از جایگزینی، از دیتابیس فعلی نسخه پشتیبان گرفته می‌شود.")
+    context.user_data.pop('restore_chain', None)
+    await _safe_edit_text(query.message, "فایل بکاپ (.db یا .zip) را ارسال کنید. برای بکاپ افزایشی/تفاضلی ابتدا فایل پایه (base) و سپس فایل‌های تغییرات را بفرستید. توجه: قبل از جایگزینی، از دیتابیس فعلی نسخه پشتیبان گرفته می‌شود.")
     from ..states import BACKUP_RESTORE_AWAIT_FILE
     return BACKUP_RESTORE_AWAIT_FILE
 
@@ -341,6 +349,10 @@ async def backup_restore_receive_file(update: Update, context: ContextTypes.DEFA
         tmpdir = tempfile.mkdtemp()
         target = os.path.join(tmpdir, fname)
         await file.download_to_drive(custom_path=target)
+        # Base/delta archives of the auto-backup are collected until the admin applies them
+        manifest = read_manifest(target) if fname.endswith('.zip') else None
+        if manifest:
+            return await _backup_restore_add_archive(update, context, target, manifest)
         # If zip, extract and find a .db
         db_path = target
         if fname.endswith('.zip'):
@@ -361,15 +373,7 @@ async def backup_restore_receive_file(update: Update, context: ContextTypes.DEFA
                 shutil.rmtree(tmpdir, ignore_errors=True)
                 return ConversationHandler.END
             db_path = cand
-        # Replace DB_NAME safely
-        from ..config import DB_NAME
-        if os.path.exists(DB_NAME):
-            bak_name = f"{DB_NAME}.bak"
-            try:
-                shutil.copy2(DB_NAME, bak_name)
-            except Exception:
-                pass
-        shutil.copy2(db_path, DB_NAME)
+        await _install_db_file(db_path)
         shutil.rmtree(tmpdir, ignore_errors=True)
         await update.message.reply_text("✅ بازیابی بکاپ انجام شد. اگر سرویس را با systemd اجرا می‌کنید، یکبار ری‌استارت کنید.")
     except Exception as e:
@@ -377,6 +381,67 @@ async def backup_restore_receive_file(update: Update, context: ContextTypes.DEFA
     return ConversationHandler.END
 
 
+async def _install_db_file(db_path: str):
+    """Replace DB_NAME with `db_path` (migrated to the current schema), keeping the current database as DB_NAME.bak."""
+    from ..config import DB_NAME
+    await run_db(replace_database_file, db_path, f"{DB_NAME}.bak")
+    # The restored file carries its own settings, messages, buttons and panels
+    settings_cache.reload()
+    invalidate_render_cache()
+    forget_panel_state()
+
+
+async def _backup_restore_add_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, path: str, manifest: dict) -> int:
+    parts = context.user_data.setdefault('restore_chain', [])
+    parts.append((path, manifest))
+    try:
+        base, deltas = plan_restore(parts)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"📥 فایل {manifest['kind']} #{manifest['seq']} از زنجیره {manifest['base_id']} دریافت شد.\n"
+            f"⚠️ هنوز قابل بازیابی نیست: {e}\nفایل‌های بعدی را ارسال کنید."
+        )
+        return BACKUP_RESTORE_AWAIT_FILE
+    newest = deltas[-1][1] if deltas else base[1]
+    kb = [[InlineKeyboardButton("✅ بازیابی تا این نقطه", callback_data="backup_restore_apply")]]
+    await update.message.reply_text(
+        f"📥 فایل {manifest['kind']} #{manifest['seq']} دریافت شد.\n"
+        f"قابل بازیابی: پایه {base[1]['base_id']} + {len(deltas)} فایل تغییرات (تا {newest['created_at']}).\n"
+        "برای نقطه جدیدتر فایل‌های تغییرات بعدی را بفرستید، یا بازیابی را بزنید.",
+        reply_markup=InlineKeyboardMarkup(kb),
+    )
+    return BACKUP_RESTORE_AWAIT_FILE
+
+
+async def backup_restore_apply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Rebuild the database from the base + delta archives collected by backup_restore_receive_file."""
+    import tempfile, shutil
+    query = update.callback_query
+    await answer_safely(query)
+    parts = context.user_data.pop('restore_chain', None) or []
+    if not parts:
+        await _safe_edit_text(query.message, "فایلی برای بازیابی دریافت نشده است.")
+        return ConversationHandler.END
+    await _safe_edit_text(query.message, "⏳ در حال بازسازی دیتابیس از بکاپ...")
+    fd, restored = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        target = await run_report(restore_chain, parts, restored)
+        await _install_db_file(restored)
+        await _safe_edit_text(
+            query.message,
+            f"✅ بازیابی انجام شد (پایه {target['base_id']}، نقطه #{target['seq']} - {target['created_at']}).\n"
+            "اگر سرویس را با systemd اجرا می‌کنید، یکبار ری‌استارت کنید.",
+        )
+    except Exception as e:
+        await _safe_edit_text(query.message, f"❌ خطا در بازیابی: {e}")
+    finally:
+        os.remove(restored)
+        for path, _manifest in parts:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    return ConversationHandler.END
+
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Main admin command handler with enhanced menu and quick stats"""
     if not _is_admin(update.effective_user.id):
@@ -419,10 +484,9 @@ async def admin_toggle_bot_active(update: Update, context: ContextTypes.DEFAULT_
         pass
     
     try:
-        cur = query_db("SELECT value FROM settings WHERE key='bot_active'", one=True)
-        current = (cur or {}).get('value') or '1'
+        current = get_setting('bot_active') or '1'
         new_val = '0' if str(current) == '1' else '1'
-        execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('bot_active', ?)", (new_val,))
+        set_setting('bot_active', new_val)
         status = "روشن" if new_val == '1' else "خاموش"
         logger.info(f"Bot status toggled to: {status} (value={new_val})")
     except Exception as e:
@@ -536,7 +600,7 @@ async def admin_approve_on_panel(update: Update, context: ContextTypes.DEFAULT_T
 
     if ptype in ('xui', 'x-ui', 'sanaei', 'alireza', '3xui', '3x-ui', 'txui', 'tx-ui', 'sui', 's-ui'):
         # Step 1: show inbound list to admin
-        inbounds, msg = api.list_inbounds() if hasattr(api, 'list_inbounds') else (None, 'Not supported')
+        inbounds, msg = await api.run(api.list_inbounds) if hasattr(api, 'list_inbounds') else (None, 'Not supported')
         if not inbounds:
             safe = html_escape(str(msg))
             err_text = base_text + f"\n\n<b>خطای پنل:</b>\n<code>{safe}</code>"
@@ -562,8 +626,7 @@ async def admin_approve_on_panel(update: Update, context: ContextTypes.DEFAULT_T
             execute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (order['discount_code'],))
         # Apply referral bonus
         await _apply_referral_bonus(order_id, context)
-        cfg = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-        footer = (cfg.get('value') if cfg else '') or ''
+        footer = get_setting('config_footer_text') or ''
         # Always send ONLY subscription link for Marzban/Marzneshin
         final_message = (
             f"✅ سفارش شما تایید شد!\n\n"
@@ -599,8 +662,7 @@ async def admin_approve_on_panel(update: Update, context: ContextTypes.DEFAULT_T
                 await context.bot.send_message(order['user_id'], final_message, parse_mode=ParseMode.HTML)
             # Purchase log to configured chat if enabled
             try:
-                st = query_db("SELECT key, value FROM settings WHERE key IN ('purchase_logs_enabled','purchase_logs_chat_id')") or []
-                kv = {r['key']: r['value'] for r in st}
+                kv = get_settings()
                 if (kv.get('purchase_logs_enabled') or '0') == '1':
                     raw = (kv.get('purchase_logs_chat_id') or '').strip()
                     log_chat = raw if raw.startswith('@') else (int(raw) if (raw and raw.lstrip('-').isdigit()) else 0)
@@ -769,7 +831,7 @@ async def admin_xui_choose_inbound(update: Update, context: ContextTypes.DEFAULT
 
     username, sub_link, msg = None, None, None
     try:
-        username, sub_link, msg = api.create_user_on_inbound(inbound_id, order['user_id'], plan)
+        username, sub_link, msg = await api.run(api.create_user_on_inbound, inbound_id, order['user_id'], plan)
     except Exception as e:
         username, sub_link, msg = None, None, str(e)
     
@@ -806,12 +868,12 @@ async def admin_xui_choose_inbound(update: Update, context: ContextTypes.DEFAULT
     api_confs = []
     if not built_confs and hasattr(api, 'get_configs_for_user_on_inbound'):
         try:
-            api_confs = api.get_configs_for_user_on_inbound(int(inbound_id), username) or []
+            api_confs = await api.run(api.get_configs_for_user_on_inbound, int(inbound_id), username) or []
         except Exception:
             api_confs = []
     display_confs = built_confs or api_confs
 
-    footer = ((query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True) or {}).get('value') or '')
+    footer = (get_setting('config_footer_text') or '')
     ptype_lower = (panel_row.get('panel_type') or '').lower()
     if display_confs:
         preview = display_confs[:1]  # send only the first config
@@ -1303,7 +1365,7 @@ async def process_manual_order_message(update: Update, context: ContextTypes.DEF
                         if panel_type in ('3xui','3x-ui','3x ui','xui','x-ui','sanaei','alireza','txui','tx-ui','tx ui') and hasattr(api, 'list_inbounds') and hasattr(api, 'get_configs_for_user_on_inbound'):
                             ib_id = None
                             try:
-                                inbounds, _mm = api.list_inbounds()
+                                inbounds, _mm = await api.run(api.list_inbounds)
                                 if inbounds:
                                     ib_id = inbounds[0].get('id')
                             except Exception:
@@ -1311,7 +1373,7 @@ async def process_manual_order_message(update: Update, context: ContextTypes.DEF
                             confs = []
                             if ib_id is not None:
                                 try:
-                                    confs = api.get_configs_for_user_on_inbound(int(ib_id), ord_row['marzban_username']) or []
+                                    confs = await api.run(api.get_configs_for_user_on_inbound, int(ib_id), ord_row['marzban_username']) or []
                                 except Exception:
                                     confs = []
                             if confs:
@@ -1579,7 +1641,7 @@ async def admin_plan_edit_save(update: Update, context: ContextTypes.DEFAULT_TYP
 async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await answer_safely(query)
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     trial_status = settings.get('free_trial_status', '0')
     trial_button_text = "\u274C غیرفعال کردن تست" if trial_status == '1' else "\u2705 فعال کردن تست"
     trial_button_callback = "set_trial_status_0" if trial_status == '1' else "set_trial_status_1"
@@ -1643,7 +1705,7 @@ async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_toggle_trial_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     new_status = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_status'", (new_status,))
+    set_setting('free_trial_status', new_status)
     await query.answer(f"وضعیت تست رایگان {'فعال' if new_status == '1' else 'غیرفعال'} شد.", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -1652,7 +1714,7 @@ async def admin_toggle_trial_status(update: Update, context: ContextTypes.DEFAUL
 async def admin_reseller_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     enabled = settings.get('reseller_enabled', '1') == '1'
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     percent = int((settings.get('reseller_discount_percent') or '50') or 50)
@@ -1681,7 +1743,7 @@ async def admin_toggle_reseller(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     val = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('reseller_enabled', ?)", (val,))
+    set_setting('reseller_enabled', val)
     return await admin_reseller_menu(update, context)
 
 
@@ -1724,7 +1786,7 @@ async def admin_reseller_set_value_save(update: Update, context: ContextTypes.DE
         await update.message.reply_text("جلسه منقضی شده است.")
         return await admin_reseller_menu(update, context)
     val = _normalize_digits(update.message.text.strip())
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, val))
+    set_setting(key, val)
     context.user_data.pop('reseller_edit_key', None)
     await update.message.reply_text("ذخیره شد.")
     # Return to reseller menu
@@ -1791,7 +1853,7 @@ async def admin_reseller_approve(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("این درخواست قبلا بررسی شده است.", show_alert=True)
         return SETTINGS_MENU
     # Activate reseller for user
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     percent = int((settings.get('reseller_discount_percent') or '50') or 50)
     days = int((settings.get('reseller_duration_days') or '30') or 30)
     cap = int((settings.get('reseller_max_purchases') or '10') or 10)
@@ -1830,7 +1892,7 @@ async def admin_toggle_usd_mode(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'usd_irt_mode'", (target,))
+    set_setting('usd_irt_mode', target)
     return await admin_settings_manage(update, context)
 
 
@@ -1980,8 +2042,8 @@ async def admin_settings_ask(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_settings_save_trial(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         days, gb = update.message.text.split('-')
-        execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_days'", (days.strip(),))
-        execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_gb'", (gb.strip(),))
+        set_setting('free_trial_days', days.strip())
+        set_setting('free_trial_gb', gb.strip())
         await update.message.reply_text("\u2705 تنظیمات تست رایگان با موفقیت ذخیره شد.")
     except Exception:
         await update.message.reply_text("فرمت نامعتبر است. لطفا با فرمت `روز-حجم` وارد کنید.")
@@ -1999,6 +2061,7 @@ async def admin_settings_save_payment_text(update: Update, context: ContextTypes
         await update.message.reply_text("ورودی نامعتبر است. متن خالی ارسال نکنید.")
         return ConversationHandler.END
     execute_db("UPDATE messages SET text = ? WHERE message_name = ?", (new_text, 'payment_info_text'))
+    invalidate_render_cache()
     context.user_data.pop('awaiting_admin', None)
     await update.message.reply_text("\u2705 متن پرداخت با موفقیت ذخیره شد.")
     # If invoked globally, refresh settings view
@@ -2368,7 +2431,7 @@ async def admin_panel_inbounds_menu(update: Update, context: ContextTypes.DEFAUL
                     try:
                         from ..panel import MarzneshinAPI as _MZ
                         alt = _MZ(prow)
-                        found, msg = alt.list_inbounds()
+                        found, msg = await alt.run(alt.list_inbounds)
                         logger.info(f"Auto-discover fallback (apiv2) used for panel {panel_id}: {bool(found)}")
                     except Exception as _e:
                         logger.error(f"Auto-discover apiv2 fallback failed: {_e}")
@@ -2558,6 +2621,7 @@ async def msg_add_receive_content(update: Update, context: ContextTypes.DEFAULT_
         "INSERT INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
         (message_name, text, file_id, file_type),
     )
+    invalidate_render_cache()
     await update.message.reply_text(f"\u2705 پیام جدید با نام `{message_name}` ساخته شد.")
     context.user_data.clear()
     return await send_admin_panel(update, context)
@@ -2598,6 +2662,7 @@ async def admin_messages_edit_text_save(update: Update, context: ContextTypes.DE
     message_name = context.user_data['editing_message_name']
     new_text = update.message.text
     execute_db("UPDATE messages SET text = ? WHERE message_name = ?", (new_text, message_name))
+    invalidate_render_cache()
     await update.message.reply_text("\u2705 متن با موفقیت بروزرسانی شد.")
     context.user_data.clear()
     return await send_admin_panel(update, context)
@@ -2627,6 +2692,7 @@ async def admin_button_delete(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     button_id = int(query.data.replace("btn_delete_", ""))
     execute_db("DELETE FROM buttons WHERE id = ?", (button_id,))
+    invalidate_render_cache()
     await query.answer("دکمه حذف شد.", show_alert=True)
     return await admin_buttons_menu(update, context)
 
@@ -2684,6 +2750,7 @@ async def admin_button_add_save(update: Update, context: ContextTypes.DEFAULT_TY
         "INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)",
         (b['menu_name'], b['text'], b['target'], b['is_url'], b['row'], b['col']),
     )
+    invalidate_render_cache()
     await update.message.reply_text("\u2705 دکمه با موفقیت اضافه شد.")
     return await admin_buttons_menu(update, context)
 
@@ -2743,31 +2810,21 @@ async def admin_broadcast_execute(update: Update, context: ContextTypes.DEFAULT_
 
 
 # --- Stats ---
+def _stats_figures():
+    """User counters and today's / this month's revenue, read from one snapshot."""
+    with read_snapshot() as snap:
+        c = counters('users', 'free_trials', 'buyers', fetch=snap.query)
+        # Revenue: final_price if present else plan price, summed per day by the rollup triggers
+        daily = stats_revenue(stats_today(), fetch=snap.query)['order_total']
+        monthly = stats_revenue(month_start(), stats_today(), fetch=snap.query)['order_total']
+    return c, daily, monthly
+
+
 async def admin_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    total_users = query_db("SELECT COUNT(user_id) as c FROM users", one=True)['c']
-    trial_users = query_db("SELECT COUNT(user_id) as c FROM free_trials", one=True)['c']
-    purchased_users = query_db("SELECT COUNT(DISTINCT user_id) as c FROM orders WHERE status = 'approved'", one=True)['c']
-    # Revenue: sum final_price if present else plan price for approved orders
-    daily_rev = query_db(
-        """
-        SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-        FROM orders o
-        JOIN plans p ON p.id = o.plan_id
-        WHERE o.status='approved' AND date(o.timestamp) = date('now','localtime')
-        """,
-        one=True,
-    )['rev']
-    monthly_rev = query_db(
-        """
-        SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-        FROM orders o
-        JOIN plans p ON p.id = o.plan_id
-        WHERE o.status='approved' AND strftime('%Y-%m', o.timestamp) = strftime('%Y-%m', 'now','localtime')
-        """,
-        one=True,
-    )['rev']
+    c, daily_rev, monthly_rev = await run_report(_stats_figures)
+    total_users, trial_users, purchased_users = c['users'], c['free_trials'], c['buyers']
     text = (
         f"\U0001F4C8 **آمار ربات**\n\n"
         f"\U0001F465 **کل کاربران:** {total_users} نفر\n"
@@ -2822,31 +2879,35 @@ async def admin_orders_manage(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     return await admin_orders_menu(update, context)
 
-async def admin_orders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0) -> int:
-    """Show orders management menu with pagination (15 per page)"""
+# Newest first; ids follow creation order, so this is the order timestamp order too
+_ORDERS_LIST = Keyset(
+    """SELECT o.id, o.user_id, o.status, o.timestamp, p.name as plan_name, 
+       COALESCE(o.final_price, p.price) as price
+       FROM orders o
+       LEFT JOIN plans p ON p.id = o.plan_id""",
+    table='orders', alias='o', key=('o.id',),
+)
+
+
+def _orders_overview(per_page: int, cursor: str | None):
+    """Order counters and one page of orders, read from one snapshot."""
+    c = counters('orders', 'orders:pending', 'orders:approved', 'orders:active', 'orders:rejected')
+    total_orders, pending_orders, rejected_orders = c['orders'], c['orders:pending'], c['orders:rejected']
+    approved_orders = c['orders:approved'] + c['orders:active']
+    with read_snapshot() as snap:
+        orders, prev_cursor, next_cursor = _ORDERS_LIST.page(cursor=cursor, size=per_page, fetch=snap.query)
+    return total_orders, pending_orders, approved_orders, rejected_orders, orders, prev_cursor, next_cursor
+
+
+async def admin_orders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, cursor: str = None) -> int:
+    """Show orders management menu with keyset pagination (15 per page)"""
     query = update.callback_query
     await query.answer()
     
-    # Get order statistics
-    total_orders = query_db("SELECT COUNT(*) as c FROM orders", one=True)['c']
-    pending_orders = query_db("SELECT COUNT(*) as c FROM orders WHERE status='pending'", one=True)['c']
-    approved_orders = query_db("SELECT COUNT(*) as c FROM orders WHERE status IN ('approved', 'active')", one=True)['c']
-    rejected_orders = query_db("SELECT COUNT(*) as c FROM orders WHERE status='rejected'", one=True)['c']
-    
     # Pagination
     per_page = 15
-    offset = page * per_page
-    total_pages = max(1, (total_orders + per_page - 1) // per_page)
-    
-    # Get orders for current page
-    orders = query_db(
-        """SELECT o.id, o.user_id, o.status, o.timestamp, p.name as plan_name, 
-           COALESCE(o.final_price, p.price) as price
-           FROM orders o
-           LEFT JOIN plans p ON p.id = o.plan_id
-           ORDER BY o.timestamp DESC
-           LIMIT ? OFFSET ?""",
-        (per_page, offset)
+    total_orders, pending_orders, approved_orders, rejected_orders, orders, prev_cursor, next_cursor = await run_report(
+        _orders_overview, per_page, cursor
     )
     
     text = (
@@ -2856,7 +2917,6 @@ async def admin_orders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         f"• در انتظار تأیید: {pending_orders:,}\n"
         f"• تأیید شده: {approved_orders:,}\n"
         f"• رد شده: {rejected_orders:,}\n\n"
-        f"📄 <b>صفحه {page + 1} از {total_pages}</b>\n\n"
     )
     
     if orders:
@@ -2872,13 +2932,12 @@ async def admin_orders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
     keyboard = []
     
     # Pagination buttons
-    if total_pages > 1:
-        nav_row = []
-        if page > 0:
-            nav_row.append(InlineKeyboardButton("◀️ قبلی", callback_data=f'admin_orders_page_{page-1}'))
-        nav_row.append(InlineKeyboardButton(f"📄 {page + 1}/{total_pages}", callback_data='noop'))
-        if page < total_pages - 1:
-            nav_row.append(InlineKeyboardButton("▶️ بعدی", callback_data=f'admin_orders_page_{page+1}'))
+    nav_row = []
+    if prev_cursor:
+        nav_row.append(InlineKeyboardButton("◀️ قبلی", callback_data=f'admin_orders_page_{prev_cursor}'))
+    if next_cursor:
+        nav_row.append(InlineKeyboardButton("▶️ بعدی", callback_data=f'admin_orders_page_{next_cursor}'))
+    if nav_row:
         keyboard.append(nav_row)
     
     keyboard.append([InlineKeyboardButton("⏳ سفارشات در انتظار", callback_data='admin_orders_pending')])
@@ -2972,23 +3031,38 @@ async def backup_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return BACKUP_CHOOSE_PANEL
 
 
+def _backup_progress(message):
+    """Progress callback for abackup_to_tempfile that edits `message` with the percentage done."""
+    async def _show(done, total):
+        try:
+            await message.edit_text(f"⏳ در حال بکاپ‌گیری از دیتابیس... {done * 100 // max(total, 1)}%")
+        except Exception:
+            pass
+    return _show
+
+
+def _backup_summary(db_backup) -> str:
+    if not db_backup:
+        return "\n⚠️ دیتابیس ربات در بکاپ نیست (لاگ را ببینید)."
+    return f"\n🗄 دیتابیس: {db_backup['bytes'] / 1048576:.1f} MB در {db_backup['seconds']:.1f} ثانیه"
+
+
 async def admin_generate_backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.message.edit_text("در حال آماده‌سازی فایل ZIP بکاپ... لطفا صبر کنید.")
 
     target = query.data.split('_')[-1]
-    panel_ids = [p['id'] for p in query_db("SELECT id FROM panels")] if target == 'all' else [int(target)]
+    panel_ids = query_column("SELECT id FROM panels") if target == 'all' else [int(target)]
 
     if not panel_ids:
         await query.message.edit_text("خطا: پنلی برای بکاپ‌گیری یافت نشد.")
         return await send_admin_panel(update, context)
 
-    import io as _io
     import json as _json
+    import tempfile as _tempfile
     import zipfile as _zipfile
-    from ..config import DB_NAME
 
-    zip_buffer = _io.BytesIO()
+    zip_buffer = _tempfile.TemporaryFile()
     total_users_count = 0
     with _zipfile.ZipFile(zip_buffer, mode='w', compression=_zipfile.ZIP_DEFLATED) as zf:
         # Add README with restore instructions
@@ -3040,12 +3114,16 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
 """
         zf.writestr('restore.sh', restore_script.encode('utf-8'))
         
-        # Include bot database
+        # Include bot database: online backup into a temp file, then streamed into the ZIP
+        db_backup = None
         try:
-            with open(DB_NAME, 'rb') as fdb:
-                zf.writestr('bot_db.sqlite', fdb.read())
+            db_backup = await abackup_to_tempfile(_backup_progress(query.message))
+            await run_report(zf.write, db_backup['path'], 'bot_db.sqlite')
         except Exception as e:
             logger.error(f"Could not include bot DB in backup: {e}")
+        finally:
+            if db_backup:
+                os.remove(db_backup['path'])
         # Add per-panel snapshots
         for panel_id in panel_ids:
             try:
@@ -3064,9 +3142,9 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
                 # Clients/users snapshot via panel API when possible
                 api = VpnPanelAPI(panel_id=panel_id)
                 users_payload = []
-                # Marzban supports get_all_users
+                # Marzban-like panels: their user list; X-UI-like panels are dumped client by client below
                 try:
-                    users, msg = await api.get_all_users()
+                    users, msg = (None, None) if api.indexes_clients else await api.get_all_users()
                 except Exception as e:
                     users, msg = None, str(e)
                 if users:
@@ -3076,7 +3154,7 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
                     # Try to enumerate clients from inbounds for X-UI-like panels
                     list_inb = None
                     try:
-                        list_inb, _ = api.list_inbounds()
+                        list_inb, _ = await api.run(api.list_inbounds)
                     except Exception:
                         list_inb = None
                     if list_inb:
@@ -3114,13 +3192,13 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
 
         # Bot-wide snapshots: members, services, wallets, plans, panels, stats, admins
         try:
-            users_tbl = query_db("SELECT user_id, first_name, join_date, referrer_id FROM users ORDER BY user_id") or []
+            users_tbl = await areport_query("SELECT user_id, first_name, join_date, referrer_id FROM users ORDER BY user_id") or []
             zf.writestr("users.json", _json.dumps(users_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add users.json: {e}")
 
         try:
-            orders_tbl = query_db(
+            orders_tbl = await areport_query(
                 "SELECT id, user_id, plan_id, status, marzban_username, timestamp, final_price, panel_id, panel_type, last_link, is_trial FROM orders ORDER BY id"
             ) or []
             zf.writestr("services.json", _json.dumps(orders_tbl, ensure_ascii=False, indent=2))
@@ -3128,46 +3206,28 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
             logger.error(f"Could not add services.json: {e}")
 
         try:
-            wallets_tbl = query_db("SELECT user_id, balance FROM user_wallets ORDER BY user_id") or []
+            wallets_tbl = await areport_query("SELECT user_id, balance FROM user_wallets ORDER BY user_id") or []
             zf.writestr("wallet_balances.json", _json.dumps(wallets_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add wallet_balances.json: {e}")
 
         try:
-            plans_tbl = query_db("SELECT id, name, description, price, duration_days, traffic_gb FROM plans ORDER BY id") or []
+            plans_tbl = await areport_query("SELECT id, name, description, price, duration_days, traffic_gb FROM plans ORDER BY id") or []
             zf.writestr("plans.json", _json.dumps(plans_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add plans.json: {e}")
 
         try:
-            panels_tbl = query_db("SELECT id, name, panel_type, url, sub_base FROM panels ORDER BY id") or []
+            panels_tbl = await areport_query("SELECT id, name, panel_type, url, sub_base FROM panels ORDER BY id") or []
             zf.writestr("panels.json", _json.dumps(panels_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add panels.json: {e}")
 
         try:
-            total_users = (query_db("SELECT COUNT(*) AS c FROM users", one=True) or {}).get('c', 0)
-            buyers = (query_db("SELECT COUNT(DISTINCT user_id) AS c FROM orders WHERE status='approved'", one=True) or {}).get('c', 0)
-            daily_rev = (query_db(
-                """
-                SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-                FROM orders o
-                JOIN plans p ON p.id = o.plan_id
-                WHERE o.status='approved' AND date(o.timestamp) = date('now','localtime')
-                """,
-                one=True,
-            ) or {}).get('rev', 0)
-            monthly_rev = (query_db(
-                """
-                SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-                FROM orders o
-                JOIN plans p ON p.id = o.plan_id
-                WHERE o.status='approved' AND strftime('%Y-%m', o.timestamp) = strftime('%Y-%m', 'now','localtime')
-                """,
-                one=True,
-            ) or {}).get('rev', 0)
-            total_orders = (query_db("SELECT COUNT(*) AS c FROM orders", one=True) or {}).get('c', 0)
-            approved_orders = (query_db("SELECT COUNT(*) AS c FROM orders WHERE status='approved'", one=True) or {}).get('c', 0)
+            c = await run_report(counters, 'users', 'buyers', 'orders', 'orders:approved')
+            total_users, buyers, total_orders, approved_orders = c['users'], c['buyers'], c['orders'], c['orders:approved']
+            daily_rev = (await run_report(stats_revenue, stats_today()))['order_total']
+            monthly_rev = (await run_report(stats_revenue, month_start(), stats_today()))['order_total']
             stats_obj = {
                 'total_users': int(total_users or 0),
                 'buyers': int(buyers or 0),
@@ -3181,7 +3241,7 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
             logger.error(f"Could not add stats.json: {e}")
 
         try:
-            add_admins = [row['user_id'] for row in (query_db("SELECT user_id FROM admins ORDER BY user_id") or [])]
+            add_admins = [row['user_id'] for row in (await areport_query("SELECT user_id FROM admins ORDER BY user_id") or [])]
             admins_obj = {
                 'primary_admin_id': ADMIN_ID,
                 'additional_admin_ids': add_admins,
@@ -3193,10 +3253,12 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
     zip_buffer.seek(0)
     filename = f"panel_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
     file_to_send = InputFile(zip_buffer, filename=filename)
+    zip_buffer.close()
+    caption = f"✅ فایل بکاپ آماده شد. مجموع کاربران: {total_users_count}" + _backup_summary(db_backup)
     try:
-        await context.bot.send_document(chat_id=query.message.chat_id, document=file_to_send, caption=f"✅ فایل بکاپ آماده شد. مجموع کاربران: {total_users_count}")
+        await context.bot.send_document(chat_id=query.message.chat_id, document=file_to_send, caption=caption)
     except TelegramError:
-        await context.bot.send_document(chat_id=ADMIN_ID, document=file_to_send, caption=f"✅ فایل بکاپ آماده شد. مجموع کاربران: {total_users_count}")
+        await context.bot.send_document(chat_id=ADMIN_ID, document=file_to_send, caption=caption)
     try:
         await query.message.delete()
     except Exception:
@@ -3211,18 +3273,17 @@ async def admin_quick_backup(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.message.edit_text("⏳ <b>در حال آماده‌سازی فایل بکاپ...</b>\n\nلطفاً صبر کنید، این کار ممکن است چند لحظه طول بکشد.", parse_mode=ParseMode.HTML)
     
     # Get all panels for backup
-    panel_ids = [p['id'] for p in query_db("SELECT id FROM panels")]
+    panel_ids = query_column("SELECT id FROM panels")
     
     if not panel_ids:
         await query.message.edit_text("❌ هیچ پنلی برای بکاپ‌گیری یافت نشد.")
         return await send_admin_panel(update, context)
     
-    import io as _io
     import json as _json
+    import tempfile as _tempfile
     import zipfile as _zipfile
-    from ..config import DB_NAME
     
-    zip_buffer = _io.BytesIO()
+    zip_buffer = _tempfile.TemporaryFile()
     total_users_count = 0
     
     with _zipfile.ZipFile(zip_buffer, mode='w', compression=_zipfile.ZIP_DEFLATED) as zf:
@@ -3275,12 +3336,16 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
 """
         zf.writestr('restore.sh', restore_script.encode('utf-8'))
         
-        # Include bot database
+        # Include bot database: online backup into a temp file, then streamed into the ZIP
+        db_backup = None
         try:
-            with open(DB_NAME, 'rb') as fdb:
-                zf.writestr('bot_db.sqlite', fdb.read())
+            db_backup = await abackup_to_tempfile(_backup_progress(query.message))
+            await run_report(zf.write, db_backup['path'], 'bot_db.sqlite')
         except Exception as e:
             logger.error(f"Could not include bot DB in backup: {e}")
+        finally:
+            if db_backup:
+                os.remove(db_backup['path'])
         
         # Add per-panel snapshots
         for panel_id in panel_ids:
@@ -3310,73 +3375,73 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
         
         # Bot-wide snapshots
         try:
-            users_tbl = query_db("SELECT user_id, first_name, join_date, referrer_id FROM users ORDER BY user_id") or []
+            users_tbl = await areport_query("SELECT user_id, first_name, join_date, referrer_id FROM users ORDER BY user_id") or []
             zf.writestr("users.json", _json.dumps(users_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add users.json: {e}")
         
         try:
-            orders_tbl = query_db("SELECT id, user_id, plan_id, status, marzban_username, timestamp, final_price, panel_id, panel_type, last_link, is_trial FROM orders ORDER BY id") or []
+            orders_tbl = await areport_query("SELECT id, user_id, plan_id, status, marzban_username, timestamp, final_price, panel_id, panel_type, last_link, is_trial FROM orders ORDER BY id") or []
             zf.writestr("services.json", _json.dumps(orders_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add services.json: {e}")
         
         try:
-            wallets_tbl = query_db("SELECT user_id, balance FROM user_wallets ORDER BY user_id") or []
+            wallets_tbl = await areport_query("SELECT user_id, balance FROM user_wallets ORDER BY user_id") or []
             zf.writestr("wallet_balances.json", _json.dumps(wallets_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add wallet_balances.json: {e}")
         
         try:
-            plans_tbl = query_db("SELECT id, name, description, price, duration_days, traffic_gb FROM plans ORDER BY id") or []
+            plans_tbl = await areport_query("SELECT id, name, description, price, duration_days, traffic_gb FROM plans ORDER BY id") or []
             zf.writestr("plans.json", _json.dumps(plans_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add plans.json: {e}")
         
         try:
-            panels_tbl = query_db("SELECT id, name, panel_type, url, sub_base FROM panels ORDER BY id") or []
+            panels_tbl = await areport_query("SELECT id, name, panel_type, url, sub_base FROM panels ORDER BY id") or []
             zf.writestr("panels.json", _json.dumps(panels_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add panels.json: {e}")
         
         try:
-            cards_tbl = query_db("SELECT card_number, holder_name FROM cards ORDER BY id") or []
+            cards_tbl = await areport_query("SELECT card_number, holder_name FROM cards ORDER BY id") or []
             zf.writestr("cards.json", _json.dumps(cards_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add cards.json: {e}")
         
         try:
-            tickets_tbl = query_db("SELECT * FROM tickets ORDER BY id") or []
+            tickets_tbl = await areport_query("SELECT * FROM tickets ORDER BY id") or []
             zf.writestr("tickets.json", _json.dumps(tickets_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add tickets.json: {e}")
         
         try:
-            settings_tbl = query_db("SELECT key, value FROM settings ORDER BY key") or []
+            settings_tbl = settings_cache.rows()
             zf.writestr("settings.json", _json.dumps(settings_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add settings.json: {e}")
         
         try:
-            discounts_tbl = query_db("SELECT * FROM discount_codes ORDER BY id") or []
+            discounts_tbl = await areport_query("SELECT * FROM discount_codes ORDER BY id") or []
             zf.writestr("discount_codes.json", _json.dumps(discounts_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add discount_codes.json: {e}")
         
         try:
-            refs_tbl = query_db("SELECT * FROM referrals ORDER BY id") or []
+            refs_tbl = await areport_query("SELECT * FROM referrals ORDER BY id") or []
             zf.writestr("referrals.json", _json.dumps(refs_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add referrals.json: {e}")
         
         try:
-            wallet_tx_tbl = query_db("SELECT * FROM wallet_transactions ORDER BY id") or []
+            wallet_tx_tbl = await areport_query("SELECT * FROM wallet_transactions ORDER BY id") or []
             zf.writestr("wallet_transactions.json", _json.dumps(wallet_tx_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add wallet_transactions.json: {e}")
         
         try:
-            admins_tbl = query_db("SELECT user_id FROM admins ORDER BY user_id") or []
+            admins_tbl = await areport_query("SELECT user_id FROM admins ORDER BY user_id") or []
             zf.writestr("admins.json", _json.dumps(admins_tbl, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Could not add admins.json: {e}")
@@ -3385,10 +3450,12 @@ echo "✅ Restore complete! Check: sudo systemctl status wingsbot"
     filename = f"panel_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
     file_to_send = InputFile(zip_buffer, filename=filename)
     
+    zip_buffer.close()
+    caption = f"✅ فایل بکاپ آماده شد. مجموع کاربران پنل: {total_users_count}" + _backup_summary(db_backup)
     try:
-        await context.bot.send_document(chat_id=query.message.chat_id, document=file_to_send, caption=f"✅ فایل بکاپ آماده شد. مجموع کاربران پنل: {total_users_count}")
+        await context.bot.send_document(chat_id=query.message.chat_id, document=file_to_send, caption=caption)
     except TelegramError:
-        await context.bot.send_document(chat_id=ADMIN_ID, document=file_to_send, caption=f"✅ فایل بکاپ آماده شد. مجموع کاربران پنل: {total_users_count}")
+        await context.bot.send_document(chat_id=ADMIN_ID, document=file_to_send, caption=caption)
     
     try:
         await query.message.delete()
@@ -3427,13 +3494,13 @@ async def admin_set_usd_rate_save(update: Update, context: ContextTypes.DEFAULT_
         else:
             val = update.message.text.strip()
         if val == '-' or val == '' or val.lower() == 'clear':
-            execute_db("UPDATE settings SET value = NULL WHERE key = 'usd_irt_manual'", ())
+            set_setting('usd_irt_manual', None)
             await update.message.reply_text("نرخ دلار پاک شد؛ از نرخ API استفاده خواهد شد.")
         else:
             rate = int(float(val))
             if rate <= 0:
                 raise ValueError()
-            execute_db("UPDATE settings SET value = ? WHERE key = 'usd_irt_manual'", (str(rate),))
+            set_setting('usd_irt_manual', str(rate))
             await update.message.reply_text("نرخ دلار ذخیره شد.")
     except Exception:
         await update.message.reply_text("ورودی نامعتبر است. یک عدد صحیح تومان وارد کنید یا '-' برای پاک کردن.")
@@ -3457,7 +3524,7 @@ async def admin_set_usd_rate_save(update: Update, context: ContextTypes.DEFAULT_
 
 async def admin_clear_usd_cache(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    execute_db("UPDATE settings SET value = '' WHERE key IN ('usd_irt_cached','usd_irt_cached_ts')")
+    settings_cache.set_many({'usd_irt_cached': '', 'usd_irt_cached_ts': ''})
     await query.answer("کش دلار پاک شد.", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -3465,35 +3532,35 @@ async def admin_clear_usd_cache(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_toggle_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'pay_card_enabled'", (val,))
+    set_setting('pay_card_enabled', val)
     return await admin_settings_manage(update, context)
 
 
 async def admin_toggle_pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'pay_crypto_enabled'", (val,))
+    set_setting('pay_crypto_enabled', val)
     return await admin_settings_manage(update, context)
 
 
 async def admin_toggle_pay_gateway(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'pay_gateway_enabled'", (val,))
+    set_setting('pay_gateway_enabled', val)
     return await admin_settings_manage(update, context)
 
 
 async def admin_toggle_gateway_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     t = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'gateway_type'", (t,))
+    set_setting('gateway_type', t)
     return await admin_settings_manage(update, context)
 
 
 async def admin_set_gateway_api_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     context.user_data['gateway_setup'] = {'step': 1, 'type': gateway_type}
     if gateway_type == 'zarinpal':
@@ -3514,7 +3581,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
             if len(txt) < 5:
                 await update.message.reply_text("MerchantID نامعتبر است. دوباره وارد کنید:")
                 return SETTINGS_AWAIT_GATEWAY_API
-            execute_db("UPDATE settings SET value = ? WHERE key = 'zarinpal_merchant_id'", (txt,))
+            set_setting('zarinpal_merchant_id', txt)
             context.user_data['gateway_setup']['step'] = 2
             await update.message.reply_text("مرحله 2/2: Callback URL را وارد کنید (مثال: https://site.com/pay/callback):")
             return SETTINGS_AWAIT_GATEWAY_API
@@ -3522,7 +3589,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
             if not (txt.startswith('http://') or txt.startswith('https://')):
                 await update.message.reply_text("Callback URL نامعتبر است. با http(s) شروع شود:")
                 return SETTINGS_AWAIT_GATEWAY_API
-            execute_db("UPDATE settings SET value = ? WHERE key = 'gateway_callback_url'", (txt,))
+            set_setting('gateway_callback_url', txt)
             await update.message.reply_text("اطلاعات زرین‌پال ذخیره شد.")
             context.user_data.pop('gateway_setup', None)
             return await admin_settings_manage(update, context)
@@ -3531,7 +3598,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
             if len(txt) < 4:
                 await update.message.reply_text("PIN نامعتبر است. دوباره وارد کنید:")
                 return SETTINGS_AWAIT_GATEWAY_API
-            execute_db("UPDATE settings SET value = ? WHERE key = 'aghapay_pin'", (txt,))
+            set_setting('aghapay_pin', txt)
             context.user_data['gateway_setup']['step'] = 2
             await update.message.reply_text("مرحله 2/2: Callback URL را وارد کنید (اختیاری، برای رد این مرحله '-' بزنید):")
             return SETTINGS_AWAIT_GATEWAY_API
@@ -3540,17 +3607,26 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
                 if not (txt.startswith('http://') or txt.startswith('https://')):
                     await update.message.reply_text("Callback URL نامعتبر است. با http(s) شروع شود یا '-' برای رد:")
                     return SETTINGS_AWAIT_GATEWAY_API
-                execute_db("UPDATE settings SET value = ? WHERE key = 'gateway_callback_url'", (txt,))
+                set_setting('gateway_callback_url', txt)
             await update.message.reply_text("اطلاعات آقای پرداخت ذخیره شد.")
             context.user_data.pop('gateway_setup', None)
             return await admin_settings_manage(update, context)
 
 
+_PENDING_WALLET_TX = Keyset(
+    "SELECT id, user_id, amount, direction, method, status, created_at FROM wallet_transactions",
+    table='wallet_transactions', key=('id',),
+)
+
+
 async def admin_wallet_tx_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     if query:
         await query.answer()
-    rows = query_db("SELECT id, user_id, amount, direction, method, status, created_at FROM wallet_transactions WHERE status = 'pending' ORDER BY id DESC LIMIT 30")
+    cursor = None
+    if query and (query.data or '').startswith('admin_wallet_tx_page_'):
+        cursor = query.data.split('_')[-1]
+    rows, prev_cursor, next_cursor = _PENDING_WALLET_TX.page("status = 'pending'", cursor=cursor, size=10)
     text = "\U0001F4B8 درخواست‌های شارژ کیف پول (در انتظار تایید)\n\n"
     keyboard = []
     if not rows:
@@ -3565,6 +3641,13 @@ async def admin_wallet_tx_menu(update: Update, context: ContextTypes.DEFAULT_TYP
                 InlineKeyboardButton("\u2705 تایید", callback_data=f"wallet_tx_approve_{r['id']}"),
                 InlineKeyboardButton("\u274C رد", callback_data=f"wallet_tx_reject_{r['id']}")
             ])
+    nav = []
+    if prev_cursor:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_wallet_tx_page_{prev_cursor}"))
+    if next_cursor:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_wallet_tx_page_{next_cursor}"))
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("\u2795 افزایش دستی", callback_data="wallet_adjust_start_credit"), InlineKeyboardButton("\u2796 کاهش دستی", callback_data="wallet_adjust_start_debit")])
     keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت به تنظیمات", callback_data="admin_settings_manage")])
 
@@ -3610,10 +3693,34 @@ async def admin_wallet_tx_view(update: Update, context: ContextTypes.DEFAULT_TYP
     return ADMIN_WALLET_MENU
 
 
-def _wallet_apply_balance(user_id: int, amount: int, direction: str):
-    delta = amount if direction == 'credit' else -amount
-    execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user_id,))
-    execute_db("UPDATE user_wallets SET balance = balance + ? WHERE user_id = ?", (delta, user_id))
+def _wallet_apply_balance(tx, tx_id: int, user_id: int, amount: int, direction: str, kind: str) -> bool:
+    """Ledger entry for wallet_transactions row `tx_id` inside `tx`; debits only succeed if the balance covers them."""
+    signed = int(amount) if direction == 'credit' else -int(amount)
+    return tx.apply_wallet_entry(user_id, signed, kind, f"wallet_tx:{tx_id}") is not None
+
+
+def _wallet_manual_adjust(user_id: int, amount: int, direction: str) -> bool:
+    with transaction() as tx:
+        tx_id = tx.execute(
+            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, ?, 'manual', 'approved', ?)",
+            (user_id, amount, direction, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        )
+        if not _wallet_apply_balance(tx, tx_id, user_id, amount, direction, 'manual'):
+            tx.rollback()
+            return False
+    return True
+
+
+def _wallet_approve(tx_id: int, r: dict) -> bool:
+    """Status flip and balance change commit together; the status guard stops a double approve."""
+    with transaction() as tx:
+        tx.execute("UPDATE wallet_transactions SET status = 'approved' WHERE id = ? AND status = 'pending'", (tx_id,))
+        applied = tx.rowcount == 1 and _wallet_apply_balance(
+            tx, tx_id, r['user_id'], r['amount'], r['direction'], r.get('method') or 'topup'
+        )
+        if not applied:
+            tx.rollback()
+    return applied
 
 
 async def admin_wallet_tx_approve(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -3624,8 +3731,14 @@ async def admin_wallet_tx_approve(update: Update, context: ContextTypes.DEFAULT_
     if not r or r.get('status') != 'pending':
         await query.answer("نامعتبر", show_alert=True)
         return ADMIN_WALLET_MENU
-    execute_db("UPDATE wallet_transactions SET status = 'approved' WHERE id = ?", (tx_id,))
-    _wallet_apply_balance(r['user_id'], r['amount'], r['direction'])
+    try:
+        applied = await run_db(_wallet_approve, tx_id, r)
+    except Exception as e:
+        logger.error(f"Approving wallet transaction {tx_id} failed: {e}")
+        applied = False
+    if not applied:
+        await query.answer("نامعتبر", show_alert=True)
+        return ADMIN_WALLET_MENU
     # Notify user on credit
     try:
         if (r.get('direction') or '') == 'credit':
@@ -3756,8 +3869,10 @@ async def admin_wallet_adjust_text_router(update: Update, context: ContextTypes.
             if int(bal_row.get('balance') or 0) < amount:
                 await update.message.reply_text("❌ موجودی کاربر کافی نیست برای کسر.")
                 raise ApplicationHandlerStop
-        execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, ?, 'manual', 'approved', ?)", (uid, amount, direc, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        _wallet_apply_balance(uid, amount, direc)
+        applied = await run_db(_wallet_manual_adjust, uid, amount, direc)
+        if not applied:
+            await update.message.reply_text("❌ موجودی کاربر کافی نیست برای کسر.")
+            raise ApplicationHandlerStop
         try:
             if direc == 'credit':
                 bal_row = query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (uid,), one=True)
@@ -3804,8 +3919,10 @@ async def admin_wallet_adjust_text_router(update: Update, context: ContextTypes.
             if int(bal_row.get('balance') or 0) < amount:
                 await update.message.reply_text("❌ موجودی کاربر کافی نیست برای کسر.")
                 raise ApplicationHandlerStop
-        execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, ?, 'manual', 'approved', ?)", (uid, amount, direc, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        _wallet_apply_balance(uid, amount, direc)
+        applied = await run_db(_wallet_manual_adjust, uid, amount, direc)
+        if not applied:
+            await update.message.reply_text("❌ موجودی کاربر کافی نیست برای کسر.")
+            raise ApplicationHandlerStop
         try:
             if direc == 'credit':
                 bal_row = query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (uid,), one=True)
@@ -3840,8 +3957,7 @@ async def admin_wallet_adjust_text_router(update: Update, context: ContextTypes.
         if not query_db("SELECT 1 FROM users WHERE user_id = ?", (uid,), one=True):
             await update.message.reply_text("❌ آیدی کاربر یافت نشد. لطفا آیدی عددی صحیح وارد کنید.")
             raise ApplicationHandlerStop
-        execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'credit', 'manual', 'approved', ?)", (uid, amount, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        _wallet_apply_balance(uid, amount, 'credit')
+        await run_db(_wallet_manual_adjust, uid, amount, 'credit')
         try:
             bal_row = query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (uid,), one=True)
             balance = bal_row.get('balance') if bal_row else 0
@@ -4099,7 +4215,7 @@ async def admin_tutorial_view(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def admin_toggle_signup_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'signup_bonus_enabled'", (val,))
+    set_setting('signup_bonus_enabled', val)
     await query.answer("ذخیره شد.", show_alert=False)
     return await admin_settings_manage(update, context)
 
@@ -4120,7 +4236,7 @@ async def admin_set_signup_bonus_amount_save(update: Update, context: ContextTyp
     except Exception:
         await update.message.reply_text("مبلغ نامعتبر است. یک عدد صحیح وارد کنید:")
         return SETTINGS_AWAIT_SIGNUP_BONUS
-    execute_db("UPDATE settings SET value = ? WHERE key = 'signup_bonus_amount'", (str(amount),))
+    set_setting('signup_bonus_amount', str(amount))
     await update.message.reply_text("ذخیره شد.")
     fake_query = type('obj', (object,), {
         'data': 'admin_settings_manage',
@@ -4132,6 +4248,19 @@ async def admin_set_signup_bonus_amount_save(update: Update, context: ContextTyp
     return await admin_settings_manage(fake_update, context)
 
 
+def _credit_referral_bonus(ref_id: int, bonus: int, order_id: int) -> bool:
+    """Credit and log the referral bonus of an order in one transaction; False if it was already credited."""
+    with transaction() as tx:
+        if tx.query("SELECT 1 FROM wallet_transactions WHERE reference = ?", (f"ref_bonus_order_{order_id}",), one=True):
+            return False
+        tx_id = tx.execute(
+            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at, reference, meta) VALUES (?, ?, 'credit', 'referral', 'approved', ?, ?, ?)",
+            (ref_id, bonus, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), f"ref_bonus_order_{order_id}", None)
+        )
+        tx.credit_wallet(ref_id, bonus, 'referral', f"wallet_tx:{tx_id}")
+    return True
+
+
 async def _apply_referral_bonus(order_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         order = query_db("SELECT id, user_id, plan_id, final_price FROM orders WHERE id = ?", (order_id,), one=True)
@@ -4141,7 +4270,7 @@ async def _apply_referral_bonus(order_id: int, context: ContextTypes.DEFAULT_TYP
         ref_id = user_row.get('referrer_id') if user_row else None
         if not ref_id or int(ref_id) == int(order['user_id']):
             return
-        # idempotency: skip if already credited for this order
+        # idempotency: skip if already credited for this order (re-checked inside the transaction)
         exists = query_db("SELECT 1 FROM wallet_transactions WHERE reference = ?", (f"ref_bonus_order_{order_id}",), one=True)
         if exists:
             return
@@ -4153,7 +4282,7 @@ async def _apply_referral_bonus(order_id: int, context: ContextTypes.DEFAULT_TYP
             base_price = 0
         if base_price <= 0:
             return
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         pct = 10
         try:
             pct = int((settings.get('referral_commission_percent') or '10').strip())
@@ -4161,20 +4290,15 @@ async def _apply_referral_bonus(order_id: int, context: ContextTypes.DEFAULT_TYP
             pct = 10
         pct = max(0, min(100, pct))
         bonus = max(1, int(base_price * (pct / 100.0)))
-        # ensure wallet row and credit
-        execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (ref_id,))
-        execute_db("UPDATE user_wallets SET balance = COALESCE(balance,0) + ? WHERE user_id = ?", (bonus, ref_id))
-        execute_db(
-            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at, reference, meta) VALUES (?, ?, 'credit', 'referral', 'approved', ?, ?, ?)",
-            (ref_id, bonus, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), f"ref_bonus_order_{order_id}", None)
-        )
+        if not await run_db(_credit_referral_bonus, ref_id, bonus, order_id):
+            return
         # notify referrer
         try:
             await context.bot.send_message(chat_id=ref_id, text=f"\U0001F389 پاداش معرفی: `{bonus:,}` تومان")
         except Exception:
             pass
-    except Exception:
-        pass
+    except Exception as e:
+        logger.error(f"Referral bonus for order {order_id} failed: {e}")
 
 
 async def admin_global_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -4258,7 +4382,7 @@ async def admin_setms_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     txt = (update.message.text or '').strip()
     arg = txt[len('/setms'):].strip() if txt.startswith('/setms') else ''
     if arg:
-        execute_db("UPDATE settings SET value = ? WHERE key = 'config_footer_text'", (arg,))
+        set_setting('config_footer_text', arg)
         await update.message.reply_text("✅ متن زیر کانفیگ بروزرسانی شد.")
         return
     context.user_data['awaiting_admin'] = 'set_config_footer'
@@ -4301,7 +4425,7 @@ async def admin_set_config_footer_save(update: Update, context: ContextTypes.DEF
     if context.user_data.get('awaiting_admin') != 'set_config_footer':
         return ConversationHandler.END
     new_text = (update.message.text or '').strip()
-    execute_db("UPDATE settings SET value = ? WHERE key = 'config_footer_text'", (new_text,))
+    set_setting('config_footer_text', new_text)
     context.user_data.pop('awaiting_admin', None)
     await update.message.reply_text("✅ متن زیر کانفیگ ذخیره شد.")
     # Refresh settings view
@@ -4335,7 +4459,7 @@ async def admin_set_ref_percent_save(update: Update, context: ContextTypes.DEFAU
         percent = int(float(txt))
         if percent < 0 or percent > 100:
             raise ValueError()
-        execute_db("UPDATE settings SET value = ? WHERE key = 'referral_commission_percent'", (str(percent),))
+        set_setting('referral_commission_percent', str(percent))
         await update.message.reply_text("✅ درصد کمیسیون ذخیره شد.")
         context.user_data.pop('awaiting_admin', None)
     except Exception:
@@ -4377,7 +4501,7 @@ async def admin_set_trial_panel_choose(update: Update, context: ContextTypes.DEF
     await query.answer()
     panel_id = query.data.split('_')[-1]
     value = '' if panel_id == '0' else panel_id
-    execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_panel_id'", (value,))
+    set_setting('free_trial_panel_id', value)
     await query.answer("ذخیره شد", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -4426,7 +4550,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
             if inbound_id is None:
                 # As last resort, fetch list and pick first
                 try:
-                    inbounds, _ = api.list_inbounds()
+                    inbounds, _ = await api.run(api.list_inbounds)
                     if inbounds:
                         inbound_id = int(inbounds[0].get('id'))
                 except Exception:
@@ -4437,9 +4561,9 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
             username_created, sub_link, message = None, None, None
             try:
                 try:
-                    username_created, sub_link, message = api.create_user_on_inbound(int(inbound_id), order['user_id'], plan, desired)
+                    username_created, sub_link, message = await api.run(api.create_user_on_inbound, int(inbound_id), order['user_id'], plan, desired)
                 except TypeError:
-                    username_created, sub_link, message = api.create_user_on_inbound(int(inbound_id), order['user_id'], plan)
+                    username_created, sub_link, message = await api.run(api.create_user_on_inbound, int(inbound_id), order['user_id'], plan)
             except Exception as e:
                 username_created, sub_link, message = None, None, str(e)
             if not (username_created and sub_link):
@@ -4466,7 +4590,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
             api_confs = []
             if not built_confs and hasattr(api, 'get_configs_for_user_on_inbound'):
                 try:
-                    api_confs = api.get_configs_for_user_on_inbound(int(inbound_id), username_created) or []
+                    api_confs = await api.run(api.get_configs_for_user_on_inbound, int(inbound_id), username_created) or []
                 except Exception:
                     api_confs = []
             display_confs = built_confs or api_confs
@@ -4485,8 +4609,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
                     display_confs = [ _with_name_fragment(c, username_created) for c in display_confs ]
             except Exception:
                 pass
-            footer_row = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-            footer_text = (footer_row.get('value') if footer_row else '') or ''
+            footer_text = get_setting('config_footer_text') or ''
             sub_abs = sub_link
             try:
                 if sub_abs and not sub_abs.startswith('http'):
@@ -4550,7 +4673,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
         inbound_id = default_inbound_id
         if not inbound_id:
             try:
-                inbounds, _ = api.list_inbounds()
+                inbounds, _ = await api.run(api.list_inbounds)
             except Exception:
                 inbounds = []
             if inbounds:
@@ -4573,7 +4696,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
         # Create user on inbound using panel helper
         username_created, sub_link, message = None, None, None
         try:
-            username_created, sub_link, message = api.create_user_on_inbound(int(inbound_id), order['user_id'], plan)
+            username_created, sub_link, message = await api.run(api.create_user_on_inbound, int(inbound_id), order['user_id'], plan)
         except Exception as e:
             username_created, sub_link, message = None, None, str(e)
             logger.error(f"Exception in create_user_on_inbound for order {order_id}: {e}")
@@ -4613,14 +4736,13 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
         api_confs = []
         if not built_confs and hasattr(api, 'get_configs_for_user_on_inbound'):
             try:
-                api_confs = api.get_configs_for_user_on_inbound(int(inbound_id), username_created) or []
+                api_confs = await api.run(api.get_configs_for_user_on_inbound, int(inbound_id), username_created) or []
             except Exception:
                 api_confs = []
         display_confs = built_confs or api_confs
 
         # Footer and message composition
-        footer_row = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-        footer_text = (footer_row.get('value') if footer_row else '') or ''
+        footer_text = get_setting('config_footer_text') or ''
         sub_abs = sub_link
         try:
             if sub_abs and not sub_abs.startswith('http'):
@@ -4652,7 +4774,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     trial_status = settings.get('free_trial_status', '0')
     trial_button_text = "\u274C غیرفعال کردن تست" if trial_status == '1' else "\u2705 فعال کردن تست"
     trial_button_callback = "set_trial_status_0" if trial_status == '1' else "set_trial_status_1"
@@ -2,7 +2,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 
-from ..db import query_db, execute_db
+from ..cache import get_settings, set_setting
 from ..states import ADMIN_CRON_MENU, ADMIN_CRON_AWAIT_HOUR
 from ..helpers.tg import safe_edit_text as _safe_edit_text, answer_safely as _ans
 
@@ -15,7 +15,7 @@ async def admin_cron_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception as e:
         logger.warning(f"Failed to answer callback in cron menu: {e}")
         pass  # Ignore expired callback queries
-    st = {s['key']: s['value'] for s in (query_db("SELECT key, value FROM settings WHERE key IN ('reminder_job_enabled','daily_job_hour')") or [])}
+    st = get_settings()
     enabled = (st.get('reminder_job_enabled') or '1') == '1'
     hour = int((st.get('daily_job_hour') or '9') or 9)
 
@@ -57,7 +57,7 @@ async def admin_cron_toggle_reminders(update: Update, context: ContextTypes.DEFA
     query = update.callback_query
     await query.answer()
     val = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('reminder_job_enabled', ?)", (val,))
+    set_setting('reminder_job_enabled', val)
     await _ans(query, "ذخیره شد.")
     return await admin_cron_menu(update, context)
 
@@ -76,7 +76,7 @@ async def admin_cron_set_hour_save(update: Update, context: ContextTypes.DEFAULT
     except Exception:
         await update.message.reply_text("عدد نامعتبر. ساعتی بین 0 تا 23 وارد کنید.")
         return ADMIN_CRON_AWAIT_HOUR
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('daily_job_hour', ?)", (str(hour),))
+    set_setting('daily_job_hour', hour)
     await update.message.reply_text("ذخیره شد. تغییر ساعت پس از ری‌استارت اعمال می‌شود.")
     # Return to menu with proper async answer
     import asyncio
@@ -3,6 +3,7 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
 from ..db import query_db, execute_db, get_message_text
+from ..cache import get_setting, invalidate_render_cache
 from ..states import (
     ADMIN_MESSAGES_MENU,
     ADMIN_MESSAGES_SELECT,
@@ -20,6 +21,13 @@ from ..helpers.tg import safe_edit_text as _safe_edit_text
 PAGE_SIZE = 10
 
 
+def _save(query: str, args=()):
+    """execute_db for message/button edits; the cached texts and menus are rebuilt on next use."""
+    result = execute_db(query, args)
+    invalidate_render_cache()
+    return result
+
+
 def _md_escape(text: str) -> str:
     if not text:
         return ''
@@ -161,7 +169,7 @@ async def msg_add_receive_content(update: Update, context: ContextTypes.DEFAULT_
         file_id = update.message.audio.file_id
         file_type = 'audio'
         text = update.message.caption or ''
-    execute_db(
+    _save(
         "INSERT INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
         (message_name, text, file_id, file_type),
     )
@@ -214,7 +222,7 @@ async def admin_messages_edit_text_save(update: Update, context: ContextTypes.DE
     if not message_name:
         await update.message.reply_text("ابتدا یک پیام را انتخاب کنید.")
         return ADMIN_MESSAGES_MENU
-    execute_db("UPDATE messages SET text = ? WHERE message_name = ?", (update.message.text, message_name))
+    _save("UPDATE messages SET text = ? WHERE message_name = ?", (update.message.text, message_name))
     await update.message.reply_text("✅ متن پیام بروزرسانی شد.")
     # Back to select view
     fake_query = type('obj', (object,), {'data': f"msg_select_{message_name}", 'message': update.message, 'answer': (lambda *args, **kwargs: None)})
@@ -228,7 +236,7 @@ async def admin_messages_delete(update: Update, context: ContextTypes.DEFAULT_TY
     message_name = context.user_data.get('editing_message_name')
     if not message_name:
         return await admin_messages_menu(update, context)
-    execute_db("DELETE FROM messages WHERE message_name = ?", (message_name,))
+    _save("DELETE FROM messages WHERE message_name = ?", (message_name,))
     await _safe_edit_text(query.message, "✅ پیام حذف شد.")
     # Go back to list
     return await admin_messages_menu(update, context)
@@ -249,12 +257,11 @@ async def admin_buttons_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         # Desired layout: row1: [buy_config_main, get_free_config]; row2: [my_services, ...]
         buy_info = next(({'row': r['row'], 'col': r['col']} for r in existing_rows if r['target'] == 'buy_config_main'), None)
-        trial_status = query_db("SELECT value FROM settings WHERE key = 'free_trial_status'", one=True)
-        trial_enabled = bool(trial_status and (trial_status.get('value') == '1'))
+        trial_enabled = get_setting('free_trial_status') == '1'
 
         # Ensure buy button
         if 'buy_config_main' not in existing_targets:
-            execute_db(
+            _save(
                 "INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)",
                 (message_name, "\U0001F4E1 خرید کانفیگ", 'buy_config_main', 0, 1, 1),
             )
@@ -267,12 +274,12 @@ async def admin_buttons_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if trial_enabled:
             desired_col = 2 if int(buy_info['col']) == 1 else 1
             if 'get_free_config' not in existing_targets:
-                execute_db(
+                _save(
                     "INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)",
                     (message_name, "\U0001F381 دریافت تست", 'get_free_config', 0, int(buy_info['row']), desired_col),
                 )
             elif not (gf_row and int(gf_row['row']) == int(buy_info['row']) and int(gf_row['col']) == desired_col):
-                execute_db("UPDATE buttons SET row = ?, col = ? WHERE menu_name = ? AND target = ?", (int(buy_info['row']), desired_col, message_name, 'get_free_config'))
+                _save("UPDATE buttons SET row = ?, col = ? WHERE menu_name = ? AND target = ?", (int(buy_info['row']), desired_col, message_name, 'get_free_config'))
 
         # Ensure my_services under them (row+1). Add or reposition to first available col in that row.
         ms_row = next(({'row': r['row'], 'col': r['col']} for r in existing_rows if r['target'] == 'my_services'), None)
@@ -281,12 +288,12 @@ async def admin_buttons_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
         row_occupancy = {(int(r['col'])) for r in (query_db("SELECT row, col FROM buttons WHERE menu_name = ? AND row = ?", (message_name, target_row)) or [])}
         desired_ms_col = 1 if 1 not in row_occupancy else 2
         if 'my_services' not in existing_targets:
-            execute_db(
+            _save(
                 "INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)",
                 (message_name, "\U0001F4DD سرویس‌های من", 'my_services', 0, target_row, desired_ms_col),
             )
         elif not (ms_row and int(ms_row['row']) == target_row and int(ms_row['col']) in (1, 2)):
-            execute_db("UPDATE buttons SET row = ?, col = ? WHERE menu_name = ? AND target = ?", (target_row, desired_ms_col, message_name, 'my_services'))
+            _save("UPDATE buttons SET row = ?, col = ? WHERE menu_name = ? AND target = ?", (target_row, desired_ms_col, message_name, 'my_services'))
 
         # Add other core buttons if missing (append in subsequent columns/rows)
         core_extras = [
@@ -303,7 +310,7 @@ async def admin_buttons_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 continue
             if col_cursor == 1:
                 next_row += 1
-            execute_db(
+            _save(
                 "INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)",
                 (message_name, text, target, 0, next_row, col_cursor),
             )
@@ -333,7 +340,7 @@ async def admin_buttons_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_button_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     button_id = int(query.data.replace("btn_delete_", ""))
-    execute_db("DELETE FROM buttons WHERE id = ?", (button_id,))
+    _save("DELETE FROM buttons WHERE id = ?", (button_id,))
     await query.answer("حذف شد", show_alert=True)
     return await admin_buttons_menu(update, context)
 
@@ -418,7 +425,7 @@ async def admin_button_edit_set_is_url(update: Update, context: ContextTypes.DEF
         _, _, _, bid, val = query.data.split('_')
         button_id = int(bid)
         is_url_val = int(val)
-        execute_db("UPDATE buttons SET is_url = ? WHERE id = ?", (is_url_val, button_id))
+        _save("UPDATE buttons SET is_url = ? WHERE id = ?", (is_url_val, button_id))
         await query.answer("نوع دکمه بروزرسانی شد.", show_alert=True)
     except Exception:
         await query.answer("خطا در بروزرسانی نوع دکمه.", show_alert=True)
@@ -436,7 +443,7 @@ async def admin_button_add_receive_text(update: Update, context: ContextTypes.DE
     # Edit-mode: update text
     if context.user_data.get('editing_button_id') and context.user_data.get('editing_button_field') == 'text':
         btn_id = context.user_data['editing_button_id']
-        execute_db("UPDATE buttons SET text = ? WHERE id = ?", (update.message.text, btn_id))
+        _save("UPDATE buttons SET text = ? WHERE id = ?", (update.message.text, btn_id))
         await update.message.reply_text("✅ متن دکمه بروزرسانی شد.")
         context.user_data.pop('editing_button_id', None)
         context.user_data.pop('editing_button_field', None)
@@ -451,7 +458,7 @@ async def admin_button_add_receive_target(update: Update, context: ContextTypes.
     # Edit-mode: update target
     if context.user_data.get('editing_button_id') and context.user_data.get('editing_button_field') == 'target':
         btn_id = context.user_data['editing_button_id']
-        execute_db("UPDATE buttons SET target = ? WHERE id = ?", (update.message.text, btn_id))
+        _save("UPDATE buttons SET target = ? WHERE id = ?", (update.message.text, btn_id))
         await update.message.reply_text("✅ هدف دکمه بروزرسانی شد.")
         context.user_data.pop('editing_button_id', None)
         context.user_data.pop('editing_button_field', None)
@@ -484,7 +491,7 @@ async def admin_button_add_receive_row(update: Update, context: ContextTypes.DEF
         try:
             new_row = int(update.message.text)
             btn_id = context.user_data['editing_button_id']
-            execute_db("UPDATE buttons SET row = ? WHERE id = ?", (new_row, btn_id))
+            _save("UPDATE buttons SET row = ? WHERE id = ?", (new_row, btn_id))
             await update.message.reply_text("✅ سطر دکمه بروزرسانی شد.")
             context.user_data.pop('editing_button_id', None)
             context.user_data.pop('editing_button_field', None)
@@ -508,7 +515,7 @@ async def admin_button_add_save(update: Update, context: ContextTypes.DEFAULT_TY
         try:
             new_col = int(update.message.text)
             btn_id = context.user_data['editing_button_id']
-            execute_db("UPDATE buttons SET col = ? WHERE id = ?", (new_col, btn_id))
+            _save("UPDATE buttons SET col = ? WHERE id = ?", (new_col, btn_id))
             await update.message.reply_text("✅ ستون دکمه بروزرسانی شد.")
             context.user_data.pop('editing_button_id', None)
             context.user_data.pop('editing_button_field', None)
@@ -520,7 +527,7 @@ async def admin_button_add_save(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         context.user_data['new_button']['col'] = int(update.message.text)
         b = context.user_data['new_button']
-        execute_db("INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)", (b['menu_name'], b['text'], b['target'], int(b.get('is_url') or 0), b['row'], b['col']))
+        _save("INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)", (b['menu_name'], b['text'], b['target'], int(b.get('is_url') or 0), b['row'], b['col']))
         await update.message.reply_text("✅ دکمه اضافه شد.")
     except Exception:
         await update.message.reply_text("مقدار نامعتبر است. دوباره وارد کنید:")
@@ -110,7 +110,7 @@ async def admin_panel_health_check(update: Update, context: ContextTypes.DEFAULT
         ok = False
         ptype = (prow.get('panel_type') or '').lower()
         if hasattr(api, 'list_inbounds'):
-            inb, m = api.list_inbounds()
+            inb, m = await api.run(api.list_inbounds)
             ok = bool(inb)
             msg = m or ''
         if not ok and hasattr(api, 'get_all_users'):
@@ -300,7 +300,7 @@ async def admin_panel_receive_pass(update: Update, context: ContextTypes.DEFAULT
     connecting_message = await update.message.reply_text("در حال اتصال به پنل و دریافت لیست اینباندها...")
 
     # The list_inbounds() method in the panel API returns a tuple: (inbounds_list, message)
-    inbounds, msg = api.list_inbounds()
+    inbounds, msg = await api.run(api.list_inbounds)
 
     if not inbounds:
         error_message = msg or "لیست اینباندها خالی است یا خطایی رخ داده است."
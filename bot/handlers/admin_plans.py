@@ -242,7 +242,7 @@ async def admin_plan_bind_panel_choose(update: Update, context: ContextTypes.DEF
                 from ..panel import TxUiAPI as ApiClass
             if ApiClass:
                 api = ApiClass(panel_row)
-                api_inbounds, _ = api.list_inbounds()
+                api_inbounds, _ = await api.run(api.list_inbounds)
                 for ib in (api_inbounds or []):
                     inb_id = int(ib.get('id') or 0)
                     name = ib.get('remark') or ib.get('tag') or str(inb_id)
@@ -0,0 +1,86 @@
+from html import escape
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.ext import ContextTypes
+
+from ..db import run_report
+from ..search import search
+from ..states import ADMIN_USERS_MENU, ADMIN_SEARCH_AWAIT_QUERY
+from ..helpers.tg import safe_edit_text as _safe_edit_text
+
+PAGE_SIZE = 8
+
+_KIND_ICONS = {'user': '👤', 'order': '📦', 'ticket': '🎫', 'ticket_message': '💬'}
+
+
+def _hit_button(hit: dict) -> InlineKeyboardButton | None:
+    kind = hit['kind']
+    label = f"{_KIND_ICONS.get(kind, '•')} {(hit.get('title') or '').strip()}"[:60]
+    if kind == 'user':
+        return InlineKeyboardButton(label, callback_data=f"admin_user_view_{hit['ref']}")
+    if kind == 'order':
+        if hit.get('user_id') is None:
+            return None
+        return InlineKeyboardButton(label, callback_data=f"admin_user_services_{hit['user_id']}")
+    return InlineKeyboardButton(label, callback_data=f"ticket_view_{hit['ref']}")
+
+
+async def _render(context: ContextTypes.DEFAULT_TYPE, page: int):
+    term = context.user_data.get('admin_search') or ''
+    hits = await run_report(search, term, None, PAGE_SIZE + 1, page * PAGE_SIZE)
+    has_next = len(hits) > PAGE_SIZE
+    hits = hits[:PAGE_SIZE]
+
+    text = f"🔎 نتایج جستجو برای <code>{escape(term)}</code> (صفحه {page + 1})\n\n"
+    kb = []
+    if not hits:
+        text += "موردی یافت نشد."
+    for hit in hits:
+        line = f"{_KIND_ICONS.get(hit['kind'], '•')} {escape((hit.get('title') or '').strip())}"
+        if hit.get('snippet'):
+            line += f"\n    <i>{escape(hit['snippet'])}</i>"
+        text += line + "\n"
+        button = _hit_button(hit)
+        if button:
+            kb.append([button])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_search_page_{page - 1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_search_page_{page + 1}"))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("🔎 جستجوی جدید", callback_data="admin_search"), InlineKeyboardButton("🔙 بازگشت", callback_data="admin_main")])
+    return text, InlineKeyboardMarkup(kb)
+
+
+async def admin_search_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    await _safe_edit_text(
+        query.message,
+        "🔎 عبارت جستجو را ارسال کنید:\n"
+        "آیدی یا نام کاربر، شماره یا یوزرنیم سرویس، یا بخشی از متن تیکت",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_main")]]),
+    )
+    return ADMIN_SEARCH_AWAIT_QUERY
+
+
+async def admin_search_receive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['admin_search'] = (update.message.text or '').strip()
+    text, markup = await _render(context, 0)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    return ADMIN_USERS_MENU
+
+
+async def admin_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    try:
+        page = max(0, int(query.data.split('_')[-1]))
+    except Exception:
+        page = 0
+    text, markup = await _render(context, page)
+    await _safe_edit_text(query.message, text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    return ADMIN_USERS_MENU
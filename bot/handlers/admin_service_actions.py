@@ -5,6 +5,7 @@ from telegram.ext import ContextTypes
 
 from ..db import query_db, execute_db
 from ..panel import VpnPanelAPI
+from .renewal import process_renewal_for_order
 from ..states import ADMIN_USERS_MENU
 from ..helpers.tg import safe_edit_text as _safe_edit_text
 from ..config import logger
@@ -79,23 +80,10 @@ async def admin_service_renew_execute(update: Update, context: ContextTypes.DEFA
             await _safe_edit_text(query.message, "❌ سرویس یافت نشد.")
             return ADMIN_USERS_MENU
         
-        # Renew on panel
-        panel_api = VpnPanelAPI(panel_id=order['panel_id'])
-        success, msg = await panel_api.renew_user(
-            username=order['marzban_username'],
-            add_days=order.get('duration_days', 30),
-            add_gb=order.get('traffic_gb', 0)
-        )
+        # Renew on panel with the order's plan; this also moves expires_at on success
+        success, msg = await process_renewal_for_order(order_id, order.get('plan_id'), context)
         
         if success:
-            # Update expiry date in database
-            from datetime import datetime, timedelta
-            new_expiry = datetime.now() + timedelta(days=order.get('duration_days', 30))
-            execute_db(
-                "UPDATE orders SET expiry_date = ? WHERE id = ?",
-                (new_expiry.strftime('%Y-%m-%d'), order_id)
-            )
-            
             # Log admin action
             try:
                 execute_db(
@@ -189,12 +177,12 @@ async def admin_service_delete_execute(update: Update, context: ContextTypes.DEF
         # Delete from panel
         try:
             panel_api = VpnPanelAPI(panel_id=order['panel_id'])
-            await panel_api.delete_user(username=order['marzban_username'])
+            await panel_api.run(panel_api.delete_user, order['marzban_username'])
         except Exception as e:
             logger.error(f"Failed to delete from panel: {e}")
         
         # Delete from database (or mark as deleted)
-        execute_db("UPDATE orders SET status = 'deleted' WHERE id = ?", (order_id,))
+        execute_db("UPDATE orders SET status = 'deleted', deleted_at = datetime('now','localtime') WHERE id = ?", (order_id,))
         
         # Log admin action
         try:
@@ -3,6 +3,7 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler
 
 from ..db import query_db, execute_db
+from ..cache import get_setting, get_settings, set_setting, settings_cache, invalidate_render_cache
 from ..states import SETTINGS_MENU, SETTINGS_AWAIT_TRIAL_DAYS, SETTINGS_AWAIT_PAYMENT_TEXT, SETTINGS_AWAIT_USD_RATE, SETTINGS_AWAIT_GATEWAY_API, SETTINGS_AWAIT_SIGNUP_BONUS, SETTINGS_AWAIT_TRAFFIC_ALERT_VALUE
 from ..helpers.tg import notify_admins, append_footer_buttons as _footer, answer_safely as _ans, safe_edit_text as _safe_edit_text
 from ..config import ADMIN_ID, logger
@@ -23,13 +24,20 @@ def _md_escape(text: str) -> str:
     )
 
 
+_BACKUP_MODE_TITLES = {
+    'full': 'کامل در هر بار',
+    'differential': 'تفاضلی (پایه + تغییرات از پایه)',
+    'incremental': 'افزایشی (پایه + تغییرات از بار قبل)',
+}
+
+
 async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     try:
         await query.answer()
     except Exception:
         pass  # Ignore expired callback queries
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     trial_status = settings.get('free_trial_status', '0')
     trial_button_text = "\u274C غیرفعال کردن تست" if trial_status == '1' else "\u2705 فعال کردن تست"
     trial_button_callback = "set_trial_status_0" if trial_status == '1' else "set_trial_status_1"
@@ -60,6 +68,8 @@ async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TY
     # Auto-backup
     auto_backup_on = (settings.get('auto_backup_enabled') or '0') == '1'
     auto_backup_hours = settings.get('auto_backup_hours') or '12'
+    auto_backup_mode = settings.get('auto_backup_mode') or 'differential'
+    auto_backup_full_every = settings.get('auto_backup_full_every') or '8'
 
     # Join/purchase logs settings
     join_logs_on = (settings.get('join_logs_enabled') or '0') == '1'
@@ -94,7 +104,9 @@ async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TY
         f"━━━━━━━━━━━━━━━━━━━━━━━━\n"
         f"💾 **بکاپ خودکار**\n"
         f"   • وضعیت: {'✅ فعال' if auto_backup_on else '❌ غیرفعال'}\n"
-        f"   • بازه زمانی: هر `{auto_backup_hours}` ساعت\n\n"
+        f"   • بازه زمانی: هر `{auto_backup_hours}` ساعت\n"
+        f"   • نوع: {_BACKUP_MODE_TITLES.get(auto_backup_mode, auto_backup_mode)}"
+        f"{'' if auto_backup_mode == 'full' else f' | پایه کامل هر `{auto_backup_full_every}` بار'}\n\n"
         f"━━━━━━━━━━━━━━━━━━━━━━━━\n"
         f"📊 **لاگ‌های سیستم**\n"
         f"   • لاگ ورود کاربر: {'✅ فعال' if join_logs_on else '❌ غیرفعال'} | چت: `{join_logs_chat}`\n"
@@ -123,6 +135,7 @@ async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TY
         [InlineKeyboardButton(("⏰ هشدار زمان: غیرفعال" if time_alert_on else "⏰ هشدار زمان: فعال"), callback_data=f"toggle_time_alert_{0 if time_alert_on else 1}"), InlineKeyboardButton("📅 تنظیم آستانه زمان (روز)", callback_data="set_time_alert_days_start")],
         # Group 5: Auto-backup
         [InlineKeyboardButton(("بکاپ خودکار: غیرفعال" if auto_backup_on else "بکاپ خودکار: فعال"), callback_data=f"toggle_auto_backup_{0 if auto_backup_on else 1}"), InlineKeyboardButton("بازه بکاپ (ساعت)", callback_data="set_auto_backup_hours_start")],
+        [InlineKeyboardButton(f"نوع بکاپ: {_BACKUP_MODE_TITLES.get(auto_backup_mode, auto_backup_mode)}", callback_data="cycle_auto_backup_mode")],
         # Group 6: Admin wallet manual adjust
         [InlineKeyboardButton("افزایش/کاهش کیف پول (ادمین)", callback_data="admin_wallet_adjust_menu")],
         # Group 7: Config footer text
@@ -161,7 +174,7 @@ async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_toggle_trial_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     new_status = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_status'", (new_status,))
+    set_setting('free_trial_status', new_status)
     await query.answer(f"وضعیت تست رایگان {'فعال' if new_status == '1' else 'غیرفعال'} شد.", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -182,7 +195,7 @@ async def admin_toggle_join_logs(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('join_logs_enabled', ?)", (target,))
+    set_setting('join_logs_enabled', target)
     return await admin_settings_manage(update, context)
 
 
@@ -190,7 +203,7 @@ async def admin_toggle_purchase_logs(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('purchase_logs_enabled', ?)", (target,))
+    set_setting('purchase_logs_enabled', target)
     return await admin_settings_manage(update, context)
 
 
@@ -219,7 +232,7 @@ async def admin_settings_save_log_chat(update: Update, context: ContextTypes.DEF
         await update.message.reply_text("ورودی نامعتبر است.")
         return ConversationHandler.END
     key = 'join_logs_chat_id' if mode == 'set_join_logs_chat' else 'purchase_logs_chat_id'
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, txt))
+    set_setting(key, txt)
     context.user_data.pop('awaiting_admin', None)
     await update.message.reply_text("ذخیره شد.")
     fake_query = type('obj', (object,), {
@@ -232,7 +245,7 @@ async def admin_settings_save_log_chat(update: Update, context: ContextTypes.DEF
 async def admin_settings_send_test_join_log(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    st = {r['key']: r['value'] for r in query_db("SELECT key,value FROM settings WHERE key IN ('join_logs_enabled','join_logs_chat_id')")}
+    st = get_settings()
     if (st.get('join_logs_enabled') or '0') != '1':
         await _ans(query, "لاگ ورود غیرفعال است.", show_alert=True)
         return await admin_settings_manage(update, context)
@@ -254,7 +267,7 @@ async def admin_settings_send_test_join_log(update: Update, context: ContextType
 async def admin_settings_send_test_purchase_log(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    st = {r['key']: r['value'] for r in query_db("SELECT key,value FROM settings WHERE key IN ('purchase_logs_enabled','purchase_logs_chat_id')")}
+    st = get_settings()
     if (st.get('purchase_logs_enabled') or '0') != '1':
         await _ans(query, "لاگ خرید غیرفعال است.", show_alert=True)
         return await admin_settings_manage(update, context)
@@ -294,7 +307,7 @@ async def admin_toggle_usd_mode(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'usd_irt_mode'", (target,))
+    set_setting('usd_irt_mode', target)
     return await admin_settings_manage(update, context)
 
 
@@ -316,8 +329,8 @@ async def admin_settings_ask(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_settings_save_trial(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         days, gb = update.message.text.split('-')
-        execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_days'", (days.strip(),))
-        execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_gb'", (gb.strip(),))
+        set_setting('free_trial_days', days.strip())
+        set_setting('free_trial_gb', gb.strip())
         await update.message.reply_text("\u2705 تنظیمات تست رایگان با موفقیت ذخیره شد.")
     except Exception:
         await update.message.reply_text("فرمت نامعتبر است. لطفا با فرمت `روز-حجم` وارد کنید.")
@@ -334,6 +347,7 @@ async def admin_settings_save_payment_text(update: Update, context: ContextTypes
         await update.message.reply_text("ورودی نامعتبر است. متن خالی ارسال نکنید.")
         return ConversationHandler.END
     execute_db("UPDATE messages SET text = ? WHERE message_name = ?", (new_text, 'payment_info_text'))
+    invalidate_render_cache()
     context.user_data.pop('awaiting_admin', None)
     await update.message.reply_text("\u2705 متن پرداخت با موفقیت ذخیره شد.")
     fake_query = type('obj', (object,), {
@@ -368,7 +382,7 @@ async def admin_toggle_user_quota(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('user_show_quota_enabled', ?)", (target,))
+    set_setting('user_show_quota_enabled', target)
     return await admin_settings_manage(update, context)
 
 
@@ -376,7 +390,7 @@ async def admin_toggle_talert(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('traffic_alert_enabled', ?)", (target,))
+    set_setting('traffic_alert_enabled', target)
     return await admin_settings_manage(update, context)
 
 
@@ -420,7 +434,7 @@ async def admin_set_talert_value_save(update: Update, context: ContextTypes.DEFA
         except Exception:
             await update.message.reply_text("❌ عدد نامعتبر است. لطفاً دوباره تلاش کنید:")
             return SETTINGS_AWAIT_TRAFFIC_ALERT_VALUE
-        execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('traffic_alert_value_gb', ?)", (str(val),))
+        set_setting('traffic_alert_value_gb', str(val))
         await update.message.reply_text(f"✅ مقدار هشدار حجم به {val} GB تنظیم شد.\n\n🔄 بازگشت به منوی تنظیمات...")
     elif mode == 'set_time_alert_days':
         try:
@@ -428,7 +442,7 @@ async def admin_set_talert_value_save(update: Update, context: ContextTypes.DEFA
         except Exception:
             await update.message.reply_text("❌ عدد صحیح نامعتبر است. لطفاً دوباره تلاش کنید:")
             return SETTINGS_AWAIT_TRAFFIC_ALERT_VALUE
-        execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('time_alert_days', ?)", (str(ival),))
+        set_setting('time_alert_days', str(ival))
         await update.message.reply_text(f"✅ روزهای هشدار زمان به {ival} روز تنظیم شد.\n\n🔄 بازگشت به منوی تنظیمات...")
     elif mode == 'set_auto_backup_hours':
         try:
@@ -438,7 +452,7 @@ async def admin_set_talert_value_save(update: Update, context: ContextTypes.DEFA
         except Exception:
             await update.message.reply_text("❌ عدد صحیح نامعتبر است. لطفاً دوباره تلاش کنید:")
             return SETTINGS_AWAIT_TRAFFIC_ALERT_VALUE
-        execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('auto_backup_hours', ?)", (str(hours),))
+        set_setting('auto_backup_hours', str(hours))
         # Reschedule the backup job with new interval
         try:
             jq = context.application.job_queue
@@ -446,7 +460,7 @@ async def admin_set_talert_value_save(update: Update, context: ContextTypes.DEFA
             for j in jq.get_jobs_by_name("auto_backup_send"):
                 j.schedule_removal()
             # Check if auto-backup is enabled
-            ab_enabled = (query_db("SELECT value FROM settings WHERE key='auto_backup_enabled'", one=True) or {}).get('value') == '1'
+            ab_enabled = get_setting('auto_backup_enabled') == '1'
             if ab_enabled:
                 from ..jobs import backup_and_send_to_admins
                 from ..config import logger
@@ -496,7 +510,7 @@ async def admin_toggle_time_alert(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('time_alert_enabled', ?)", (target,))
+    set_setting('time_alert_enabled', target)
     return await admin_settings_manage(update, context)
 
 
@@ -504,7 +518,7 @@ async def admin_toggle_auto_backup(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('auto_backup_enabled', ?)", (target,))
+    set_setting('auto_backup_enabled', target)
     # Reschedule job immediately
     try:
         # Cancel existing
@@ -513,11 +527,7 @@ async def admin_toggle_auto_backup(update: Update, context: ContextTypes.DEFAULT
             j.schedule_removal()
         # If enabling, schedule with current hours
         if target == '1':
-            from ..db import query_db as _q
-            try:
-                hours = int((_q("SELECT value FROM settings WHERE key='auto_backup_hours'", one=True) or {}).get('value') or '12')
-            except Exception:
-                hours = 12
+            hours = settings_cache.get_int('auto_backup_hours', 12)
             if hours > 0:
                 from ..jobs import backup_and_send_to_admins
                 jq.run_repeating(backup_and_send_to_admins, interval=hours*3600, first=60, name="auto_backup_send")
@@ -526,6 +536,17 @@ async def admin_toggle_auto_backup(update: Update, context: ContextTypes.DEFAULT
     return await admin_settings_manage(update, context)
 
 
+async def admin_cycle_auto_backup_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Switch the auto-backup between full archives and base + delta (differential / incremental)."""
+    query = update.callback_query
+    await query.answer()
+    from ..backup import BACKUP_MODES
+    current = get_setting('auto_backup_mode') or 'differential'
+    nxt = BACKUP_MODES[(BACKUP_MODES.index(current) + 1) % len(BACKUP_MODES)] if current in BACKUP_MODES else 'differential'
+    set_setting('auto_backup_mode', nxt)
+    return await admin_settings_manage(update, context)
+
+
 async def admin_set_auto_backup_hours_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
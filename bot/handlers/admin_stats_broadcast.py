@@ -2,10 +2,12 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-from ..db import query_db, execute_db
+from ..db import execute_db, read_snapshot, run_report, areport_query, ITER_BATCH_SIZE
+from ..stats import counters, revenue, today, days_ago, month_start
 from ..helpers.tg import safe_edit_text as _safe_edit_text
 from ..states import BROADCAST_SELECT_AUDIENCE, BROADCAST_SELECT_MODE, BROADCAST_AWAIT_MESSAGE, ADMIN_MAIN_MENU
 from ..states import ADMIN_STATS_MENU
+from ..config import logger
 
 
 async def admin_broadcast_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -44,79 +46,71 @@ async def admin_broadcast_execute(update: Update, context: ContextTypes.DEFAULT_
     if not audience:
         await update.message.reply_text("ابتدا مخاطب ارسال را انتخاب کنید.")
         return ADMIN_MAIN_MENU
-    users = []
     if audience == 'buyers':
-        users = query_db("SELECT DISTINCT user_id FROM orders WHERE status='approved'")
+        sql = "SELECT DISTINCT user_id FROM orders WHERE status='approved' AND user_id > ? ORDER BY user_id LIMIT ?"
     else:
-        users = query_db("SELECT user_id FROM users")
+        sql = "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+    # Recipients are read one short keyset page at a time: memory stays at one
+    # page, and no read snapshot is held open for the (long) duration of the send.
     sent = 0
-    for u in users or []:
-        uid = u['user_id']
-        try:
-            if mode == 'forward':
-                await context.bot.forward_message(chat_id=uid, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            else:
-                await context.bot.copy_message(chat_id=uid, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            sent += 1
-        except Exception:
-            pass
+    last_uid = 0
+    while True:
+        page = await areport_query(sql, (last_uid, ITER_BATCH_SIZE))
+        if not page:
+            break
+        last_uid = page[-1]['user_id']
+        for u in page:
+            uid = u['user_id']
+            try:
+                if mode == 'forward':
+                    await context.bot.forward_message(chat_id=uid, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
+                else:
+                    await context.bot.copy_message(chat_id=uid, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
+                sent += 1
+            except Exception:
+                pass
     await update.message.reply_text(f"✅ ارسال انجام شد. ({sent} نفر)")
     context.user_data.pop('broadcast_audience', None)
     return ADMIN_MAIN_MENU
 
 
+def _collect_stats() -> dict:
+    """All figures for the stats page, from the rollup tables (bot/stats.py), read from one snapshot."""
+    with read_snapshot() as snap:
+        c = counters('users', 'buyers', 'orders:approved', 'orders:pending', fetch=snap.query)
+        day = revenue(today(), fetch=snap.query)
+        return {
+            'total_users': c['users'], 'buyers': c['buyers'],
+            'enabled_panels': snap.query("SELECT COUNT(*) AS c FROM panels WHERE COALESCE(enabled,1)=1", one=True)['c'],
+            'total_services': c['orders:approved'], 'pending_orders': c['orders:pending'],
+            'daily_rev': day['order_total'],
+            'monthly_rev': revenue(month_start(), today(), fetch=snap.query)['order_total'],
+            'last7_rev': revenue(days_ago(6), today(), fetch=snap.query)['order_total'],
+            'total_payments': c['orders:approved'], 'today_payments': day['order_count'],
+        }
+
+
 async def admin_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    total_users = (query_db("SELECT COUNT(*) AS c FROM users", one=True) or {}).get('c', 0)
-    buyers = (query_db("SELECT COUNT(DISTINCT user_id) AS c FROM orders WHERE status='approved'", one=True) or {}).get('c', 0)
-    enabled_panels = (query_db("SELECT COUNT(*) AS c FROM panels WHERE COALESCE(enabled,1)=1", one=True) or {}).get('c', 0)
-    total_services = (query_db("SELECT COUNT(*) AS c FROM orders WHERE status='approved'", one=True) or {}).get('c', 0)
-    pending_orders = (query_db("SELECT COUNT(*) AS c FROM orders WHERE status='pending'", one=True) or {}).get('c', 0)
-    daily_rev = (query_db(
-        """
-        SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-        FROM orders o
-        JOIN plans p ON p.id = o.plan_id
-        WHERE o.status='approved' AND date(o.timestamp) = date('now','localtime')
-        """,
-        one=True,
-    ) or {}).get('rev', 0)
-    monthly_rev = (query_db(
-        """
-        SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-        FROM orders o
-        JOIN plans p ON p.id = o.plan_id
-        WHERE o.status='approved' AND strftime('%Y-%m', o.timestamp) = strftime('%Y-%m', 'now','localtime')
-        """,
-        one=True,
-    ) or {}).get('rev', 0)
-    last7_rev = (query_db(
-        """
-        SELECT COALESCE(SUM(CASE WHEN o.final_price IS NOT NULL THEN o.final_price ELSE p.price END),0) AS rev
-        FROM orders o
-        JOIN plans p ON p.id = o.plan_id
-        WHERE o.status='approved' AND date(o.timestamp) >= date('now','-6 day','localtime')
-        """,
-        one=True,
-    ) or {}).get('rev', 0)
-
-    # Payment stats
-    total_payments = (query_db("SELECT COUNT(*) AS c FROM orders WHERE status='approved'", one=True) or {}).get('c', 0)
-    today_payments = (query_db("SELECT COUNT(*) AS c FROM orders WHERE status='approved' AND date(timestamp) = date('now','localtime')", one=True) or {}).get('c', 0)
+    try:
+        s = await run_report(_collect_stats)
+    except Exception as e:
+        logger.error(f"admin stats failed: {e}")
+        s = {}
     
     text = (
         "📊 <b>آمار ربات</b>\n\n"
-        f"👥 <b>کاربران:</b> {int(total_users):,}\n"
-        f"🛒 <b>خریداران:</b> {int(buyers):,}\n"
-        f"🌐 <b>پنل‌های فعال:</b> {int(enabled_panels)}\n"
-        f"📱 <b>سرویس‌های فعال:</b> {int(total_services):,}\n"
-        f"⏳ <b>سفارشات در انتظار:</b> {int(pending_orders):,}\n\n"
-        f"💰 <b>درآمد امروز:</b> {int(daily_rev):,} تومان\n"
-        f"📅 <b>درآمد 7 روز اخیر:</b> {int(last7_rev):,} تومان\n"
-        f"📆 <b>درآمد این ماه:</b> {int(monthly_rev):,} تومان\n\n"
-        f"💳 <b>پرداخت‌های امروز:</b> {int(today_payments):,}\n"
-        f"💵 <b>کل پرداخت‌ها:</b> {int(total_payments):,}"
+        f"👥 <b>کاربران:</b> {int(s.get('total_users', 0)):,}\n"
+        f"🛒 <b>خریداران:</b> {int(s.get('buyers', 0)):,}\n"
+        f"🌐 <b>پنل‌های فعال:</b> {int(s.get('enabled_panels', 0))}\n"
+        f"📱 <b>سرویس‌های فعال:</b> {int(s.get('total_services', 0)):,}\n"
+        f"⏳ <b>سفارشات در انتظار:</b> {int(s.get('pending_orders', 0)):,}\n\n"
+        f"💰 <b>درآمد امروز:</b> {int(s.get('daily_rev', 0)):,} تومان\n"
+        f"📅 <b>درآمد 7 روز اخیر:</b> {int(s.get('last7_rev', 0)):,} تومان\n"
+        f"📆 <b>درآمد این ماه:</b> {int(s.get('monthly_rev', 0)):,} تومان\n\n"
+        f"💳 <b>پرداخت‌های امروز:</b> {int(s.get('today_payments', 0)):,}\n"
+        f"💵 <b>کل پرداخت‌ها:</b> {int(s.get('total_payments', 0)):,}"
     )
     keyboard = [
         [InlineKeyboardButton("🔄 بروزرسانی", callback_data="stats_refresh")],
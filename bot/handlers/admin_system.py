@@ -3,16 +3,26 @@
 import psutil
 import platform
 import os
+import html
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, read_snapshot, run_db, run_report, db_stats
+from ..archive import archive_counts
+from ..stats import counters, check_stats, rebuild_stats
+from ..ledger import verify_ledger, rebuild_balances
 from ..panel import VpnPanelAPI
 from ..states import ADMIN_MAIN_MENU
 from ..helpers.tg import safe_edit_text as _safe_edit_text
 
+def _db_counts() -> dict:
+    with read_snapshot() as snap:
+        c = counters('users', 'orders:active', 'orders:pending', fetch=snap.query)
+    return {'users': c['users'], 'active_services': c['orders:active'], 'pending_orders': c['orders:pending']}
+
+
 async def admin_system_health(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show system health and status"""
     query = update.callback_query
@@ -48,11 +58,8 @@ async def admin_system_health(update: Update, context: ContextTypes.DEFAULT_TYPE
         }
         
         # Database info
-        db_info = {
-            'users': query_db("SELECT COUNT(*) as c FROM users", one=True)['c'],
-            'active_services': query_db("SELECT COUNT(*) as c FROM orders WHERE status='active'", one=True)['c'],
-            'pending_orders': query_db("SELECT COUNT(*) as c FROM orders WHERE status='pending'", one=True)['c']
-        }
+        db_info = await run_report(_db_counts)
+        archived = await run_report(archive_counts)
         
         # Panel status
         panels = query_db("SELECT id, name, url, panel_type, enabled FROM panels")
@@ -95,6 +102,7 @@ async def admin_system_health(update: Update, context: ContextTypes.DEFAULT_TYPE
 - کاربران: {users:,}
 - سرویس‌های فعال: {active_services:,}
 - سفارشات در انتظار: {pending_orders:,}
+- آرشیو (سفارش/تراکنش/پیام تیکت): {archived}
 
 *وضعیت پنل‌ها:*
 {panel_status}
@@ -109,6 +117,7 @@ async def admin_system_health(update: Update, context: ContextTypes.DEFAULT_TYPE
             disk_free=disk_info['free'],
             disk_percent=disk_info['percent'],
             **db_info,
+            archived=" / ".join(f"{archived[t][1]:,}" for t in ('orders', 'wallet_transactions', 'ticket_messages')),
             panel_status='\n'.join([
                 f"- {p['name']} ({p['type']}): {'✅ ' if p['enabled'] else '❌ '}{p['status']}"
                 for p in panel_status
@@ -118,6 +127,9 @@ async def admin_system_health(update: Update, context: ContextTypes.DEFAULT_TYPE
         keyboard = [
             [InlineKeyboardButton("🔄 بروزرسانی", callback_data="admin_system_health")],
             [InlineKeyboardButton("🔔 پاک‌سازی اعلان‌های هشدار", callback_data="admin_clear_notifications")],
+            [InlineKeyboardButton("🐢 کندترین کوئری‌های دیتابیس", callback_data="admin_db_stats")],
+            [InlineKeyboardButton("🧮 بررسی شمارنده‌های آمار", callback_data="admin_stats_check")],
+            [InlineKeyboardButton("🧾 بررسی دفتر کیف پول", callback_data="admin_ledger_check")],
             [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_main")]
         ]
         
@@ -202,3 +214,90 @@ async def admin_clear_notifications(update: Update, context: ContextTypes.DEFAUL
     except Exception as e:
         await query.answer(f"❌ خطا: {str(e)}", show_alert=True)
         return await admin_system_health(update, context)
+
+
+async def admin_db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Show the DB statements with the highest total time since start (or last reset)"""
+    query = update.callback_query
+    if query.data == 'admin_db_stats_reset':
+        db_stats.reset()
+        await query.answer("آمار کوئری‌ها صفر شد")
+    else:
+        await query.answer()
+
+    top = db_stats.top(10)
+    since = datetime.fromtimestamp(db_stats.since).strftime('%Y-%m-%d %H:%M')
+    lines = [f"🐢 <b>کوئری‌های دیتابیس بر اساس کل زمان</b>\nاز {since}\n"]
+    if not top:
+        lines.append("هنوز آماری ثبت نشده است.")
+    for i, st in enumerate(top, 1):
+        lines.append(
+            f"<b>{i}.</b> <code>{html.escape(st['sql'][:120])}</code>\n"
+            f"   {st['calls']:,} بار | کل {st['total_ms'] / 1000:.2f}s | "
+            f"p50 {st['p50_ms']:.1f} / p95 {st['p95_ms']:.1f} / p99 {st['p99_ms']:.1f} ms | "
+            f"ردیف/بار {st['rows'] / st['calls']:.1f}"
+        )
+    keyboard = [
+        [InlineKeyboardButton("🔄 بروزرسانی", callback_data="admin_db_stats"),
+         InlineKeyboardButton("♻️ صفر کردن", callback_data="admin_db_stats_reset")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_system_health")]
+    ]
+    await _safe_edit_text(query.message, "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+    return ADMIN_MAIN_MENU
+
+
+_LEDGER_CHECKS = {'chain': "زنجیره‌ی تراکنش", 'balance': "موجودی کاربر", 'total': "جمع موجودی‌ها"}
+
+
+async def admin_ledger_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Audit the wallet ledger since the last checkpoint; _full replays it all, _rebuild resets the balances from it"""
+    query = update.callback_query
+    full = query.data == 'admin_ledger_full'
+    if query.data == 'admin_ledger_rebuild':
+        await query.answer("در حال بازسازی موجودی‌ها از دفتر...")
+        await run_db(rebuild_balances)
+    else:
+        await query.answer()
+
+    problems = await run_report(verify_ledger, full)
+    lines = [f"🧾 <b>بررسی دفتر کیف پول</b> ({'کامل' if full else 'از آخرین نقطه‌ی کنترل'})\n"]
+    if not problems:
+        lines.append("✅ موجودی‌ها با دفتر تراکنش‌ها یکسان هستند.")
+    else:
+        lines.append(f"⚠️ {len(problems)} مورد اختلاف (ذخیره‌شده ← مورد انتظار):")
+        for check, key, stored, expected in problems[:15]:
+            lines.append(f"• {_LEDGER_CHECKS.get(check, check)} <code>{html.escape(str(key))}</code>: {stored} ← {expected}")
+    keyboard = [
+        [InlineKeyboardButton("🔄 بررسی مجدد", callback_data="admin_ledger_check"),
+         InlineKeyboardButton("🔍 بررسی کامل", callback_data="admin_ledger_full")],
+        [InlineKeyboardButton("♻️ بازسازی موجودی‌ها", callback_data="admin_ledger_rebuild")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_system_health")]
+    ]
+    await _safe_edit_text(query.message, "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+    return ADMIN_MAIN_MENU
+
+
+async def admin_stats_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Compare the dashboard rollups with the raw tables; admin_stats_rebuild recomputes them"""
+    query = update.callback_query
+    if query.data == 'admin_stats_rebuild':
+        await query.answer("در حال بازسازی آمار...")
+        await run_db(rebuild_stats)
+    else:
+        await query.answer()
+
+    diffs = await run_report(check_stats)
+    lines = ["🧮 <b>بررسی شمارنده‌ها و درآمد روزانه</b>\n"]
+    if not diffs:
+        lines.append("✅ همه‌ی شمارنده‌ها با جداول اصلی یکسان هستند.")
+    else:
+        lines.append(f"⚠️ {len(diffs)} مورد اختلاف (ذخیره‌شده ← واقعی):")
+        for table, key, stored, expected in diffs[:15]:
+            lines.append(f"• <code>{html.escape(str(key))}</code>: {stored} ← {expected}")
+    keyboard = [
+        [InlineKeyboardButton("🔄 بررسی مجدد", callback_data="admin_stats_check"),
+         InlineKeyboardButton("♻️ بازسازی", callback_data="admin_stats_rebuild")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_system_health")]
+    ]
+    await _safe_edit_text(query.message, "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+    return ADMIN_MAIN_MENU
@@ -4,13 +4,20 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler, ApplicationHandlerStop
 
 from ..db import query_db, execute_db
+from ..pagination import Keyset
 from ..helpers.tg import safe_edit_text as _safe_edit_text
 from ..config import ADMIN_ID
 from ..states import ADMIN_MAIN_MENU, ADMIN_AWAIT_TICKET_REPLY
 
 
+_PENDING_TICKETS = Keyset("SELECT id, user_id, created_at FROM tickets", table='tickets', key=('id',))
+
+
 async def admin_tickets_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    rows = query_db("SELECT id, user_id, created_at FROM tickets WHERE status = 'pending' ORDER BY id DESC LIMIT 50")
+    cursor = None
+    if update.callback_query and (update.callback_query.data or '').startswith('admin_tickets_page_'):
+        cursor = update.callback_query.data.split('_')[-1]
+    rows, prev_cursor, next_cursor = _PENDING_TICKETS.page("status = 'pending'", cursor=cursor, size=20)
     text = "\U0001F4AC تیکت‌های پاسخ‌داده‌نشده\n\n"
     kb = []
     if not rows:
@@ -18,6 +25,13 @@ async def admin_tickets_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         for r in rows:
             kb.append([InlineKeyboardButton(f"#{r['id']} از {r['user_id']} - {r['created_at']}", callback_data=f"ticket_view_{r['id']}")])
+    nav = []
+    if prev_cursor:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_tickets_page_{prev_cursor}"))
+    if next_cursor:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_tickets_page_{next_cursor}"))
+    if nav:
+        kb.append(nav)
     kb.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data='admin_main')])
     if update.callback_query:
         await update.callback_query.answer()
@@ -3,49 +3,85 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 import io
 import csv
+import tempfile
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, iter_db, run_report
+from ..archive import user_archive
+from ..search import match_expression
+from ..pagination import Keyset
 from ..states import ADMIN_USERS_MENU, ADMIN_USERS_AWAIT_SEARCH
 from ..helpers.tg import safe_edit_text as _safe_edit_text
 
 PAGE_SIZE = 10
 
-def _build_users_query(search: str | None):
-    base = "SELECT user_id, first_name, COALESCE(banned,0) AS banned, join_date FROM users"
-    args = []
+_USERS_SELECT = "SELECT user_id, first_name, COALESCE(banned,0) AS banned, join_date FROM users"
+# Newest members first; served by idx_users_join_date
+_USERS_LIST = Keyset(_USERS_SELECT, table='users', key=('join_date', 'user_id'), id_column='user_id')
+# Per-user lists, newest first
+_USER_ORDERS = Keyset(
+    """SELECT o.id, o.plan_id, o.status, o.marzban_username, o.panel_type, o.timestamp,
+       p.name as plan_name, p.price, p.duration_days, p.traffic_gb
+       FROM orders o
+       LEFT JOIN plans p ON p.id = o.plan_id""",
+    table='orders', alias='o', key=('o.id',),
+)
+_USER_TICKETS = Keyset("SELECT id, status, created_at FROM tickets", table='tickets', key=('id',))
+_USER_WALLET_TX = Keyset(
+    "SELECT id, amount, direction, status, created_at FROM wallet_transactions", table='wallet_transactions', key=('id',),
+)
+_USER_REFS = Keyset("SELECT id, referee_id, created_at FROM referrals", table='referrals', key=('id',))
+
+
+def _users_filter(search: str | None):
+    """WHERE clause and args for the users list search."""
+    expr = match_expression(search) if search else None
+    if expr:
+        return "user_id IN (SELECT ref FROM search_index WHERE search_index MATCH ? AND kind = 'user')", (expr,)
     if search:
-        base += " WHERE CAST(user_id AS TEXT) LIKE ? OR (first_name IS NOT NULL AND first_name LIKE ?)"
         like = f"%{search}%"
-        args = [like, like]
-    base += " ORDER BY join_date DESC"
+        return "CAST(user_id AS TEXT) LIKE ? OR (first_name IS NOT NULL AND first_name LIKE ?)", (like, like)
+    return '', ()
+
+
+def _build_users_query(search: str | None):
+    where, args = _users_filter(search)
+    base = _USERS_SELECT + (f" WHERE {where}" if where else '')
+    base += " ORDER BY join_date DESC, user_id DESC"
     return base, tuple(args)
 
+
+def _page_arg(data: str, prefix: str):
+    """(user id, cursor) of a per-user list callback: <prefix><uid>[_page_<cursor>]."""
+    uid, _, cursor = data[len(prefix):].partition('_page_')
+    return int(uid), (cursor or None)
+
+
+def _nav_row(callback_prefix: str, prev_cursor, next_cursor) -> list:
+    nav = []
+    if prev_cursor:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"{callback_prefix}{prev_cursor}"))
+    if next_cursor:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"{callback_prefix}{next_cursor}"))
+    return nav
+
 async def admin_users_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     context.user_data.setdefault('users_search', '')
-    context.user_data.setdefault('users_page', 1)
+    context.user_data.setdefault('users_cursor', None)
     return await admin_users_page(update, context)
 
 async def admin_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    page = 1
     if query and query.data.startswith('admin_users_page_'):
-        try:
-            page = int(query.data.split('_')[-1])
-        except Exception:
-            page = 1
-        context.user_data['users_page'] = page
+        cursor = query.data.split('_')[-1]
+        context.user_data['users_cursor'] = cursor
     else:
-        page = context.user_data.get('users_page', 1)
+        cursor = context.user_data.get('users_cursor')
 
     search = context.user_data.get('users_search', '')
-    sql, args = _build_users_query(search)
-    rows = query_db(sql, args) or []
-    total = len(rows)
-    start = (page - 1) * PAGE_SIZE
-    end = start + PAGE_SIZE
-    slice_rows = rows[start:end]
+    where, args = _users_filter(search)
+    slice_rows, prev_cursor, next_cursor = _USERS_LIST.page(where, args, cursor=cursor, size=PAGE_SIZE)
 
     text = "👥 مدیریت کاربران\n\n"
     if search:
@@ -56,13 +92,8 @@ async def admin_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         for r in slice_rows:
             status = 'مسدود' if int(r.get('banned') or 0) == 1 else 'عادی'
             text += f"- `{r['user_id']}` | {r.get('first_name') or '-'} | {status}\n"
-    total_pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
     kb = []
-    nav = []
-    if page > 1:
-        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_users_page_{page-1}"))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_users_page_{page+1}"))
+    nav = _nav_row("admin_users_page_", prev_cursor, next_cursor)
     if nav:
         kb.append(nav)
     kb.append([InlineKeyboardButton("🔎 جستجو", callback_data="admin_users_search"), InlineKeyboardButton("📤 خروجی CSV", callback_data="admin_users_export")])
@@ -80,7 +111,7 @@ async def admin_users_search_start(update: Update, context: ContextTypes.DEFAULT
 async def admin_users_search_apply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     term = (update.message.text or '').strip()
     context.user_data['users_search'] = term
-    context.user_data['users_page'] = 1
+    context.user_data['users_cursor'] = None
     fake_query = type('obj', (object,), {'data': 'admin_users_menu', 'message': update.message, 'answer': (lambda *a, **k: None)})
     fake_update = type('obj', (object,), {'callback_query': fake_query})
     return await admin_users_menu(fake_update, context)
@@ -93,21 +124,30 @@ async def admin_users_toggle_ban(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data['awaiting_admin'] = 'toggle_ban_user'
     return ADMIN_USERS_MENU
 
+def _write_users_csv(sql: str, args):
+    """Stream the users of `sql` into a temp file (spills to disk past a few MB); returned rewound."""
+    out = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(['user_id', 'first_name', 'banned', 'join_date'])
+    for r in iter_db(sql, args):
+        writer.writerow([r.get('user_id'), r.get('first_name') or '', int(r.get('banned') or 0), r.get('join_date') or ''])
+    text.flush()
+    text.detach()
+    out.seek(0)
+    return out
+
+
 async def admin_users_export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     search = context.user_data.get('users_search', '')
     sql, args = _build_users_query(search)
-    rows = query_db(sql, args) or []
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(['user_id', 'first_name', 'banned', 'join_date'])
-    for r in rows:
-        writer.writerow([r.get('user_id'), r.get('first_name') or '', int(r.get('banned') or 0), r.get('join_date') or ''])
-    data = buf.getvalue().encode('utf-8')
-    bio = io.BytesIO(data)
-    bio.name = 'users.csv'
-    await query.message.reply_document(document=InputFile(bio, filename='users.csv'), caption='CSV کاربران')
+    out = await run_report(_write_users_csv, sql, args)
+    try:
+        await query.message.reply_document(document=InputFile(out, filename='users.csv'), caption='CSV کاربران')
+    finally:
+        out.close()
     return ADMIN_USERS_MENU
 
 
@@ -155,7 +195,7 @@ async def admin_users_view_by_id_show(update: Update, context: ContextTypes.DEFA
     kb = [
         [InlineKeyboardButton("📦 سرویس‌ها", callback_data=f"admin_user_services_{uid}"), InlineKeyboardButton("🎫 تیکت‌ها", callback_data=f"admin_user_tickets_{uid}")],
         [InlineKeyboardButton("💳 کیف پول", callback_data=f"admin_user_wallet_{uid}"), InlineKeyboardButton("👥 ارجاع‌ها", callback_data=f"admin_user_refs_{uid}")],
-        [InlineKeyboardButton(("آنبن" if banned else "بن"), callback_data=f"admin_user_ban_{uid}")],
+        [InlineKeyboardButton("🗄 آرشیو", callback_data=f"admin_user_archive_{uid}"), InlineKeyboardButton(("آنبن" if banned else "بن"), callback_data=f"admin_user_ban_{uid}")],
         [InlineKeyboardButton("بازگشت", callback_data="admin_users_menu")],
     ]
     await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
@@ -201,36 +241,19 @@ async def admin_users_toggle_ban_inline(update: Update, context: ContextTypes.DE
     return await admin_users_view_by_id_show(fake_update, context, uid)
 
 
-def _paginate(items, page: int, size: int):
-    total = len(items)
-    start = max(0, (page - 1) * size)
-    end = start + size
-    return items[start:end], total
-
-
 async def admin_users_show_services(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    parts = query.data.split('_')
-    uid = int(parts[-1]) if parts[-2] != 'page' else int(parts[-3])
-    page = int(parts[-1]) if parts[-2] == 'page' else 1
+    uid, cursor = _page_arg(query.data, 'admin_user_services_')
     
     # Debug logging
     from ..config import logger
-    logger.info(f"[admin_users_show_services] callback_data={query.data}, parsed uid={uid}, page={page}")
+    logger.info(f"[admin_users_show_services] callback_data={query.data}, parsed uid={uid}, cursor={cursor}")
     
-    rows = query_db(
-        """SELECT o.id, o.plan_id, o.status, o.marzban_username, o.panel_type, o.timestamp,
-           p.name as plan_name, p.price, p.duration_days, p.traffic_gb
-           FROM orders o
-           LEFT JOIN plans p ON p.id = o.plan_id
-           WHERE o.user_id = ?
-           ORDER BY o.id DESC""",
-        (uid,)
-    ) or []
+    page_rows, prev_cursor, next_cursor = _USER_ORDERS.page("o.user_id = ?", (uid,), cursor=cursor, size=5)
     
-    logger.info(f"[admin_users_show_services] Found {len(rows)} orders for user {uid}")
-    if not rows:
+    logger.info(f"[admin_users_show_services] Showing {len(page_rows)} orders for user {uid}")
+    if not page_rows:
         # Store user_id for re-displaying user details on back
         context.user_data['viewing_user_id'] = uid
         kb = [
@@ -248,7 +271,6 @@ async def admin_users_show_services(update: Update, context: ContextTypes.DEFAUL
         )
         return ADMIN_USERS_MENU
     
-    page_rows, total = _paginate(rows, page, 5)
     text = f"📦 <b>سرویس‌های کاربر {uid}</b>\n\n"
     
     kb = []
@@ -292,14 +314,8 @@ async def admin_users_show_services(update: Update, context: ContextTypes.DEFAUL
         kb.append(service_row)
     
     # Pagination
-    nav = []
-    total_pages = max(1, (total + 5 - 1) // 5)
-    if total_pages > 1:
-        if page > 1:
-            nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"admin_user_services_{uid}_page_{page-1}"))
-        nav.append(InlineKeyboardButton(f"📄 {page}/{total_pages}", callback_data='noop'))
-        if page < total_pages:
-            nav.append(InlineKeyboardButton("▶️ بعدی", callback_data=f"admin_user_services_{uid}_page_{page+1}"))
+    nav = _nav_row(f"admin_user_services_{uid}_page_", prev_cursor, next_cursor)
+    if nav:
         kb.append(nav)
     
     kb.append([InlineKeyboardButton("🔙 بازگشت به کاربر", callback_data=f"admin_user_view_{uid}")])
@@ -310,23 +326,15 @@ async def admin_users_show_services(update: Update, context: ContextTypes.DEFAUL
 async def admin_users_show_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    parts = query.data.split('_')
-    uid = int(parts[-1]) if parts[-2] != 'page' else int(parts[-3])
-    page = int(parts[-1]) if parts[-2] == 'page' else 1
-    rows = query_db("SELECT id, status, created_at FROM tickets WHERE user_id = ? ORDER BY id DESC", (uid,)) or []
+    uid, cursor = _page_arg(query.data, 'admin_user_tickets_')
+    page_rows, prev_cursor, next_cursor = _USER_TICKETS.page("user_id = ?", (uid,), cursor=cursor, size=10)
     text = "🎫 تیکت‌ها:\n\n"
-    if not rows:
+    if not page_rows:
         text += "موردی نیست."
     else:
-        page_rows, total = _paginate(rows, page, 10)
         for t in page_rows:
             text += f"- #{t['id']} | {t.get('status')} | {t.get('created_at') or ''}\n"
-    nav = []
-    total_pages = max(1, (len(rows) + 10 - 1) // 10)
-    if page > 1:
-        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_user_tickets_{uid}_page_{page-1}"))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_user_tickets_{uid}_page_{page+1}"))
+    nav = _nav_row(f"admin_user_tickets_{uid}_page_", prev_cursor, next_cursor)
     kb = []
     if nav:
         kb.append(nav)
@@ -338,25 +346,17 @@ async def admin_users_show_tickets(update: Update, context: ContextTypes.DEFAULT
 async def admin_users_show_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    parts = query.data.split('_')
-    uid = int(parts[-1]) if parts[-2] != 'page' else int(parts[-3])
-    page = int(parts[-1]) if parts[-2] == 'page' else 1
+    uid, cursor = _page_arg(query.data, 'admin_user_wallet_')
     bal = (query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (uid,), one=True) or {}).get('balance', 0)
-    txs = query_db("SELECT id, amount, direction, status, created_at FROM wallet_transactions WHERE user_id = ? ORDER BY id DESC", (uid,)) or []
+    page_rows, prev_cursor, next_cursor = _USER_WALLET_TX.page("user_id = ?", (uid,), cursor=cursor, size=10)
     text = f"💳 کیف پول\n\nموجودی: {int(bal):,} تومان\n\nتراکنش‌ها:\n"
-    if not txs:
+    if not page_rows:
         text += "موردی نیست."
     else:
-        page_rows, total = _paginate(txs, page, 10)
         for t in page_rows:
             sign = '+' if (t.get('direction')=='credit') else '-'
             text += f"- #{t['id']} | {sign}{int(t.get('amount') or 0):,} | {t.get('status')} | {t.get('created_at') or ''}\n"
-    nav = []
-    total_pages = max(1, (len(txs) + 10 - 1) // 10)
-    if page > 1:
-        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_user_wallet_{uid}_page_{page-1}"))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_user_wallet_{uid}_page_{page+1}"))
+    nav = _nav_row(f"admin_user_wallet_{uid}_page_", prev_cursor, next_cursor)
     kb = []
     if nav:
         kb.append(nav)
@@ -368,27 +368,41 @@ async def admin_users_show_wallet(update: Update, context: ContextTypes.DEFAULT_
 async def admin_users_show_refs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    parts = query.data.split('_')
-    uid = int(parts[-1]) if parts[-2] != 'page' else int(parts[-3])
-    page = int(parts[-1]) if parts[-2] == 'page' else 1
+    uid, cursor = _page_arg(query.data, 'admin_user_refs_')
     cnt = (query_db("SELECT COUNT(*) AS c FROM referrals WHERE referrer_id = ?", (uid,), one=True) or {}).get('c', 0)
-    recent_all = query_db("SELECT referee_id, created_at FROM referrals WHERE referrer_id = ? ORDER BY created_at DESC", (uid,)) or []
-    recent, total = _paginate(recent_all, page, 10)
+    recent, prev_cursor, next_cursor = _USER_REFS.page("referrer_id = ?", (uid,), cursor=cursor, size=10)
     text = f"👥 زیرمجموعه‌ها: {int(cnt)}\n\nآخرین موارد:\n"
     if not recent:
         text += "موردی نیست."
     else:
         for r in recent:
             text += f"- {r.get('referee_id')} | {r.get('created_at') or ''}\n"
-    nav = []
-    total_pages = max(1, (len(recent_all) + 10 - 1) // 10)
-    if page > 1:
-        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_user_refs_{uid}_page_{page-1}"))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_user_refs_{uid}_page_{page+1}"))
+    nav = _nav_row(f"admin_user_refs_{uid}_page_", prev_cursor, next_cursor)
     kb = []
     if nav:
         kb.append(nav)
     kb.append([InlineKeyboardButton("🔙 بازگشت به کاربر", callback_data=f"admin_user_view_{uid}")])
     await _safe_edit_text(query.message, text, reply_markup=InlineKeyboardMarkup(kb))
     return ADMIN_USERS_MENU
+
+
+async def admin_users_show_archive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Archived (deleted/canceled) orders and settled wallet transactions of a user"""
+    query = update.callback_query
+    await query.answer()
+    uid = int(query.data.split('_')[-1])
+    archived = await run_report(user_archive, uid)
+    text = "🗄 آرشیو کاربر\n\nسفارش‌های حذف‌شده:\n"
+    if not archived['orders']:
+        text += "موردی نیست.\n"
+    for o in archived['orders']:
+        text += f"- #{o['id']} | {o.get('plan_name') or '-'} | {o.get('marzban_username') or '-'} | {o.get('status')} | {o.get('deleted_at') or o.get('timestamp') or ''}\n"
+    text += "\nتراکنش‌های قدیمی:\n"
+    if not archived['wallet_transactions']:
+        text += "موردی نیست."
+    for t in archived['wallet_transactions']:
+        sign = '+' if (t.get('direction')=='credit') else '-'
+        text += f"- #{t['id']} | {sign}{int(t.get('amount') or 0):,} | {t.get('status')} | {t.get('created_at') or ''}\n"
+    kb = [[InlineKeyboardButton("🔙 بازگشت به کاربر", callback_data=f"admin_user_view_{uid}")]]
+    await _safe_edit_text(query.message, text, reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_USERS_MENU
@@ -4,7 +4,8 @@ from telegram.error import TelegramError
 from telegram.ext import ContextTypes, ApplicationHandlerStop
 
 from ..config import ADMIN_ID, CHANNEL_ID, CHANNEL_USERNAME, logger
-from ..db import query_db
+from ..db import query_db, aquery_db
+from ..cache import get_setting, get_settings, render_cache
 from ..utils import register_new_user
 from ..helpers.flow import get_flow
 from ..helpers.keyboards import build_start_menu_keyboard
@@ -21,14 +22,13 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 		return
 	# Gate: if bot is OFF, block non-admins globally with a maintenance message
 	try:
-		active_row = query_db("SELECT value FROM settings WHERE key='bot_active'", one=True)
-		bot_on = (active_row and str(active_row.get('value') or '1') == '1')
+		bot_on = str(get_setting('bot_active') or '1') == '1'
 	except Exception:
 		bot_on = True
 	if not bot_on:
 		# Allow extra admins
 		try:
-			extra_admin = query_db("SELECT 1 FROM admins WHERE user_id = ?", (user.id,), one=True)
+			extra_admin = await aquery_db("SELECT 1 FROM admins WHERE user_id = ?", (user.id,), one=True)
 			if extra_admin:
 				logger.debug(f"force_join_checker: extra admin {user.id} bypassed (bot off)")
 				return
@@ -36,8 +36,7 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 			pass
 		# For normal users, show maintenance and stop
 		try:
-			mm = query_db("SELECT value FROM settings WHERE key='maintenance_message'", one=True)
-			text = (mm.get('value') if mm else None) or (
+			text = get_setting('maintenance_message') or (
                 "🔧 <b>ربات در حال نگهداری است</b>\n\n"
                 "━━━━━━━━━━━━━━━━━━━━━━━━\n"
                 "⚠️ ربات به‌طور موقت برای نگهداری و بهبود خاموش شده است.\n\n"
@@ -54,7 +53,7 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 			pass
 		raise ApplicationHandlerStop
 	try:
-		extra_admin = query_db("SELECT 1 FROM admins WHERE user_id = ?", (user.id,), one=True)
+		extra_admin = await aquery_db("SELECT 1 FROM admins WHERE user_id = ?", (user.id,), one=True)
 		if extra_admin:
 			logger.debug(f"force_join_checker: extra admin {user.id} bypassed")
 			return
@@ -132,10 +131,29 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 	raise ApplicationHandlerStop
 
 
+def _build_message_keyboard(message_name: str, back_to: str) -> InlineKeyboardMarkup:
+	buttons_data = render_cache.buttons(message_name)
+	keyboard = []
+	if buttons_data:
+		max_row = max((b['row'] for b in buttons_data), default=0)
+		keyboard_rows = [[] for _ in range(max_row + 1)]
+		for b in buttons_data:
+			btn = (
+				InlineKeyboardButton(b['text'], url=b['target'])
+				if b['is_url']
+				else InlineKeyboardButton(b['text'], callback_data=b['target'])
+			)
+			if 0 < b['row'] <= len(keyboard_rows):
+				keyboard_rows[b['row'] - 1].append(btn)
+		keyboard = [row for row in keyboard_rows if row]
+	keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data=back_to)])
+	return InlineKeyboardMarkup(keyboard)
+
+
 async def send_dynamic_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_name: str, back_to: str = 'start_main'):
 	query = update.callback_query
 
-	message_data = query_db("SELECT text, file_id, file_type FROM messages WHERE message_name = ?", (message_name,), one=True)
+	message_data = render_cache.message(message_name)
 	if not message_data:
 		await answer_safely(query, f"محتوای '{message_name}' یافت نشد!", show_alert=True)
 		return
@@ -147,36 +165,11 @@ async def send_dynamic_message(update: Update, context: ContextTypes.DEFAULT_TYP
 	file_id = message_data.get('file_id')
 	file_type = message_data.get('file_type')
 
-	buttons_data = query_db(
-		"SELECT text, target, is_url, row, col FROM buttons WHERE menu_name = ? ORDER BY row, col",
-		(message_name,),
-	)
-
-	if message_name == 'start_main':
-		trial_status = query_db("SELECT value FROM settings WHERE key = 'free_trial_status'", one=True)
-		if not trial_status or trial_status.get('value') != '1':
-			buttons_data = [b for b in buttons_data if b.get('target') != 'get_free_config']
-
-	keyboard = []
-	if buttons_data:
-		max_row = max((b['row'] for b in buttons_data), default=0) if buttons_data else 0
-		keyboard_rows = [[] for _ in range(max_row + 1)]
-		for b in buttons_data:
-			btn = (
-				InlineKeyboardButton(b['text'], url=b['target'])
-				if b['is_url']
-				else InlineKeyboardButton(b['text'], callback_data=b['target'])
-			)
-			if 0 < b['row'] <= len(keyboard_rows):
-				keyboard_rows[b['row'] - 1].append(btn)
-		keyboard = [row for row in keyboard_rows if row]
-
 	if message_name == 'start_main':
 		# For start_main, the dynamic keyboard builder handles everything
 		reply_markup = build_start_menu_keyboard()
 	else:
-		keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data=back_to)])
-		reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+		reply_markup = render_cache.keyboard((message_name, back_to), lambda: _build_message_keyboard(message_name, back_to))
 
 
 	try:
@@ -257,8 +250,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Optional: send join/start logs to admin-defined chat (skip if suppressed by flow OR user already existed)
     try:
         if not context.user_data.pop('suppress_join_log', False) and not user_existed:
-            st = query_db("SELECT key, value FROM settings WHERE key IN ('join_logs_enabled','join_logs_chat_id')") or []
-            kv = {r['key']: r['value'] for r in st}
+            kv = get_settings()
             if (kv.get('join_logs_enabled') or '0') == '1':
                 raw = (kv.get('join_logs_chat_id') or '').strip()
                 chat_ident = raw if raw.startswith('@') else (int(raw) if (raw and raw.lstrip('-').isdigit()) else 0)
@@ -304,7 +296,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not sender:
         pass
 
-    message_data = query_db("SELECT text FROM messages WHERE message_name = 'start_main'", one=True)
+    message_data = render_cache.message('start_main')
     text = message_data.get('text') if message_data else "خوش آمدید!"
 
     reply_markup = build_start_menu_keyboard()
@@ -335,7 +327,7 @@ async def dynamic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
 
 	# First, check if the callback data corresponds to a dynamic message.
 	# This is safer than a blacklist of prefixes.
-	if query_db("SELECT 1 FROM messages WHERE message_name = ?", (message_name,), one=True):
+	if render_cache.message(message_name) is not None:
 		await send_dynamic_message(update, context, message_name=message_name, back_to='start_main')
 		# Stop further handlers from processing this update
 		raise ApplicationHandlerStop
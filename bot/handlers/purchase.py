@@ -4,7 +4,8 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.error import BadRequest
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, aquery_db, aexecute_db, run_db, transaction
+from ..cache import get_setting, get_settings, settings_cache, render_cache
 from ..handlers.common import start_command
 from ..states import SELECT_PLAN, AWAIT_DISCOUNT_CODE, AWAIT_PAYMENT_SCREENSHOT, RENEW_AWAIT_PAYMENT, SELECT_PAYMENT_METHOD, AWAIT_CUSTOM_USERNAME
 from ..config import NOBITEX_TOKEN, logger, ADMIN_ID
@@ -109,7 +110,7 @@ async def start_purchase_flow(update: Update, context: ContextTypes.DEFAULT_TYPE
         keyboard.append([InlineKeyboardButton(f"{plan['name']} - {label_price}", callback_data=f"select_plan_{plan['id']}")])
     keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data='start_main')])
 
-    message_data = query_db("SELECT text FROM messages WHERE message_name = 'buy_config_main'", one=True)
+    message_data = render_cache.message('buy_config_main')
     text = message_data.get('text') if message_data else "پلن موردنظر خود را انتخاب کنید:"
 
     await _safe_edit(query.message, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
@@ -348,10 +349,9 @@ def _fetch_nobitex_usd_irt() -> float:
 
 def _fetch_usdt_irt_price() -> float:
     # Priority based on mode: manual or api; then cached
-    from ..db import query_db as _q, execute_db as _x
-    mode = ((_q("SELECT value FROM settings WHERE key = 'usd_irt_mode'", one=True) or {}).get('value') or 'manual').lower()
+    mode = (get_setting('usd_irt_mode') or 'manual').lower()
     if mode == 'manual':
-        manual = (_q("SELECT value FROM settings WHERE key = 'usd_irt_manual'", one=True) or {}).get('value') or ''
+        manual = get_setting('usd_irt_manual') or ''
         try:
             rate = float(manual.strip()) if manual.strip() else 0.0
             if rate > 0:
@@ -361,14 +361,13 @@ def _fetch_usdt_irt_price() -> float:
     else:
         price = _fetch_nobitex_usd_irt()
         if price > 0:
-            try:
-                _x("UPDATE settings SET value = ? WHERE key = 'usd_irt_cached'", (str(int(price)),))
-                _x("UPDATE settings SET value = ? WHERE key = 'usd_irt_cached_ts'", (datetime.now().isoformat(timespec='seconds'),))
-            except Exception:
-                pass
+            settings_cache.set_many({
+                'usd_irt_cached': int(price),
+                'usd_irt_cached_ts': datetime.now().isoformat(timespec='seconds'),
+            })
             return price
     # Cached fallback
-    cached = (_q("SELECT value FROM settings WHERE key = 'usd_irt_cached'", one=True) or {}).get('value') or ''
+    cached = get_setting('usd_irt_cached') or ''
     try:
         c = float(cached.strip()) if cached.strip() else 0.0
         if c > 0:
@@ -394,7 +393,7 @@ async def show_payment_method_selection(update: Update, context: ContextTypes.DE
         await update.effective_message.reply_text("⚠️ خطا! مبلغ نهایی مشخص نیست. لطفاً از ابتدا شروع کنید.")
         return await cancel_flow(update, context)
 
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     pay_card = settings.get('pay_card_enabled', '1') == '1'
     pay_crypto = settings.get('pay_crypto_enabled', '1') == '1'
     pay_gateway = settings.get('pay_gateway_enabled', '0') == '1'
@@ -466,6 +465,27 @@ async def show_payment_method_selection(update: Update, context: ContextTypes.DE
     return SELECT_PAYMENT_METHOD
 
 
+def _wallet_charge(user_id: int, amount: int) -> bool:
+    with transaction() as tx:
+        tx_id = tx.execute(
+            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'debit', 'wallet', 'approved', ?)",
+            (user_id, amount, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        )
+        if not tx.debit_wallet(user_id, amount, 'purchase', f"wallet_tx:{tx_id}"):
+            tx.rollback()
+            return False
+    return True
+
+
+def _wallet_refund(user_id: int, amount: int):
+    with transaction() as tx:
+        tx_id = tx.execute(
+            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'credit', 'refund', 'approved', ?)",
+            (user_id, amount, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        )
+        tx.credit_wallet(user_id, amount, 'refund', f"wallet_tx:{tx_id}")
+
+
 async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     from ..config import logger
     query = update.callback_query
@@ -480,12 +500,25 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.message.edit_text("⚠️ خطا: مبلغ نهایی یافت نشد. لطفاً از ابتدا اقدام کنید.")
         return ConversationHandler.END
         
-    bal_row = query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (user.id,), one=True)
+    bal_row = await aquery_db("SELECT balance FROM user_wallets WHERE user_id = ?", (user.id,), one=True)
     balance = bal_row.get('balance') if bal_row else 0
     
     logger.info(f"[pay_wallet] User {user.id} balance={balance}, price={final_price}")
     
-    if balance < int(final_price):
+    # Deduct and log transaction atomically; the conditional debit also rejects
+    # a concurrent double-click that already spent the balance
+    charged = False
+    if balance >= int(final_price):
+        logger.info(f"[pay_wallet] Deducting {final_price} from user {user.id} wallet")
+        try:
+            charged = await run_db(_wallet_charge, user.id, int(final_price))
+            logger.info(f"[pay_wallet] Wallet transaction completed successfully")
+        except Exception as e:
+            logger.error(f"[pay_wallet] Error in wallet transaction: {e}", exc_info=True)
+            await query.message.edit_text(f"❌ خطا در پردازش تراکنش: {str(e)}")
+            return ConversationHandler.END
+
+    if not charged:
         kb = [
             [InlineKeyboardButton("💳 شارژ کیف پول", callback_data='wallet_menu')],
             [InlineKeyboardButton("🔙 بازگشت", callback_data='buy_config_main')],
@@ -498,18 +531,6 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return SELECT_PAYMENT_METHOD
 
-    # Deduct and log transaction
-    logger.info(f"[pay_wallet] Deducting {final_price} from user {user.id} wallet")
-    try:
-        execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user.id,))
-        execute_db("UPDATE user_wallets SET balance = balance - ? WHERE user_id = ?", (int(final_price), user.id))
-        execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'debit', 'wallet', 'approved', ?)", (user.id, int(final_price), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        logger.info(f"[pay_wallet] Wallet transaction completed successfully")
-    except Exception as e:
-        logger.error(f"[pay_wallet] Error in wallet transaction: {e}", exc_info=True)
-        await query.message.edit_text(f"❌ خطا در پردازش تراکنش: {str(e)}")
-        return ConversationHandler.END
-
     is_renewal = context.user_data.get('renewing_order_id')
     logger.info(f"[pay_wallet] is_renewal={is_renewal}, user_data keys: {list(context.user_data.keys())}")
     
@@ -525,7 +546,7 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.message.edit_text("❌ خطا در فرآیند تمدید. لطفاً مجدداً تلاش کنید.")
             return ConversationHandler.END
             
-        plan = query_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
+        plan = await aquery_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
         logger.info(f"[pay_wallet] Starting renewal process for order {order_id}")
         
         # Auto-process renewal immediately (no admin approval needed)
@@ -542,13 +563,13 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if ok:
                 # Apply discount code usage
                 if discount_code:
-                    execute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (discount_code,))
+                    await aexecute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (discount_code,))
                 # Reset reminder date
-                execute_db("UPDATE orders SET last_reminder_date = NULL WHERE id = ?", (order_id,))
+                await aexecute_db("UPDATE orders SET last_reminder_date = NULL WHERE id = ?", (order_id,))
                 new_bal = (balance - int(final_price))
                 
                 # Fetch updated service details to show user
-                order_details = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
+                order_details = await aquery_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
                 from datetime import timedelta
                 
                 # Calculate new expiry date
@@ -628,8 +649,7 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         pass
             else:
                 # Refund on failure
-                execute_db("UPDATE user_wallets SET balance = balance + ? WHERE user_id = ?", (int(final_price), user.id))
-                execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'credit', 'refund', 'approved', ?)", (user.id, int(final_price), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                await run_db(_wallet_refund, user.id, int(final_price))
                 
                 error_msg = (
                     f"❌ **متاسفانه تمدید ناموفق بود**\n\n"
@@ -662,8 +682,7 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 )
         except Exception as e:
             # Refund on exception
-            execute_db("UPDATE user_wallets SET balance = balance + ? WHERE user_id = ?", (int(final_price), user.id))
-            execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'credit', 'refund', 'approved', ?)", (user.id, int(final_price), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            await run_db(_wallet_refund, user.id, int(final_price))
             
             exception_msg = (
                 f"⚠️ **خطای سیستمی در تمدید**\n\n"
@@ -704,9 +723,11 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
     # Create order first so we can attempt auto-approval on Sanaei/X-UI panels
     desired = (context.user_data.get('desired_username') or '').strip()
-    order_id = execute_db(
-        "INSERT INTO orders (user_id, plan_id, timestamp, final_price, discount_code, desired_username) VALUES (?, ?, ?, ?, ?, ?)",
-        (user.id, plan_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), int(final_price), discount_code, desired),
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    order_id = await aexecute_db(
+        "INSERT INTO orders (user_id, plan_id, timestamp, expires_at, final_price, discount_code, desired_username) "
+        "VALUES (?, ?, ?, datetime(?, '+' || (SELECT duration_days FROM plans WHERE id = ?) || ' days'), ?, ?, ?)",
+        (user.id, plan_id, now_str, now_str, plan_id, int(final_price), discount_code, desired),
     )
 
     # Try auto-approval (for panels with default inbound configured)
@@ -724,7 +745,7 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         #    (user.id, int(final_price), datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         #)
         try:
-            plan = query_db("SELECT name FROM plans WHERE id = ?", (context.user_data.get('selected_plan_id'),), one=True) or {}
+            plan = await aquery_db("SELECT name FROM plans WHERE id = ?", (context.user_data.get('selected_plan_id'),), one=True) or {}
             await _log_purchase(
                 context,
                 user.id,
@@ -736,10 +757,10 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         except Exception:
             pass
         try:
-            r = query_db("SELECT max_purchases, used_purchases FROM resellers WHERE user_id = ?", (user.id,), one=True)
+            r = await aquery_db("SELECT max_purchases, used_purchases FROM resellers WHERE user_id = ?", (user.id,), one=True)
             if r and int(r.get('used_purchases') or 0) < int(r.get('max_purchases') or 0):
-                execute_db("UPDATE resellers SET used_purchases = used_purchases + 1 WHERE user_id = ?", (user.id,))
-                execute_db("UPDATE orders SET reseller_applied = 1 WHERE id = ?", (order_id,))
+                await aexecute_db("UPDATE resellers SET used_purchases = used_purchases + 1 WHERE user_id = ?", (user.id,))
+                await aexecute_db("UPDATE orders SET reseller_applied = 1 WHERE id = ?", (order_id,))
         except Exception:
             pass
         try:
@@ -764,7 +785,7 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     # Fallback: auto-approval not possible -> complete automatically without admin prompt
-    plan = query_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
+    plan = await aquery_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
     # Charge wallet immediately (keeps same economics)
     #execute_db("UPDATE user_wallets SET balance = balance - ? WHERE user_id = ?", (int(final_price), user.id))
     #execute_db(
@@ -811,7 +832,7 @@ async def show_payment_info_card(update: Update, context: ContextTypes.DEFAULT_T
         return await cancel_flow(update, context)
 
     cards = query_db("SELECT card_number, holder_name FROM cards")
-    payment_message_data = query_db("SELECT text FROM messages WHERE message_name = 'payment_info_text'", one=True)
+    payment_message_data = render_cache.message('payment_info_text')
 
     is_renewal = context.user_data.get('renewing_order_id')
     if is_renewal:
@@ -923,7 +944,7 @@ async def show_payment_info_gateway(update: Update, context: ContextTypes.DEFAUL
         await update.effective_message.reply_text("خطا! قیمت نهایی مشخص نیست. لطفا از ابتدا شروع کنید.")
         return await cancel_flow(update, context)
 
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     callback_url = (settings.get('gateway_callback_url') or '').strip()
 
@@ -1023,9 +1044,11 @@ async def receive_payment_screenshot(update: Update, context: ContextTypes.DEFAU
         return ConversationHandler.END
 
     plan = query_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     order_id = execute_db(
-        "INSERT INTO orders (user_id, plan_id, screenshot_file_id, timestamp, final_price, discount_code) VALUES (?, ?, ?, ?, ?, ?)",
-        (user.id, plan_id, (photo_file_id or document_file_id or None), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), final_price, discount_code),
+        "INSERT INTO orders (user_id, plan_id, screenshot_file_id, timestamp, expires_at, final_price, discount_code) "
+        "VALUES (?, ?, ?, ?, datetime(?, '+' || (SELECT duration_days FROM plans WHERE id = ?) || ' days'), ?, ?)",
+        (user.id, plan_id, (photo_file_id or document_file_id or None), now_str, now_str, plan_id, final_price, discount_code),
     )
 
     user_info = f"\U0001F464 **کاربر:** {user.mention_html()}\n\U0001F194 **آیدی:** `{user.id}`"
@@ -1174,14 +1197,14 @@ async def gateway_verify_purchase(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("خطا: اطلاعات پرداخت یافت نشد.")
         return SELECT_PAYMENT_METHOD
     if gw.get('type') == 'zarinpal':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         merchant_id = settings.get('zarinpal_merchant_id') or ''
         ok, ref_id = _zarinpal_verify(merchant_id, gw.get('amount_rial', 0), gw.get('authority', ''))
         if not ok:
             await query.message.edit_text("پرداخت تایید نشد. اگر پرداخت کرده‌اید چند لحظه دیگر دوباره بررسی کنید یا از روش‌های دیگر استفاده کنید.")
             return SELECT_PAYMENT_METHOD
     elif gw.get('type') == 'aghapay':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         pin = settings.get('aghapay_pin') or ''
         ok = _aghapay_verify(pin, int(context.user_data.get('final_price', 0)), gw.get('transid', ''))
         if not ok:
@@ -1197,9 +1220,10 @@ async def gateway_verify_purchase(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("خطا: اطلاعات خرید یافت نشد. لطفا مجددا خرید کنید.")
         await start_command(update, context)
         return ConversationHandler.END
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     order_id = execute_db(
-        "INSERT INTO orders (user_id, plan_id, timestamp, final_price, discount_code) VALUES (?, ?, ?, ?, ?)",
-        (user.id, plan_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), final_price, discount_code),
+        "INSERT INTO orders (user_id, plan_id, timestamp, expires_at, final_price, discount_code) VALUES (?, ?, ?, datetime(?, '+' || (SELECT duration_days FROM plans WHERE id = ?) || ' days'), ?, ?)",
+        (user.id, plan_id, now_str, now_str, plan_id, final_price, discount_code),
     )
     # Increment reseller usage if applicable
     try:
@@ -1241,14 +1265,14 @@ async def gateway_verify_renewal(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.edit_text("خطا: اطلاعات پرداخت یافت نشد.")
         return RENEW_AWAIT_PAYMENT
     if gw.get('type') == 'zarinpal':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         merchant_id = settings.get('zarinpal_merchant_id') or ''
         ok, ref_id = _zarinpal_verify(merchant_id, gw.get('amount_rial', 0), gw.get('authority', ''))
         if not ok:
             await query.message.edit_text("پرداخت تایید نشد. اگر پرداخت کرده‌اید کمی بعد دوباره بررسی کنید.")
             return RENEW_AWAIT_PAYMENT
     elif gw.get('type') == 'aghapay':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         pin = settings.get('aghapay_pin') or ''
         ok = _aghapay_verify(pin, int(context.user_data.get('final_price', 0)), gw.get('transid', ''))
         if not ok:
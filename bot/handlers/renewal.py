@@ -5,7 +5,7 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, extend_order_expiry
 from ..states import (
     RENEW_SELECT_PLAN,
     RENEW_AWAIT_DISCOUNT_CODE,
@@ -34,7 +34,14 @@ def _get_additions_from_plan(plan: dict) -> Tuple[float, int]:
 
 
 def _find_inbound_id(api: VpnPanelAPI, marz_username: str) -> Optional[int]:
-    """Search all inbounds for a client email matching marz_username."""
+    """Inbound holding the client email marz_username: from the panel's client index when it keeps one,
+    otherwise by searching all inbounds."""
+    if getattr(api, 'indexes_clients', False):
+        try:
+            found = api._locate_client(marz_username)
+        except Exception:
+            return None
+        return found[0][0] if found else None
     try:
         inbounds, _msg = api.list_inbounds()
     except Exception:
@@ -308,22 +315,22 @@ async def process_renewal_for_order(order_id: int, plan_id: int, context: Contex
             # Recreate-only to avoid updateClient 404s; fallback to panel-level renew
             renewed_user, message = None, None
             if hasattr(api, 'renew_by_recreate_on_inbound'):
-                renewed_user, message = api.renew_by_recreate_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await api.run(api.renew_by_recreate_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 logger.info(f"renew_by_recreate_on_inbound result: success={bool(renewed_user)} msg={message}")
 
             if not renewed_user:
                 logger.info("Fallback to renew_user_on_inbound")
-                renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await api.run(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 logger.info(f"renew_user_on_inbound result: success={bool(renewed_user)} msg={message}")
         else:
-            inbound_id = _find_inbound_id(api, marz_username) or 0
+            inbound_id = await api.run(_find_inbound_id, api, marz_username) or 0
             if inbound_id:
                 execute_db("UPDATE orders SET xui_inbound_id = ? WHERE id = ?", (inbound_id, order_id))
                 logger.info(f"Found inbound {inbound_id} for {marz_username} via search; persisted for future renewals")
 
-                renewed_user, message = api.renew_by_recreate_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await api.run(api.renew_by_recreate_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 if not renewed_user:
-                    renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                    renewed_user, message = await api.run(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
             else:
                 logger.warning(f"No inbound found for {marz_username}; falling back to panel-level renew")
                 renewed_user, message = await api.renew_user_in_panel(marz_username, plan)
@@ -337,22 +344,22 @@ async def process_renewal_for_order(order_id: int, plan_id: int, context: Contex
             # Recreate-only for X-UI/3x-UI/TX-UI to avoid 404 update endpoints
             renewed_user, message = None, None
             if hasattr(api, 'renew_by_recreate_on_inbound'):
-                renewed_user, message = api.renew_by_recreate_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await api.run(api.renew_by_recreate_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 logger.info(f"[ELIF] renew_by_recreate_on_inbound result: success={bool(renewed_user)} msg={message}")
 
             if not renewed_user:
                 logger.info("[ELIF] Fallback to renew_user_on_inbound")
-                renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await api.run(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 logger.info(f"[ELIF] renew_user_on_inbound result: success={bool(renewed_user)} msg={message}")
         else:
-            inbound_id = _find_inbound_id(api, marz_username) or 0
+            inbound_id = await api.run(_find_inbound_id, api, marz_username) or 0
             if inbound_id:
                 execute_db("UPDATE orders SET xui_inbound_id = ? WHERE id = ?", (inbound_id, order_id))
                 logger.info(f"[ELIF] Found inbound {inbound_id} for {marz_username} via search; persisted for future renewals")
 
-                renewed_user, message = api.renew_by_recreate_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await api.run(api.renew_by_recreate_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 if not renewed_user:
-                    renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                    renewed_user, message = await api.run(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
             else:
                 logger.warning(f"[ELIF] No inbound found for {marz_username}; falling back to panel-level renew")
                 renewed_user, message = await api.renew_user_in_panel(marz_username, plan)
@@ -366,6 +373,10 @@ async def process_renewal_for_order(order_id: int, plan_id: int, context: Contex
                 execute_db("UPDATE orders SET xui_client_id = ? WHERE id = ?", (new_cid, order_id))
         except Exception:
             pass
+        try:
+            extend_order_expiry(order_id, _get_additions_from_plan(plan)[1])
+        except Exception:
+            pass
         try:
             # Only reset usage counters for Marzban-like panels; X-UI/3x-UI/TX-UI recreate already resets usage
             xui_types = ('3xui','3x-ui','3x ui','xui','x-ui','sanaei','alireza','txui','tx-ui','tx ui')
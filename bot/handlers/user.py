@@ -9,18 +9,20 @@ def _with_name_fragment(uri: str, name: str) -> str:
         if '#' in uri:
             return uri.split('#', 1)[0] + f"#{name}"
         return uri
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests, base64
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.error import TelegramError, BadRequest
 from telegram.ext import ContextTypes, ConversationHandler, CallbackQueryHandler, MessageHandler, filters
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, aquery_db, aexecute_db, run_db, transaction
+from ..cache import get_setting, get_settings, settings_cache
 from ..utils import register_new_user
 from ..helpers.flow import set_flow, clear_flow
 from ..helpers.keyboards import build_start_menu_keyboard
 from ..panel import VpnPanelAPI
+from ..panel_cache import panel_users, panel_user
 from ..utils import bytes_to_gb
 from ..states import (
     WALLET_AWAIT_AMOUNT_CARD,
@@ -108,8 +110,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
         return
 
     # Use admin-selected panel for free trials if set; fallback to first
-    cfg = query_db("SELECT value FROM settings WHERE key = 'free_trial_panel_id'", one=True)
-    sel_id = (cfg.get('value') if cfg else '') or ''
+    sel_id = get_setting('free_trial_panel_id') or ''
     first_panel = None
     if sel_id.isdigit():
         first_panel = query_db("SELECT id FROM panels WHERE id = ?", (int(sel_id),), one=True)
@@ -127,7 +128,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
     except Exception:
         pass
 
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings WHERE key LIKE 'free_trial_%'")}
+    settings = get_settings()
     trial_plan = {'traffic_gb': settings.get('free_trial_gb', '0.2'), 'duration_days': settings.get('free_trial_days', '1')}
 
     panel_api = VpnPanelAPI(panel_id=first_panel['id'])
@@ -149,8 +150,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
         # For XUI-like panels, if a trial inbound is set, create on that inbound directly
         prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (first_panel['id'],), one=True) or {}
         ptype = (prow.get('panel_type') or '').lower()
-        trial_inb_row = query_db("SELECT value FROM settings WHERE key='free_trial_inbound_id'", one=True)
-        trial_inb = int(trial_inb_row.get('value')) if (trial_inb_row and str(trial_inb_row.get('value') or '').isdigit()) else None
+        trial_inb = settings_cache.get_int('free_trial_inbound_id', None)
         
         # Delete existing user from panel first to prevent duplicate email error
         import re as _re
@@ -160,13 +160,13 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
                 # Try to delete from specific inbound
                 if hasattr(panel_api, 'delete_user_on_inbound'):
                     try:
-                        panel_api.delete_user_on_inbound(trial_inb, base_username)
+                        await panel_api.run(panel_api.delete_user_on_inbound, trial_inb, base_username)
                     except Exception:
                         pass
             # Fallback: try generic delete
             if hasattr(panel_api, 'delete_user'):
                 try:
-                    panel_api.delete_user(base_username)
+                    await panel_api.run(panel_api.delete_user, base_username)
                 except Exception:
                     pass
         except Exception:
@@ -175,7 +175,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
         if ptype in ('xui','x-ui','3xui','3x-ui','alireza','txui','tx-ui','tx ui') and trial_inb is not None and hasattr(panel_api, 'create_user_on_inbound'):
             username_created, sub_link, _msg = None, None, None
             try:
-                username_created, sub_link, _msg = panel_api.create_user_on_inbound(trial_inb, user_id, trial_plan)
+                username_created, sub_link, _msg = await panel_api.run(panel_api.create_user_on_inbound, trial_inb, user_id, trial_plan)
             except Exception as e:
                 username_created, sub_link, _msg = None, None, str(e)
             marzban_username, config_link, message = username_created, sub_link, _msg
@@ -193,25 +193,29 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
         plan_id = plan_id_row['id'] if plan_id_row else -1
 
         # Persist order; for XUI-like with selected inbound, save xui_inbound_id too
+        now = datetime.now()
+        now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            trial_expires_at = (now + timedelta(days=float(trial_plan['duration_days']))).strftime("%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError):
+            trial_expires_at = None
         xui_inb = None
         try:
             prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (first_panel['id'],), one=True) or {}
             ptype = (prow.get('panel_type') or '').lower()
             if ptype in ('xui','x-ui','3xui','3x-ui','alireza','txui','tx-ui','tx ui'):
-                trial_inb_row = query_db("SELECT value FROM settings WHERE key='free_trial_inbound_id'", one=True)
-                if trial_inb_row and str(trial_inb_row.get('value') or '').isdigit():
-                    xui_inb = int(trial_inb_row.get('value'))
+                xui_inb = settings_cache.get_int('free_trial_inbound_id', None)
         except Exception:
             xui_inb = None
         if xui_inb is not None:
             execute_db(
-                "INSERT INTO orders (user_id, plan_id, panel_id, status, marzban_username, timestamp, xui_inbound_id, panel_type, is_trial) VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT panel_type FROM panels WHERE id=?), 1)",
-                (user_id, plan_id, first_panel['id'], 'approved', marzban_username, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), xui_inb, first_panel['id']),
+                "INSERT INTO orders (user_id, plan_id, panel_id, status, marzban_username, timestamp, expires_at, xui_inbound_id, panel_type, is_trial) VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT panel_type FROM panels WHERE id=?), 1)",
+                (user_id, plan_id, first_panel['id'], 'approved', marzban_username, now_str, trial_expires_at, xui_inb, first_panel['id']),
             )
         else:
             execute_db(
-                "INSERT INTO orders (user_id, plan_id, panel_id, status, marzban_username, timestamp, panel_type, is_trial) VALUES (?, ?, ?, ?, ?, ?, (SELECT panel_type FROM panels WHERE id=?), 1)",
-                (user_id, plan_id, first_panel['id'], 'approved', marzban_username, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), first_panel['id']),
+                "INSERT INTO orders (user_id, plan_id, panel_id, status, marzban_username, timestamp, expires_at, panel_type, is_trial) VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT panel_type FROM panels WHERE id=?), 1)",
+                (user_id, plan_id, first_panel['id'], 'approved', marzban_username, now_str, trial_expires_at, first_panel['id']),
             )
         execute_db("INSERT INTO free_trials (user_id, timestamp) VALUES (?, ?)", (user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
@@ -237,7 +241,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
                     ib_id = None
             if ib_id is not None and hasattr(panel_api, 'get_configs_for_user_on_inbound'):
                 try:
-                    confs = panel_api.get_configs_for_user_on_inbound(int(ib_id), marzban_username) or []
+                    confs = await panel_api.run(panel_api.get_configs_for_user_on_inbound, int(ib_id), marzban_username) or []
                 except Exception:
                     confs = []
             if not confs and isinstance(config_link, str) and config_link.startswith('http'):
@@ -254,7 +258,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
                 except Exception:
                     confs_named = confs
                 cfg_text = "\n".join(f"<code>{c}</code>" for c in confs_named)
-                footer = ((query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True) or {}).get('value') or '')
+                footer = (get_setting('config_footer_text') or '')
                 text = (
                     f"✅ کانفیگ تست رایگان شما با موفقیت ساخته شد!\n\n"
                     f"<b>حجم:</b> {trial_plan['traffic_gb']} گیگابایت\n"
@@ -317,7 +321,7 @@ async def my_services_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         except Exception:
             page = 1
     
-    orders = query_db(
+    orders = await aquery_db(
         "SELECT * FROM orders WHERE user_id = ? AND status NOT IN ('deleted', 'canceled') ORDER BY timestamp DESC",
         (user_id,)
     )
@@ -370,22 +374,11 @@ async def my_services_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             if panel_id not in panel_users_cache:
                 panel_users_cache[panel_id] = {}
     
-    # Fetch all users for each panel once
+    # Usage comes from the per-panel user snapshots; only a panel never listed before is waited for
     import asyncio
     for panel_id in panel_users_cache.keys():
         try:
-            panel_api = VpnPanelAPI(panel_id=panel_id)
-            # Get all users from this panel with timeout
-            users_list, _ = await asyncio.wait_for(
-                panel_api.get_all_users(limit=1000),
-                timeout=5.0
-            )
-            if users_list:
-                # Index by username for quick lookup
-                for user_info in users_list:
-                    username = user_info.get('username')
-                    if username:
-                        panel_users_cache[panel_id][username] = user_info
+            panel_users_cache[panel_id] = await asyncio.wait_for(panel_users(panel_id), timeout=5.0)
         except Exception:
             pass  # Silently fail - panel might be down
     
@@ -479,7 +472,7 @@ async def show_specific_service_details(update: Update, context: ContextTypes.DE
     order_id = int(query.data.split('_')[-1])
     await query.answer()
 
-    order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
+    order = await aquery_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
     if not order or order['user_id'] != query.from_user.id:
         await query.message.edit_text(
             "❌ <b>خطا</b>\n\nاین سرویس یافت نشد یا حذف شده است.",
@@ -525,7 +518,7 @@ async def show_specific_service_details(update: Update, context: ContextTypes.DE
         import asyncio
         logger.info(f"[view_service] Calling get_user for {marzban_username}")
         user_info, message = await asyncio.wait_for(
-            panel_api.get_user(marzban_username),
+            panel_user(panel_id, marzban_username),
             timeout=15.0
         )
         logger.info(f"[view_service] get_user returned: user_info={'OK' if user_info else 'None'}, message={message}")
@@ -580,7 +573,7 @@ async def show_specific_service_details(update: Update, context: ContextTypes.DE
     # For 3x-UI/X-UI panels, try to show direct configs instead of sub link
     panel_type = (order.get('panel_type') or '').lower()
     if not panel_type and order.get('panel_id'):
-        prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (order['panel_id'],), one=True)
+        prow = await aquery_db("SELECT panel_type FROM panels WHERE id = ?", (order['panel_id'],), one=True)
         if prow:
             panel_type = (prow.get('panel_type') or '').lower()
     link_label = "\U0001F517 لینک اشتراک:"
@@ -595,11 +588,11 @@ async def show_specific_service_details(update: Update, context: ContextTypes.DE
                 if order.get('xui_inbound_id'):
                     ib_id = int(order['xui_inbound_id'])
                 else:
-                    inbounds, _m = panel_api.list_inbounds()
+                    inbounds, _m = await panel_api.run(panel_api.list_inbounds)
                     if inbounds:
                         ib_id = inbounds[0].get('id')
                 if ib_id is not None:
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, marzban_username) or []
+                    confs = await panel_api.run(panel_api.get_configs_for_user_on_inbound, ib_id, marzban_username) or []
             if not confs and sub_link and isinstance(sub_link, str) and sub_link.startswith('http'):
                 confs = _fetch_subscription_configs(sub_link)
             if confs:
@@ -615,14 +608,13 @@ async def show_specific_service_details(update: Update, context: ContextTypes.DE
         except Exception:
             pass
     try:
-        execute_db("UPDATE orders SET last_link = ? WHERE id = ?", (sub_link or '', order_id))
+        await aexecute_db("UPDATE orders SET last_link = ? WHERE id = ?", (sub_link or '', order_id))
     except Exception:
         pass
 
     # Respect setting: user_show_quota_enabled
     try:
-        show_quota = (query_db("SELECT value FROM settings WHERE key='user_show_quota_enabled'", one=True) or {}).get('value')
-        show_quota = (show_quota or '1') == '1'
+        show_quota = (get_setting('user_show_quota_enabled') or '1') == '1'
     except Exception:
         show_quota = True
 
@@ -717,13 +709,13 @@ async def view_service_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             if order.get('xui_inbound_id'):
                 ib_id = int(order['xui_inbound_id'])
             elif hasattr(panel_api, 'list_inbounds'):
-                inbounds, _m = panel_api.list_inbounds()
+                inbounds, _m = await panel_api.run(panel_api.list_inbounds)
                 if inbounds:
                     ib_id = inbounds[0].get('id')
             confs = []
             if ib_id is not None and hasattr(panel_api, 'get_configs_for_user_on_inbound'):
                 try:
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, order['marzban_username']) or []
+                    confs = await panel_api.run(panel_api.get_configs_for_user_on_inbound, ib_id, order['marzban_username']) or []
                 except Exception:
                     confs = []
             if confs:
@@ -733,7 +725,7 @@ async def view_service_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Fallback to subscription link
     if qr_target is None:
         try:
-            user_info, message = await panel_api.get_user(order['marzban_username'])
+            user_info, message = await panel_user(order['panel_id'], order['marzban_username'])
             if user_info:
                 sub = user_info.get('subscription_url') or ''
                 if sub and not sub.startswith('http'):
@@ -830,19 +822,19 @@ async def delete_service_confirm(update: Update, context: ContextTypes.DEFAULT_T
             if panel_type in ('3xui','3x-ui','3x ui','xui','x-ui','sanaei','alireza','txui','tx-ui','tx ui'):
                 if hasattr(api, 'delete_user_on_inbound') and inb and username:
                     try:
-                        deleted_on_panel = bool(api.delete_user_on_inbound(inb, username, client_id=cid))
+                        deleted_on_panel = bool(await api.run(api.delete_user_on_inbound, inb, username, client_id=cid))
                     except TypeError:
-                        deleted_on_panel = bool(api.delete_user_on_inbound(inb, username))
+                        deleted_on_panel = bool(await api.run(api.delete_user_on_inbound, inb, username))
                 if not deleted_on_panel and hasattr(api, 'delete_user') and username:
                     try:
-                        deleted_on_panel = bool(api.delete_user(username))
+                        deleted_on_panel = bool(await api.run(api.delete_user, username))
                     except Exception:
                         deleted_on_panel = False
             else:
                 # Marzban/Marzneshin like
                 if hasattr(api, 'delete_user') and username:
                     try:
-                        deleted_on_panel = bool(api.delete_user(username))
+                        deleted_on_panel = bool(await api.run(api.delete_user, username))
                     except Exception:
                         deleted_on_panel = False
                 elif hasattr(api, 'disable_user') and username:
@@ -854,7 +846,7 @@ async def delete_service_confirm(update: Update, context: ContextTypes.DEFAULT_T
         deleted_on_panel = False
     # Mark deleted in DB
     try:
-        execute_db("UPDATE orders SET status = 'deleted' WHERE id = ?", (order_id,))
+        execute_db("UPDATE orders SET status = 'deleted', deleted_at = datetime('now','localtime') WHERE id = ?", (order_id,))
     except Exception:
         pass
     msg = "✅ سرویس با موفقیت حذف شد." + ("\n\n✅ از پنل نیز حذف گردید." if deleted_on_panel else "\n\n⚠️ توجه: ممکن است از پنل حذف نشده باشد.")
@@ -909,14 +901,14 @@ async def check_service_status(update: Update, context: ContextTypes.DEFAULT_TYP
             # Method 2: Try to get token or login (for XUI panels)
             elif hasattr(panel_api, 'get_token'):
                 try:
-                    panel_api.get_token()
+                    await panel_api.run(panel_api.get_token)
                     is_online = True
                 except Exception:
                     is_online = False
             # Method 3: Try a simple API call
             elif hasattr(panel_api, 'list_inbounds'):
                 try:
-                    inbounds, _ = panel_api.list_inbounds()
+                    inbounds, _ = await panel_api.run(panel_api.list_inbounds)
                     is_online = inbounds is not None
                 except Exception:
                     is_online = False
@@ -996,7 +988,7 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
             # ensure login for 3x-UI
             if hasattr(panel_api, 'get_token'):
                 try:
-                    panel_api.get_token()
+                    await panel_api.run(panel_api.get_token)
                 except Exception:
                     pass
             ib_id = None
@@ -1004,7 +996,7 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
                 ib_id = int(order['xui_inbound_id'])
             else:
                 if hasattr(panel_api, 'list_inbounds'):
-                    inbounds, _m = panel_api.list_inbounds()
+                    inbounds, _m = await panel_api.run(panel_api.list_inbounds)
                     if inbounds:
                         ib_id = inbounds[0].get('id')
             if ib_id is None:
@@ -1018,7 +1010,7 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
             if hasattr(panel_api, 'get_configs_for_user_on_inbound'):
                 for _ in range(4):
                     pref_id = (order.get('xui_client_id') or None)
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, order['marzban_username'], preferred_id=pref_id) or []
+                    confs = await panel_api.run(panel_api.get_configs_for_user_on_inbound, ib_id, order['marzban_username'], preferred_id=pref_id) or []
                     if confs:
                         break
                     time.sleep(1.0)
@@ -1104,7 +1096,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # Try to ensure token if available
         if hasattr(panel_api, '_ensure_token'):
             try:
-                panel_api._ensure_token()
+                await panel_api.run(panel_api._ensure_token)
             except Exception:
                 try:
                     logger.warning("revoke_key: _ensure_token failed", exc_info=True)
@@ -1129,14 +1121,14 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         if not ok and (order.get('xui_inbound_id') and hasattr(panel_api, 'rotate_user_key_on_inbound')):
             if hasattr(panel_api, 'get_token'):
                 try:
-                    panel_api.get_token()
+                    await panel_api.run(panel_api.get_token)
                 except Exception:
                     try:
                         logger.warning("revoke_key: get_token failed", exc_info=True)
                     except Exception:
                         pass
             try:
-                updated = panel_api.rotate_user_key_on_inbound(int(order['xui_inbound_id']), order['marzban_username'])
+                updated = await panel_api.run(panel_api.rotate_user_key_on_inbound, int(order['xui_inbound_id']), order['marzban_username'])
                 ok = bool(updated)
             except Exception:
                 ok = False
@@ -1147,7 +1139,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # 3x-UI rotate across inbounds as fallback
         if not ok and hasattr(panel_api, 'rotate_user_key'):
             try:
-                ok = bool(panel_api.rotate_user_key(order['marzban_username']))
+                ok = bool(await panel_api.run(panel_api.rotate_user_key, order['marzban_username']))
             except Exception:
                 ok = False
                 try:
@@ -1157,7 +1149,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # Marzban fallback
         if not ok and hasattr(panel_api, 'revoke_subscription'):
             try:
-                ok, _msg = panel_api.revoke_subscription(order['marzban_username'])
+                ok, _msg = await panel_api.run(panel_api.revoke_subscription, order['marzban_username'])
             except Exception:
                 ok = False
                 try:
@@ -1186,7 +1178,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 ib_id = int(order['xui_inbound_id'])
             else:
                 try:
-                    inbounds, _m = panel_api.list_inbounds()
+                    inbounds, _m = await panel_api.run(panel_api.list_inbounds)
                     if inbounds:
                         ib_id = inbounds[0].get('id')
                 except Exception:
@@ -1194,7 +1186,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             if ib_id is None:
                 await query.answer("اینباندی یافت نشد", show_alert=True)
                 return ConversationHandler.END
-            new_client = panel_api.recreate_user_key_on_inbound(ib_id, order['marzban_username'])
+            new_client = await panel_api.run(panel_api.recreate_user_key_on_inbound, ib_id, order['marzban_username'])
             if not new_client:
                 await query.answer("خطا در تغییر کلید", show_alert=True)
                 return ConversationHandler.END
@@ -1208,7 +1200,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             try:
                 # Try to reuse X-UI/3x-UI config builder with preferred new id
                 if hasattr(panel_api, 'get_configs_for_user_on_inbound'):
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, order['marzban_username'], preferred_id=(new_client.get('id') or new_client.get('uuid'))) or []
+                    confs = await panel_api.run(panel_api.get_configs_for_user_on_inbound, ib_id, order['marzban_username'], preferred_id=new_client.get('id') or new_client.get('uuid')) or []
                 if confs:
                     try:
                         disp_name = (order.get('marzban_username') or '')
@@ -1380,7 +1372,7 @@ async def _wallet_show_gateway_message(update: Update, context: ContextTypes.DEF
     if not amount:
         await update.message.reply_text("خطا: مبلغ یافت نشد.")
         return ConversationHandler.END
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     callback_url = (settings.get('gateway_callback_url') or '').strip()
     amount_rial = int(amount) * 10
@@ -1438,7 +1430,7 @@ async def wallet_verify_gateway(update: Update, context: ContextTypes.DEFAULT_TY
         await query.message.edit_text("اطلاعات پرداخت یافت نشد.")
         return ConversationHandler.END
     ok = False
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     if gw.get('type') == 'zarinpal':
         from .purchase import _zarinpal_verify
         ok, _ = _zarinpal_verify(settings.get('zarinpal_merchant_id') or '', gw.get('amount_rial', 0), gw.get('authority',''))
@@ -1806,8 +1798,7 @@ async def referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     link = f"https://t.me/{(await context.bot.get_me()).username}?start={uid}"
     total = query_db("SELECT COUNT(*) AS c FROM referrals WHERE referrer_id = ?", (uid,), one=True) or {'c': 0}
     buyers = query_db("SELECT COUNT(DISTINCT o.user_id) AS c FROM orders o JOIN referrals r ON r.referee_id = o.user_id WHERE r.referrer_id = ? AND o.status='approved'", (uid,), one=True) or {'c': 0}
-    cfg = query_db("SELECT value FROM settings WHERE key = 'referral_commission_percent'", one=True)
-    percent = int((cfg.get('value') if cfg else '10') or 10)
+    percent = settings_cache.get_int('referral_commission_percent', 10)
     text = (
         "معرفی به دوستان\n\n"
         f"لینک اختصاصی شما:\n{link}\n\n"
@@ -1824,7 +1815,7 @@ async def reseller_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = query.from_user.id
     # Mark intent so direct uploads are accepted even if button wasn't pressed
     context.user_data['reseller_intent'] = True
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     if settings.get('reseller_enabled', '1') != '1':
         await query.message.edit_text("قابلیت نمایندگی موقتا غیرفعال است.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت", callback_data='start_main')]]))
         return ConversationHandler.END
@@ -1882,7 +1873,7 @@ async def reseller_pay_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     context.user_data['reseller_intent'] = True
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     text = (
         f"پرداخت هزینه نمایندگی ({fee:,} تومان)\n\nروش پرداخت خود را انتخاب کنید:"
@@ -1900,7 +1891,7 @@ async def reseller_pay_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def reseller_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     cards = query_db("SELECT card_number, holder_name FROM cards") or []
     if not cards:
@@ -1919,7 +1910,7 @@ async def reseller_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def reseller_pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     wallets = query_db("SELECT asset, chain, address, memo FROM wallets ORDER BY id DESC") or []
     if not wallets:
@@ -1939,7 +1930,7 @@ async def reseller_pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def reseller_pay_gateway(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     callback_url = (settings.get('gateway_callback_url') or '').strip()
@@ -1995,7 +1986,7 @@ async def reseller_verify_gateway(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("اطلاعات پرداخت یافت نشد.")
         return ConversationHandler.END
     ok = False
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     if gw.get('type') == 'zarinpal':
         from .purchase import _zarinpal_verify
         ok, ref_id = _zarinpal_verify(settings.get('zarinpal_merchant_id') or '', gw.get('amount_rial', 0), gw.get('authority',''))
@@ -2010,7 +2001,7 @@ async def reseller_verify_gateway(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
     # Log request and notify admins
     user = query.from_user
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     rr_id = execute_db(
         "INSERT INTO reseller_requests (user_id, amount, method, status, created_at, reference) VALUES (?, ?, ?, 'pending', ?, ?)",
@@ -2050,7 +2041,7 @@ async def reseller_upload_router(update: Update, context: ContextTypes.DEFAULT_T
     method = pay.get('method') or 'card'
     amount = int(pay.get('amount') or 0)
     if amount <= 0:
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+        settings = get_settings()
         amount = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     file_id = None
     caption_extra = ''
@@ -2298,6 +2289,16 @@ async def wallet_topup_card_receive_amount(update: Update, context: ContextTypes
         await update.callback_query.answer("این دکمه غیرفعال است.", show_alert=True)
     return ConversationHandler.END
 
+def _wallet_debit_delivered(user_id: int, price: int) -> int:
+    """Debit a delivered wallet order and log it; the balance may go negative. Returns the new balance."""
+    with transaction() as tx:
+        tx_id = tx.execute(
+            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, -price, 'debit', 'wallet', 'approved', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        return tx.apply_wallet_entry(user_id, -price, 'purchase', f"wallet_tx:{tx_id}", allow_negative=True)
+
+
 async def purchase_method_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -2312,9 +2313,10 @@ async def purchase_method_selected(update: Update, context: ContextTypes.DEFAULT
             return PURCHASE_AWAIT_PAYMENT_METHOD
 
         # Create order first, but keep it in a special pending state
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         order_id = execute_db(
-            "INSERT INTO orders (user_id, plan_id, status, final_price, timestamp) VALUES (?, ?, ?, ?, ?)",
-            (user_id, plan['id'], 'pending_wallet', plan['price'], datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            "INSERT INTO orders (user_id, plan_id, status, final_price, timestamp, expires_at) VALUES (?, ?, ?, ?, ?, datetime(?, ?))",
+            (user_id, plan['id'], 'pending_wallet', plan['price'], now_str, now_str, f"+{int(plan['duration_days'])} days")
         )
         if not order_id:
             await query.edit_message_text("خطا در ثبت سفارش. لطفا دوباره تلاش کنید.")
@@ -2324,13 +2326,9 @@ async def purchase_method_selected(update: Update, context: ContextTypes.DEFAULT
         auto_approved = await auto_approve_wallet_order(order_id, context, update.effective_user)
 
         if auto_approved:
-            # On success, now we can deduct balance and log the transaction
-            new_balance = balance['balance'] - plan['price']
-            execute_db("UPDATE user_wallets SET balance = ? WHERE user_id = ?", (new_balance, user_id))
-            execute_db(
-                "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, -plan['price'], 'debit', 'wallet', 'approved', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-            )
+            # On success, now we can deduct balance and log the transaction; the service is
+            # already delivered, so the debit goes through even if the balance moved meanwhile
+            new_balance = await run_db(_wallet_debit_delivered, user_id, int(plan['price']))
             await query.edit_message_text(
                 f"🎉 <b>پرداخت با موفقیت انجام شد!</b>\n\n"
                 f"✅ سرویس شما به صورت خودکار ایجاد و ارسال شد\n"
@@ -2418,7 +2416,7 @@ async def purchase_method_selected(update: Update, context: ContextTypes.DEFAULT
         return ConversationHandler.END
 
     if payment_method == 'gateway':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         # ... existing code ...
 
 async def purchase_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
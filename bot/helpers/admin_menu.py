@@ -2,28 +2,26 @@
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from ..db import query_db
+from ..db import read_snapshot, run_report
+from ..stats import counters, revenue, today
+from ..cache import get_setting
+
+def _dashboard_stats() -> dict:
+    """Dashboard figures from the rollup tables, read from one snapshot."""
+    with read_snapshot() as snap:
+        c = counters('users', 'orders:active', 'orders:pending', fetch=snap.query)
+        return {
+            'total_users': c['users'],
+            'active_services': c['orders:active'],
+            'today_income': revenue(today(), fetch=snap.query)['wallet_total'],
+            'pending_orders': c['orders:pending'],
+            'open_tickets': snap.query("SELECT COUNT(*) AS c FROM tickets WHERE status='open'", one=True)['c'],
+        }
 
 async def get_admin_stats():
     """Get quick stats for admin dashboard"""
     try:
-        stats = query_db("""
-            SELECT 
-                (SELECT COUNT(*) FROM users) as total_users,
-                (SELECT COUNT(*) FROM orders WHERE status='active') as active_services,
-                (SELECT COALESCE(SUM(amount), 0) FROM wallet_transactions 
-                 WHERE direction='credit' AND status='approved' AND date(created_at) = date('now')) as today_income,
-                (SELECT COUNT(*) FROM orders WHERE status='pending') as pending_orders,
-                (SELECT COUNT(*) FROM tickets WHERE status='open') as open_tickets
-        """, one=True)
-        
-        return {
-            'total_users': stats.get('total_users', 0),
-            'active_services': stats.get('active_services', 0),
-            'today_income': stats.get('today_income', 0),
-            'pending_orders': stats.get('pending_orders', 0),
-            'open_tickets': stats.get('open_tickets', 0)
-        }
+        return await run_report(_dashboard_stats)
     except Exception as e:
         print(f"Error getting admin stats: {e}")
         return {
@@ -38,7 +36,7 @@ def get_main_menu_keyboard():
     """Generate main admin menu keyboard"""
     # Get bot active status
     try:
-        active_val = (query_db("SELECT value FROM settings WHERE key='bot_active'", one=True) or {}).get('value') or '1'
+        active_val = get_setting('bot_active') or '1'
         bot_on = str(active_val) == '1'
     except Exception:
         bot_on = True
@@ -53,6 +51,9 @@ def get_main_menu_keyboard():
             InlineKeyboardButton("👥 کاربران", callback_data="admin_user_management"),
             InlineKeyboardButton("📦 سفارشات", callback_data="admin_orders_manage")
         ],
+        [
+            InlineKeyboardButton("🔎 جستجو (کاربر، سرویس، تیکت)", callback_data="admin_search")
+        ],
         [
             InlineKeyboardButton("🌐 پنل‌ها", callback_data="admin_panels_menu"),
             InlineKeyboardButton("📝 پلن‌ها", callback_data="admin_plan_manage")
@@ -114,43 +115,3 @@ async def get_admin_dashboard_text():
         f"⏳ سفارشات در انتظار: {stats['pending_orders']:,}\n"
         f"📩 تیکت‌های باز: {stats['open_tickets']:,}"
     )
-
-async def get_user_management_keyboard(page=0, limit=10):
-    """Generate user management keyboard with pagination"""
-    offset = page * limit
-    users = query_db(
-        """
-        SELECT user_id, first_name 
-        FROM users 
-        ORDER BY user_id DESC 
-        LIMIT ? OFFSET ?
-        """, 
-        (limit, offset)
-    )
-    
-    keyboard = []
-    for user in users:
-        name = user['first_name'] or "بدون نام"
-        btn_text = f"👤 {name} (ID: {user['user_id']})"
-        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"admin_view_user_{user['user_id']}")])
-    
-    # Add pagination
-    total_users = query_db("SELECT COUNT(*) as count FROM users", one=True)['count']
-    total_pages = (total_users + limit - 1) // limit
-    
-    pagination = []
-    if page > 0:
-        pagination.append(InlineKeyboardButton("⏪ قبلی", callback_data=f"admin_users_page_{page-1}"))
-    if (page + 1) < total_pages:
-        pagination.append(InlineKeyboardButton("بعدی ⏩", callback_data=f"admin_users_page_{page+1}"))
-    
-    if pagination:
-        keyboard.append(pagination)
-    
-    keyboard.append([
-        InlineKeyboardButton("🔍 جستجوی کاربر", callback_data="admin_search_user"),
-        InlineKeyboardButton("➕ کاربر جدید", callback_data="admin_add_user")
-    ])
-    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_main_menu")])
-    
-    return keyboard, f"صفحه {page + 1} از {max(1, total_pages)} - تعداد کل کاربران: {total_users:,}"
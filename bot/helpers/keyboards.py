@@ -1,14 +1,17 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from ..db import query_db
+from ..cache import get_setting, render_cache
 
 
 def build_start_menu_keyboard() -> InlineKeyboardMarkup:
-    buttons_data = query_db(
-        "SELECT text, target, is_url, row, col FROM buttons WHERE menu_name = 'start_main' ORDER BY row, col"
-    )
+    """The start menu; built once and shared until buttons or settings change."""
+    return render_cache.keyboard('start_main', _build_start_menu_keyboard)
 
-    trial_status = query_db("SELECT value FROM settings WHERE key = 'free_trial_status'", one=True)
-    if not trial_status or trial_status.get('value') != '1':
+
+def _build_start_menu_keyboard() -> InlineKeyboardMarkup:
+    buttons_data = render_cache.buttons('start_main')
+
+    trial_on = get_setting('free_trial_status') == '1'
+    if not trial_on:
         buttons_data = [b for b in buttons_data if b.get('target') != 'get_free_config']
 
     keyboard = []
@@ -36,7 +39,7 @@ def build_start_menu_keyboard() -> InlineKeyboardMarkup:
         row = []
         for target, text in row_targets:
             if target == 'get_free_config':
-                if not (trial_status and trial_status.get('value') == '1'):
+                if not trial_on:
                     continue
             if target not in existing_targets and not any(
                 (isinstance(btn, InlineKeyboardButton) and getattr(btn, 'callback_data', None) == target)
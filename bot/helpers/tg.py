@@ -1,5 +1,5 @@
 from telegram.error import BadRequest, TelegramError
-from ..db import query_db
+from ..db import query_db, query_column
 from ..config import ADMIN_ID, logger
 
 
@@ -169,7 +169,7 @@ async def answer_safely(query, text: str | None = None, show_alert: bool = False
 
 def get_all_admin_ids() -> list[int]:
     try:
-        rows = query_db("SELECT user_id FROM admins") or []
+        rows = query_column("SELECT user_id FROM admins")
     except Exception:
         rows = []
     admin_ids: list[int] = []
@@ -181,7 +181,7 @@ def get_all_admin_ids() -> list[int]:
         pass
     for r in rows:
         try:
-            uid = int(r.get('user_id'))
+            uid = int(r)
             if uid not in admin_ids:
                 admin_ids.append(uid)
         except Exception:
@@ -5,8 +5,10 @@ from telegram.error import Forbidden, BadRequest
 from telegram.ext import ContextTypes
 
 from .config import logger
+from .cache import get_settings, settings_cache
 from .db import query_db, execute_db
 from .panel import VpnPanelAPI
+from .panel_cache import panel_users, panel_user
 from .utils import bytes_to_gb
 from .memory_optimizer import cleanup_memory, log_memory_stats, check_memory_threshold
 
@@ -15,7 +17,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Running daily expiration check job...")
     log_memory_stats()  # Log initial memory state
     
-    st_global = {s['key']: s['value'] for s in (query_db("SELECT key, value FROM settings WHERE key IN ('reminder_job_enabled')") or [])}
+    st_global = get_settings()
     if (st_global.get('reminder_job_enabled') or '1') != '1':
         logger.info("Reminder job disabled by settings. Skipping run.")
         return
@@ -66,7 +68,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Reseller expiry check failed: {e}")
 
     # Load alert settings once
-    st = {s['key']: s['value'] for s in (query_db("SELECT key, value FROM settings WHERE key IN ('traffic_alert_enabled','traffic_alert_value_gb','time_alert_enabled','time_alert_days')") or [])}
+    st = get_settings()
     alert_enabled = (st.get('traffic_alert_enabled') or '0') == '1'
     try:
         alert_gb = float(st.get('traffic_alert_value_gb') or 5)
@@ -85,19 +87,17 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
         
         try:
             panel_api = VpnPanelAPI(panel_id=panel_data['id'])
-            all_users, msg = await panel_api.get_all_users()
+            # Read from the panel's user snapshot; panels that cannot list users are asked per username below
+            all_users, msg = None, "panel cannot list its users"
+            if panel_api.lists_users:
+                all_users = list((await panel_users(panel_data['id'])).values())
 
             async def _process_user_record(username: str, m_user: dict):
                 if username not in orders_map:
                     return
                 user_orders = orders_map[username]
                 # Deletion policy: if expired > 2 days -> delete; if plan is trial -> delete immediately after expiry
-                try:
-                    exp_ts = int(m_user.get('expire') or 0)
-                except Exception:
-                    exp_ts = 0
                 now_ts = int(datetime.now().timestamp())
-                should_delete = False
                 is_trial = False
                 # Determine trial by plan duration heuristic (<= 3 days) when plan info is available
                 try:
@@ -112,11 +112,27 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                         is_trial = min(durations) <= 3
                 except Exception:
                     is_trial = False
-                if exp_ts > 0:
-                    if is_trial and exp_ts < now_ts:
-                        should_delete = True
-                    elif exp_ts < (now_ts - 2 * 86400):
-                        should_delete = True
+
+                def _past_deletion(record) -> bool:
+                    try:
+                        exp_ts = int(record.get('expire') or 0)
+                    except Exception:
+                        exp_ts = 0
+                    return exp_ts > 0 and exp_ts < (now_ts if is_trial else now_ts - 2 * 86400)
+
+                should_delete = _past_deletion(m_user)
+                if should_delete:
+                    # The snapshot record may be stale (renewed elsewhere, listing failing):
+                    # only delete on what the panel says right now
+                    try:
+                        live, _ = await VpnPanelAPI(panel_id=panel_data['id']).get_user(username)
+                    except Exception:
+                        live = None
+                    if isinstance(live, dict):
+                        m_user = live
+                        should_delete = _past_deletion(live)
+                    else:
+                        should_delete = False
                 # Execute deletion once per username if needed
                 if should_delete:
                     # Use panel of the first order tied to this username
@@ -132,13 +148,13 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                             msg_d = None
                             if hasattr(p_api, 'delete_user'):
                                 try:
-                                    ok, msg_d = p_api.delete_user(username)
+                                    ok, msg_d = await p_api.run(p_api.delete_user, username)
                                 except Exception as e:
                                     ok = False; msg_d = str(e)
                             if ok:
                                 # Mark all matching orders as deleted
                                 for o in user_orders:
-                                    execute_db("UPDATE orders SET status='deleted' WHERE id = ?", (o['id'],))
+                                    execute_db("UPDATE orders SET status='deleted', deleted_at=datetime('now','localtime') WHERE id = ?", (o['id'],))
                                 logger.info(f"Deleted expired service {username} on panel {target_order['panel_id']}")
                                 return  # stop further processing for this username
                             else:
@@ -211,7 +227,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                                     logger.error(f"Error sending traffic alert to {order['user_id']}: {e}")
 
             if not all_users:
-                # Fallback path for panels that don't support get_all_users (e.g., 3x-UI)
+                # Fallback path for panels that cannot list their users, or whose listing failed
                 logger.info(f"Panel ID {panel_data['id']} does not support get_all_users: {msg}. Falling back to per-order query.")
                 # For this panel, gather usernames from orders
                 panel_usernames = []
@@ -224,7 +240,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                 # Query each username individually
                 for uname in panel_usernames:
                     try:
-                        uinfo, _m = await panel_api.get_user(uname)
+                        uinfo, _m = await panel_user(panel_data['id'], uname)
                         if isinstance(uinfo, dict):
                             # Normalize to expected keys
                             m_user = {
@@ -278,7 +294,7 @@ async def backup_and_send_to_admins(context: ContextTypes.DEFAULT_TYPE):
             if os.path.exists(env_path):
                 z.write(env_path, arcname='.env')
             # Include settings dump
-            settings = query_db("SELECT key, value FROM settings") or []
+            settings = settings_cache.rows()
             dump = json.dumps(settings, ensure_ascii=False, indent=2)
             z.writestr('settings.json', data=dump)
         # Prepare recipients: primary admin + extra admins
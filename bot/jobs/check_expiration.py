@@ -4,14 +4,16 @@ from telegram.error import Forbidden, BadRequest
 from telegram.ext import ContextTypes
 
 from ..config import logger
-from ..db import query_db, execute_db
+from ..cache import get_settings, settings_cache
+from ..db import query_db, execute_db, order_flag_writer
 from ..panel import VpnPanelAPI
+from ..panel_cache import panel_users, panel_user
 from ..utils import bytes_to_gb
 
 
 async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Running daily expiration check job...")
-    st_global = {s['key']: s['value'] for s in (query_db("SELECT key, value FROM settings WHERE key IN ('reminder_job_enabled')") or [])}
+    st_global = get_settings()
     if (st_global.get('reminder_job_enabled') or '1') != '1':
         logger.info("Reminder job disabled by settings. Skipping run.")
         return
@@ -48,7 +50,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Reseller expiry check failed: {e}")
 
     # Load alert settings once
-    st = {s['key']: s['value'] for s in (query_db("SELECT key, value FROM settings WHERE key IN ('traffic_alert_enabled','traffic_alert_value_gb','time_alert_enabled','time_alert_days')") or [])}
+    st = get_settings()
     alert_enabled = (st.get('traffic_alert_enabled') or '0') == '1'
     try:
         alert_gb = float(st.get('traffic_alert_value_gb') or 5)
@@ -64,7 +66,10 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
     for panel_data in all_panels:
         try:
             panel_api = VpnPanelAPI(panel_id=panel_data['id'])
-            all_users, msg = await panel_api.get_all_users()
+            # Read from the panel's user snapshot; panels that cannot list users are asked per username below
+            all_users, msg = None, "panel cannot list its users"
+            if panel_api.lists_users:
+                all_users = list((await panel_users(panel_data['id'])).values())
             
             # For 3x-UI or panels that don't support bulk fetch, all_users will be None/empty
             # and we'll use the fallback path below
@@ -74,12 +79,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                     return
                 user_orders = orders_map[username]
                 # Deletion policy: if expired > 2 days -> delete; if plan is trial -> delete immediately after expiry
-                try:
-                    exp_ts = int(m_user.get('expire') or 0)
-                except Exception:
-                    exp_ts = 0
                 now_ts = int(datetime.now().timestamp())
-                should_delete = False
                 is_trial = False
                 # Determine trial by plan duration heuristic (<= 3 days) when plan info is available
                 try:
@@ -94,11 +94,27 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                         is_trial = min(durations) <= 3
                 except Exception:
                     is_trial = False
-                if exp_ts > 0:
-                    if is_trial and exp_ts < now_ts:
-                        should_delete = True
-                    elif exp_ts < (now_ts - 2 * 86400):
-                        should_delete = True
+
+                def _past_deletion(record) -> bool:
+                    try:
+                        exp_ts = int(record.get('expire') or 0)
+                    except Exception:
+                        exp_ts = 0
+                    return exp_ts > 0 and exp_ts < (now_ts if is_trial else now_ts - 2 * 86400)
+
+                should_delete = _past_deletion(m_user)
+                if should_delete:
+                    # The snapshot record may be stale (renewed elsewhere, listing failing):
+                    # only delete on what the panel says right now
+                    try:
+                        live, _ = await VpnPanelAPI(panel_id=panel_data['id']).get_user(username)
+                    except Exception:
+                        live = None
+                    if isinstance(live, dict):
+                        m_user = live
+                        should_delete = _past_deletion(live)
+                    else:
+                        should_delete = False
                 # Execute deletion once per username if needed
                 if should_delete:
                     # Use panel of the first order tied to this username
@@ -114,13 +130,13 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                             msg_d = None
                             if hasattr(p_api, 'delete_user'):
                                 try:
-                                    ok, msg_d = p_api.delete_user(username)
+                                    ok, msg_d = await p_api.run(p_api.delete_user, username)
                                 except Exception as e:
                                     ok = False; msg_d = str(e)
                             if ok:
                                 # Mark all matching orders as deleted
                                 for o in user_orders:
-                                    execute_db("UPDATE orders SET status='deleted' WHERE id = ?", (o['id'],))
+                                    execute_db("UPDATE orders SET status='deleted', deleted_at=datetime('now','localtime') WHERE id = ?", (o['id'],))
                                 logger.info(f"Deleted expired service {username} on panel {target_order['panel_id']}")
                                 return  # stop further processing for this username
                             else:
@@ -154,7 +170,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                                 [InlineKeyboardButton("🔗 دریافت لینک مجدد", callback_data=f"refresh_service_link_{order['id']}")],
                             ]
                             await context.bot.send_message(order['user_id'], final_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(kb))
-                            execute_db("UPDATE orders SET last_reminder_date = ? WHERE id = ?", (today_str, order['id']))
+                            order_flag_writer.add("UPDATE orders SET last_reminder_date = ? WHERE id = ?", (today_str, order['id']))
                             logger.info(f"Sent reminder to user {order['user_id']} for service {username}")
                         except (Forbidden, BadRequest):
                             logger.warning(f"Could not send reminder to blocked user {order['user_id']}")
@@ -183,13 +199,13 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                                         [InlineKeyboardButton("🔗 دریافت لینک مجدد", callback_data=f"refresh_service_link_{order['id']}")],
                                     ]
                                     await context.bot.send_message(order['user_id'], final_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(kb))
-                                    execute_db("UPDATE orders SET last_traffic_alert_date = ? WHERE id = ?", (today_str, order['id']))
+                                    order_flag_writer.add("UPDATE orders SET last_traffic_alert_date = ? WHERE id = ?", (today_str, order['id']))
                                     logger.info(f"Sent traffic alert to user {order['user_id']} for service {username}")
                                 except Exception as e:
                                     logger.error(f"Error sending traffic alert to {order['user_id']}: {e}")
 
             if not all_users:
-                # Fallback path for panels that don't support get_all_users (e.g., 3x-UI)
+                # Fallback path for panels that cannot list their users, or whose listing failed
                 logger.info(f"Panel ID {panel_data['id']} does not support get_all_users: {msg}. Falling back to per-order query.")
                 # For this panel, gather usernames from orders
                 panel_usernames = []
@@ -202,7 +218,7 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                 # Query each username individually
                 for uname in panel_usernames:
                     try:
-                        uinfo, _m = await panel_api.get_user(uname)
+                        uinfo, _m = await panel_user(panel_data['id'], uname)
                         if isinstance(uinfo, dict):
                             # Normalize to expected keys
                             m_user = {
@@ -223,29 +239,45 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
                 await _process_user_record(username, m_user)
         except Exception as e:
             logger.error(f"Failed to process reminders for panel ID {panel_data['id']}: {e}")
+    # Persist the batched reminder/alert dates before the job returns
+    await order_flag_writer.aflush()
 
 
 async def backup_and_send_to_admins(context: ContextTypes.DEFAULT_TYPE):
-    """Create a backup archive and send it to admins periodically."""
+    """Send the periodic backup archive to admins.
+
+    Depending on the auto_backup_mode setting that is a full archive every time
+    ('full'), or a full base every auto_backup_full_every runs with only the
+    changed pages in between ('differential' / 'incremental', see bot/backup.py).
+    """
     try:
-        import tempfile, os, io, json, zipfile, shutil
-        from ..config import DB_NAME, ADMIN_ID
-        # Create temp directory and zip file
+        import tempfile, os, json, shutil
+        from ..config import ADMIN_ID
+        from ..backup import amake_chain_backup, save_chain_state
+        mode = settings_cache.get('auto_backup_mode') or 'differential'
+        full_every = settings_cache.get_int('auto_backup_full_every', 8)
         tmpdir = tempfile.mkdtemp()
-        zip_path = os.path.join(tmpdir, 'wingsbot_backup.zip')
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
-            # Include DB
-            if os.path.exists(DB_NAME):
-                z.write(DB_NAME, arcname=os.path.basename(DB_NAME))
-            # Include .env if present at project root
-            proj_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-            env_path = os.path.join(proj_root, '.env')
-            if os.path.exists(env_path):
-                z.write(env_path, arcname='.env')
-            # Include settings dump
-            settings = query_db("SELECT key, value FROM settings") or []
-            dump = json.dumps(settings, ensure_ascii=False, indent=2)
-            z.writestr('settings.json', data=dump)
+        # Base archives also carry .env (if present at project root) and a settings dump
+        proj_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        settings_path = os.path.join(tmpdir, 'settings.json')
+        settings = settings_cache.rows()
+        with open(settings_path, 'w', encoding='utf-8') as f:
+            json.dump(settings, f, ensure_ascii=False, indent=2)
+        out_dir = os.path.join(tmpdir, 'out')
+        os.makedirs(out_dir)
+        result = await amake_chain_backup(
+            out_dir, mode, full_every,
+            [(os.path.join(proj_root, '.env'), '.env'), (settings_path, 'settings.json')],
+        )
+        if result['kind'] == 'base':
+            caption = 'پشتیبان خودکار ربات'
+            if mode != 'full':
+                caption += f" (پایه {result['base_id']})"
+        else:
+            caption = (
+                f"پشتیبان خودکار ربات - تغییرات #{result['seq']} از پایه {result['base_id']} "
+                f"({result['pages']} صفحه، {result['bytes'] / 1048576:.2f} MB)"
+            )
         # Prepare recipients: primary admin + extra admins
         admins = [ADMIN_ID] if ADMIN_ID else []
         extra = query_db("SELECT user_id FROM admins") or []
@@ -256,18 +288,22 @@ async def backup_and_send_to_admins(context: ContextTypes.DEFAULT_TYPE):
                     admins.append(uid)
             except Exception:
                 continue
-        # Send zip to each admin
+        # Send the archive to each admin; the chain only advances once someone has it
+        delivered = 0
         if not admins:
             logger.info("No admins found to send backup")
         else:
-            with open(zip_path, 'rb') as f:
-                data = f.read()
             from telegram import InputFile
+            filename = os.path.basename(result['path'])
             for uid in admins:
                 try:
-                    await context.bot.send_document(chat_id=uid, document=InputFile(io.BytesIO(data), filename='wingsbot_backup.zip'), caption='پشتیبان خودکار ربات')
+                    with open(result['path'], 'rb') as f:
+                        await context.bot.send_document(chat_id=uid, document=InputFile(f, filename=filename), caption=caption)
+                    delivered += 1
                 except Exception as e:
                     logger.warning(f"Could not send backup to admin {uid}: {e}")
+        if delivered:
+            save_chain_state(result)
         shutil.rmtree(tmpdir, ignore_errors=True)
     except Exception as e:
         logger.error(f"backup_and_send_to_admins failed: {e}")
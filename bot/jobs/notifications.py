@@ -3,11 +3,39 @@
 from datetime import datetime, timedelta
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from ..db import query_db, execute_db
+from ..db import query_db, areport_query, order_flag_writer, ITER_BATCH_SIZE
 from ..config import logger
 from ..panel import VpnPanelAPI
+from ..panel_cache import panel_users, panel_user
 import gc
 
+_ACTIVE_PANEL_ORDERS_SQL = """
+    SELECT o.id, o.user_id, o.marzban_username, o.panel_id,
+           p.name as plan_name, p.traffic_gb,
+           o.notified_traffic_80, o.notified_traffic_95
+    FROM orders o
+    LEFT JOIN plans p ON o.plan_id = p.id
+    WHERE o.status = 'approved'
+    AND o.marzban_username IS NOT NULL
+    AND o.panel_id = ?
+    AND o.id > ?
+    ORDER BY o.id
+    LIMIT ?
+"""
+
+
+async def _active_panel_orders(panel_id: int):
+    """The approved orders of a panel, fetched a page at a time by id. Each page is its own short
+    read, so no statement (and WAL snapshot) stays open across the panel and Telegram calls."""
+    after = 0
+    while True:
+        page = await areport_query(_ACTIVE_PANEL_ORDERS_SQL, (panel_id, after, ITER_BATCH_SIZE))
+        for order in page:
+            yield order
+        if len(page) < ITER_BATCH_SIZE:
+            return
+        after = page[-1]['id']
+
 
 async def check_low_traffic_and_expiry(context):
     """
@@ -20,6 +48,8 @@ async def check_low_traffic_and_expiry(context):
     except Exception as e:
         logger.error(f"Error in check_low_traffic_and_expiry: {e}")
     finally:
+        # Persist the batched notified_* flags before the job returns
+        await order_flag_writer.aflush()
         # Force garbage collection to free memory
         gc.collect()
 
@@ -32,46 +62,34 @@ async def check_low_traffic(context):
     """
     try:
         logger.info("[Notification Job] Starting traffic check...")
-        # Get active orders
-        orders = query_db("""
-            SELECT o.id, o.user_id, o.marzban_username, o.panel_id,
-                   p.name as plan_name, p.traffic_gb,
-                   o.notified_traffic_80, o.notified_traffic_95
-            FROM orders o
-            LEFT JOIN plans p ON o.plan_id = p.id
-            WHERE o.status = 'approved'
-            AND o.marzban_username IS NOT NULL
-            AND o.panel_id IS NOT NULL
+        # Panels with active orders; each panel's orders are then streamed in
+        # batches instead of loading every approved order up front
+        panel_ids = query_db("""
+            SELECT DISTINCT panel_id FROM orders
+            WHERE status = 'approved'
+            AND marzban_username IS NOT NULL
+            AND panel_id IS NOT NULL
         """) or []
         
-        if not orders:
+        if not panel_ids:
             logger.info("[Notification Job] No active orders to check")
             return
         
-        # Group orders by panel_id to minimize API calls
-        orders_by_panel = {}
-        for order in orders:
-            panel_id = order['panel_id']
-            if panel_id not in orders_by_panel:
-                orders_by_panel[panel_id] = []
-            orders_by_panel[panel_id].append(order)
-        
-        # For each panel, fetch all users once (or individually for 3x-UI)
-        for panel_id, panel_orders in orders_by_panel.items():
+        checked = 0
+        # For each panel, read its user snapshot (per user for panels that cannot list users)
+        for row in panel_ids:
+            panel_id = row['panel_id']
             try:
-                # Check panel type first
-                panel_info = query_db("SELECT panel_type FROM panels WHERE id = ?", (panel_id,), one=True)
-                panel_type = panel_info.get('panel_type') if panel_info else 'marzban'
+                api = VpnPanelAPI(panel_id=panel_id)
                 
-                if panel_type == '3xui':
-                    # For 3x-UI, fetch each user individually (doesn't support bulk fetch)
-                    logger.info(f"[Notification Job] Processing panel {panel_id} (3x-UI) - fetching users individually...")
-                    api = VpnPanelAPI(panel_id=panel_id)
+                if not api.lists_users:
+                    logger.info(f"[Notification Job] Processing panel {panel_id} - looking up users individually...")
                     
-                    for order in panel_orders:
+                    async for order in _active_panel_orders(panel_id):
+                        checked += 1
                         try:
                             username = order['marzban_username']
-                            result = await api.get_user(username)
+                            result = await panel_user(panel_id, username)
                             
                             # Handle both tuple (user_data, message) and dict returns
                             if isinstance(result, tuple):
@@ -97,37 +115,30 @@ async def check_low_traffic(context):
                                     context.bot, order['user_id'], order['id'],
                                     order['plan_name'], usage_percent, used, total, level='warning'
                                 )
-                                execute_db("UPDATE orders SET notified_traffic_80 = 1 WHERE id = ?", (order['id'],))
+                                order_flag_writer.add("UPDATE orders SET notified_traffic_80 = 1 WHERE id = ?", (order['id'],))
                             elif usage_percent >= 95 and not order.get('notified_traffic_95'):
                                 await send_traffic_warning(
                                     context.bot, order['user_id'], order['id'],
                                     order['plan_name'], usage_percent, used, total, level='critical'
                                 )
-                                execute_db("UPDATE orders SET notified_traffic_95 = 1 WHERE id = ?", (order['id'],))
+                                order_flag_writer.add("UPDATE orders SET notified_traffic_95 = 1 WHERE id = ?", (order['id'],))
                         except Exception as e:
-                            logger.error(f"Error checking traffic for 3x-UI order {order['id']}: {e}")
+                            logger.error(f"Error checking traffic for order {order['id']}: {e}")
                             continue
                     
                     continue  # Move to next panel
                 
-                # For Marzban/other panels: fetch all users at once
-                logger.info(f"[Notification Job] Fetching users from panel {panel_id} (using cache if available)...")
-                api = VpnPanelAPI(panel_id=panel_id)
-                all_users, msg = await api.get_all_users()
+                # Panels that list their users: one snapshot, already indexed by username
+                logger.info(f"[Notification Job] Reading the user snapshot of panel {panel_id}...")
+                users_dict = await panel_users(panel_id)
                 
-                if not all_users:
-                    logger.warning(f"[Notification Job] Could not fetch users from panel {panel_id}: {msg}")
+                if not users_dict:
+                    logger.warning(f"[Notification Job] No user snapshot for panel {panel_id}")
                     continue
                 
-                # Build lookup dict by username
-                users_dict = {}
-                for u in all_users:
-                    username = u.get('username') or u.get('email')
-                    if username:
-                        users_dict[username] = u
-                
                 # Check each order against the fetched data
-                for order in panel_orders:
+                async for order in _active_panel_orders(panel_id):
+                    checked += 1
                     try:
                         username = order['marzban_username']
                         user_data = users_dict.get(username)
@@ -156,7 +167,7 @@ async def check_low_traffic(context):
                                 total,
                                 level='warning'
                             )
-                            execute_db("UPDATE orders SET notified_traffic_80 = 1 WHERE id = ?", (order['id'],))
+                            order_flag_writer.add("UPDATE orders SET notified_traffic_80 = 1 WHERE id = ?", (order['id'],))
                         
                         # Check 95% threshold
                         elif usage_percent >= 95 and not order.get('notified_traffic_95'):
@@ -170,7 +181,7 @@ async def check_low_traffic(context):
                                 total,
                                 level='critical'
                             )
-                            execute_db("UPDATE orders SET notified_traffic_95 = 1 WHERE id = ?", (order['id'],))
+                            order_flag_writer.add("UPDATE orders SET notified_traffic_95 = 1 WHERE id = ?", (order['id'],))
                         
                     except Exception as e:
                         logger.error(f"Error checking traffic for order {order['id']}: {e}")
@@ -180,7 +191,7 @@ async def check_low_traffic(context):
                 logger.error(f"Error processing panel {panel_id} in traffic check: {e}")
                 continue
         
-        logger.info(f"[Notification Job] Traffic check completed for {len(orders)} orders")
+        logger.info(f"[Notification Job] Traffic check completed for {checked} orders")
         
     except Exception as e:
         logger.error(f"Error in check_low_traffic: {e}")
@@ -199,19 +210,19 @@ async def check_near_expiry(context):
         # Get orders expiring in 3 days
         orders_3d = query_db("""
             SELECT o.id, o.user_id, o.marzban_username,
-                   p.name as plan_name, o.timestamp, p.duration_days,
+                   p.name as plan_name, o.expires_at,
                    o.notified_expiry_3d, o.notified_expiry_1d
             FROM orders o
             LEFT JOIN plans p ON o.plan_id = p.id
             WHERE o.status = 'approved'
-            AND datetime(o.timestamp, '+' || p.duration_days || ' days') <= ?
-            AND datetime(o.timestamp, '+' || p.duration_days || ' days') > ?
+            AND o.expires_at <= ?
+            AND o.expires_at > ?
             AND o.notified_expiry_3d != 1
         """, (three_days.strftime('%Y-%m-%d %H:%M:%S'), now.strftime('%Y-%m-%d %H:%M:%S'))) or []
         
         for order in orders_3d:
             try:
-                expiry = datetime.strptime(order['timestamp'], '%Y-%m-%d %H:%M:%S') + timedelta(days=order['duration_days'])
+                expiry = datetime.strptime(order['expires_at'], '%Y-%m-%d %H:%M:%S')
                 days_left = (expiry - now).days
                 
                 await send_expiry_warning(
@@ -223,7 +234,11 @@ async def check_near_expiry(context):
                     expiry,
                     level='warning'
                 )
-                execute_db("UPDATE orders SET notified_expiry_3d = 1 WHERE id = ?", (order['id'],))
+                # Only for the period warned about: a renewal before the flush re-armed the flag
+                order_flag_writer.add(
+                    "UPDATE orders SET notified_expiry_3d = 1 WHERE id = ? AND expires_at = ?",
+                    (order['id'], order['expires_at']),
+                )
                 
             except Exception as e:
                 logger.error(f"Error sending 3-day expiry for order {order['id']}: {e}")
@@ -231,19 +246,19 @@ async def check_near_expiry(context):
         # Get orders expiring in 1 day
         orders_1d = query_db("""
             SELECT o.id, o.user_id, o.marzban_username,
-                   p.name as plan_name, o.timestamp, p.duration_days,
+                   p.name as plan_name, o.expires_at,
                    o.notified_expiry_1d
             FROM orders o
             LEFT JOIN plans p ON o.plan_id = p.id
             WHERE o.status = 'approved'
-            AND datetime(o.timestamp, '+' || p.duration_days || ' days') <= ?
-            AND datetime(o.timestamp, '+' || p.duration_days || ' days') > ?
+            AND o.expires_at <= ?
+            AND o.expires_at > ?
             AND o.notified_expiry_1d != 1
         """, (one_day.strftime('%Y-%m-%d %H:%M:%S'), now.strftime('%Y-%m-%d %H:%M:%S'))) or []
         
         for order in orders_1d:
             try:
-                expiry = datetime.strptime(order['timestamp'], '%Y-%m-%d %H:%M:%S') + timedelta(days=order['duration_days'])
+                expiry = datetime.strptime(order['expires_at'], '%Y-%m-%d %H:%M:%S')
                 hours_left = int((expiry - now).total_seconds() / 3600)
                 
                 await send_expiry_warning(
@@ -256,7 +271,10 @@ async def check_near_expiry(context):
                     level='critical',
                     hours=hours_left
                 )
-                execute_db("UPDATE orders SET notified_expiry_1d = 1 WHERE id = ?", (order['id'],))
+                order_flag_writer.add(
+                    "UPDATE orders SET notified_expiry_1d = 1 WHERE id = ? AND expires_at = ?",
+                    (order['id'], order['expires_at']),
+                )
                 
             except Exception as e:
                 logger.error(f"Error sending 1-day expiry for order {order['id']}: {e}")
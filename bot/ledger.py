@@ -0,0 +1,136 @@
+"""
+Wallet ledger.
+
+Every balance change is a row in wallet_ledger: the signed amount, the user's
+balance after it, a kind (purchase, refund, topup method, manual, referral,
+bonus, opening) and the wallet_transactions row it belongs to. Rows are only
+ever appended, by Transaction.apply_wallet_entry in the same transaction as
+the write it pays for; triggers from migration 9 reject UPDATE and DELETE, so a
+correction is a new entry. user_wallets.balance is the cache the wallet
+screens read (one primary-key row), with ledger_id pointing at the entry it
+reflects.
+
+wallet_checkpoints records, at a ledger id, the sum of all cached balances
+once everything up to that id has been audited. An audit only looks at what
+came after the last checkpoint: each newer entry must continue its user's
+chain (balance_after = previous balance_after + amount), each user touched
+since must have a cache equal to their last entry, and the checkpoint total
+plus the newer amounts must equal today's sum of the cache, which also
+catches hand edits to wallets nobody has touched since. The daily job writes
+a checkpoint after a clean audit, so an audit reads about a day of entries
+however long the ledger gets. verify_ledger(full=True) replays the whole
+ledger and rebuild_balances() resets the cache from it.
+"""
+
+from datetime import datetime
+
+from .config import logger
+from .db import transaction, read_snapshot, run_db
+
+# Last ledger id, number of wallets and sum of the cached balances
+_STATE_SQL = (
+    "SELECT (SELECT COALESCE(MAX(id), 0) FROM wallet_ledger), COUNT(*), COALESCE(SUM(balance), 0) FROM user_wallets"
+)
+
+_CHECKPOINT_SQL = "SELECT ledger_id, total FROM wallet_checkpoints ORDER BY id DESC LIMIT 1"
+
+# Entries after a ledger id with the balance their user had before them; only a user's
+# first entry in the range needs an index lookup, the rest come from the window
+_CHAIN_SQL = """
+    SELECT e.id, e.amount, e.balance_after,
+           COALESCE(LAG(e.balance_after) OVER (PARTITION BY e.user_id ORDER BY e.id),
+                    (SELECT p.balance_after FROM wallet_ledger p WHERE p.user_id = e.user_id AND p.id <= ?1
+                     ORDER BY p.id DESC LIMIT 1), 0)
+    FROM wallet_ledger e WHERE e.id > ?1
+"""
+
+# Cache vs last entry for every user with entries after a ledger id. NOT INDEXED keeps
+# the planner on the rowid range instead of walking all of idx_wallet_ledger_user
+_CACHE_SQL = """
+    SELECT l.user_id, w.balance, w.ledger_id, l.id, l.balance_after
+    FROM wallet_ledger l LEFT JOIN user_wallets w ON w.user_id = l.user_id
+    WHERE l.id IN (SELECT MAX(id) FROM wallet_ledger NOT INDEXED WHERE id > ? GROUP BY user_id)
+"""
+
+_SINCE_SQL = "SELECT COALESCE(SUM(amount), 0) FROM wallet_ledger WHERE id > ?"
+
+# Non-zero balances that no entry accounts for
+_UNLEDGERED_SQL = "SELECT user_id, balance FROM user_wallets WHERE ledger_id IS NULL AND balance != 0"
+
+# {col} of a wallet's last entry, inside the UPDATE of user_wallets in rebuild_balances
+_LAST_ENTRY_SQL = "(SELECT {col} FROM wallet_ledger l WHERE l.user_id = user_wallets.user_id ORDER BY l.id DESC LIMIT 1)"
+
+
+def _audit(conn, full: bool):
+    """(problems, state) read from one snapshot; problems are (check, key, stored, expected)."""
+    base = None if full else conn.execute(_CHECKPOINT_SQL).fetchone()
+    since, base_total = (base[0], base[1]) if base else (0, 0)
+    problems = []
+    for entry_id, amount, balance_after, previous in conn.execute(_CHAIN_SQL, (since,)):
+        if balance_after != previous + amount:
+            problems.append(('chain', entry_id, balance_after, previous + amount))
+    for user_id, balance, ledger_id, last_id, last_balance in conn.execute(_CACHE_SQL, (since,)):
+        if balance != last_balance or ledger_id != last_id:
+            problems.append(('balance', user_id, balance, last_balance))
+    if full:
+        for user_id, balance in conn.execute(_UNLEDGERED_SQL):
+            problems.append(('balance', user_id, balance, 0))
+    state = conn.execute(_STATE_SQL).fetchone()
+    expected = base_total + conn.execute(_SINCE_SQL, (since,)).fetchone()[0]
+    if state[2] != expected:
+        problems.append(('total', 'wallets', state[2], expected))
+    return problems, tuple(state)
+
+
+def verify_ledger(full: bool = False) -> list:
+    """Audit the entries since the last checkpoint (or all of them) against the cached balances."""
+    with read_snapshot() as snap:
+        problems, _state = _audit(snap.conn, full)
+    return problems
+
+
+def record_checkpoint(tx, state=None):
+    """Write a checkpoint at `state` (ledger id, wallets, total), by default the current one."""
+    ledger_id, wallets, total = state or tx.conn.execute(_STATE_SQL).fetchone()
+    tx.execute(
+        "INSERT INTO wallet_checkpoints (ledger_id, wallets, total, created_at) VALUES (?, ?, ?, ?)",
+        (ledger_id, wallets, total, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+    )
+
+
+def checkpoint_ledger() -> list:
+    """Audit since the last checkpoint and, if it is clean, checkpoint the audited state."""
+    with read_snapshot() as snap:
+        problems, state = _audit(snap.conn, False)
+    if problems:
+        logger.warning(f"Wallet ledger audit found {len(problems)} problems, no checkpoint written: {problems[:5]}")
+        return problems
+    with transaction() as tx:
+        record_checkpoint(tx, state)
+    return problems
+
+
+def rebuild_balances() -> int:
+    """Reset every cached balance to its user's last ledger entry and checkpoint; returns the wallets changed."""
+    balance, entry = _LAST_ENTRY_SQL.format(col='l.balance_after'), _LAST_ENTRY_SQL.format(col='l.id')
+    with transaction() as tx:
+        tx.execute(
+            f"UPDATE user_wallets SET balance = COALESCE({balance}, 0), ledger_id = {entry} "
+            f"WHERE balance IS NOT COALESCE({balance}, 0) OR ledger_id IS NOT {entry}"
+        )
+        changed = tx.rowcount
+        tx.execute(
+            "INSERT INTO user_wallets (user_id, balance, ledger_id) "
+            "SELECT l.user_id, l.balance_after, l.id FROM wallet_ledger l "
+            "WHERE l.id IN (SELECT MAX(id) FROM wallet_ledger GROUP BY user_id) "
+            "AND NOT EXISTS (SELECT 1 FROM user_wallets w WHERE w.user_id = l.user_id)"
+        )
+        changed += tx.rowcount
+        record_checkpoint(tx)
+    logger.info(f"Wallet balances rebuilt from the ledger, {changed} changed")
+    return changed
+
+
+async def ledger_job(context):
+    """Scheduled job: audit the day's ledger entries and checkpoint them."""
+    await run_db(checkpoint_ledger)
@@ -0,0 +1,753 @@
+"""
+Versioned schema migrations.
+
+Each step in MIGRATIONS runs once, in order, inside its own transaction together
+with the schema_version row that records it. A database that is already current
+costs a single SELECT at startup.
+
+To change the schema, append a new (version, description, function) entry; never
+edit a step that has already shipped.
+"""
+import sqlite3
+from datetime import datetime
+
+from .config import logger
+from .db import get_connection, transaction, Transaction
+
+
+def _columns(tx: Transaction, table: str) -> set:
+    return {row['name'] for row in tx.query(f"PRAGMA table_info({table})")}
+
+
+def _add_column(tx: Transaction, table: str, column: str, decl: str):
+    if column not in _columns(tx, table):
+        tx.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _create_tables(tx: Transaction):
+    tx.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, join_date TEXT)")
+    _add_column(tx, 'users', 'banned', "INTEGER NOT NULL DEFAULT 0")
+    _add_column(tx, 'users', 'referrer_id', "INTEGER")
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER NOT NULL,
+            referee_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE(referrer_id, referee_id)
+        )
+        """
+    )
+    tx.execute("CREATE TABLE IF NOT EXISTS messages (message_name TEXT PRIMARY KEY, text TEXT, file_id TEXT, file_type TEXT)")
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS buttons (id INTEGER PRIMARY KEY AUTOINCREMENT, menu_name TEXT, text TEXT, target TEXT, is_url BOOLEAN DEFAULT 0, row INTEGER, col INTEGER)"
+    )
+    tx.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT, price INTEGER NOT NULL, duration_days INTEGER NOT NULL, traffic_gb REAL NOT NULL)"
+    )
+    # Optional per-plan binding to panel/inbound
+    _add_column(tx, 'plans', 'panel_id', "INTEGER")
+    _add_column(tx, 'plans', 'xui_inbound_id', "INTEGER")
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS cards (id INTEGER PRIMARY KEY AUTOINCREMENT, card_number TEXT NOT NULL, holder_name TEXT NOT NULL)"
+    )
+    tx.execute("CREATE TABLE IF NOT EXISTS free_trials (user_id INTEGER PRIMARY KEY, timestamp TEXT)")
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS discount_codes (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE NOT NULL, percentage INTEGER NOT NULL, usage_limit INTEGER NOT NULL, times_used INTEGER DEFAULT 0, expiry_date TEXT)"
+    )
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS panels (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, panel_type TEXT NOT NULL DEFAULT 'marzban', url TEXT NOT NULL, username TEXT NOT NULL, password TEXT NOT NULL, sub_base TEXT, token TEXT)"
+    )
+    _add_column(tx, 'panels', 'enabled', "INTEGER NOT NULL DEFAULT 1")
+    if 'panel_type' not in _columns(tx, 'panels'):
+        tx.execute("ALTER TABLE panels ADD COLUMN panel_type TEXT NOT NULL DEFAULT 'marzban'")
+        tx.execute("UPDATE panels SET panel_type = 'marzban' WHERE panel_type IS NULL")
+    _add_column(tx, 'panels', 'sub_base', "TEXT")
+    _add_column(tx, 'panels', 'token', "TEXT")
+    # Inbounds manually set for each panel
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS panel_inbounds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            panel_id INTEGER NOT NULL,
+            protocol TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            inbound_id INTEGER,
+            UNIQUE(panel_id, tag),
+            FOREIGN KEY (panel_id) REFERENCES panels(id) ON DELETE CASCADE
+        )
+        """
+    )
+    _add_column(tx, 'panel_inbounds', 'inbound_id', "INTEGER")
+
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, plan_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending', marzban_username TEXT, screenshot_file_id TEXT, timestamp TEXT,
+            panel_id INTEGER, discount_code TEXT, final_price INTEGER, last_reminder_date TEXT, panel_type TEXT,
+            last_link TEXT, xui_inbound_id INTEGER, xui_client_id TEXT, reseller_applied INTEGER DEFAULT 0,
+            is_trial INTEGER DEFAULT 0,
+            notified_traffic_80 INTEGER DEFAULT 0,
+            notified_traffic_95 INTEGER DEFAULT 0,
+            notified_expiry_3d INTEGER DEFAULT 0,
+            notified_expiry_1d INTEGER DEFAULT 0
+        )
+        """
+    )
+    # Columns that older installs added over time
+    for column, decl in (
+        ('panel_id', "INTEGER"),
+        ('discount_code', "TEXT"),
+        ('final_price', "INTEGER"),
+        ('last_reminder_date', "TEXT"),
+        ('panel_type', "TEXT"),
+        ('last_link', "TEXT"),
+        ('last_traffic_alert_date', "TEXT"),
+        ('desired_username', "TEXT"),
+        ('xui_inbound_id', "INTEGER"),
+        ('xui_client_id', "TEXT"),
+        ('is_trial', "INTEGER DEFAULT 0"),
+        ('reseller_applied', "INTEGER DEFAULT 0"),
+        ('notified_traffic_80', "INTEGER DEFAULT 0"),
+        ('notified_traffic_95', "INTEGER DEFAULT 0"),
+        ('notified_expiry_3d', "INTEGER DEFAULT 0"),
+        ('notified_expiry_1d', "INTEGER DEFAULT 0"),
+    ):
+        _add_column(tx, 'orders', column, decl)
+
+    # Crypto wallets, user balances and wallet transactions
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wallets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset TEXT NOT NULL,
+            chain TEXT NOT NULL,
+            address TEXT NOT NULL,
+            memo TEXT
+        )
+        """
+    )
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_wallets (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wallet_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            direction TEXT NOT NULL, -- credit/debit
+            method TEXT NOT NULL,    -- gateway/crypto/card/manual
+            status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
+            created_at TEXT NOT NULL,
+            screenshot_file_id TEXT,
+            reference TEXT,
+            meta TEXT
+        )
+        """
+    )
+    # Reseller tables
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS resellers (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'active',
+            activated_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            discount_percent INTEGER NOT NULL,
+            max_purchases INTEGER NOT NULL,
+            used_purchases INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reseller_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            method TEXT NOT NULL, -- card/crypto/gateway
+            status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
+            created_at TEXT NOT NULL,
+            screenshot_file_id TEXT,
+            reference TEXT,
+            meta TEXT
+        )
+        """
+    )
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content_type TEXT,
+            text TEXT,
+            file_id TEXT,
+            created_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        )
+        """
+    )
+    # Threaded ticket messages
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            sender TEXT NOT NULL, -- 'user' | 'admin'
+            content_type TEXT,
+            text TEXT,
+            file_id TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
+        )
+        """
+    )
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tutorials (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            sort_order INTEGER DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tutorial_media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tutorial_id INTEGER NOT NULL,
+            content_type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            caption TEXT,
+            sort_order INTEGER DEFAULT 0,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (tutorial_id) REFERENCES tutorials(id) ON DELETE CASCADE
+        )
+        """
+    )
+    # Additional admins besides primary ADMIN_ID
+    tx.execute("CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY)")
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS admin_audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            target TEXT,
+            created_at TEXT NOT NULL,
+            meta TEXT
+        )
+        """
+    )
+
+    # Indexes for hot queries
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_date ON orders(status, timestamp)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_plan ON orders(plan_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_user_status ON wallet_transactions(user_id, status, created_at)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_panels_enabled ON panels(enabled)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_panel_inbounds_panel ON panel_inbounds(panel_id)")
+
+
+_DEFAULT_MESSAGES = {
+    'start_main': ('\U0001F44B سلام! به ربات فروش کانفیگ ما خوش آمدید.\nبرای شروع از دکمه‌های زیر استفاده کنید.', None, None),
+    'admin_panel_main': ('\U0001F5A5️ پنل مدیریت ربات. لطفا یک گزینه را انتخاب کنید.', None, None),
+    'buy_config_main': ('\U0001F4E1 **خرید کانفیگ**\n\nلطفا یکی از پلن‌های زیر را انتخاب کنید:', None, None),
+    'payment_info_text': ('\U0001F4B3 **اطلاعات پرداخت** \U0001F4B3\n\nمبلغ پلن انتخابی را به یکی از کارت‌های زیر واریز کرده و سپس اسکرین‌شات رسید را در همین صفحه ارسال نمایید.', None, None),
+    'renewal_reminder_text': ('\u26A0\uFE0F **یادآوری تمدید سرویس**\n\nکاربر گرامی، اعتبار سرویس شما رو به اتمام است.\n\n{details}\n\nبرای جلوگیری از قطع شدن سرویس، لطفاً از طریق دکمه "سرویس من" در منوی اصلی ربات اقدام به تمدید نمایید.', None, None),
+    'admin_messages_menu': ('مدیریت پیام‌ها و صفحات:', None, None),
+    'admin_users_menu': ('👥 مدیریت کاربران', None, None),
+    'admin_stats_title': ('\U0001F4C8 **آمار ربات**', None, None),
+    'admin_panels_menu': ('\U0001F5A5️ مدیریت پنل‌ها', None, None),
+    'admin_plans_menu': ('\U0001F4CB مدیریت پلن‌ها', None, None),
+    'admin_cards_menu': ('\U0001F4B3 مدیریت کارت‌های بانکی', None, None),
+    'admin_settings_menu': ('\u2699\uFE0F **تنظیمات کلی ربات**', None, None),
+    'trial_panel_select': ('پنل ساخت تست را انتخاب کنید:', None, None),
+    'trial_inbound_select': ('اینباند کانفیگ تست را انتخاب کنید:', None, None)
+}
+
+_DEFAULT_SETTINGS = [
+    ('free_trial_days', '1'),
+    ('free_trial_gb', '0.2'),
+    ('free_trial_status', '1'),
+    # USD rate
+    ('usd_irt_manual', ''),
+    ('usd_irt_cached', ''),
+    ('usd_irt_cached_ts', ''),
+    ('usd_irt_mode', 'manual'),
+    # Payment method toggles and gateway config
+    ('pay_card_enabled', '1'),
+    ('pay_crypto_enabled', '1'),
+    ('pay_gateway_enabled', '0'),
+    ('gateway_type', 'zarinpal'),
+    ('zarinpal_merchant_id', ''),
+    ('aghapay_pin', ''),
+    ('aghapay_api_key', ''),
+    ('gateway_callback_url', ''),
+    # Signup bonus defaults
+    ('signup_bonus_enabled', '0'),
+    ('signup_bonus_amount', '0'),
+    # Free trial: selected panel (optional)
+    ('free_trial_panel_id', ''),
+    # Referral commission percent (default 10)
+    ('referral_commission_percent', '10'),
+    # Config footer text (shown under config link)
+    ('config_footer_text', 'آموزش اتصال :\nhttps://t.me/madeingod_tm'),
+    # Reseller defaults
+    ('reseller_enabled', '1'),
+    ('reseller_fee_toman', '200000'),
+    ('reseller_discount_percent', '50'),
+    ('reseller_duration_days', '30'),
+    ('reseller_max_purchases', '10'),
+    # User visibility & traffic alerts
+    ('user_show_quota_enabled', '1'),
+    ('traffic_alert_enabled', '0'),
+    # GB-only threshold for remaining traffic
+    ('traffic_alert_value_gb', '5'),
+    # Time-based alerts
+    ('time_alert_enabled', '1'),
+    ('time_alert_days', '3'),
+    # Auto-backup
+    ('auto_backup_enabled', '0'),
+    ('auto_backup_hours', '12'),
+    # Cron/job defaults
+    ('daily_job_hour', '9'),
+    ('reminder_job_enabled', '1'),
+    # Maintenance message default
+    ('maintenance_message', '⚠️ ربات موقتا در حال نگهداری است. لطفا بعدا مراجعه کنید.'),
+]
+
+
+def _default_content(tx: Transaction):
+    for name, (text, f_id, f_type) in _DEFAULT_MESSAGES.items():
+        tx.execute(
+            "INSERT OR IGNORE INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
+            (name, text, f_id, f_type),
+        )
+
+    # Move the legacy single-panel settings into the panels table
+    if not tx.query("SELECT 1 FROM panels", one=True):
+        url_row = tx.query("SELECT value FROM settings WHERE key = 'panel_url'", one=True)
+        user_row = tx.query("SELECT value FROM settings WHERE key = 'panel_user'", one=True)
+        password_row = tx.query("SELECT value FROM settings WHERE key = 'panel_pass'", one=True)
+
+        url = url_row.get('value') if url_row else 'https://your-panel.com'
+        user = user_row.get('value') if user_row else 'admin'
+        password = password_row.get('value') if password_row else 'password'
+
+        tx.execute(
+            "INSERT INTO panels (name, panel_type, url, username, password, sub_base) VALUES (?, ?, ?, ?, ?, ?)",
+            ('پنل اصلی (پیش‌فرض)', 'marzban', url, user, password, None),
+        )
+        tx.execute("DELETE FROM settings WHERE key IN ('panel_url', 'panel_user', 'panel_pass')")
+
+    tx.conn.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", _DEFAULT_SETTINGS)
+
+    if not tx.query("SELECT 1 FROM cards", one=True):
+        tx.execute(
+            "INSERT INTO cards (card_number, holder_name) VALUES (?, ?)",
+            ("6037-0000-0000-0000", "نام دارنده کارت"),
+        )
+
+
+def _m001_baseline(tx: Transaction):
+    # Everything db_setup() used to probe for on every start. Idempotent, so it
+    # also adopts databases created by older releases.
+    _create_tables(tx)
+    _default_content(tx)
+
+
+def _m002_notification_index(tx: Transaction):
+    # Previously only created by running run_migration.py by hand
+    tx.execute(
+        "CREATE INDEX IF NOT EXISTS idx_orders_notifications ON orders("
+        "status, notified_traffic_80, notified_traffic_95, notified_expiry_3d, notified_expiry_1d)"
+    )
+
+
+def _m003_order_expires_at(tx: Transaction):
+    # Materialized expiry so near-expiry scans are index range scans instead of
+    # evaluating datetime(timestamp, '+N days') for every order
+    _add_column(tx, 'orders', 'expires_at', "TEXT")
+    tx.execute(
+        "UPDATE orders SET expires_at = datetime(timestamp, '+' || "
+        "(SELECT duration_days FROM plans WHERE plans.id = orders.plan_id) || ' days') "
+        "WHERE expires_at IS NULL"
+    )
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_expires ON orders(status, expires_at)")
+
+
+def _m004_lookup_indexes(tx: Transaction):
+    # Found by test_query_plans.py: these lookups were full table scans
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets(user_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_status ON wallet_transactions(status)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_reference ON wallet_transactions(reference)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_marzban_username ON orders(marzban_username)")
+
+
+def _m005_archive_tables(tx: Transaction):
+    # Cold rows are moved here by bot/archive.py; same columns plus archived_at
+    _add_column(tx, 'orders', 'deleted_at', "TEXT")
+    for table in ('orders', 'wallet_transactions', 'ticket_messages'):
+        tx.execute(f"CREATE TABLE IF NOT EXISTS {table}_archive AS SELECT *, NULL AS archived_at FROM {table} WHERE 0")
+        tx.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_archive_id ON {table}_archive(id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_user ON orders_archive(user_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_archive_user ON wallet_transactions_archive(user_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_ticket_messages_archive_ticket ON ticket_messages_archive(ticket_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages(ticket_id, created_at)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_status_created ON wallet_transactions(status, created_at)")
+
+
+# Counter bump used by the stats triggers: {name} and {delta} are SQL expressions
+_BUMP = (
+    "INSERT INTO stats_counters (name, value) VALUES ({name}, {delta}) "
+    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;"
+)
+# Add (sign 1) or remove (sign -1) an approved order's revenue on its local day
+_ORDER_REVENUE = (
+    "INSERT INTO daily_revenue (day, order_total, order_count) "
+    "SELECT date({r}.timestamp), {sign} * COALESCE((SELECT COALESCE({r}.final_price, p.price) FROM plans p WHERE p.id = {r}.plan_id), 0), {sign} "
+    "WHERE {r}.status = 'approved' AND date({r}.timestamp) IS NOT NULL "
+    "ON CONFLICT(day) DO UPDATE SET order_total = order_total + excluded.order_total, order_count = order_count + excluded.order_count;"
+)
+_WALLET_REVENUE = (
+    "INSERT INTO daily_revenue (day, wallet_total) "
+    "SELECT date({r}.created_at), {sign} * {r}.amount "
+    "WHERE {r}.status = 'approved' AND {r}.direction = 'credit' AND date({r}.created_at) IS NOT NULL "
+    "ON CONFLICT(day) DO UPDATE SET wallet_total = wallet_total + excluded.wallet_total;"
+)
+# A user becomes a buyer with their first approved order and stops being one with the last
+_BUYER_GAIN = (
+    "INSERT INTO stats_counters (name, value) SELECT 'buyers', 1 "
+    "WHERE NOT EXISTS (SELECT 1 FROM stats_buyers WHERE user_id = NEW.user_id) "
+    "ON CONFLICT(name) DO UPDATE SET value = value + 1;"
+    "INSERT INTO stats_buyers (user_id, approved) VALUES (NEW.user_id, 1) "
+    "ON CONFLICT(user_id) DO UPDATE SET approved = approved + 1;"
+)
+_BUYER_LOSS = (
+    "UPDATE stats_buyers SET approved = approved - 1 WHERE user_id = OLD.user_id;"
+    "UPDATE stats_counters SET value = value - 1 WHERE name = 'buyers' "
+    "AND EXISTS (SELECT 1 FROM stats_buyers WHERE user_id = OLD.user_id AND approved <= 0);"
+    "DELETE FROM stats_buyers WHERE user_id = OLD.user_id AND approved <= 0;"
+)
+
+
+# Migration 6 fills the rollups from the raw tables as they were then (bot/stats.py
+# has the live rebuild); kept here so the step does not change with that module
+_STATS_BACKFILL = [
+    "DELETE FROM stats_counters",
+    "DELETE FROM stats_buyers",
+    "DELETE FROM daily_revenue",
+    """
+    INSERT INTO stats_counters (name, value)
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'free_trials', COUNT(*) FROM free_trials
+    UNION ALL SELECT 'orders', COUNT(*) FROM orders
+    UNION ALL SELECT 'orders:' || COALESCE(status, ''), COUNT(*) FROM orders GROUP BY status
+    UNION ALL SELECT 'buyers', COUNT(DISTINCT user_id) FROM orders WHERE status = 'approved'
+    """,
+    "INSERT INTO stats_buyers (user_id, approved) SELECT user_id, COUNT(*) FROM orders WHERE status = 'approved' GROUP BY user_id",
+    """
+    INSERT INTO daily_revenue (day, order_total, order_count, wallet_total)
+    SELECT day, SUM(order_total), SUM(order_count), SUM(wallet_total) FROM (
+        SELECT date(o.timestamp) AS day,
+               COALESCE((SELECT COALESCE(o.final_price, p.price) FROM plans p WHERE p.id = o.plan_id), 0) AS order_total,
+               1 AS order_count, 0 AS wallet_total
+        FROM orders o WHERE o.status = 'approved' AND date(o.timestamp) IS NOT NULL
+        UNION ALL
+        SELECT date(created_at), 0, 0, amount FROM wallet_transactions
+        WHERE status = 'approved' AND direction = 'credit' AND date(created_at) IS NOT NULL
+        UNION ALL
+        SELECT date(created_at), 0, 0, amount FROM wallet_transactions_archive
+        WHERE status = 'approved' AND direction = 'credit' AND date(created_at) IS NOT NULL
+    ) GROUP BY day
+    """,
+]
+
+
+def _m006_stats_rollups(tx: Transaction):
+    # Dashboard counters and per-day revenue, kept current by triggers (see bot/stats.py).
+    # Deletes only come from archiving, so they leave revenue history alone.
+    tx.execute("CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    tx.execute("CREATE TABLE IF NOT EXISTS stats_buyers (user_id INTEGER PRIMARY KEY, approved INTEGER NOT NULL DEFAULT 0)")
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS daily_revenue (day TEXT PRIMARY KEY, order_total INTEGER NOT NULL DEFAULT 0, "
+        "order_count INTEGER NOT NULL DEFAULT 0, wallet_total INTEGER NOT NULL DEFAULT 0)"
+    )
+    triggers = {
+        'trg_stats_users_ins': ("AFTER INSERT ON users", _BUMP.format(name="'users'", delta=1)),
+        'trg_stats_users_del': ("AFTER DELETE ON users", _BUMP.format(name="'users'", delta=-1)),
+        'trg_stats_trials_ins': ("AFTER INSERT ON free_trials", _BUMP.format(name="'free_trials'", delta=1)),
+        'trg_stats_trials_del': ("AFTER DELETE ON free_trials", _BUMP.format(name="'free_trials'", delta=-1)),
+        'trg_stats_orders_ins': (
+            "AFTER INSERT ON orders",
+            _BUMP.format(name="'orders'", delta=1)
+            + _BUMP.format(name="'orders:' || COALESCE(NEW.status, '')", delta=1)
+            + _ORDER_REVENUE.format(r='NEW', sign=1),
+        ),
+        'trg_stats_orders_del': (
+            "AFTER DELETE ON orders",
+            _BUMP.format(name="'orders'", delta=-1)
+            + _BUMP.format(name="'orders:' || COALESCE(OLD.status, '')", delta=-1),
+        ),
+        'trg_stats_orders_status': (
+            "AFTER UPDATE OF status ON orders WHEN OLD.status IS NOT NEW.status",
+            _BUMP.format(name="'orders:' || COALESCE(OLD.status, '')", delta=-1)
+            + _BUMP.format(name="'orders:' || COALESCE(NEW.status, '')", delta=1),
+        ),
+        'trg_stats_orders_revenue': (
+            "AFTER UPDATE OF status, timestamp, final_price, plan_id ON orders "
+            "WHEN OLD.status = 'approved' OR NEW.status = 'approved'",
+            _ORDER_REVENUE.format(r='OLD', sign=-1) + _ORDER_REVENUE.format(r='NEW', sign=1),
+        ),
+        'trg_stats_buyers_ins': ("AFTER INSERT ON orders WHEN NEW.status = 'approved'", _BUYER_GAIN),
+        'trg_stats_buyers_approve': (
+            "AFTER UPDATE OF status ON orders WHEN NEW.status = 'approved' AND OLD.status IS NOT 'approved'",
+            _BUYER_GAIN,
+        ),
+        'trg_stats_buyers_unapprove': (
+            "AFTER UPDATE OF status ON orders WHEN OLD.status = 'approved' AND NEW.status IS NOT 'approved'",
+            _BUYER_LOSS,
+        ),
+        'trg_stats_buyers_del': ("AFTER DELETE ON orders WHEN OLD.status = 'approved'", _BUYER_LOSS),
+        'trg_stats_wallet_ins': ("AFTER INSERT ON wallet_transactions", _WALLET_REVENUE.format(r='NEW', sign=1)),
+        'trg_stats_wallet_upd': (
+            "AFTER UPDATE OF status, direction, amount, created_at ON wallet_transactions",
+            _WALLET_REVENUE.format(r='OLD', sign=-1) + _WALLET_REVENUE.format(r='NEW', sign=1),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        tx.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+    for sql in _STATS_BACKFILL:
+        tx.execute(sql)
+
+
+# Migration 7's index layout, as bot/search.py had it then: per kind the source table,
+# the columns whose change re-indexes a row, and the rowid and index values of row {r}
+_SEARCH_SOURCES = {
+    'user': ('users', 'first_name', "{r}.user_id * 4 + 0",
+             "'user', {r}.user_id, {r}.user_id, {r}.user_id || ' ' || COALESCE({r}.first_name, ''), ''"),
+    'order': ('orders', 'marzban_username, desired_username, user_id', "{r}.id * 4 + 1",
+              "'order', {r}.id, {r}.user_id, "
+              "'#' || {r}.id || ' ' || COALESCE({r}.marzban_username, '') || ' ' || COALESCE({r}.desired_username, ''), ''"),
+    'ticket': ('tickets', 'text, user_id', "{r}.id * 4 + 2",
+               "'ticket', {r}.id, {r}.user_id, '#' || {r}.id, COALESCE({r}.text, '')"),
+    'ticket_message': ('ticket_messages', 'text, ticket_id', "{r}.id * 4 + 3",
+                       "'ticket_message', {r}.ticket_id, NULL, '#' || {r}.ticket_id, COALESCE({r}.text, '')"),
+}
+
+
+def _m007_search_index(tx: Transaction):
+    # Admin search (see bot/search.py); trigram needs SQLite 3.34+, older builds get word-prefix matching
+    columns = "kind UNINDEXED, ref UNINDEXED, user_id UNINDEXED, title, body"
+    try:
+        tx.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5({columns}, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        tx.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5({columns}, tokenize='unicode61', prefix='2 3')")
+    insert = "INSERT INTO search_index (rowid, kind, ref, user_id, title, body) SELECT {rowid}, {values}"
+    delete = "DELETE FROM search_index WHERE rowid = {rowid}"
+    tx.execute("DELETE FROM search_index")
+    for table, watched, rowid, values in _SEARCH_SOURCES.values():
+        index_new = insert.format(rowid=rowid.format(r='NEW'), values=values.format(r='NEW')) + ";"
+        unindex_old = delete.format(rowid=rowid.format(r='OLD')) + ";"
+        triggers = {
+            f'trg_search_{table}_ins': (f"AFTER INSERT ON {table}", index_new),
+            f'trg_search_{table}_upd': (f"AFTER UPDATE OF {watched} ON {table}", unindex_old + index_new),
+            f'trg_search_{table}_del': (f"AFTER DELETE ON {table}", unindex_old),
+        }
+        for name, (event, body) in triggers.items():
+            tx.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+        tx.execute(insert.format(rowid=rowid.format(r='s'), values=values.format(r='s')) + f" FROM {table} s")
+
+
+def _m008_keyset_indexes(tx: Transaction):
+    # Sort orders of the keyset-paginated admin lists (bot/pagination.py) that no index covered yet
+    # Row-value cursors skip NULL sort keys, and SQLite only seeks plain-column indexes for them
+    tx.execute("UPDATE users SET join_date = '' WHERE join_date IS NULL")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date, user_id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_user ON wallet_transactions(user_id, id)")
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id, id)")
+
+
+def _m009_wallet_ledger(tx: Transaction):
+    # Append-only wallet ledger with checkpoints (see bot/ledger.py); user_wallets becomes its cache
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS wallet_ledger (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+        "amount INTEGER NOT NULL, balance_after INTEGER NOT NULL, kind TEXT NOT NULL, reference TEXT, created_at TEXT NOT NULL)"
+    )
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user ON wallet_ledger(user_id, id)")
+    for event in ('UPDATE', 'DELETE'):
+        tx.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_wallet_ledger_no_{event.lower()} BEFORE {event} ON wallet_ledger "
+            "BEGIN SELECT RAISE(ABORT, 'wallet_ledger is append-only'); END"
+        )
+    tx.execute(
+        "CREATE TABLE IF NOT EXISTS wallet_checkpoints (id INTEGER PRIMARY KEY AUTOINCREMENT, ledger_id INTEGER NOT NULL, "
+        "wallets INTEGER NOT NULL, total INTEGER NOT NULL, created_at TEXT NOT NULL)"
+    )
+    _add_column(tx, 'user_wallets', 'ledger_id', "INTEGER")
+    # Existing balances open the ledger
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    tx.execute(
+        "INSERT INTO wallet_ledger (user_id, amount, balance_after, kind, created_at) "
+        "SELECT user_id, balance, balance, 'opening', ? FROM user_wallets WHERE balance != 0 AND ledger_id IS NULL ORDER BY user_id",
+        (now,),
+    )
+    tx.execute(
+        "UPDATE user_wallets SET ledger_id = (SELECT MAX(l.id) FROM wallet_ledger l WHERE l.user_id = user_wallets.user_id) "
+        "WHERE ledger_id IS NULL"
+    )
+    # First checkpoint at the opening state
+    tx.execute(
+        "INSERT INTO wallet_checkpoints (ledger_id, wallets, total, created_at) "
+        "SELECT (SELECT COALESCE(MAX(id), 0) FROM wallet_ledger), COUNT(*), COALESCE(SUM(balance), 0), ? FROM user_wallets",
+        (now,),
+    )
+
+
+def _m010_panel_clients(tx: Transaction):
+    # Which inbound of an X-UI/3x-UI/TX-UI panel holds each client (see bot/panel_index.py);
+    # filled lazily from the panels, so there is nothing to backfill
+    tx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS panel_clients (
+            panel_id INTEGER NOT NULL,
+            email TEXT NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            client_uuid TEXT,
+            sub_id TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (panel_id, email, inbound_id),
+            FOREIGN KEY (panel_id) REFERENCES panels(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+
+def _m011_panel_api_variants(tx: Transaction):
+    # Endpoint variants that worked on each panel, by operation (see panel._Variants)
+    _add_column(tx, 'panels', 'api_variants', "TEXT")
+
+
+def _m012_orders_panel_index(tx: Transaction):
+    # The traffic job pages a panel's approved orders by id; (panel_id, status)
+    # keeps them in id order, so each page is one index range
+    tx.execute("CREATE INDEX IF NOT EXISTS idx_orders_panel_status ON orders(panel_id, status)")
+
+
+# Migration 13: what an order was charged is stored at approval and revenue moves by that amount
+_ORDER_PRICE = "COALESCE((SELECT COALESCE({r}.final_price, p.price) FROM plans p WHERE p.id = {r}.plan_id), 0)"
+_ORDER_CHARGE = (
+    "UPDATE orders SET charged_amount = CASE WHEN NEW.status = 'approved' "
+    "THEN COALESCE({kept}, " + _ORDER_PRICE.format(r='NEW') + ") END WHERE id = NEW.id;"
+)
+_ORDER_CHARGED_ADD = (
+    "INSERT INTO daily_revenue (day, order_total, order_count) "
+    "SELECT date(o.timestamp), o.charged_amount, 1 FROM orders o "
+    "WHERE o.id = NEW.id AND o.status = 'approved' AND date(o.timestamp) IS NOT NULL "
+    "ON CONFLICT(day) DO UPDATE SET order_total = order_total + excluded.order_total, order_count = order_count + excluded.order_count;"
+)
+_ORDER_CHARGED_SUB = (
+    "INSERT INTO daily_revenue (day, order_total, order_count) "
+    "SELECT date(OLD.timestamp), -COALESCE(OLD.charged_amount, 0), -1 "
+    "WHERE OLD.status = 'approved' AND date(OLD.timestamp) IS NOT NULL "
+    "ON CONFLICT(day) DO UPDATE SET order_total = order_total + excluded.order_total, order_count = order_count + excluded.order_count;"
+)
+
+
+def _m013_order_charged_amount(tx: Transaction):
+    # Revenue used to be re-priced from the plan when an approved order changed or
+    # expired, so plan price edits made daily_revenue drift; orders now keep the
+    # amount they were approved at and the triggers add and remove exactly that
+    _add_column(tx, 'orders', 'charged_amount', "INTEGER")
+    _add_column(tx, 'orders_archive', 'charged_amount', "INTEGER")
+    tx.execute(
+        "UPDATE orders SET charged_amount = " + _ORDER_PRICE.format(r='orders') + " WHERE status = 'approved'"
+    )
+    tx.execute("DROP TRIGGER IF EXISTS trg_stats_orders_ins")
+    tx.execute("DROP TRIGGER IF EXISTS trg_stats_orders_revenue")
+    triggers = {
+        'trg_stats_orders_ins': (
+            "AFTER INSERT ON orders",
+            _BUMP.format(name="'orders'", delta=1)
+            + _BUMP.format(name="'orders:' || COALESCE(NEW.status, '')", delta=1)
+            + _ORDER_CHARGE.format(kept='NEW.charged_amount')
+            + _ORDER_CHARGED_ADD,
+        ),
+        'trg_stats_orders_revenue': (
+            "AFTER UPDATE OF status, timestamp, final_price, plan_id ON orders "
+            "WHEN OLD.status = 'approved' OR NEW.status = 'approved'",
+            _ORDER_CHARGED_SUB
+            + _ORDER_CHARGE.format(kept="CASE WHEN OLD.status = 'approved' THEN OLD.charged_amount END")
+            + _ORDER_CHARGED_ADD,
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        tx.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+
+
+MIGRATIONS = [
+    (1, "baseline schema and default content", _m001_baseline),
+    (2, "index for notification flags", _m002_notification_index),
+    (3, "orders.expires_at with backfill and (status, expires_at) index", _m003_order_expires_at),
+    (4, "indexes for ticket, wallet and panel-username lookups", _m004_lookup_indexes),
+    (5, "orders.deleted_at and archive tables for cold rows", _m005_archive_tables),
+    (6, "stats counters and daily revenue rollups maintained by triggers", _m006_stats_rollups),
+    (7, "full-text admin search index over users, orders and tickets", _m007_search_index),
+    (8, "indexes for keyset pagination of the admin lists", _m008_keyset_indexes),
+    (9, "append-only wallet ledger with balance checkpoints", _m009_wallet_ledger),
+    (10, "username to inbound index for X-UI family panels", _m010_panel_clients),
+    (11, "panels.api_variants for memoized endpoint discovery", _m011_panel_api_variants),
+    (12, "orders (panel_id, status) index for paged notification reads", _m012_orders_panel_index),
+    (13, "orders.charged_amount so revenue rollups keep the approved price", _m013_order_charged_amount),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version() -> int:
+    """Schema version of the database, 0 if it has never been migrated."""
+    try:
+        row = get_connection().execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0] or 0)
+
+
+def migrate() -> int:
+    """Apply pending migrations and return the resulting schema version."""
+    version = current_version()
+    if version >= LATEST_VERSION:
+        return version
+
+    conn = get_connection()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT NOT NULL)"
+    )
+    conn.commit()
+    for step, description, func in MIGRATIONS:
+        if step <= version:
+            continue
+        with transaction() as tx:
+            # Another process may have applied it while we waited for the write lock
+            if tx.query("SELECT 1 FROM schema_version WHERE version = ?", (step,), one=True):
+                continue
+            func(tx)
+            tx.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (step, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            )
+        logger.info(f"DB migration {step} applied: {description}")
+        version = step
+    return version
@@ -0,0 +1,96 @@
+"""
+Keyset pagination for the admin lists.
+
+A page is "the next N rows after the last one shown", found by seeking the
+sort index to that row instead of counting past OFFSET rows, so page 500 of
+the orders list costs the same as page 1 and only N + 1 rows are ever read.
+
+The position travels in the callback_data of the prev/next buttons as a
+cursor token: 'n' (rows after) or 'p' (rows before) plus the boundary row's id
+in base 36, e.g. 'n2bi9'. The sort key of that row is looked up by id, so the
+token stays a few bytes long whatever the list is sorted on and fits easily
+in Telegram's 64-byte callback_data limit.
+"""
+
+import re
+
+from .db import query_db
+
+_TOKEN = re.compile(r'^([np])([0-9a-z]+)$')
+CURSOR_PATTERN = r'[np][0-9a-z]+'
+
+
+def _base36(n: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+
+def encode_cursor(direction: str, row_id: int) -> str:
+    return f"{direction}{_base36(int(row_id))}"
+
+
+def decode_cursor(token: str | None):
+    """(direction, row id) of a cursor token; (None, None) for the first page or a malformed token."""
+    m = _TOKEN.match(token or '')
+    if not m:
+        return None, None
+    return m.group(1), int(m.group(2), 36)
+
+
+class Keyset:
+    """
+    One keyset-paginated list.
+
+    select   -- "SELECT ... FROM <table> [alias] [JOIN ...]", without WHERE/ORDER BY
+    table    -- the table the rows come from; id_column is its unique key, returned in each row
+    key      -- sort expressions, most significant first, ending with the id; they are also
+                evaluated against `table [alias]` alone to look up a cursor row
+    """
+
+    def __init__(self, select: str, table: str, key: tuple, id_column: str = 'id', alias: str = '', descending: bool = True):
+        self.select = select
+        self.table = table
+        self.key = tuple(key)
+        self.id_column = id_column
+        self.alias = alias
+        self.descending = descending
+        qualified_id = f"{alias}.{id_column}" if alias else id_column
+        if self.key == (qualified_id,):
+            # Sorted on the id alone: compare with the cursor value directly
+            self._boundary = "?"
+        else:
+            self._boundary = f"(SELECT {', '.join(self.key)} FROM {table} {alias} WHERE {qualified_id} = ?)"
+
+    def page(self, where: str = '', args=(), cursor: str | None = None, size: int = 10, fetch=query_db):
+        """(rows, prev cursor, next cursor) for the page at `cursor`; a cursor is None when there is nothing that way."""
+        direction, ref = decode_cursor(cursor)
+        backward = direction == 'p'
+        desc = self.descending != backward
+        conds = [f"({where})"] if where else []
+        params = list(args)
+        if ref is not None:
+            conds.append(f"({', '.join(self.key)}) {'<' if desc else '>'} {self._boundary}")
+            params.append(ref)
+        order = ', '.join(f"{k} {'DESC' if desc else 'ASC'}" for k in self.key)
+        sql = f"{self.select}{' WHERE ' + ' AND '.join(conds) if conds else ''} ORDER BY {order} LIMIT ?"
+        rows = fetch(sql, (*params, size + 1)) or []
+        if ref is not None and not rows:
+            # The boundary row is gone (deleted or archived) or the list shrank: start over
+            return self.page(where, args, None, size, fetch)
+        more = len(rows) > size
+        if backward and not more:
+            # Back at the start: show a full first page rather than the few rows before the cursor
+            return self.page(where, args, None, size, fetch)
+        rows = rows[:size]
+        if backward:
+            rows.reverse()
+        has_prev = more if backward else ref is not None
+        has_next = ref is not None if backward else more
+        prev_cursor = encode_cursor('p', rows[0][self.id_column]) if has_prev and rows else None
+        next_cursor = encode_cursor('n', rows[-1][self.id_column]) if has_next and rows else None
+        return rows, prev_cursor, next_cursor
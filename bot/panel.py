@@ -1,14 +1,20 @@
+import asyncio
+import functools
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import uuid
 import time as _time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlsplit
 from datetime import datetime, timedelta
 import random
 import re
+import threading
 
-from .config import logger
-from .db import query_db
+from . import panel_index
+from .config import PANEL_MAX_CONNECTIONS, logger
+from .db import query_db, execute_db
 
 
 def generate_username(user_id: int, desired_username: str = None) -> str:
@@ -29,30 +35,327 @@ def generate_username(user_id: int, desired_username: str = None) -> str:
     return f"{base}_{user_id}_{random_suffix}"
 
 
-# Cache API instances per panel for reuse (cookies/tokens kept in requests.Session)
+# Cache API instances per panel for reuse (cookies/tokens kept in requests.Session,
+# plus the panel's connection pool and worker threads)
 # Each instance caches its own token, so we can keep instances longer
 _PANEL_API_CACHE: dict[tuple, tuple] = {}
 _PANEL_API_TTL_SECONDS = 14400  # 4 hours (tokens refresh automatically within instance)
 
 
+def _user_changed(api, username):
+    from .panel_cache import invalidate
+    invalidate(api.panel_id, username)
+
+
+def forget_panel_state():
+    """Drop everything cached about the panels: API instances with their endpoint memos, client index
+    rebuild times and user snapshots. For when the database holding the panels was replaced."""
+    from .panel_cache import invalidate_all
+    _PANEL_API_CACHE.clear()
+    panel_index.reset()
+    invalidate_all()
+
+
+def _reindex_client(api, inbound_id, username):
+    try:
+        if inbound_id is None:
+            panel_index.forget(api.panel_id, username)
+        else:
+            panel_index.index_client(api.panel_id, inbound_id, api._fetch_inbound_detail(inbound_id), username)
+    except Exception as e:
+        logger.warning(f"Client index of panel {api.panel_id} not updated for {username}: {e}")
+
+
+def _changes_user(pos: int):
+    """For panel methods that change one user: drop it from the user snapshots afterwards.
+    `pos` is the index of the username among the positional arguments; a username at 1 follows
+    the inbound id, whose client index entry is then re-read (panel-wide changes drop it)."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                username = args[pos] if len(args) > pos else None
+                _user_changed(self, username)
+                if username and self.indexes_clients:
+                    _reindex_client(self, args[0] if pos == 1 else None, username)
+        return wrapper
+    return decorate
+
+
+# Statuses for the _Variants candidate being tried on this thread
+_last_response = threading.local()
+
+
+def _note_response(resp, *args, **kwargs):
+    # Only the first response after a candidate is handed out is its own;
+    # later ones come from requests the loop body makes afterwards
+    watch = getattr(_last_response, 'watch', None)
+    if watch is not None and not watch:
+        watch.append(resp.status_code)
+
+
+class _Variants:
+    """
+    The candidates of one panel operation (URL forms, login styles) that a
+    method loops over until one works. Call worked() with the one that did:
+    it is stored per panel in panels.api_variants as a template (base URL
+    dropped, path segments equal to one of `params` replaced by its name), so
+    the memo survives candidates being reordered or added in the code. It is
+    tried first from then on, and the others are tried again only when its own
+    request answers 404 or 405 (a panel upgrade or a different fork), not on
+    timeouts or server errors. With any_failure (login styles) they are tried
+    whenever the remembered one did not work.
+    """
+
+    def __init__(self, api, op: str, candidates, any_failure: bool = False, params=None):
+        self.api = api
+        self.op = op
+        self.candidates = list(candidates)
+        self.any_failure = any_failure
+        self.params = {str(v): k for k, v in (params or {}).items() if v not in (None, '')}
+
+    def template(self, candidate) -> str:
+        text = str(candidate)
+        base = getattr(self.api, 'base_url', '') or ''
+        if base and text.startswith(base):
+            text = text[len(base):]
+        return '/'.join(f"{{{self.params[s]}}}" if s in self.params else s for s in text.split('/'))
+
+    def __iter__(self):
+        known = self.api._known_variants().get(self.op)
+        first = next((i for i, c in enumerate(self.candidates) if self.template(c) == known), None)
+        if first is not None:
+            _last_response.watch = watch = []
+            yield self.candidates[first]
+            _last_response.watch = None
+            if not self.any_failure and (watch[0] if watch else None) not in (404, 405):
+                return
+        for i, candidate in enumerate(self.candidates):
+            if i != first:
+                yield candidate
+
+    def worked(self, candidate):
+        self.api._remember_variant(self.op, self.template(candidate))
+
+
 class BasePanelAPI:
-    async def get_all_users(self):
-        raise NotImplementedError
+    """
+    Panel clients are blocking requests code. Each panel gets its own keep-alive
+    connection pool and up to PANEL_MAX_CONNECTIONS worker threads; the async
+    methods run the blocking _get_user/_get_all_users/... there, so a slow or
+    dead panel only ties up its own workers and never the event loop. The
+    awaiting side can be cancelled at any time (asyncio.wait_for); the worker
+    finishes the request in the background within the request timeout.
+    Handlers call the synchronous helpers the same way:
+
+        inbounds, msg = await api.run(api.list_inbounds)
+
+    Panels that can list all their users set lists_users; bot/panel_cache.py
+    keeps one snapshot of them per panel. Panels that keep clients inside their
+    inbounds set indexes_clients and find them through bot/panel_index.py.
+    Methods that try several URL forms or login styles walk them through
+    _variants(), which remembers the one that worked in panels.api_variants.
+    """
+
+    _executor = None
+    _variant_memo = None
+    lists_users = False
+    indexes_clients = False
+    sub_link_named = False
+
+    def _open_session(self) -> requests.Session:
+        """Session whose keep-alive pool is capped at the panel's connection limit."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PANEL_MAX_CONNECTIONS, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(_note_response)
+        return session
+
+    def _variants(self, op: str, candidates, any_failure: bool = False, **params) -> _Variants:
+        """Endpoint candidates for `op`, the one known to work on this panel first (see _Variants);
+        `params` are the per-call values (inbound id, email, uuid) that appear in the candidates."""
+        return _Variants(self, op, candidates, any_failure, params)
+
+    def _known_variants(self) -> dict:
+        if self._variant_memo is None:
+            row = query_db("SELECT api_variants FROM panels WHERE id = ?", (self.panel_id,), one=True) or {}
+            try:
+                memo = json.loads(row.get('api_variants') or '{}')
+            except ValueError:
+                memo = {}
+            self._variant_memo = memo if isinstance(memo, dict) else {}
+        return self._variant_memo
+
+    def _remember_variant(self, op: str, template: str):
+        memo = self._known_variants()
+        if memo.get(op) != template:
+            memo[op] = template
+            execute_db("UPDATE panels SET api_variants = ? WHERE id = ?", (json.dumps(memo, sort_keys=True), self.panel_id))
+
+    async def run(self, func, *args, timeout: float | None = None, **kwargs):
+        """Await a blocking call of this panel on its worker threads."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=PANEL_MAX_CONNECTIONS, thread_name_prefix=f"panel-{getattr(self, 'panel_id', '?')}"
+            )
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        return await (asyncio.wait_for(future, timeout) if timeout else future)
+
+    async def get_all_users(self, *args, **kwargs):
+        return await self.run(self._get_all_users, *args, **kwargs)
 
     async def get_user(self, username):
-        raise NotImplementedError
+        return await self.run(self._get_user, username)
 
     async def renew_user_in_panel(self, username, plan):
+        try:
+            return await self.run(self._renew_user_in_panel, username, plan)
+        finally:
+            _user_changed(self, username)
+
+    async def create_user(self, user_id, plan, *args, **kwargs):
+        return await self.run(self._create_user, user_id, plan, *args, **kwargs)
+
+    async def reset_user_traffic(self, username):
+        try:
+            return await self.run(self._reset_user_traffic, username)
+        finally:
+            _user_changed(self, username)
+
+    def _get_all_users(self):
         raise NotImplementedError
 
-    async def create_user(self, user_id, plan, desired_username: str | None = None):
+    def _get_user(self, username):
         raise NotImplementedError
 
-    async def reset_user_traffic(self, username):
+    def _renew_user_in_panel(self, username, plan):
         raise NotImplementedError
 
+    def _create_user(self, user_id, plan, desired_username: str | None = None):
+        raise NotImplementedError
+
+    def _reset_user_traffic(self, username):
+        raise NotImplementedError
+
+    def _list_clients(self):
+        """({inbound_id: inbound}, msg) with the clients of every inbound, from one inbound listing;
+        the client index is rebuilt from it on the way."""
+        items, msg = self.list_inbounds(raw=True)
+        if items is None:
+            return None, msg
+        inbounds = {}
+        for it in items:
+            if it.get('id') is None:
+                continue
+            if 'settings' not in it:
+                # Forks whose listing leaves the clients out
+                it = self._fetch_inbound_detail(it['id']) or it
+            inbounds[int(it['id'])] = it
+        panel_index.index_panel(self.panel_id, inbounds.values())
+        return inbounds, "Success"
+
+    def _index_clients(self):
+        """Rebuild the panel's client index; {inbound_id: inbound}, or None when the listing failed or the
+        index was rebuilt moments ago."""
+        if not panel_index.rebuild_due(self.panel_id):
+            return None
+        inbounds, msg = self._list_clients()
+        if inbounds is None:
+            logger.warning(f"Client index of panel {self.panel_id} not rebuilt: {msg}")
+        return inbounds
+
+    def _client_sub_link(self, sub_id: str, username: str) -> str:
+        if not sub_id:
+            return ''
+        if self.sub_base:
+            origin = self.sub_base
+        else:
+            parts = urlsplit(self.base_url)
+            port = ''
+            if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                port = f":{parts.port}"
+            origin = f"{parts.scheme}://{parts.hostname or ''}{port}"
+        return f"{origin}/sub/{sub_id}?name={username}" if self.sub_link_named else f"{origin}/sub/{sub_id}"
+
+    def _client_users(self):
+        """All clients of an X-UI family panel as get_all_users records (username, used_traffic,
+        data_limit, expire, status, subscription_url). Usage comes from the clientStats that the
+        inbound listing carries, so a sync is one request; inbounds listed without them cost one
+        getClientTraffics request each."""
+        inbounds, msg = self._list_clients()
+        if inbounds is None:
+            return None, msg
+        now = int(_time.time())
+        users = {}
+        for inbound_id, inbound in inbounds.items():
+            stats = inbound.get('clientStats')
+            if not isinstance(stats, list):
+                fetch = getattr(self, '_fetch_client_traffics', None)
+                stats = (fetch(inbound_id) or []) if fetch else []
+            used = {}
+            for s in stats:
+                if isinstance(s, dict) and (s.get('email') or s.get('name')):
+                    try:
+                        used[s.get('email') or s.get('name')] = int(s.get('up') or 0) + int(s.get('down') or 0)
+                    except (TypeError, ValueError):
+                        pass
+            for c in panel_index.inbound_clients(inbound):
+                email = c.get('email')
+                if not email or email in users:
+                    continue
+                try:
+                    limit = int(c.get('totalGB') or 0)
+                    expiry_ms = int(c.get('expiryTime') or 0)
+                except (TypeError, ValueError):
+                    limit, expiry_ms = 0, 0
+                expire = expiry_ms // 1000 if expiry_ms > 0 else 0
+                used_bytes = used.get(email, 0)
+                if c.get('enable') is False:
+                    status = 'disabled'
+                elif expire and expire < now:
+                    status = 'expired'
+                elif limit and used_bytes >= limit:
+                    status = 'limited'
+                else:
+                    status = 'active'
+                users[email] = {
+                    'username': email,
+                    'used_traffic': used_bytes,
+                    'data_limit': limit,
+                    'expire': expire,
+                    'status': status,
+                    'subscription_url': self._client_sub_link(c.get('subId') or '', email),
+                }
+        return list(users.values()), "Success"
+
+    def _locate_client(self, username):
+        """[(inbound_id, inbound, client)] for every inbound holding the client email `username`."""
+        found = []
+        for row in panel_index.lookup(self.panel_id, username):
+            inbound = self._fetch_inbound_detail(row['inbound_id'])
+            if inbound is None:
+                continue
+            client = panel_index.check_row(self.panel_id, username, row, inbound)
+            if client is not None:
+                found.append((row['inbound_id'], inbound, client))
+        if found:
+            return found
+        # Not indexed (created outside the bot, or the index is new): re-list the panel once
+        inbounds = self._index_clients() or {}
+        for row in panel_index.lookup(self.panel_id, username):
+            client = panel_index.find_client(inbounds.get(row['inbound_id']), username)
+            if client is not None:
+                found.append((row['inbound_id'], inbounds[row['inbound_id']], client))
+        return found
+
 
 class MarzbanAPI(BasePanelAPI):
+    lists_users = True
+
     def __init__(self, panel_row):
         self.panel_id = panel_row['id']
         _raw = (panel_row['url'] or '').strip().rstrip('/')
@@ -61,7 +364,7 @@ class MarzbanAPI(BasePanelAPI):
         self.base_url = _raw
         self.username = panel_row['username']
         self.password = panel_row['password']
-        self.session = requests.Session()
+        self.session = self._open_session()
         self.access_token = None
         self.token_expire_time = None
 
@@ -109,6 +412,7 @@ class MarzbanAPI(BasePanelAPI):
             logger.error(f"Error authenticating to Marzban panel {self.panel_id}: {e}")
             return False
 
+    @_changes_user(1)
     def delete_user_on_inbound(self, inbound_id: int, username: str, client_id: str | None = None):
         # Delete a specific client from a specific inbound by email or client id
         if not self.get_token():
@@ -136,12 +440,14 @@ class MarzbanAPI(BasePanelAPI):
             f"{self.base_url}/xui/api/inbounds/get/{inbound_id}",
             f"{self.base_url}/panel/api/inbounds/get/{inbound_id}",
         ]
-        for ep in eps:
+        variants = self._variants('inbound_detail', eps, inbound_id=inbound_id)
+        for ep in variants:
             try:
                 r = self.session.get(ep, headers={'Accept': 'application/json'}, timeout=12)
                 if r.status_code != 200:
                     continue
                 data = r.json()
+                variants.worked(ep)
                 # Common shapes: {'obj': {...}} or flat
                 return data.get('obj') if isinstance(data, dict) and isinstance(data.get('obj'), dict) else data
             except Exception:
@@ -169,6 +475,7 @@ class MarzbanAPI(BasePanelAPI):
                 continue
         return False
 
+    @_changes_user(1)
     def renew_user_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         # Increase quota/time for a client on a specific inbound by updating settings
         if not self.get_token():
@@ -206,6 +513,7 @@ class MarzbanAPI(BasePanelAPI):
         ok = self._update_client_on_inbound(int(inbound_id), new_settings_json)
         return (target, "Success") if ok else (None, "ناموفق در بروزرسانی کلاینت")
 
+    @_changes_user(1)
     def renew_by_recreate_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         # Delete client and re-add with increased quotas
         _ = self.delete_user_on_inbound(inbound_id, username)
@@ -213,6 +521,7 @@ class MarzbanAPI(BasePanelAPI):
         plan_like = {'traffic_gb': add_gb, 'duration_days': add_days}
         return self.create_user_on_inbound(inbound_id, 0, plan_like, desired_username=username)
 
+    @_changes_user(1)
     def rotate_user_key_on_inbound(self, inbound_id: int, username: str):
         # Rotate key by assigning a new UUID for the same email (preferred)
         if not self.get_token():
@@ -236,7 +545,7 @@ class MarzbanAPI(BasePanelAPI):
         created_user, sub_link, msg = self.create_user_on_inbound(inbound_id, 0, {'traffic_gb': 0, 'duration_days': 0}, desired_username=username)
         return {"email": username} if (created_user and sub_link) else None
 
-    async def get_all_users(self, limit=None, offset=0):
+    def _get_all_users(self, limit=None, offset=0):
         if not self.access_token and not self.get_token():
             return None, "خطا در اتصال به پنل"
         headers = {'Authorization': f'Bearer {self.access_token}', 'accept': 'application/json'}
@@ -268,7 +577,8 @@ class MarzbanAPI(BasePanelAPI):
             f"{self.base_url}/api/config",
         ]
         last_error = None
-        for url in endpoints:
+        variants = self._variants('list_inbounds', endpoints)
+        for url in variants:
             try:
                 try:
                     logger.info(f"Marzban list_inbounds -> GET {url}")
@@ -339,13 +649,14 @@ class MarzbanAPI(BasePanelAPI):
                     logger.info(f"Marzban list_inbounds <- OK {len(inbounds)} items from {url}")
                 except Exception:
                     pass
+                variants.worked(url)
                 return inbounds, "Success"
             except requests.RequestException as e:
                 last_error = str(e)
                 continue
         return None, (last_error or "Unknown")
 
-    async def get_user(self, marzban_username):
+    def _get_user(self, marzban_username):
         if not self.access_token and not self.get_token():
             return None, "خطا در اتصال به پنل"
         headers = {'Authorization': f'Bearer {self.access_token}', 'accept': 'application/json'}
@@ -381,6 +692,7 @@ class MarzbanAPI(BasePanelAPI):
             logger.error(f"Failed to get user {marzban_username}: {e}")
             return None, f"خطای پنل: {e}"
 
+    @_changes_user(0)
     def revoke_subscription(self, marzban_username: str):
         # Try to revoke/rotate subscription URL for a user using common Marzban endpoints
         if not self.access_token and not self.get_token():
@@ -404,6 +716,7 @@ class MarzbanAPI(BasePanelAPI):
                 continue
         return False, (last or "Unknown")
 
+    @_changes_user(0)
     def delete_user(self, marzban_username: str):
         # Delete user account on Marzban panel
         if not self.access_token and not self.get_token():
@@ -425,8 +738,8 @@ class MarzbanAPI(BasePanelAPI):
                 continue
         return False, (last or "Unknown")
 
-    async def renew_user_in_panel(self, marzban_username, plan):
-        current_user_info, message = await self.get_user(marzban_username)
+    def _renew_user_in_panel(self, marzban_username, plan):
+        current_user_info, message = self._get_user(marzban_username)
         if not current_user_info:
             return None, f"کاربر {marzban_username} برای تمدید یافت نشد."
         current_expire = current_user_info.get('expire') or int(datetime.now().timestamp())
@@ -452,7 +765,7 @@ class MarzbanAPI(BasePanelAPI):
             logger.error(f"Failed to renew user {marzban_username}: {e} - {error_detail}")
             return None, f"خطای پنل هنگام تمدید: {error_detail}"
 
-    async def reset_user_traffic(self, marzban_username: str):
+    def _reset_user_traffic(self, marzban_username: str):
         if not self.access_token and not self.get_token():
             return False, "خطا در اتصال به پنل"
         headers = {'Authorization': f'Bearer {self.access_token}', 'accept': 'application/json'}
@@ -476,7 +789,7 @@ class MarzbanAPI(BasePanelAPI):
                 continue
         return False, (last or "Unknown")
 
-    async def create_user(self, user_id, plan, desired_username: str | None = None):
+    def _create_user(self, user_id, plan, desired_username: str | None = None):
         if not self.access_token and not self.get_token():
             return None, None, "خطا در اتصال به پنل. لطفا تنظیمات را بررسی کنید."
 
@@ -571,6 +884,10 @@ class MarzbanAPI(BasePanelAPI):
 class XuiAPI(BasePanelAPI):
     """Alireza (X-UI) support using uppercase /xui/API endpoints as per provided method."""
 
+    lists_users = True
+    indexes_clients = True
+    sub_link_named = True
+
     def __init__(self, panel_row):
         self.panel_id = panel_row['id']
         _raw = (panel_row['url'] or '').strip().rstrip('/')
@@ -583,7 +900,7 @@ class XuiAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = self._open_session()
         self._json_headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -599,46 +916,42 @@ class XuiAPI(BasePanelAPI):
                 logger.debug(f"Using cached X-UI session for panel {self.panel_id} (logged in {int(_time.time() - self._login_time)}s ago)")
                 return True
         
-        # Try form login first (more compatible across versions)
-        try:
+        # Form login first (more compatible across versions), JSON login as fallback
+        styles = self._variants('login', ('form', 'json'), any_failure=True)
+        for style in styles:
             try:
-                self.session.get(f"{self.base_url}/login", timeout=8)
-            except requests.RequestException:
-                pass
-            form_headers = {
-                'Accept': 'text/html,application/json',
-                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                'X-Requested-With': 'XMLHttpRequest',
-            }
-            resp = self.session.post(
-                f"{self.base_url}/login",
-                data={"username": self.username, "password": self.password},
-                headers=form_headers,
-                allow_redirects=False,
-                timeout=12,
-            )
-            if resp.status_code in (200, 204, 302, 303):
-                self._logged_in = True
-                self._login_time = _time.time()
-                logger.info(f"Successfully logged in to X-UI panel {self.panel_id}")
-                return True
-        except requests.RequestException:
-            pass
-        # Fallback to JSON login
-        try:
-            resp = self.session.post(
-                f"{self.base_url}/login",
-                json={"username": self.username, "password": self.password},
-                headers=self._json_headers,
-                timeout=12,
-            )
-            if resp.status_code in (200, 204, 302, 303):
-                self._logged_in = True
-                self._login_time = _time.time()
-                logger.info(f"Successfully logged in to X-UI panel {self.panel_id}")
-                return True
-        except requests.RequestException as e:
-            logger.error(f"X-UI login error: {e}")
+                if style == 'form':
+                    try:
+                        self.session.get(f"{self.base_url}/login", timeout=8)
+                    except requests.RequestException:
+                        pass
+                    form_headers = {
+                        'Accept': 'text/html,application/json',
+                        'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                        'X-Requested-With': 'XMLHttpRequest',
+                    }
+                    resp = self.session.post(
+                        f"{self.base_url}/login",
+                        data={"username": self.username, "password": self.password},
+                        headers=form_headers,
+                        allow_redirects=False,
+                        timeout=12,
+                    )
+                else:
+                    resp = self.session.post(
+                        f"{self.base_url}/login",
+                        json={"username": self.username, "password": self.password},
+                        headers=self._json_headers,
+                        timeout=12,
+                    )
+                if resp.status_code in (200, 204, 302, 303):
+                    styles.worked(style)
+                    self._logged_in = True
+                    self._login_time = _time.time()
+                    logger.info(f"Successfully logged in to X-UI panel {self.panel_id}")
+                    return True
+            except requests.RequestException as e:
+                logger.error(f"X-UI {style} login error: {e}")
         return False
 
     def _fetch_client_traffics(self, inbound_id: int):
@@ -648,7 +961,8 @@ class XuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/api/inbounds/getClientTraffics/{inbound_id}",
             f"{self.base_url}/panel/api/inbounds/getClientTraffics/{inbound_id}",
         ]
-        for url in endpoints:
+        variants = self._variants('client_traffics', endpoints, inbound_id=inbound_id)
+        for url in variants:
             try:
                 resp = self.session.get(url, headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -656,6 +970,7 @@ class XuiAPI(BasePanelAPI):
                 data = resp.json()
                 items = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(items, list):
+                    variants.worked(url)
                     return items
             except Exception:
                 continue
@@ -668,7 +983,8 @@ class XuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/getClientTraffics/{email}",
             f"{self.base_url}/panel/API/inbounds/getClientTraffics/{email}",
         ]
-        for url in endpoints:
+        variants = self._variants('client_traffic', endpoints, email=email)
+        for url in variants:
             try:
                 resp = self.session.get(url, headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -676,6 +992,7 @@ class XuiAPI(BasePanelAPI):
                 data = resp.json()
                 obj = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(obj, dict):
+                    variants.worked(url)
                     return obj
             except Exception:
                 continue
@@ -694,7 +1011,8 @@ class XuiAPI(BasePanelAPI):
         # Some versions accept the id in path
         del_eps = ([f"{e}/{old_uuid}" for e in del_eps] + del_eps) if old_uuid else del_eps
         headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-        for ep in del_eps:
+        variants = self._variants('del_client' if old_uuid else 'del_client_by_email', del_eps, uuid=old_uuid)
+        for ep in variants:
             try:
                 for body in (
                     {"id": int(inbound_id), "clientId": old_uuid},
@@ -703,40 +1021,25 @@ class XuiAPI(BasePanelAPI):
                 ):
                     r = self.session.post(ep, headers=headers, json=body, timeout=12)
                     if r.status_code in (200, 201, 202, 204):
+                        variants.worked(ep)
                         return True
             except requests.RequestException:
                 continue
         return False
 
+    @_changes_user(0)
     def delete_user(self, username: str):
         # Remove a client by email across all inbounds
         if not self.get_token():
             return False, "خطا در ورود به پنل X-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return False, msg
         found_any = False
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else (settings_str or {})
-            except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in list(clients):
-                if c.get('email') == username:
-                    ok = self._delete_client_on_inbound(inbound_id, c, username)
-                    if ok:
-                        found_any = True
+        for inbound_id, _inbound, c in self._locate_client(username):
+            ok = self._delete_client_on_inbound(inbound_id, c, username)
+            if ok:
+                found_any = True
         return (True, "Success") if found_any else (False, "کلاینتی برای حذف یافت نشد")
 
-    def list_inbounds(self):
+    def list_inbounds(self, raw: bool = False):
         if not self.get_token():
             return None, "خطا در ورود به پنل X-UI"
         try:
@@ -749,8 +1052,9 @@ class XuiAPI(BasePanelAPI):
                 f"{self.base_url}/panel/api/inbounds",
             ]
             last_error = None
+            variants = self._variants('list_inbounds', endpoints)
             for attempt in range(2):
-                for url in endpoints:
+                for url in variants:
                     try:
                         resp = self.session.get(url, headers={'Accept': 'application/json'}, timeout=12)
                     except requests.RequestException as e:
@@ -786,6 +1090,10 @@ class XuiAPI(BasePanelAPI):
                     if not isinstance(items, list):
                         last_error = f"ساختار JSON لیست اینباند قابل تشخیص نیست @ {url}"
                         continue
+                    variants.worked(url)
+                    if raw:
+                        # Full inbound objects, settings included, for the client index
+                        return [it for it in items if isinstance(it, dict)], "Success"
                     inbounds = []
                     for it in items:
                         if not isinstance(it, dict):
@@ -851,8 +1159,9 @@ class XuiAPI(BasePanelAPI):
         ]
         headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
         last_error = None
+        variants = self._variants('add_client', endpoints)
         for attempt in range(2):
-            for ep in endpoints:
+            for ep in variants:
                 for body in payloads:
                     try:
                         resp = self.session.post(ep, headers=headers, json=body, timeout=15)
@@ -860,6 +1169,7 @@ class XuiAPI(BasePanelAPI):
                         last_error = str(e)
                         continue
                     if resp.status_code in (200, 201):
+                        variants.worked(ep)
                         # Build subscription link
                         if self.sub_base:
                             origin = self.sub_base
@@ -871,6 +1181,7 @@ class XuiAPI(BasePanelAPI):
                                 port = f":{parts.port}"
                             origin = f"{parts.scheme}://{host}{port}"
                         sub_link = f"{origin}/sub/{subid}?name={new_username}"
+                        panel_index.record_client(self.panel_id, inbound_id, client_obj)
                         return new_username, sub_link, "Success"
                     # 401/403 → retry after login once
                     if resp.status_code in (401, 403) and attempt == 0:
@@ -887,121 +1198,87 @@ class XuiAPI(BasePanelAPI):
             pass
         return None, None, (last_error or "Unknown error")
 
-    async def get_all_users(self):
-        return None, "Not supported for X-UI"
+    def _get_all_users(self):
+        return self._client_users()
 
-    async def get_user(self, username):
+    def _get_user(self, username):
         # Find client by email across inbounds and map to common fields
         if not self.get_token():
             return None, "خطا در ورود به پنل X-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return None, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
+        for inbound_id, _inbound, c in self._locate_client(username):
+            total_bytes = int(c.get('totalGB', 0) or 0)
+            # Try compute used traffic if present in client or stats
+            used_bytes = 0
             try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
+                down = int(c.get('downlink', 0) or 0)
             except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    total_bytes = int(c.get('totalGB', 0) or 0)
-                    # Try compute used traffic if present in client or stats
-                    used_bytes = 0
-                    try:
-                        down = int(c.get('downlink', 0) or 0)
-                    except Exception:
-                        down = 0
-                    try:
-                        up = int(c.get('uplink', 0) or 0)
-                    except Exception:
-                        up = 0
-                    try:
-                        used_bytes = int(c.get('total', 0) or 0)
-                    except Exception:
-                        used_bytes = down + up
-                    if used_bytes == 0:
-                        # Fetch from getClientTraffics endpoint (by inbound)
-                        stats = self._fetch_client_traffics(inbound_id) or []
-                        for s in stats:
-                            if (s.get('email') or s.get('name')) == username:
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                                break
-                        if used_bytes == 0:
-                            # Direct by email
-                            s = self._fetch_client_traffic_by_email(username)
-                            if isinstance(s, dict):
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
-                    subid = c.get('subId') or ''
-                    # Build subscription URL
-                    if self.sub_base:
-                        origin = self.sub_base
-                    else:
-                        parts = urlsplit(self.base_url)
-                        host = parts.hostname or ''
-                        port = ''
-                        if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
-                            port = f":{parts.port}"
-                        origin = f"{parts.scheme}://{host}{port}"
-                    # Use the user's email (username) as name param for readability
-                    sub_link = f"{origin}/sub/{subid}?name={username}" if subid else ''
-                    return {
-                        'data_limit': total_bytes,
-                        'used_traffic': used_bytes,
-                        'expire': expire,
-                        'subscription_url': sub_link,
-                    }, "Success"
+                down = 0
+            try:
+                up = int(c.get('uplink', 0) or 0)
+            except Exception:
+                up = 0
+            try:
+                used_bytes = int(c.get('total', 0) or 0)
+            except Exception:
+                used_bytes = down + up
+            if used_bytes == 0:
+                # Fetch from getClientTraffics endpoint (by inbound)
+                stats = self._fetch_client_traffics(inbound_id) or []
+                for s in stats:
+                    if (s.get('email') or s.get('name')) == username:
+                        try:
+                            d = int(s.get('down') or s.get('download') or 0)
+                        except Exception:
+                            d = 0
+                        try:
+                            u = int(s.get('up') or s.get('upload') or 0)
+                        except Exception:
+                            u = 0
+                        used_bytes = d + u
+                        break
+                if used_bytes == 0:
+                    # Direct by email
+                    s = self._fetch_client_traffic_by_email(username)
+                    if isinstance(s, dict):
+                        try:
+                            d = int(s.get('down') or s.get('download') or 0)
+                        except Exception:
+                            d = 0
+                        try:
+                            u = int(s.get('up') or s.get('upload') or 0)
+                        except Exception:
+                            u = 0
+                        used_bytes = d + u
+            expiry_ms = int(c.get('expiryTime', 0) or 0)
+            expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
+            subid = c.get('subId') or ''
+            # Build subscription URL
+            if self.sub_base:
+                origin = self.sub_base
+            else:
+                parts = urlsplit(self.base_url)
+                host = parts.hostname or ''
+                port = ''
+                if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                    port = f":{parts.port}"
+                origin = f"{parts.scheme}://{host}{port}"
+            # Use the user's email (username) as name param for readability
+            sub_link = f"{origin}/sub/{subid}?name={username}" if subid else ''
+            return {
+                'data_limit': total_bytes,
+                'used_traffic': used_bytes,
+                'expire': expire,
+                'subscription_url': sub_link,
+            }, "Success"
         return None, "کاربر یافت نشد"
 
-    async def reset_user_traffic(self, username: str):
+    def _reset_user_traffic(self, username: str):
         if not self.get_token():
             return False, "خطا در ورود به پنل X-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return False, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
-            except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    renewed, _m = self.renew_by_recreate_on_inbound(inbound_id, username, 0.0, 0)
-                    if renewed:
-                        return True, "Success"
+        for inbound_id, _inbound, c in self._locate_client(username):
+            renewed, _m = self.renew_by_recreate_on_inbound(inbound_id, username, 0.0, 0)
+            if renewed:
+                return True, "Success"
         return False, "کلاینت یافت نشد"
 
     def _fetch_inbound_detail(self, inbound_id: int):
@@ -1012,7 +1289,8 @@ class XuiAPI(BasePanelAPI):
             f"/xui/api/inbounds/get/{inbound_id}",
             f"/panel/api/inbounds/get/{inbound_id}",
         ]
-        for p in paths:
+        variants = self._variants('inbound_detail', paths, inbound_id=inbound_id)
+        for p in variants:
             try:
                 resp = self.session.get(f"{self.base_url}{p}", headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -1020,6 +1298,7 @@ class XuiAPI(BasePanelAPI):
                 data = resp.json()
                 inbound = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(inbound, dict):
+                    variants.worked(p)
                     return inbound
             except Exception:
                 continue
@@ -1072,13 +1351,10 @@ class XuiAPI(BasePanelAPI):
                     continue
         return False
 
-    async def renew_user_in_panel(self, username, plan):
+    def _renew_user_in_panel(self, username, plan):
         # Login first
         if not self.get_token():
             return None, "خطا در ورود به پنل X-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return None, msg
         now_ms = int(datetime.now().timestamp() * 1000)
         add_bytes = 0
         try:
@@ -1094,103 +1370,90 @@ class XuiAPI(BasePanelAPI):
         
         logger.info(f"X-UI renew_user_in_panel for {username}: add_bytes={add_bytes}, add_ms={add_ms}")
         
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            clients = []
-            try:
-                if isinstance(settings_str, str):
-                    settings_obj = json.loads(settings_str)
-                    clients = settings_obj.get('clients', [])
-            except Exception:
-                clients = []
-            if not isinstance(clients, list):
-                continue
-            for idx, c in enumerate(clients):
-                if c.get('email') == username:
-                    current_exp = int(c.get('expiryTime', 0) or 0)
-                    base = max(current_exp, now_ms)
-                    target_exp = base + (add_ms if add_ms > 0 else 0)
-                    new_total = int(c.get('totalGB', 0) or 0) + (add_bytes if add_bytes > 0 else 0)
-                    updated = dict(c)
-                    updated['expiryTime'] = target_exp
-                    updated['totalGB'] = new_total
-                    # Endpoint variants (prioritize updateClient/{uuid})
-                    uuid_old = c.get('id') or c.get('uuid') or ''
-                    base_eps = [
-                        "/xui/API/inbounds/updateClient",
-                        "/panel/API/inbounds/updateClient",
-                        "/xui/api/inbounds/updateClient",
-                        "/panel/api/inbounds/updateClient",
-                    ]
-                    endpoints = ([f"{e}/{uuid_old}" for e in base_eps] + base_eps) if uuid_old else base_eps
-                    json_headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'X-Requested-With': 'XMLHttpRequest'}
-                    form_headers = {'Accept': 'application/json', 'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8', 'X-Requested-With': 'XMLHttpRequest'}
-                    last_err = None
-                    for up in endpoints:
+        for inbound_id, inbound, c in self._locate_client(username):
+            clients = panel_index.inbound_clients(inbound)
+            idx = clients.index(c)
+            current_exp = int(c.get('expiryTime', 0) or 0)
+            base = max(current_exp, now_ms)
+            target_exp = base + (add_ms if add_ms > 0 else 0)
+            new_total = int(c.get('totalGB', 0) or 0) + (add_bytes if add_bytes > 0 else 0)
+            updated = dict(c)
+            updated['expiryTime'] = target_exp
+            updated['totalGB'] = new_total
+            # Endpoint variants (prioritize updateClient/{uuid})
+            uuid_old = c.get('id') or c.get('uuid') or ''
+            base_eps = [
+                "/xui/API/inbounds/updateClient",
+                "/panel/API/inbounds/updateClient",
+                "/xui/api/inbounds/updateClient",
+                "/panel/api/inbounds/updateClient",
+            ]
+            endpoints = ([f"{e}/{uuid_old}" for e in base_eps] + base_eps) if uuid_old else base_eps
+            json_headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'X-Requested-With': 'XMLHttpRequest'}
+            form_headers = {'Accept': 'application/json', 'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8', 'X-Requested-With': 'XMLHttpRequest'}
+            last_err = None
+            for up in endpoints:
+                try:
+                    # A) settings with single updated client
+                    payload_settings_single = {"id": int(inbound_id), "settings": json.dumps({"clients": [updated]})}
+                    resp = self.session.post(f"{self.base_url}{up}", headers=json_headers, json=payload_settings_single, timeout=15)
+                    if resp.status_code in (200, 201):
+                        ref = self._fetch_inbound_detail(inbound_id)
                         try:
-                            # A) settings with single updated client
-                            payload_settings_single = {"id": int(inbound_id), "settings": json.dumps({"clients": [updated]})}
-                            resp = self.session.post(f"{self.base_url}{up}", headers=json_headers, json=payload_settings_single, timeout=15)
-                            if resp.status_code in (200, 201):
-                                ref = self._fetch_inbound_detail(inbound_id)
-                                try:
-                                    robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
-                                except Exception:
-                                    robj = {}
-                                for c2 in (robj.get('clients') or []):
-                                    if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
-                                        return updated, "Success"
-                            # B) clients array JSON
-                            payload_clients = {"id": int(inbound_id), "clients": [updated]}
-                            resp = self.session.post(f"{self.base_url}{up}", headers=json_headers, json=payload_clients, timeout=15)
-                            if resp.status_code in (200, 201):
-                                ref = self._fetch_inbound_detail(inbound_id)
-                                try:
-                                    robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
-                                except Exception:
-                                    robj = {}
-                                for c2 in (robj.get('clients') or []):
-                                    if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
-                                        return updated, "Success"
-                            # C) form-urlencoded with settings (single)
-                            resp = self.session.post(f"{self.base_url}{up}", headers=form_headers, data={"id": str(int(inbound_id)), "settings": json.dumps({"clients": [updated]})}, timeout=15)
-                            if resp.status_code in (200, 201):
-                                ref = self._fetch_inbound_detail(inbound_id)
-                                try:
-                                    robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
-                                except Exception:
-                                    robj = {}
-                                for c2 in (robj.get('clients') or []):
-                                    if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
-                                        return updated, "Success"
-                            # D) settings with full clients
-                            full_clients = list(clients)
-                            full_clients[idx] = updated
-                            payload_settings_full = {"id": int(inbound_id), "settings": json.dumps({"clients": full_clients})}
-                            resp = self.session.post(f"{self.base_url}{up}", headers=json_headers, json=payload_settings_full, timeout=15)
-                            if resp.status_code in (200, 201):
-                                ref = self._fetch_inbound_detail(inbound_id)
-                                try:
-                                    robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
-                                except Exception:
-                                    robj = {}
-                                for c2 in (robj.get('clients') or []):
-                                    if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
-                                        return updated, "Success"
-                            last_err = f"HTTP {resp.status_code}: {(resp.text or '')[:160]}"
-                        except requests.RequestException as e:
-                            last_err = str(e)
-                            continue
-                    return None, (last_err or "به‌روزرسانی کلاینت ناموفق بود")
+                            robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
+                        except Exception:
+                            robj = {}
+                        for c2 in (robj.get('clients') or []):
+                            if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
+                                return updated, "Success"
+                    # B) clients array JSON
+                    payload_clients = {"id": int(inbound_id), "clients": [updated]}
+                    resp = self.session.post(f"{self.base_url}{up}", headers=json_headers, json=payload_clients, timeout=15)
+                    if resp.status_code in (200, 201):
+                        ref = self._fetch_inbound_detail(inbound_id)
+                        try:
+                            robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
+                        except Exception:
+                            robj = {}
+                        for c2 in (robj.get('clients') or []):
+                            if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
+                                return updated, "Success"
+                    # C) form-urlencoded with settings (single)
+                    resp = self.session.post(f"{self.base_url}{up}", headers=form_headers, data={"id": str(int(inbound_id)), "settings": json.dumps({"clients": [updated]})}, timeout=15)
+                    if resp.status_code in (200, 201):
+                        ref = self._fetch_inbound_detail(inbound_id)
+                        try:
+                            robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
+                        except Exception:
+                            robj = {}
+                        for c2 in (robj.get('clients') or []):
+                            if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
+                                return updated, "Success"
+                    # D) settings with full clients
+                    full_clients = list(clients)
+                    full_clients[idx] = updated
+                    payload_settings_full = {"id": int(inbound_id), "settings": json.dumps({"clients": full_clients})}
+                    resp = self.session.post(f"{self.base_url}{up}", headers=json_headers, json=payload_settings_full, timeout=15)
+                    if resp.status_code in (200, 201):
+                        ref = self._fetch_inbound_detail(inbound_id)
+                        try:
+                            robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
+                        except Exception:
+                            robj = {}
+                        for c2 in (robj.get('clients') or []):
+                            if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == target_exp and int(c2.get('totalGB', 0) or 0) == new_total:
+                                return updated, "Success"
+                    last_err = f"HTTP {resp.status_code}: {(resp.text or '')[:160]}"
+                except requests.RequestException as e:
+                    last_err = str(e)
+                    continue
+            return None, (last_err or "به‌روزرسانی کلاینت ناموفق بود")
         return None, "کلاینت برای تمدید یافت نشد"
 
-    async def create_user(self, user_id, plan, desired_username: str | None = None):
+    def _create_user(self, user_id, plan, desired_username: str | None = None):
         return None, None, "برای X-UI ابتدا اینباند را انتخاب کنید."
 
+    @_changes_user(1)
     def renew_user_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         # Login first
         if not self.get_token():
@@ -1391,6 +1654,7 @@ class XuiAPI(BasePanelAPI):
         except Exception as e:
             return None, str(e)
 
+    @_changes_user(1)
     def renew_by_recreate_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         if not self.get_token():
             return None, "خطا در ورود به پنل X-UI"
@@ -1669,6 +1933,7 @@ class XuiAPI(BasePanelAPI):
         except Exception:
             return []
 
+    @_changes_user(1)
     def recreate_user_key_on_inbound(self, inbound_id: int, username: str):
         # Login and fetch inbound
         if not self.get_token():
@@ -1777,6 +2042,9 @@ class XuiAPI(BasePanelAPI):
 class ThreeXuiAPI(BasePanelAPI):
     """3x-UI support using lowercase /xui/api endpoints."""
 
+    lists_users = True
+    indexes_clients = True
+
     def __init__(self, panel_row):
         self.panel_id = panel_row['id']
         _raw = (panel_row['url'] or '').strip().rstrip('/')
@@ -1789,7 +2057,7 @@ class ThreeXuiAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = self._open_session()
         self._json_headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -1797,43 +2065,42 @@ class ThreeXuiAPI(BasePanelAPI):
         }
 
     def get_token(self):
-        # Try form login first (more compatible)
-        try:
+        # Form login first (more compatible), JSON login as fallback
+        styles = self._variants('login', ('form', 'json'), any_failure=True)
+        for style in styles:
             try:
-                self.session.get(f"{self.base_url}/login", timeout=8)
-            except requests.RequestException:
-                pass
-            form_headers = {
-                'Accept': 'text/html,application/json',
-                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                'X-Requested-With': 'XMLHttpRequest',
-            }
-            resp = self.session.post(
-                f"{self.base_url}/login",
-                data={"username": self.username, "password": self.password},
-                headers=form_headers,
-                allow_redirects=False,
-                timeout=12,
-            )
-            if resp.status_code in (200, 204, 302, 303):
-                return True
-        except requests.RequestException:
-            pass
-        # Fallback to JSON login
-        try:
-            resp = self.session.post(
-                f"{self.base_url}/login",
-                json={"username": self.username, "password": self.password},
-                headers=self._json_headers,
-                timeout=12,
-            )
-            if resp.status_code in (200, 204, 302, 303):
-                return True
-        except requests.RequestException as e:
-            logger.error(f"3x-UI login error: {e}")
+                if style == 'form':
+                    try:
+                        self.session.get(f"{self.base_url}/login", timeout=8)
+                    except requests.RequestException:
+                        pass
+                    form_headers = {
+                        'Accept': 'text/html,application/json',
+                        'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                        'X-Requested-With': 'XMLHttpRequest',
+                    }
+                    resp = self.session.post(
+                        f"{self.base_url}/login",
+                        data={"username": self.username, "password": self.password},
+                        headers=form_headers,
+                        allow_redirects=False,
+                        timeout=12,
+                    )
+                else:
+                    resp = self.session.post(
+                        f"{self.base_url}/login",
+                        json={"username": self.username, "password": self.password},
+                        headers=self._json_headers,
+                        timeout=12,
+                    )
+                if resp.status_code in (200, 204, 302, 303):
+                    styles.worked(style)
+                    return True
+            except requests.RequestException as e:
+                logger.error(f"3x-UI {style} login error: {e}")
         return False
 
-    def list_inbounds(self):
+    def list_inbounds(self, raw: bool = False):
         if not self.get_token():
             return None, "خطا در ورود به پنل 3x-UI"
         try:
@@ -1846,8 +2113,9 @@ class ThreeXuiAPI(BasePanelAPI):
                 f"{self.base_url}/panel/API/inbounds/",
             ]
             last_error = None
+            variants = self._variants('list_inbounds', endpoints)
             for attempt in range(2):
-                for url in endpoints:
+                for url in variants:
                     try:
                         resp = self.session.get(url, headers=self._json_headers, timeout=12)
                     except requests.RequestException as e:
@@ -1879,6 +2147,10 @@ class ThreeXuiAPI(BasePanelAPI):
                     if not isinstance(items, list):
                         last_error = f"ساختار JSON لیست اینباند قابل تشخیص نیست @ {url}"
                         continue
+                    variants.worked(url)
+                    if raw:
+                        # Full inbound objects, settings included, for the client index
+                        return [it for it in items if isinstance(it, dict)], "Success"
                     inbounds = []
                     for it in items:
                         if not isinstance(it, dict):
@@ -1904,7 +2176,8 @@ class ThreeXuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/getClientTraffics/{inbound_id}",
             f"{self.base_url}/panel/API/inbounds/getClientTraffics/{inbound_id}",
         ]
-        for url in endpoints:
+        variants = self._variants('client_traffics', endpoints, inbound_id=inbound_id)
+        for url in variants:
             try:
                 resp = self.session.get(url, headers=self._json_headers, timeout=12)
                 if resp.status_code != 200:
@@ -1912,6 +2185,7 @@ class ThreeXuiAPI(BasePanelAPI):
                 data = resp.json()
                 items = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(items, list):
+                    variants.worked(url)
                     return items
             except Exception:
                 continue
@@ -1924,7 +2198,8 @@ class ThreeXuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/getClientTraffics/{email}",
             f"{self.base_url}/panel/API/inbounds/getClientTraffics/{email}",
         ]
-        for url in endpoints:
+        variants = self._variants('client_traffic', endpoints, email=email)
+        for url in variants:
             try:
                 resp = self.session.get(url, headers=self._json_headers, timeout=12)
                 if resp.status_code != 200:
@@ -1932,11 +2207,13 @@ class ThreeXuiAPI(BasePanelAPI):
                 data = resp.json()
                 obj = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(obj, dict):
+                    variants.worked(url)
                     return obj
             except Exception:
                 continue
         return None
 
+    @_changes_user(1)
     def rotate_user_key_on_inbound(self, inbound_id: int, username: str):
         """Rotate user's UUID/key on a specific inbound without changing traffic/expiry."""
         logger.info(f"[rotate_key] 3x-UI rotate key for user={username} on inbound={inbound_id}")
@@ -1984,10 +2261,12 @@ class ThreeXuiAPI(BasePanelAPI):
             
             payload = {"id": int(inbound_id), "settings": new_settings_json}
             
-            for ep in endpoints:
+            variants = self._variants('rotate_client', endpoints)
+            for ep in variants:
                 try:
                     resp = self.session.post(ep, headers=self._json_headers, json=payload, timeout=15)
                     if resp.status_code in (200, 201):
+                        variants.worked(ep)
                         logger.info(f"[rotate_key] Successfully rotated key via {ep}")
                         # Update subId to force new subscription link
                         import random, string
@@ -2056,7 +2335,8 @@ class ThreeXuiAPI(BasePanelAPI):
 
             # Try each endpoint with multiple payload formats
             last_preview = None
-            for ep in endpoints:
+            variants = self._variants('add_client', endpoints)
+            for ep in variants:
                 # 1) clients array JSON
                 payload1 = {"id": int(inbound_id), "clients": [client_obj]}
                 r1 = self.session.post(ep, headers=self._json_headers, json=payload1, timeout=15)
@@ -2107,6 +2387,7 @@ class ThreeXuiAPI(BasePanelAPI):
             else:
                 # no break -> all failed
                 return None, None, f"API failure: {last_preview or 'unknown'}"
+            variants.worked(chosen_ep)
 
             if self.sub_base:
                 origin = self.sub_base
@@ -2119,127 +2400,94 @@ class ThreeXuiAPI(BasePanelAPI):
                 origin = f"{parts.scheme}://{host}{port}"
             # Include readable name parameter if possible
             sub_link = f"{origin}/sub/{subid}?name={new_username}"
+            panel_index.record_client(self.panel_id, inbound_id, client_obj)
             # Return username and also stash client id for downstream if needed (admin layer persists inbound id)
             return new_username, sub_link, "Success"
         except requests.RequestException as e:
             logger.error(f"3x-UI create_user_on_inbound error: {e}")
             return None, None, str(e)
 
-    async def get_all_users(self):
-        return None, "Not supported for 3x-UI"
+    def _get_all_users(self):
+        return self._client_users()
 
-    async def get_user(self, username):
+    def _get_user(self, username):
         if not self.get_token():
             return None, "خطا در ورود به پنل 3x-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return None, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
+        for inbound_id, _inbound, c in self._locate_client(username):
+            total_bytes = int(c.get('totalGB', 0) or 0)
+            used_bytes = 0
             try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
+                down = int(c.get('downlink', 0) or 0)
             except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    total_bytes = int(c.get('totalGB', 0) or 0)
-                    used_bytes = 0
-                    try:
-                        down = int(c.get('downlink', 0) or 0)
-                    except Exception:
-                        down = 0
-                    try:
-                        up = int(c.get('uplink', 0) or 0)
-                    except Exception:
-                        up = 0
-                    try:
-                        used_bytes = int(c.get('total', 0) or 0)
-                    except Exception:
-                        used_bytes = down + up
-                    if used_bytes == 0:
-                        # try stats endpoint
-                        stats = []
+                down = 0
+            try:
+                up = int(c.get('uplink', 0) or 0)
+            except Exception:
+                up = 0
+            try:
+                used_bytes = int(c.get('total', 0) or 0)
+            except Exception:
+                used_bytes = down + up
+            if used_bytes == 0:
+                # try stats endpoint
+                stats = []
+                try:
+                    stats = self._fetch_client_traffics(inbound_id)
+                except Exception:
+                    stats = []
+                for s in (stats or []):
+                    if (s.get('email') or s.get('name')) == username:
                         try:
-                            stats = self._fetch_client_traffics(inbound_id)
+                            d = int(s.get('down') or s.get('download') or 0)
                         except Exception:
-                            stats = []
-                        for s in (stats or []):
-                            if (s.get('email') or s.get('name')) == username:
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                                break
-                        if used_bytes == 0:
-                            # direct by email
-                            s = self._fetch_client_traffic_by_email(username)
-                            if isinstance(s, dict):
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
-                    subid = c.get('subId') or ''
-                    if self.sub_base:
-                        origin = self.sub_base
-                    else:
-                        parts = urlsplit(self.base_url)
-                        host = parts.hostname or ''
-                        port = ''
-                        if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
-                            port = f":{parts.port}"
-                        origin = f"{parts.scheme}://{host}{port}"
-                    sub_link = f"{origin}/sub/{subid}" if subid else ''
-                    return {
-                        'data_limit': total_bytes,
-                        'used_traffic': used_bytes,
-                        'expire': expire,
-                        'subscription_url': sub_link,
-                    }, "Success"
+                            d = 0
+                        try:
+                            u = int(s.get('up') or s.get('upload') or 0)
+                        except Exception:
+                            u = 0
+                        used_bytes = d + u
+                        break
+                if used_bytes == 0:
+                    # direct by email
+                    s = self._fetch_client_traffic_by_email(username)
+                    if isinstance(s, dict):
+                        try:
+                            d = int(s.get('down') or s.get('download') or 0)
+                        except Exception:
+                            d = 0
+                        try:
+                            u = int(s.get('up') or s.get('upload') or 0)
+                        except Exception:
+                            u = 0
+                        used_bytes = d + u
+            expiry_ms = int(c.get('expiryTime', 0) or 0)
+            expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
+            subid = c.get('subId') or ''
+            if self.sub_base:
+                origin = self.sub_base
+            else:
+                parts = urlsplit(self.base_url)
+                host = parts.hostname or ''
+                port = ''
+                if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                    port = f":{parts.port}"
+                origin = f"{parts.scheme}://{host}{port}"
+            sub_link = f"{origin}/sub/{subid}" if subid else ''
+            return {
+                'data_limit': total_bytes,
+                'used_traffic': used_bytes,
+                'expire': expire,
+                'subscription_url': sub_link,
+            }, "Success"
         return None, "کاربر یافت نشد"
 
-    async def reset_user_traffic(self, username: str):
+    def _reset_user_traffic(self, username: str):
         if not self.get_token():
             return False, "خطا در ورود به پنل 3x-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return False, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
-            except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    renewed, _m = self.renew_by_recreate_on_inbound(inbound_id, username, 0.0, 0)
-                    if renewed:
-                        return True, "Success"
+        for inbound_id, _inbound, c in self._locate_client(username):
+            renewed, _m = self.renew_by_recreate_on_inbound(inbound_id, username, 0.0, 0)
+            if renewed:
+                return True, "Success"
         return False, "کلاینت یافت نشد"
 
     def _fetch_inbound_detail(self, inbound_id: int):
@@ -2251,7 +2499,8 @@ class ThreeXuiAPI(BasePanelAPI):
             f"/xui/API/inbounds/get/{inbound_id}",
             f"/panel/API/inbounds/get/{inbound_id}",
         ]
-        for p in paths:
+        variants = self._variants('inbound_detail', paths, inbound_id=inbound_id)
+        for p in variants:
             try:
                 resp = self.session.get(f"{self.base_url}{p}", headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -2259,6 +2508,7 @@ class ThreeXuiAPI(BasePanelAPI):
                 data = resp.json()
                 inbound = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(inbound, dict):
+                    variants.worked(p)
                     return inbound
             except Exception:
                 continue
@@ -2418,6 +2668,7 @@ class ThreeXuiAPI(BasePanelAPI):
         except Exception:
             return []
 
+    @_changes_user(1)
     def renew_by_recreate_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         # Delete old client and create a new one with increased quota/expiry
         if not self.get_token():
@@ -2566,6 +2817,7 @@ class ThreeXuiAPI(BasePanelAPI):
         except Exception as e:
             return None, str(e)
 
+    @_changes_user(1)
     def renew_user_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         # Ensure login
         try:
@@ -2620,7 +2872,8 @@ class ThreeXuiAPI(BasePanelAPI):
                         endpoints.append(f"{be}/{old_uuid}")
             endpoints.extend(base_endpoints)
             last_preview = None
-            for ep in endpoints:
+            variants = self._variants('update_client_by_id' if old_uuid else 'update_client', endpoints, uuid=old_uuid)
+            for ep in variants:
                 try:
                     r = self.session.post(f"{self.base_url}{ep}", headers={'Content-Type': 'application/json'}, json=payload, timeout=15)
                     if r.status_code in (200, 201):
@@ -2629,12 +2882,15 @@ class ThreeXuiAPI(BasePanelAPI):
                             # success detection
                             if isinstance(j, dict):
                                 if j.get('success') is True:
+                                    variants.worked(ep)
                                     return updated, "Success"
                                 status_val = str(j.get('status', '')).lower()
                                 if status_val in ('ok','success','200'):
+                                    variants.worked(ep)
                                     return updated, "Success"
                                 code_val = str(j.get('code', ''))
                                 if code_val.startswith('2'):
+                                    variants.worked(ep)
                                     return updated, "Success"
                         except Exception:
                             # many 3x-ui return empty body on success; verify by reading back
@@ -2645,6 +2901,7 @@ class ThreeXuiAPI(BasePanelAPI):
                                 ns = {}
                             for c2 in (ns.get('clients') or []):
                                 if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == updated['expiryTime'] and int(c2.get('totalGB', 0) or 0) == updated['totalGB']:
+                                    variants.worked(ep)
                                     return updated, "Success"
                     else:
                         last_preview = f"{ep} -> HTTP {r.status_code}: {(r.text or '')[:180]}"
@@ -2660,12 +2917,9 @@ class ThreeXuiAPI(BasePanelAPI):
         except Exception as e:
             return None, str(e)
 
-    async def renew_user_in_panel(self, username, plan):
+    def _renew_user_in_panel(self, username, plan):
         if not self.get_token():
             return None, "خطا در ورود به پنل 3x-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return None, msg
         now_ms = int(datetime.now().timestamp() * 1000)
         try:
             add_bytes = int(float(plan['traffic_gb']) * (1024 ** 3))
@@ -2677,67 +2931,53 @@ class ThreeXuiAPI(BasePanelAPI):
         except Exception:
             add_ms = 0
         try:
-            logger.info(f"[3xui] renew_user_in_panel: username={username} add_bytes={add_bytes} add_ms={add_ms} inbound_count={len(inbounds)}")
+            logger.info(f"[3xui] renew_user_in_panel: username={username} add_bytes={add_bytes} add_ms={add_ms}")
         except Exception:
             pass
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            clients = []
+        for inbound_id, _inbound, c in self._locate_client(username):
+            current_exp = int(c.get('expiryTime', 0) or 0)
+            base = max(current_exp, now_ms)
+            target_exp = base + (add_ms if add_ms > 0 else 0)
+            new_total = int(c.get('totalGB', 0) or 0) + (add_bytes if add_bytes > 0 else 0)
+            updated = dict(c)
+            updated['expiryTime'] = target_exp
+            updated['totalGB'] = new_total
+            settings_payload = json.dumps({"clients": [updated]})
+            payload = {"id": int(inbound_id), "settings": settings_payload}
+            endpoints = [
+                "/xui/api/inbounds/updateClient",
+                "/panel/api/inbounds/updateClient",
+                "/xui/api/inbound/updateClient",
+            ]
+            last_ep = None; last_code = None; last_err = None
+            variants = self._variants('renew_client', endpoints)
+            for up in variants:
+                try:
+                    url = f"{self.base_url}{up}"
+                    resp = self.session.post(url, headers={'Content-Type': 'application/json'}, json=payload, timeout=15)
+                    last_ep = url; last_code = resp.status_code
+                    if resp.status_code in (200, 201, 202, 204):
+                        # verify by refetching inbound settings
+                        ref = self._fetch_inbound_detail(inbound_id)
+                        try:
+                            robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
+                        except Exception:
+                            robj = {}
+                        for c2 in (robj.get('clients') or []):
+                            if c2.get('email') == username and int(c2.get('totalGB', 0) or 0) == new_total and int(c2.get('expiryTime', 0) or 0) == target_exp:
+                                variants.worked(up)
+                                return updated, "Success"
+                        # If panel returns success but verification didn't match, continue trying next endpoint
+                    else:
+                        last_err = f"HTTP {resp.status_code}: {(resp.text or '')[:180]}"
+                except requests.RequestException as e:
+                    last_err = f"EXC: {e}"
+                    continue
             try:
-                if isinstance(settings_str, str):
-                    settings_obj = json.loads(settings_str)
-                    clients = settings_obj.get('clients', [])
+                logger.error(f"[3xui] renew_user_in_panel failed: inbound={inbound_id} endpoint={last_ep} status={last_code} err={last_err}")
             except Exception:
-                clients = []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    current_exp = int(c.get('expiryTime', 0) or 0)
-                    base = max(current_exp, now_ms)
-                    target_exp = base + (add_ms if add_ms > 0 else 0)
-                    new_total = int(c.get('totalGB', 0) or 0) + (add_bytes if add_bytes > 0 else 0)
-                    updated = dict(c)
-                    updated['expiryTime'] = target_exp
-                    updated['totalGB'] = new_total
-                    settings_payload = json.dumps({"clients": [updated]})
-                    payload = {"id": int(inbound_id), "settings": settings_payload}
-                    endpoints = [
-                        "/xui/api/inbounds/updateClient",
-                        "/panel/api/inbounds/updateClient",
-                        "/xui/api/inbound/updateClient",
-                    ]
-                    last_ep = None; last_code = None; last_err = None
-                    for up in endpoints:
-                        try:
-                            url = f"{self.base_url}{up}"
-                            resp = self.session.post(url, headers={'Content-Type': 'application/json'}, json=payload, timeout=15)
-                            last_ep = url; last_code = resp.status_code
-                            if resp.status_code in (200, 201, 202, 204):
-                                # verify by refetching inbound settings
-                                ref = self._fetch_inbound_detail(inbound_id)
-                                try:
-                                    robj = json.loads(ref.get('settings')) if isinstance(ref.get('settings'), str) else (ref.get('settings') or {})
-                                except Exception:
-                                    robj = {}
-                                for c2 in (robj.get('clients') or []):
-                                    if c2.get('email') == username and int(c2.get('totalGB', 0) or 0) == new_total and int(c2.get('expiryTime', 0) or 0) == target_exp:
-                                        return updated, "Success"
-                                # If panel returns success but verification didn't match, continue trying next endpoint
-                            else:
-                                last_err = f"HTTP {resp.status_code}: {(resp.text or '')[:180]}"
-                        except requests.RequestException as e:
-                            last_err = f"EXC: {e}"
-                            continue
-                    try:
-                        logger.error(f"[3xui] renew_user_in_panel failed: inbound={inbound_id} endpoint={last_ep} status={last_code} err={last_err}")
-                    except Exception:
-                        pass
-                    return None, "به‌روزرسانی کلاینت ناموفق بود"
+                pass
+            return None, "به‌روزرسانی کلاینت ناموفق بود"
         return None, "کلاینت برای تمدید یافت نشد"
 
     def _update_client_by_uuid(self, inbound_id: int, client_uuid: str, total_bytes: int, expiry_ms: int, updated_client: dict | None = None):
@@ -2968,6 +3208,7 @@ class ThreeXuiAPI(BasePanelAPI):
             logger.error(f"[renew] 3x-UI renewal failed for uuid={client_uuid}")
             return None, "به‌روزرسانی کلاینت ناموفق بود"
 
+    @_changes_user(1)
     def renew_by_recreate_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         """Delete and re-create client to reset usage, while preserving/increasing limits."""
         logger.info(f"[renew] 3x-UI renew_by_recreate_on_inbound: inbound={inbound_id}, username={username}, add_gb={add_gb}, add_days={add_days}")
@@ -3120,6 +3361,7 @@ class ThreeXuiAPI(BasePanelAPI):
 
         return None, "ساخت کلاینت جدید ناموفق بود"
 
+    @_changes_user(1)
     def delete_user_on_inbound(self, inbound_id: int, username: str, client_id: str | None = None):
         """Delete a client from an inbound by email (username) or client_id."""
         logger.info(f"[delete] 3x-UI delete_user_on_inbound: inbound={inbound_id}, username={username}, client_id={client_id}")
@@ -3160,7 +3402,8 @@ class ThreeXuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/{inbound_id}/delClient/{client_id}",
         ]
         
-        for endpoint in endpoints:
+        variants = self._variants('del_client', endpoints, inbound_id=inbound_id, uuid=client_id)
+        for endpoint in variants:
             try:
                 logger.info(f"[delete] Trying endpoint: {endpoint}")
                 resp = self.session.post(endpoint, headers=self._json_headers, json={"id": inbound_id}, timeout=12)
@@ -3172,10 +3415,12 @@ class ThreeXuiAPI(BasePanelAPI):
                         data = resp.json()
                         if isinstance(data, dict) and data.get('success') is not False:
                             logger.info(f"[delete] Successfully deleted client {client_id}")
+                            variants.worked(endpoint)
                             return True
                     except Exception:
                         # Some panels return empty body on success
                         logger.info(f"[delete] Successfully deleted client {client_id} (empty response)")
+                        variants.worked(endpoint)
                         return True
             except Exception as e:
                 logger.error(f"[delete] Error at {endpoint}: {e}")
@@ -3188,6 +3433,9 @@ class ThreeXuiAPI(BasePanelAPI):
 class TxUiAPI(BasePanelAPI):
     """TX-UI support. Tries both tx and xui prefixes with lowercase endpoints. """
 
+    lists_users = True
+    indexes_clients = True
+
     def __init__(self, panel_row):
         self.panel_id = panel_row['id']
         _raw = (panel_row['url'] or '').strip().rstrip('/')
@@ -3200,7 +3448,7 @@ class TxUiAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = self._open_session()
         self._json_headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -3221,7 +3469,7 @@ class TxUiAPI(BasePanelAPI):
             logger.error(f"TX-UI login error: {e}")
             return False
 
-    def list_inbounds(self):
+    def list_inbounds(self, raw: bool = False):
         if not self.get_token():
             return None, "خطا در ورود به پنل TX-UI"
         try:
@@ -3232,8 +3480,9 @@ class TxUiAPI(BasePanelAPI):
                 f"{self.base_url}/xui/api/inbounds",
             ]
             last_error = None
+            variants = self._variants('list_inbounds', endpoints)
             for attempt in range(2):
-                for url in endpoints:
+                for url in variants:
                     resp = self.session.get(url, headers=self._json_headers, timeout=12)
                     if resp.status_code != 200:
                         last_error = f"HTTP {resp.status_code}"
@@ -3261,6 +3510,10 @@ class TxUiAPI(BasePanelAPI):
                     if not isinstance(items, list):
                         last_error = "ساختار JSON لیست اینباند قابل تشخیص نیست"
                         continue
+                    variants.worked(url)
+                    if raw:
+                        # Full inbound objects, settings included, for the client index
+                        return [it for it in items if isinstance(it, dict)], "Success"
                     inbounds = []
                     for it in items:
                         if not isinstance(it, dict):
@@ -3334,7 +3587,8 @@ class TxUiAPI(BasePanelAPI):
             ]
 
             last_preview = None
-            for ep in endpoints:
+            variants = self._variants('add_client', endpoints)
+            for ep in variants:
                 payload1 = {"id": int(inbound_id), "clients": [client_obj]}
                 r1 = self.session.post(ep, headers=self._json_headers, json=payload1, timeout=15)
                 if r1.status_code in (200, 201):
@@ -3381,6 +3635,7 @@ class TxUiAPI(BasePanelAPI):
                     last_preview = f"endpoint={ep} form=form HTTP {r3.status_code}: {(r3.text or '')[:200]}"
             else:
                 return None, None, f"API failure: {last_preview or 'unknown'}"
+            variants.worked(chosen_ep)
 
             if self.sub_base:
                 origin = self.sub_base
@@ -3393,55 +3648,39 @@ class TxUiAPI(BasePanelAPI):
                 origin = f"{parts.scheme}://{host}{port}"
             # Default: no ?name=
             sub_link = f"{origin}/sub/{subid}"
+            panel_index.record_client(self.panel_id, inbound_id, client_obj)
             return new_username, sub_link, "Success"
         except requests.RequestException as e:
             logger.error(f"TX-UI create_user_on_inbound error: {e}")
             return None, None, str(e)
 
-    async def get_all_users(self):
-        return None, "Not supported for TX-UI"
+    def _get_all_users(self):
+        return self._client_users()
 
-    async def get_user(self, username):
+    def _get_user(self, username):
         if not self.get_token():
             return None, "خطا در ورود به پنل TX-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return None, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
-            except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    total_bytes = int(c.get('totalGB', 0) or 0)
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
-                    subid = c.get('subId') or ''
-                    if self.sub_base:
-                        origin = self.sub_base
-                    else:
-                        parts = urlsplit(self.base_url)
-                        host = parts.hostname or ''
-                        port = ''
-                        if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
-                            port = f":{parts.port}"
-                        origin = f"{parts.scheme}://{host}{port}"
-                    sub_link = f"{origin}/sub/{subid}" if subid else ''
-                    return {
-                        'data_limit': total_bytes,
-                        'used_traffic': 0,
-                        'expire': expire,
-                        'subscription_url': sub_link,
-                    }, "Success"
+        for inbound_id, _inbound, c in self._locate_client(username):
+            total_bytes = int(c.get('totalGB', 0) or 0)
+            expiry_ms = int(c.get('expiryTime', 0) or 0)
+            expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
+            subid = c.get('subId') or ''
+            if self.sub_base:
+                origin = self.sub_base
+            else:
+                parts = urlsplit(self.base_url)
+                host = parts.hostname or ''
+                port = ''
+                if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                    port = f":{parts.port}"
+                origin = f"{parts.scheme}://{host}{port}"
+            sub_link = f"{origin}/sub/{subid}" if subid else ''
+            return {
+                'data_limit': total_bytes,
+                'used_traffic': 0,
+                'expire': expire,
+                'subscription_url': sub_link,
+            }, "Success"
         return None, "کاربر یافت نشد"
 
     def _fetch_inbound_detail(self, inbound_id: int):
@@ -3450,7 +3689,8 @@ class TxUiAPI(BasePanelAPI):
             f"/xui/api/inbounds/get/{inbound_id}",
             f"/panel/api/inbounds/get/{inbound_id}",
         ]
-        for p in paths:
+        variants = self._variants('inbound_detail', paths, inbound_id=inbound_id)
+        for p in variants:
             try:
                 resp = self.session.get(f"{self.base_url}{p}", headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -3458,6 +3698,7 @@ class TxUiAPI(BasePanelAPI):
                 data = resp.json()
                 inbound = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(inbound, dict):
+                    variants.worked(p)
                     return inbound
             except Exception:
                 continue
@@ -3617,12 +3858,9 @@ class TxUiAPI(BasePanelAPI):
         except Exception:
             return []
 
-    async def renew_user_in_panel(self, username, plan):
+    def _renew_user_in_panel(self, username, plan):
         if not self.get_token():
             return None, "خطا در ورود به پنل TX-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
-            return None, msg
         now_ms = int(datetime.now().timestamp() * 1000)
         try:
             add_bytes = int(float(plan['traffic_gb']) * (1024 ** 3))
@@ -3633,46 +3871,35 @@ class TxUiAPI(BasePanelAPI):
             add_ms = days * 86400 * 1000 if days > 0 else 0
         except Exception:
             add_ms = 0
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            clients = []
-            try:
-                if isinstance(settings_str, str):
-                    settings_obj = json.loads(settings_str)
-                    clients = settings_obj.get('clients', [])
-            except Exception:
-                clients = []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    current_exp = int(c.get('expiryTime', 0) or 0)
-                    base = max(current_exp, now_ms)
-                    target_exp = base + (add_ms if add_ms > 0 else 0)
-                    new_total = int(c.get('totalGB', 0) or 0) + (add_bytes if add_bytes > 0 else 0)
-                    updated = dict(c)
-                    updated['expiryTime'] = target_exp
-                    updated['totalGB'] = new_total
-                    settings_payload = json.dumps({"clients": [updated]})
-                    payload = {"id": int(inbound_id), "settings": settings_payload}
-                    for up in ["/tx/api/inbounds/updateClient", "/xui/api/inbounds/updateClient", "/panel/api/inbounds/updateClient"]:
-                        try:
-                            resp = self.session.post(f"{self.base_url}{up}", headers={'Content-Type': 'application/json'}, json=payload, timeout=15)
-                            if resp.status_code in (200, 201):
-                                return updated, "Success"
-                        except requests.RequestException:
-                            continue
-                    return None, "به‌روزرسانی کلاینت ناموفق بود"
+        for inbound_id, _inbound, c in self._locate_client(username):
+            current_exp = int(c.get('expiryTime', 0) or 0)
+            base = max(current_exp, now_ms)
+            target_exp = base + (add_ms if add_ms > 0 else 0)
+            new_total = int(c.get('totalGB', 0) or 0) + (add_bytes if add_bytes > 0 else 0)
+            updated = dict(c)
+            updated['expiryTime'] = target_exp
+            updated['totalGB'] = new_total
+            settings_payload = json.dumps({"clients": [updated]})
+            payload = {"id": int(inbound_id), "settings": settings_payload}
+            endpoints = ["/tx/api/inbounds/updateClient", "/xui/api/inbounds/updateClient", "/panel/api/inbounds/updateClient"]
+            variants = self._variants('renew_client', endpoints)
+            for up in variants:
+                try:
+                    resp = self.session.post(f"{self.base_url}{up}", headers={'Content-Type': 'application/json'}, json=payload, timeout=15)
+                    if resp.status_code in (200, 201):
+                        variants.worked(up)
+                        return updated, "Success"
+                except requests.RequestException:
+                    continue
+            return None, "به‌روزرسانی کلاینت ناموفق بود"
         return None, "کلاینت برای تمدید یافت نشد"
 
+    @_changes_user(1)
     def renew_by_recreate_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         """Bridge method for renewal flow - calls renew_user_on_inbound for TX-UI"""
         return self.renew_user_on_inbound(inbound_id, username, add_gb, add_days)
     
+    @_changes_user(1)
     def renew_user_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
         if not self.get_token():
             return None, "خطا در ورود به پنل TX-UI"
@@ -3726,7 +3953,8 @@ class TxUiAPI(BasePanelAPI):
             payload_json = {"id": int(inbound_id), "settings": settings_payload}
             payload_form = {"id": str(int(inbound_id)), "settings": settings_payload}
             last_err = None
-            for ep in endpoints:
+            variants = self._variants('update_client_by_id' if uuid_old else 'update_client', endpoints, uuid=uuid_old)
+            for ep in variants:
                 try:
                     r = self.session.post(f"{self.base_url}{ep}", headers=form_headers, data=payload_form, timeout=15)
                     if r.status_code in (200, 201):
@@ -3737,6 +3965,7 @@ class TxUiAPI(BasePanelAPI):
                             robj = {}
                         for c2 in (robj.get('clients') or []):
                             if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == updated['expiryTime'] and int(c2.get('totalGB', 0) or 0) == updated['totalGB']:
+                                variants.worked(ep)
                                 return updated, "Success"
                     r = self.session.post(f"{self.base_url}{ep}", headers=json_headers, json=payload_json, timeout=15)
                     if r.status_code in (200, 201):
@@ -3747,6 +3976,7 @@ class TxUiAPI(BasePanelAPI):
                             robj = {}
                         for c2 in (robj.get('clients') or []):
                             if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == updated['expiryTime'] and int(c2.get('totalGB', 0) or 0) == updated['totalGB']:
+                                variants.worked(ep)
                                 return updated, "Success"
                     # Also try clients array
                     r = self.session.post(f"{self.base_url}{ep}", headers=json_headers, json={"id": int(inbound_id), "clients": [updated]}, timeout=15)
@@ -3758,6 +3988,7 @@ class TxUiAPI(BasePanelAPI):
                             robj = {}
                         for c2 in (robj.get('clients') or []):
                             if c2.get('email') == username and int(c2.get('expiryTime', 0) or 0) == updated['expiryTime'] and int(c2.get('totalGB', 0) or 0) == updated['totalGB']:
+                                variants.worked(ep)
                                 return updated, "Success"
                     last_err = f"HTTP {r.status_code}: {(r.text or '')[:160]}"
                 except requests.RequestException as e:
@@ -3841,7 +4072,7 @@ class MarzneshinAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = self._open_session()
         self._json_headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
         self._last_token_error = None
         
@@ -4159,7 +4390,7 @@ class MarzneshinAPI(BasePanelAPI):
             logger.error(f"Marzneshin create_user_on_inbound error: {e}")
             return None, None, str(e)
 
-    async def create_user(self, user_id, plan, desired_username: str | None = None):
+    def _create_user(self, user_id, plan, desired_username: str | None = None):
         """Create a user via Marzneshin API and return subscription link only.
 
         Returns: (username, subscription_url, message)
@@ -4194,7 +4425,7 @@ class MarzneshinAPI(BasePanelAPI):
             if ru.status_code not in (200, 201):
                 return None, None, f"HTTP {ru.status_code} @ /api/users: {(ru.text or '')[:200]}"
             # Fetch user info to get subscription_url
-            user_info, _ = await self.get_user(new_username)
+            user_info, _ = self._get_user(new_username)
             sub_link = None
             if isinstance(user_info, dict):
                 sub_link = user_info.get('subscription_url') or user_info.get('subscription') or None
@@ -4205,7 +4436,7 @@ class MarzneshinAPI(BasePanelAPI):
         except requests.RequestException as e:
             return None, None, str(e)
 
-    async def get_user(self, username):
+    def _get_user(self, username):
         # Marzneshin: use /api/users/{username} for core info and /sub/{username}/{key}/info|usage for stats
         # 1) Ensure token and get user
         if not self.token and not self._ensure_token():
@@ -4310,7 +4541,7 @@ class MarzneshinAPI(BasePanelAPI):
             'subscription_url': sub_url or '',
         }, "Success"
 
-    async def renew_user_in_panel(self, username, plan):
+    def _renew_user_in_panel(self, username, plan):
         # Marzneshin renewal via PUT /api/users/{username}: add days and bytes
         if not self.token and not self._ensure_token():
             detail = (self._last_token_error or "نامشخص")
@@ -4375,7 +4606,7 @@ class MarzneshinAPI(BasePanelAPI):
         except requests.RequestException as e:
             return None, str(e)
 
-    async def create_user(self, user_id, plan):
+    def _create_user(self, user_id, plan):
         # Ensure token
         if not self.token and not self._ensure_token():
             detail = (self._last_token_error or "نامشخص")
@@ -4557,6 +4788,7 @@ class MarzneshinAPI(BasePanelAPI):
         except requests.RequestException as e:
             return None, None, str(e)
 
+    @_changes_user(0)
     def rotate_user_key(self, username: str) -> bool:
         # Iterate inbounds, find client by email and rotate its credentials
         inbounds, msg = self.list_inbounds()
@@ -4755,6 +4987,7 @@ class MarzneshinAPI(BasePanelAPI):
         except Exception:
             return []
 
+    @_changes_user(1)
     def rotate_user_key_on_inbound(self, inbound_id: int, username: str):
         # Ensure we are logged in before attempting update
         try:
@@ -4892,6 +5125,12 @@ def VpnPanelAPI(panel_id: int) -> BasePanelAPI:
     panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
     if not panel_row:
         raise ValueError(f"Panel with ID {panel_id} not found in database.")
+    return panel_api_for_row(panel_row)
+
+
+def panel_api_for_row(panel_row: dict) -> BasePanelAPI:
+    """The (cached) API instance for a panels row the caller already read; no database access."""
+    panel_id = panel_row['id']
     ptype = (panel_row.get('panel_type') or 'marzban').lower()
     # Cache key sensitive to panel type, id, url and username; if changed, new instance
     key = (ptype, int(panel_row['id']), (panel_row.get('url') or '').strip(), (panel_row.get('username') or '').strip())
@@ -0,0 +1,157 @@
+"""
+Per-panel snapshots of the panel users.
+
+The services list, the service details screen and the traffic/expiry jobs all
+need the usage, limit, expiry and subscription link of panel users. They read
+them from here instead of asking the panel every time: a panel that can list
+its users (lists_users) keeps one username -> record map, refreshed in the
+background every PANEL_SNAPSHOT_SECONDS; panels that can only be asked about
+one user at a time cache each record the first time it is needed.
+
+Reads are stale-while-revalidate: an old record is returned at once and a
+refresh starts in the background. Only a panel or user never seen before is
+waited for, and concurrent readers share that one fetch. Panel methods that
+change a user (renew, reset, delete, key rotation) invalidate it on their way
+out, so the next read fetches it again; a bulk refresh that was already running
+does not bring the old record back.
+"""
+
+import asyncio
+import time
+
+from .config import PANEL_SNAPSHOT_SECONDS, logger
+from .db import query_db, run_db
+from .panel import VpnPanelAPI, panel_api_for_row
+
+
+class _Snapshot:
+    def __init__(self, lists_users: bool):
+        self.lists_users = lists_users
+        self.users = {}          # username -> record
+        self.fetched_at = None   # last full listing (lists_users panels)
+        self.user_at = {}        # username -> when fetched on its own
+        self.changed = {}        # username -> when last invalidated
+
+
+_snapshots: dict[int, _Snapshot] = {}
+# Fetches in flight, keyed (panel_id, username or None), shared by concurrent readers
+_fetches: dict[tuple, asyncio.Task] = {}
+
+
+def _username(record: dict):
+    return record.get('username') or record.get('email')
+
+
+def _stale(ts) -> bool:
+    return ts is None or time.monotonic() - ts > PANEL_SNAPSHOT_SECONDS
+
+
+async def _api(panel_id: int):
+    # VpnPanelAPI reads the panel row; do that on a DB thread
+    return await run_db(VpnPanelAPI, panel_id)
+
+
+def _snapshot(panel_id: int, api) -> _Snapshot:
+    snap = _snapshots.get(panel_id)
+    if snap is None:
+        snap = _snapshots[panel_id] = _Snapshot(bool(getattr(api, 'lists_users', False)))
+    return snap
+
+
+async def _fetch_all(panel_id: int):
+    api = await _api(panel_id)
+    snap = _snapshot(panel_id, api)
+    started = time.monotonic()
+    users, msg = await api.get_all_users()
+    if not isinstance(users, list):
+        logger.warning(f"Panel {panel_id} user snapshot not refreshed: {msg}")
+        return
+    fresh = {}
+    for record in users:
+        name = _username(record)
+        # Changed while the listing was in flight: leave it to a single-user fetch
+        if name and snap.changed.get(name, 0) < started:
+            fresh[name] = record
+    snap.users = fresh
+    snap.user_at = {}
+    snap.changed = {name: ts for name, ts in snap.changed.items() if ts >= started}
+    snap.fetched_at = time.monotonic()
+
+
+async def _fetch_one(panel_id: int, username: str):
+    api = await _api(panel_id)
+    snap = _snapshot(panel_id, api)
+    started = time.monotonic()
+    info, msg = await api.get_user(username)
+    if isinstance(info, dict) and snap.changed.get(username, 0) < started:
+        snap.users[username] = info
+        snap.user_at[username] = time.monotonic()
+    return info, msg
+
+
+def _start(panel_id: int, username: str | None) -> asyncio.Task:
+    key = (panel_id, username)
+    task = _fetches.get(key)
+    if task is None or task.done():
+        coro = _fetch_one(panel_id, username) if username else _fetch_all(panel_id)
+        task = _fetches[key] = asyncio.create_task(coro)
+        task.add_done_callback(lambda t: _fetches.pop(key, None) if _fetches.get(key) is t else None)
+    return task
+
+
+async def _current(panel_id: int) -> _Snapshot:
+    snap = _snapshots.get(panel_id) or _snapshot(panel_id, await _api(panel_id))
+    if snap.lists_users and _stale(snap.fetched_at):
+        task = _start(panel_id, None)
+        if snap.fetched_at is None:
+            # Nothing to serve yet; shield so a caller's timeout leaves the fetch running for the next one
+            await asyncio.shield(task)
+    return snap
+
+
+async def panel_users(panel_id: int) -> dict:
+    """username -> record of one panel (a copy); for panels that cannot list users, the records cached so far."""
+    return dict((await _current(panel_id)).users)
+
+
+async def panel_user(panel_id: int, username: str):
+    """(record, message) like get_user, served from the snapshot when it has the user."""
+    snap = await _current(panel_id)
+    record = snap.users.get(username)
+    if record is None:
+        return await asyncio.shield(_start(panel_id, username))
+    if not snap.lists_users and _stale(snap.user_at.get(username)):
+        _start(panel_id, username)
+    return record, "Success"
+
+
+def invalidate(panel_id: int, username: str | None = None):
+    """Forget one user of a panel (or the whole panel); safe to call from the panel worker threads."""
+    if username is None:
+        _snapshots.pop(panel_id, None)
+        return
+    snap = _snapshots.get(panel_id)
+    if snap is not None:
+        snap.changed[username] = time.monotonic()
+        snap.users.pop(username, None)
+        snap.user_at.pop(username, None)
+
+
+def invalidate_all():
+    """Forget every panel, e.g. after the database (and with it the panel list) was replaced."""
+    _snapshots.clear()
+
+
+async def refresh_panel_snapshots(context):
+    """Scheduled job: re-list the users of every enabled panel that supports it."""
+    panels = await run_db(query_db, "SELECT * FROM panels WHERE COALESCE(enabled, 1) = 1") or []
+    enabled = {int(p['id']): p for p in panels}
+    for panel_id in list(_snapshots):
+        if panel_id not in enabled:
+            _snapshots.pop(panel_id, None)
+    for panel_id, row in enabled.items():
+        try:
+            if _snapshot(panel_id, panel_api_for_row(row)).lists_users:
+                await _start(panel_id, None)
+        except Exception as e:
+            logger.error(f"Refreshing the user snapshot of panel {panel_id} failed: {e}")
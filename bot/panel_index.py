@@ -0,0 +1,132 @@
+"""
+Username -> inbound index for the X-UI family panels (X-UI, 3x-UI, TX-UI).
+
+Those panels keep their clients inside the settings JSON of each inbound, so
+finding one email meant fetching every inbound and decoding its whole client
+list. panel_clients (migration 10) records, per panel, which inbound holds each
+email together with the client uuid and subId; a lookup is one primary-key
+read followed by a single inbound fetch.
+
+The index is filled from one inbound listing (the list endpoints return the
+settings of every inbound), updated by the panel methods that create, renew,
+rotate or delete a client, and repaired on the way: a row pointing at an
+inbound that no longer holds the email is dropped, and an email that is not in
+the index triggers a rebuild, at most once per REBUILD_SECONDS per panel so
+lookups of users that are gone do not re-list the panel every time.
+"""
+
+import json
+import sqlite3
+import time
+from datetime import datetime
+
+from .db import query_db, execute_db, transaction
+
+REBUILD_SECONDS = 60
+
+_rebuilt_at: dict[int, float] = {}
+
+_UPSERT_SQL = (
+    "INSERT INTO panel_clients (panel_id, email, inbound_id, client_uuid, sub_id, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(panel_id, email, inbound_id) DO UPDATE SET client_uuid = excluded.client_uuid, "
+    "sub_id = excluded.sub_id, updated_at = excluded.updated_at"
+)
+
+
+def inbound_clients(inbound) -> list:
+    """The client dicts in an inbound's settings ([] when missing or unreadable)."""
+    if not isinstance(inbound, dict):
+        return []
+    settings = inbound.get('settings')
+    try:
+        settings = json.loads(settings) if isinstance(settings, str) else (settings or {})
+    except Exception:
+        return []
+    clients = settings.get('clients') if isinstance(settings, dict) else None
+    return [c for c in clients if isinstance(c, dict)] if isinstance(clients, list) else []
+
+
+def find_client(inbound, email: str):
+    for c in inbound_clients(inbound):
+        if c.get('email') == email:
+            return c
+    return None
+
+
+def _row(panel_id: int, inbound_id, client: dict, now: str):
+    return (
+        int(panel_id), client.get('email'), int(inbound_id),
+        client.get('id') or client.get('uuid') or client.get('password'), client.get('subId'), now,
+    )
+
+
+def lookup(panel_id: int, email: str) -> list:
+    """Index rows (inbound_id, client_uuid, sub_id) of the inbounds known to hold `email` on a panel."""
+    return query_db(
+        "SELECT inbound_id, client_uuid, sub_id FROM panel_clients WHERE panel_id = ? AND email = ? ORDER BY inbound_id",
+        (int(panel_id), email),
+    ) or []
+
+
+def record_client(panel_id: int, inbound_id, client: dict):
+    if client and client.get('email') and inbound_id is not None:
+        execute_db(_UPSERT_SQL, _row(panel_id, inbound_id, client, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def forget(panel_id: int, email: str, inbound_id=None):
+    if inbound_id is None:
+        execute_db("DELETE FROM panel_clients WHERE panel_id = ? AND email = ?", (int(panel_id), email))
+    else:
+        execute_db(
+            "DELETE FROM panel_clients WHERE panel_id = ? AND email = ? AND inbound_id = ?",
+            (int(panel_id), email, int(inbound_id)),
+        )
+
+
+def index_client(panel_id: int, inbound_id, inbound, email: str):
+    """Bring the rows of one email on one inbound in line with a freshly fetched inbound."""
+    if not isinstance(inbound, dict):
+        return
+    client = find_client(inbound, email)
+    if client is None:
+        forget(panel_id, email, inbound_id)
+    else:
+        record_client(panel_id, inbound_id, client)
+
+
+def check_row(panel_id: int, email: str, row: dict, inbound):
+    """Compare an index row with its freshly fetched inbound: the client, or None (row dropped) when it is gone."""
+    client = find_client(inbound, email)
+    if client is None:
+        forget(panel_id, email, row['inbound_id'])
+    elif _row(panel_id, row['inbound_id'], client, '')[3:5] != (row['client_uuid'], row['sub_id']):
+        record_client(panel_id, row['inbound_id'], client)
+    return client
+
+
+def index_panel(panel_id: int, inbounds) -> int:
+    """Replace a panel's rows with the clients of `inbounds` (full inbound dicts); returns the rows written."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [
+        _row(panel_id, ib['id'], c, now)
+        for ib in inbounds if ib.get('id') is not None
+        for c in inbound_clients(ib) if c.get('email')
+    ]
+    try:
+        with transaction() as tx:
+            tx.execute("DELETE FROM panel_clients WHERE panel_id = ?", (int(panel_id),))
+            tx.conn.executemany(_UPSERT_SQL, rows)
+    except sqlite3.Error:
+        return 0
+    _rebuilt_at[int(panel_id)] = time.monotonic()
+    return len(rows)
+
+
+def reset():
+    """Forget when each panel was indexed (the rows themselves live in the database)."""
+    _rebuilt_at.clear()
+
+
+def rebuild_due(panel_id: int) -> bool:
+    last = _rebuilt_at.get(int(panel_id))
+    return last is None or time.monotonic() - last > REBUILD_SECONDS
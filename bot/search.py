@@ -0,0 +1,110 @@
+"""
+Admin search over users, orders, tickets and ticket messages.
+
+search_index is an FTS5 table (trigram tokenizer, so any 3+ character
+substring matches, Persian names and service usernames included) created by
+migration 7 and kept in sync by triggers on the source tables. Each source row
+has a fixed rowid in the index, id * 4 + kind code, so the triggers update or
+drop exactly one index row. Results are ranked by bm25 and paged with
+LIMIT/OFFSET; a search only ever reads the index, never the source tables.
+
+SQLite builds without the trigram tokenizer (before 3.34) get a unicode61
+index with prefix matching instead. Rows moved to the archive tables leave the
+index with them.
+"""
+
+import re
+
+from .db import query_db, query_scalar
+
+# kind -> rowid code; the rowid of a source row is id * 4 + code
+KINDS = {'user': 0, 'order': 1, 'ticket': 2, 'ticket_message': 3}
+
+# What each kind contributes: (source table, key column, ref, user_id, title, body);
+# ref is the id an admin screen opens (a ticket message opens its ticket). The triggers
+# keep migration 7's frozen copy of this layout; changing it needs a new migration
+_SOURCES = {
+    'user': ('users', 'user_id', "{r}.user_id", "{r}.user_id",
+             "{r}.user_id || ' ' || COALESCE({r}.first_name, '')", "''"),
+    'order': ('orders', 'id', "{r}.id", "{r}.user_id",
+              "'#' || {r}.id || ' ' || COALESCE({r}.marzban_username, '') || ' ' || COALESCE({r}.desired_username, '')", "''"),
+    'ticket': ('tickets', 'id', "{r}.id", "{r}.user_id", "'#' || {r}.id", "COALESCE({r}.text, '')"),
+    'ticket_message': ('ticket_messages', 'id', "{r}.ticket_id", "NULL", "'#' || {r}.ticket_id", "COALESCE({r}.text, '')"),
+}
+
+# Columns whose change has to be reflected in the index
+WATCHED = {
+    'user': 'first_name',
+    'order': 'marzban_username, desired_username, user_id',
+    'ticket': 'text, user_id',
+    'ticket_message': 'text, ticket_id',
+}
+
+_MIN_TERM = 3
+
+
+def index_row_sql(kind: str, r: str) -> str:
+    """INSERT of the index row for the source row `r` ('NEW' in triggers, a table alias in rebuilds)."""
+    table, key, ref, user_id, title, body = _SOURCES[kind]
+    cols = [f"{r}.{key} * 4 + {KINDS[kind]}", f"'{kind}'"] + [c.format(r=r) for c in (ref, user_id, title, body)]
+    return f"INSERT INTO search_index (rowid, kind, ref, user_id, title, body) SELECT {', '.join(cols)}"
+
+
+def unindex_row_sql(kind: str, r: str) -> str:
+    key = _SOURCES[kind][1]
+    return f"DELETE FROM search_index WHERE rowid = {r}.{key} * 4 + {KINDS[kind]}"
+
+
+def rebuild_search_index(tx):
+    """Re-fill search_index from the source tables (manual repair)."""
+    tx.execute("DELETE FROM search_index")
+    for kind, (table, *_rest) in _SOURCES.items():
+        tx.execute(f"{index_row_sql(kind, 's')} FROM {table} s")
+
+
+_tokenizer = None
+
+
+def _trigram() -> bool:
+    global _tokenizer
+    if _tokenizer is None:
+        sql = query_scalar("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'search_index'", default='') or ''
+        _tokenizer = 'trigram' if 'trigram' in sql else 'unicode61'
+    return _tokenizer == 'trigram'
+
+
+def match_expression(text: str) -> str | None:
+    """FTS5 query for `text`: every word must occur. None when no word is long enough to look up."""
+    words = [w for w in re.split(r'\s+', (text or '').strip()) if w]
+    trigram = _trigram()
+    terms = []
+    for w in words:
+        if trigram and len(w) < _MIN_TERM:
+            continue
+        quoted = '"' + w.replace('"', '""') + '"'
+        terms.append(quoted if trigram else quoted + '*')
+    return ' '.join(terms) or None
+
+
+def search(text: str, kinds=None, limit: int = 10, offset: int = 0) -> list:
+    """Ranked hits as dicts (kind, ref, user_id, title, snippet); fetch limit + 1 to know whether a next page exists."""
+    kinds = [k for k in (kinds or KINDS) if k in KINDS]
+    marks = ', '.join('?' * len(kinds))
+    cols = "kind, ref, user_id, title, snippet(search_index, 4, '', '', '…', 40) AS snippet"
+    expr = match_expression(text)
+    if expr:
+        return query_db(
+            f"SELECT {cols} FROM search_index WHERE search_index MATCH ? AND kind IN ({marks}) "
+            "ORDER BY rank LIMIT ? OFFSET ?",
+            (expr, *kinds, limit, offset),
+        ) or []
+    # Words too short for the trigram index: plain substring match over the index itself
+    term = (text or '').strip()
+    if not term:
+        return []
+    like = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return query_db(
+        f"SELECT {cols} FROM search_index WHERE (title LIKE ? ESCAPE '\\' OR body LIKE ? ESCAPE '\\') AND kind IN ({marks}) "
+        "ORDER BY rowid DESC LIMIT ? OFFSET ?",
+        (like, like, *kinds, limit, offset),
+    ) or []
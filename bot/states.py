@@ -55,5 +55,6 @@
     ADMIN_USERS_MENU, ADMIN_USERS_AWAIT_SEARCH,
     # Cron Settings
     ADMIN_CRON_MENU, ADMIN_CRON_AWAIT_HOUR,
-    __RESERVED_UNUSED_STATE1, __RESERVED_UNUSED_STATE2,
+    # Admin search
+    ADMIN_SEARCH_AWAIT_QUERY, __RESERVED_UNUSED_STATE2,
 ) = range(89)
\ No newline at end of file
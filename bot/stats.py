@@ -0,0 +1,124 @@
+"""
+Dashboard counters and daily revenue rollups.
+
+stats_counters holds live row counts (users, free_trials, orders, orders per
+status as 'orders:<status>', distinct buyers) and daily_revenue holds, per local
+day, the approved-order revenue/count and the approved wallet credits. Both are
+kept current by the triggers created in migrations 6 and 13, so every order or
+wallet write updates them in the same transaction, whichever code path made it.
+The dashboards read a handful of primary-key rows instead of aggregating the raw
+tables.
+
+Revenue is history: archiving old rows does not take it out of daily_revenue,
+and an order's amount is fixed at approval. It is stored in
+orders.charged_amount and the triggers add and later remove exactly that
+amount, so plan price edits never rewrite past days. check_stats() compares
+everything against the raw tables and rebuild_stats() recomputes it; `python rebuild_stats.py [--check]` runs
+them from the shell.
+"""
+
+from datetime import datetime, timedelta
+
+from .config import logger
+from .db import query_map, query_db, transaction, read_snapshot
+
+# Expected values, computed from the raw tables
+_COUNTERS_SQL = """
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'free_trials', COUNT(*) FROM free_trials
+    UNION ALL SELECT 'orders', COUNT(*) FROM orders
+    UNION ALL SELECT 'orders:' || COALESCE(status, ''), COUNT(*) FROM orders GROUP BY status
+    UNION ALL SELECT 'buyers', COUNT(DISTINCT user_id) FROM orders WHERE status = 'approved'
+"""
+
+_BUYERS_SQL = "SELECT user_id, COUNT(*) FROM orders WHERE status = 'approved' GROUP BY user_id"
+
+# The amount charged at approval; the triggers price orders that lack one (final_price, else the
+# plan price, 0 when the plan is gone) the same way
+_REVENUE_SQL = """
+    SELECT day, SUM(order_total), SUM(order_count), SUM(wallet_total) FROM (
+        SELECT date(o.timestamp) AS day,
+               COALESCE(o.charged_amount,
+                        (SELECT COALESCE(o.final_price, p.price) FROM plans p WHERE p.id = o.plan_id), 0) AS order_total,
+               1 AS order_count, 0 AS wallet_total
+        FROM orders o WHERE o.status = 'approved' AND date(o.timestamp) IS NOT NULL
+        UNION ALL
+        SELECT date(created_at), 0, 0, amount FROM wallet_transactions
+        WHERE status = 'approved' AND direction = 'credit' AND date(created_at) IS NOT NULL
+        UNION ALL
+        SELECT date(created_at), 0, 0, amount FROM wallet_transactions_archive
+        WHERE status = 'approved' AND direction = 'credit' AND date(created_at) IS NOT NULL
+    ) GROUP BY day
+"""
+
+
+def rebuild_stats(tx=None):
+    """Recompute every counter and rollup from the raw tables."""
+    if tx is None:
+        with transaction() as tx:
+            return rebuild_stats(tx)
+    tx.execute("DELETE FROM stats_counters")
+    tx.execute("DELETE FROM stats_buyers")
+    tx.execute("DELETE FROM daily_revenue")
+    tx.execute(f"INSERT INTO stats_counters (name, value) {_COUNTERS_SQL}")
+    tx.execute(f"INSERT INTO stats_buyers (user_id, approved) {_BUYERS_SQL}")
+    tx.execute(f"INSERT INTO daily_revenue (day, order_total, order_count, wallet_total) {_REVENUE_SQL}")
+    logger.info("Stats counters and daily revenue rebuilt")
+
+
+def check_stats() -> list:
+    """Differences between the rollups and the raw tables as (table, key, stored, expected)."""
+    with read_snapshot() as snap:
+        stored = {r['name']: r['value'] for r in snap.query("SELECT name, value FROM stats_counters")}
+        expected = {r[0]: r[1] for r in snap.conn.execute(_COUNTERS_SQL)}
+        stored_days = {
+            r['day']: (r['order_total'], r['order_count'], r['wallet_total'])
+            for r in snap.query("SELECT day, order_total, order_count, wallet_total FROM daily_revenue")
+        }
+        expected_days = {r[0]: tuple(r[1:]) for r in snap.conn.execute(_REVENUE_SQL)}
+    diffs = []
+    for name in sorted(set(stored) | set(expected)):
+        if (stored.get(name) or 0) != (expected.get(name) or 0):
+            diffs.append(('stats_counters', name, stored.get(name, 0), expected.get(name, 0)))
+    for day in sorted(set(stored_days) | set(expected_days)):
+        have, want = stored_days.get(day, (0, 0, 0)), expected_days.get(day, (0, 0, 0))
+        if have != want:
+            diffs.append(('daily_revenue', day, have, want))
+    return diffs
+
+
+def counters(*names, fetch=None) -> dict:
+    """{name: value} for the given counters, 0 for any that are missing.
+
+    `fetch` is a query_db-like callable; reports pass Snapshot.query to read on the reporting connection.
+    """
+    marks = ', '.join('?' * len(names))
+    sql = f"SELECT name, value FROM stats_counters WHERE name IN ({marks})"
+    if fetch is None:
+        values = query_map(sql, names)
+    else:
+        values = {r['name']: r['value'] for r in fetch(sql, names) or []}
+    return {name: int(values.get(name) or 0) for name in names}
+
+
+def revenue(since: str, until: str = None, fetch=query_db) -> dict:
+    """Sums over daily_revenue for local days since..until (inclusive, 'YYYY-MM-DD')."""
+    row = fetch(
+        "SELECT COALESCE(SUM(order_total), 0) AS order_total, COALESCE(SUM(order_count), 0) AS order_count, "
+        "COALESCE(SUM(wallet_total), 0) AS wallet_total FROM daily_revenue WHERE day BETWEEN ? AND ?",
+        (since, until or since),
+        one=True,
+    ) or {}
+    return {k: int(row.get(k) or 0) for k in ('order_total', 'order_count', 'wallet_total')}
+
+
+def today() -> str:
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+def days_ago(n: int) -> str:
+    return (datetime.now() - timedelta(days=n)).strftime('%Y-%m-%d')
+
+
+def month_start() -> str:
+    return datetime.now().strftime('%Y-%m-01')
@@ -1,14 +1,39 @@
 from datetime import datetime
 from telegram import User, Update
-from .db import query_db, execute_db
+from .db import aquery_db, aexecute_db, run_db, transaction
+from .cache import get_settings
 from .config import logger
 from telegram.constants import ParseMode
 
 
+def _insert_new_user(user_id: int, first_name, referrer_id, amount: int, now_str: str) -> bool:
+	"""User row, referral and signup bonus in one transaction; False when the user already existed."""
+	with transaction() as tx:
+		tx.execute(
+			"INSERT OR IGNORE INTO users (user_id, first_name, join_date, referrer_id) VALUES (?, ?, ?, ?)",
+			(user_id, first_name, now_str, referrer_id),
+		)
+		# A concurrent update already registered this user: no second referral or bonus
+		if tx.rowcount != 1:
+			return False
+		if referrer_id and referrer_id != user_id:
+			tx.execute(
+				"INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at) VALUES (?, ?, ?)",
+				(referrer_id, user_id, now_str),
+			)
+		if amount > 0:
+			tx_id = tx.execute(
+				"INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at, reference, meta) VALUES (?, ?, 'credit', 'bonus', 'approved', ?, ?, ?)",
+				(user_id, amount, now_str, 'signup_bonus', None)
+			)
+			tx.credit_wallet(user_id, amount, 'bonus', f"wallet_tx:{tx_id}")
+	return True
+
+
 async def register_new_user(user: User, update: Update = None, referrer_hint: int | None = None):
 	if not user:
 		return
-	existing = query_db("SELECT referrer_id FROM users WHERE user_id = ?", (user.id,), one=True)
+	existing = await aquery_db("SELECT referrer_id FROM users WHERE user_id = ?", (user.id,), one=True)
 	if not existing:
 		referrer_id = None
 		if referrer_hint is not None:
@@ -21,47 +46,38 @@ async def register_new_user(user: User, update: Update = None, referrer_hint: in
 					referrer_id = int(parts[1])
 				except Exception:
 					referrer_id = None
-		execute_db(
-			"INSERT INTO users (user_id, first_name, join_date, referrer_id) VALUES (?, ?, ?, ?)",
-			(user.id, user.first_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), referrer_id),
-		)
-		if referrer_id and referrer_id != user.id:
-			execute_db(
-				"INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at) VALUES (?, ?, ?)",
-				(referrer_id, user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-			)
-		logger.info(f"Registered new user {user.id} ({user.first_name}), ref={referrer_id}")
-		# Signup bonus: credit wallet once for first-time users
-		settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+		# Signup bonus settings are read up front so the user row, referral and bonus commit together
+		settings = get_settings()
+		amount = 0
 		if settings.get('signup_bonus_enabled', '0') == '1':
 			try:
 				amount = int((settings.get('signup_bonus_amount') or '0') or 0)
 			except Exception:
 				amount = 0
-			if amount > 0:
-				# ensure wallet row
-				execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user.id,))
-				# credit
-				execute_db("UPDATE user_wallets SET balance = COALESCE(balance,0) + ? WHERE user_id = ?", (amount, user.id))
-				execute_db(
-					"INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at, reference, meta) VALUES (?, ?, 'credit', 'bonus', 'approved', ?, ?, ?)",
-					(user.id, amount, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'signup_bonus', None)
-				)
-				# notify user
-				if update and update.effective_chat:
-					try:
-						await update.effective_chat.send_message(
-							f"\u2728 هدیه خوش‌آمدگویی: `{amount:,}` تومان به کیف پول شما افزوده شد.",
-							parse_mode=ParseMode.MARKDOWN,
-						)
-					except Exception:
-						pass
+		now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+		try:
+			if not await run_db(_insert_new_user, user.id, user.first_name, referrer_id, amount, now_str):
+				return
+		except Exception as e:
+			logger.error(f"Registering user {user.id} failed: {e}")
+			return
+		logger.info(f"Registered new user {user.id} ({user.first_name}), ref={referrer_id}")
+		if amount > 0:
+			# notify user
+			if update and update.effective_chat:
+				try:
+					await update.effective_chat.send_message(
+						f"\u2728 هدیه خوش‌آمدگویی: `{amount:,}` تومان به کیف پول شما افزوده شد.",
+						parse_mode=ParseMode.MARKDOWN,
+					)
+				except Exception:
+					pass
 	else:
 		# Backfill referrer if missing and hint exists
 		current_ref = existing.get('referrer_id')
 		if (current_ref is None or current_ref == '' ) and referrer_hint and referrer_hint != user.id:
-			execute_db("UPDATE users SET referrer_id = ? WHERE user_id = ?", (referrer_hint, user.id))
-			execute_db(
+			await aexecute_db("UPDATE users SET referrer_id = ? WHERE user_id = ?", (referrer_hint, user.id))
+			await aexecute_db(
 				"INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at) VALUES (?, ?, ?)",
 				(referrer_hint, user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
 			)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Check or rebuild the dashboard counters and daily revenue rollups.
+
+    python rebuild_stats.py --check    # list differences against the raw tables, exit 1 if any
+    python rebuild_stats.py            # recompute everything from the raw tables
+
+The rollups are kept current by triggers, so this is only needed after editing
+the database by hand. Safe to run while the bot is up: the rebuild is a single
+transaction.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bot.migrations import migrate  # noqa: E402
+from bot.stats import check_stats, rebuild_stats  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check or rebuild stats_counters and daily_revenue")
+    parser.add_argument('--check', action='store_true', help="only compare against the raw tables")
+    args = parser.parse_args()
+
+    migrate()
+    if not args.check:
+        rebuild_stats()
+    diffs = check_stats()
+    for table, key, stored, expected in diffs:
+        print(f"{table} {key}: stored {stored}, expected {expected}")
+    if diffs:
+        print(f"❌ {len(diffs)} differences")
+        sys.exit(1)
+    print("✅ Rollups match the raw tables" + ("" if args.check else " (rebuilt)"))
+
+
+if __name__ == '__main__':
+    main()
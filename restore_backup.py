@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Rebuild a database from auto-backup archives (a base plus its deltas) without the bot.
+
+    python restore_backup.py wingsbot_20250101090000_base.zip wingsbot_20250101090000_diff003.zip -o restored.db
+
+Give the base archive and any deltas of the same chain, in any order: for a
+differential chain the newest delta is enough, for an incremental chain every
+delta up to the point to restore is needed. The result is verified against the
+checksum recorded at backup time. Stop the bot and copy the file over bot.db
+(or send the archives to the bot's restore menu instead).
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bot.backup import read_manifest, restore_chain  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild a database from base + delta backup archives")
+    parser.add_argument('archives', nargs='+', help="base and delta .zip archives")
+    parser.add_argument('-o', '--output', default='restored.db', help="database file to write (default: restored.db)")
+    args = parser.parse_args()
+
+    archives = []
+    for path in args.archives:
+        manifest = read_manifest(path)
+        if manifest is None:
+            print(f"❌ Not a base/delta backup archive: {path}")
+            sys.exit(1)
+        print(f"📦 {os.path.basename(path)}: {manifest['kind']} #{manifest['seq']} of {manifest['base_id']} ({manifest['created_at']})")
+        archives.append((path, manifest))
+
+    if os.path.exists(args.output):
+        print(f"❌ {args.output} already exists")
+        sys.exit(1)
+    try:
+        target = restore_chain(archives, args.output)
+    except Exception as e:
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        print(f"❌ Restore failed: {e}")
+        sys.exit(1)
+    print(f"✅ Restored {target['base_id']}#{target['seq']} ({target['created_at']}) to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Query-plan regression check for the SQL embedded in the bot.
+
+Collects every SQL string literal under bot/, runs EXPLAIN QUERY PLAN for each one
+against a throw-away database built by the migrations and seeded with enough rows
+for the planner to behave like production, and fails when a statement does a full
+SCAN of a large table that is not listed in ALLOWED_SCANS, or when a statement does
+not prepare and is not listed in UNPLANNED_SQL. f-string holes that stand for
+identifiers or SQL fragments are expanded from TEMPLATE_VALUES; the others are
+parameters and become '?'.
+
+    python test_query_plans.py        # report; exit 1 on unapproved scans or unplanned statements
+    python test_query_plans.py -v     # also list every statement and its plan
+    python -m pytest test_query_plans.py
+"""
+import ast
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+_tmpdir = tempfile.mkdtemp()
+os.environ["DB_NAME"] = os.path.join(_tmpdir, "plans.db")
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from bot import db  # noqa: E402
+from bot.migrations import migrate  # noqa: E402
+from bot.pagination import Keyset  # noqa: E402
+
+# Another test module may have imported bot.config first; use the scratch DB regardless
+db.DB_NAME = os.environ["DB_NAME"]
+
+# Tables that grow with users/orders; a SCAN over any of these is a regression
+LARGE_TABLES = {
+    'users', 'orders', 'referrals', 'wallet_transactions', 'tickets',
+    'ticket_messages', 'admin_audit', 'free_trials', 'reseller_requests',
+    'orders_archive', 'wallet_transactions_archive', 'ticket_messages_archive',
+    'wallet_ledger', 'panel_clients',
+}
+
+# Full scans that are intended: (file, substring of the SQL, reason)
+ALLOWED_SCANS = [
+    ('bot/handlers/admin.py', 'FROM users WHERE user_id != ?', "broadcast recipients"),
+    ('bot/handlers/admin.py', 'SELECT DISTINCT user_id FROM orders WHERE status', "broadcast recipients"),
+    ('bot/handlers/admin.py', 'FROM users ORDER BY user_id', "CSV export / backup"),
+    ('bot/handlers/admin.py', 'FROM orders ORDER BY', "CSV export / backup"),
+    ('bot/handlers/admin.py', 'SELECT * FROM tickets ORDER BY id', "CSV export / backup"),
+    ('bot/handlers/admin.py', 'SELECT * FROM referrals ORDER BY id', "CSV export / backup"),
+    ('bot/handlers/admin.py', 'SELECT * FROM wallet_transactions ORDER BY id', "CSV export / backup"),
+    ('bot/handlers/admin.py', 'FROM reseller_requests ORDER BY id DESC LIMIT', "newest N by rowid, stops after LIMIT rows"),
+    ('bot/handlers/admin_users.py', 'FROM users', "admin user list/export; terms under 3 characters are a leading-wildcard LIKE"),
+    # Admin-only totals
+    ('bot/handlers/admin.py', 'SELECT COUNT(user_id) as c FROM users', "admin stats"),
+    ('bot/handlers/admin.py', 'SELECT COUNT(user_id) as c FROM free_trials', "admin stats"),
+    ('bot/handlers/admin.py', 'SELECT COUNT(*) as c FROM orders', "admin stats"),
+    ('bot/handlers/admin.py', 'SELECT COUNT(*) AS c FROM users', "admin stats"),
+    ('bot/handlers/admin.py', 'SELECT COUNT(*) AS c FROM orders', "admin stats"),
+    ('bot/handlers/admin_stats_broadcast.py', 'SELECT COUNT(*) AS c FROM users', "admin stats"),
+    ('bot/handlers/admin_system.py', 'SELECT COUNT(*) as c FROM users', "system health"),
+    ('bot/helpers/admin_notifications.py', 'SELECT COUNT(*) as count FROM users', "join log to admins"),
+    ('bot/archive.py', 'SELECT COUNT(*) FROM orders)', "archive totals on the health screen"),
+    # Rollup rebuild/consistency check (bot/stats.py): recomputes from the raw tables by design
+    ('bot/stats.py', "SELECT 'users', COUNT(*) FROM users", "stats rebuild/check"),
+    ('bot/stats.py', "FROM orders WHERE status = 'approved' GROUP BY user_id", "stats rebuild/check"),
+    ('bot/stats.py', "SUM(wallet_total) FROM (", "stats rebuild/check"),
+    # Wallet cache rebuild (bot/ledger.py): reads the last entry of every user on purpose
+    ('bot/ledger.py', "SELECT MAX(id) FROM wallet_ledger GROUP BY user_id", "wallet balance rebuild"),
+    # Archiving job: walks the thread index once per batch, off the request path
+    ('bot/archive.py', 'GROUP BY ticket_id', "archiving job"),
+]
+
+# Values for f-string holes that are identifiers or SQL fragments, per file: a list of
+# {hole source: value} bindings (or a function of the connection returning one), and the
+# statement is planned once per binding. Holes naming a module-level string constant are
+# expanded without an entry here.
+def _archive_bindings(conn):
+    from bot.archive import _COLD_ROWS
+    return [
+        {'table': table, 'key': key, 'cols': ', '.join(r[1] for r in conn.execute(f"PRAGMA table_info({table})"))}
+        for table, (key, _sql) in _COLD_ROWS.items()
+    ]
+
+
+def _ledger_bindings(conn):
+    from bot.ledger import _LAST_ENTRY_SQL
+    return [{'balance': _LAST_ENTRY_SQL.format(col='l.balance_after'), 'entry': _LAST_ENTRY_SQL.format(col='l.id')}]
+
+
+TEMPLATE_VALUES = {
+    'bot/archive.py': _archive_bindings,
+    'bot/ledger.py': _ledger_bindings,
+    'bot/handlers/admin.py': [{'field': 'price', 'type_list_sql': "('xui', '3xui')"}],
+    'bot/handlers/admin_plans.py': [{'field': 'price'}],
+}
+
+# Statements that cannot be planned where they are written: (file, substring of the SQL, reason)
+UNPLANNED_SQL = [
+    ('bot/search.py', 'INSERT INTO search_index (rowid', "row template for triggers and rebuilds; see collect_generated_statements"),
+    ('bot/search.py', 'DELETE FROM search_index WHERE rowid', "trigger body template, compiled by migration 7"),
+]
+
+_SQL_START = re.compile(r"^\s*(SELECT|UPDATE|DELETE|INSERT|REPLACE|WITH)\b", re.IGNORECASE)
+_SCAN = re.compile(r"^SCAN (\w+)")
+
+
+def _seed(users: int = 20000, orders: int = 50000):
+    rnd = random.Random(7)
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, first_name, join_date, referrer_id) VALUES (?, ?, '2025-01-01 00:00:00', ?)",
+            [(i, f"u{i}", rnd.randint(1, users) if i % 5 == 0 else None) for i in range(1, users + 1)],
+        )
+        conn.executemany(
+            "INSERT INTO plans (name, price, duration_days, traffic_gb) VALUES (?, 100000, ?, 50)",
+            [(f"p{d}", d) for d in (30, 60, 90)],
+        )
+        conn.executemany(
+            "INSERT INTO orders (user_id, plan_id, status, marzban_username, timestamp, expires_at, panel_id) "
+            "VALUES (?, ?, ?, ?, '2025-01-01 00:00:00', '2025-02-01 00:00:00', 1)",
+            [
+                (rnd.randint(1, users), rnd.randint(1, 3), rnd.choice(("approved", "pending", "rejected", "deleted")), f"user_{i}")
+                for i in range(orders)
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO referrals (referrer_id, referee_id, created_at) VALUES (?, ?, '2025-01-01 00:00:00')",
+            [(rnd.randint(1, users), i) for i in range(1, users // 4)],
+        )
+        conn.executemany(
+            "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) "
+            "VALUES (?, 1000, 'credit', 'card', ?, '2025-01-01 00:00:00')",
+            [(rnd.randint(1, users), rnd.choice(("pending", "approved", "rejected"))) for _ in range(orders)],
+        )
+        conn.executemany(
+            "INSERT INTO tickets (user_id, text, created_at, status) VALUES (?, 't', '2025-01-01 00:00:00', ?)",
+            [(rnd.randint(1, users), rnd.choice(("pending", "answered", "closed"))) for _ in range(users // 2)],
+        )
+        conn.executemany(
+            "INSERT INTO ticket_messages (ticket_id, sender, text, created_at) VALUES (?, 'user', 'm', '2025-01-01 00:00:00')",
+            [(rnd.randint(1, users // 2),) for _ in range(users)],
+        )
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+def _render(node, constants: dict, binding: dict) -> str:
+    """The text of an f-string, holes expanded from `binding` or module constants, '?' otherwise."""
+    parts = []
+    for v in node.values:
+        if isinstance(v, ast.Constant):
+            parts.append(v.value)
+            continue
+        expr = ast.unparse(v.value)
+        if expr in binding:
+            parts.append(binding[expr])
+        elif isinstance(v.value, ast.Name) and v.value.id in constants:
+            parts.append(constants[v.value.id])
+        else:
+            parts.append('?')
+    return ''.join(parts)
+
+
+def collect_statements(conn=None):
+    """Every SQL string literal in bot/ as (path, line, sql); f-strings are rendered as described above."""
+    found = []
+    for base, _dirs, files in os.walk(os.path.join(ROOT, 'bot')):
+        for name in sorted(files):
+            if not name.endswith('.py'):
+                continue
+            path = os.path.join(base, name)
+            rel = os.path.relpath(path, ROOT).replace(os.sep, '/')
+            if rel == 'bot/migrations.py':
+                # One-off schema steps, not runtime queries
+                continue
+            with open(path, encoding='utf-8') as f:
+                tree = ast.parse(f.read(), filename=rel)
+            skipped = {
+                id(n.value) for n in ast.walk(tree)
+                if isinstance(n, ast.Expr) and isinstance(n.value, ast.Constant)
+            }
+            # The literal pieces of an f-string are not statements of their own
+            skipped |= {id(v) for n in ast.walk(tree) if isinstance(n, ast.JoinedStr) for v in n.values}
+            constants = {
+                n.targets[0].id: n.value.value for n in tree.body
+                if isinstance(n, ast.Assign) and isinstance(n.targets[0], ast.Name)
+                and isinstance(n.value, ast.Constant) and isinstance(n.value.value, str)
+            }
+            bindings = TEMPLATE_VALUES.get(rel, [{}])
+            if callable(bindings):
+                bindings = bindings(conn or db.get_connection())
+            # Keyset select fragments are checked as whole page queries by collect_keyset_statements()
+            skipped |= {
+                id(a) for n in ast.walk(tree)
+                if isinstance(n, ast.Call) and getattr(n.func, 'id', None) == 'Keyset'
+                for a in n.args
+            }
+            for node in ast.walk(tree):
+                if id(node) in skipped:
+                    continue
+                if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                    sqls = [node.value]
+                elif isinstance(node, ast.JoinedStr):
+                    sqls = list(dict.fromkeys(_render(node, constants, b) for b in bindings))
+                else:
+                    continue
+                for sql in sqls:
+                    if _SQL_START.match(sql) and re.search(r"\b(FROM|INTO|SET|VALUES)\b", sql, re.IGNORECASE):
+                        found.append((rel, node.lineno, sql))
+    return found
+
+
+def collect_generated_statements():
+    """Statements the bot assembles from SQL builders rather than writes out: the search index rebuild."""
+    from bot import search
+    line = search.rebuild_search_index.__code__.co_firstlineno
+    return [
+        ('bot/search.py', line, f"{search.index_row_sql(kind, 's')} FROM {table} s")
+        for kind, (table, *_rest) in search._SOURCES.items()
+    ]
+
+
+def _module_value(node, constants: dict):
+    if isinstance(node, ast.Name):
+        return constants[node.id]
+    return ast.literal_eval(node)
+
+
+def collect_keyset_statements():
+    """
+    The SQL of every keyset-paginated list: `NAME = Keyset(...)` definitions combined with the
+    WHERE of each `NAME.page(...)` call, first page and cursor page. The Keyset select literals
+    themselves are fragments, so collect_statements() skips them.
+    """
+    found = []
+    for base, _dirs, files in os.walk(os.path.join(ROOT, 'bot')):
+        for name in sorted(files):
+            if not name.endswith('.py'):
+                continue
+            path = os.path.join(base, name)
+            rel = os.path.relpath(path, ROOT).replace(os.sep, '/')
+            with open(path, encoding='utf-8') as f:
+                tree = ast.parse(f.read(), filename=rel)
+            constants, lists = {}, {}
+            for node in tree.body:
+                if not (isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name)):
+                    continue
+                target, value = node.targets[0].id, node.value
+                if isinstance(value, ast.Constant) and isinstance(value.value, str):
+                    constants[target] = value.value
+                elif isinstance(value, ast.Call) and getattr(value.func, 'id', None) == 'Keyset':
+                    args = [_module_value(a, constants) for a in value.args]
+                    kwargs = {k.arg: _module_value(k.value, constants) for k in value.keywords}
+                    lists[target] = Keyset(*args, **kwargs)
+            for node in ast.walk(tree):
+                if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'page'):
+                    continue
+                keyset = lists.get(getattr(node.func.value, 'id', None))
+                if keyset is None:
+                    continue
+                where = node.args[0] if node.args else next((k.value for k in node.keywords if k.arg == 'where'), None)
+                where = where.value if isinstance(where, ast.Constant) else ''
+                sqls = []
+                # An empty result with a cursor makes page() start over, so this records both shapes
+                keyset.page(where, (None,) * where.count('?'), cursor='n1', fetch=lambda sql, args: sqls.append(sql) or [])
+                found.extend((rel, node.lineno, sql) for sql in sqls)
+    return found
+
+
+def explain(conn: sqlite3.Connection, sql: str):
+    """Plan details for `sql`, binding NULL to every parameter."""
+    params = sql.count('?')
+    last = None
+    for n in (params, *range(params)):
+        try:
+            return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, (None,) * n)]
+        except sqlite3.ProgrammingError as e:
+            last = e
+    raise last
+
+
+def _allowed(rel: str, sql: str, listed=ALLOWED_SCANS) -> bool:
+    return any(rel == path and needle in sql for path, needle, _reason in listed)
+
+
+def check_plans(verbose: bool = False):
+    """Returns (violations, errors); each item is (path, line, sql, detail)."""
+    conn = db.get_connection()
+    violations, errors = [], []
+    statements = collect_statements(conn) + collect_keyset_statements() + collect_generated_statements()
+    unplanned = 0
+    for rel, line, sql in statements:
+        try:
+            plan = explain(conn, sql)
+        except sqlite3.Error as e:
+            if _allowed(rel, sql, UNPLANNED_SQL):
+                unplanned += 1
+            else:
+                errors.append((rel, line, sql, str(e)))
+            continue
+        if verbose:
+            print(f"{rel}:{line}: {' '.join(sql.split())[:100]}\n    " + "\n    ".join(plan))
+        scans = [d for d in plan if (m := _SCAN.match(d)) and m.group(1) in LARGE_TABLES]
+        if scans and not _allowed(rel, sql):
+            violations.append((rel, line, sql, "; ".join(scans)))
+    print(
+        f"{len(statements)} statements checked, {len(violations)} unapproved scans, "
+        f"{len(errors)} could not be planned, {unplanned} listed as unplannable"
+    )
+    return violations, errors
+
+
+def _report(items, title):
+    if items:
+        print(f"\n{title}:")
+    for rel, line, sql, detail in items:
+        print(f"  {rel}:{line}: {detail}\n      {' '.join(sql.split())[:140]}")
+
+
+_ready = False
+
+
+def _setup():
+    global _ready
+    if not _ready:
+        migrate()
+        _seed()
+        _ready = True
+
+
+def test_query_plans():
+    _setup()
+    violations, errors = check_plans()
+    _report(errors, "Statements that do not prepare against the current schema")
+    _report(violations, "Full scans of large tables")
+    assert not violations
+    assert not errors
+
+
+def main():
+    _setup()
+    violations, errors = check_plans(verbose='-v' in sys.argv)
+    _report(errors, "Statements that do not prepare against the current schema")
+    _report(violations, "Full scans of large tables")
+    db.close_all_connections()
+    shutil.rmtree(_tmpdir, ignore_errors=True)
+    sys.exit(1 if violations or errors else 0)
+
+
+if __name__ == "__main__":
+    main()
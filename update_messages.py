@@ -8,7 +8,10 @@ import sqlite3
 import sys
 import os
 
-DB_NAME = "bot_db.sqlite"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Same database file as the bot (DB_NAME env, default bot.db)
+from bot.config import DB_NAME  # noqa: E402
 
 def initialize_messages_table():
     """ایجاد جدول messages اگر وجود ندارد"""